@@ -0,0 +1,66 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+DEFAULT_THRESHOLD = 0.2
+
+
+def parse_arguments():
+    """
+    Method to parse the comparison arguments.
+
+    :return: Parsed arguments
+    """
+    parser = ArgumentParser(description="Compare two BQ External Table benchmark results")
+    parser.add_argument("baseline", help="The JSON results of the reference version")
+    parser.add_argument("candidate", help="The JSON results of the version to check")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative slowdown reported as a regression, 0.2 for 20%%")
+    return parser.parse_args()
+
+
+def get_result_key(result):
+    """
+    Method that gets the key identifying a benchmark result across runs.
+
+    :param result: The benchmark result
+    :return: The key
+    """
+    return result["benchmark"], json.dumps(result["parameters"], sort_keys=True)
+
+
+def compare_results(baseline, candidate, threshold=DEFAULT_THRESHOLD):
+    """
+    Method that compares the timings of the benchmarks present in two results.
+
+    :param baseline: The results of the reference version
+    :param candidate: The results of the version to check
+    :param threshold: Relative slowdown reported as a regression
+    :return: The list of (benchmark, parameters, baseline seconds, candidate seconds, ratio, regression) tuples
+    """
+    baseline_results = {get_result_key(result): result for result in baseline["results"]}
+    comparison = []
+    for result in candidate["results"]:
+        key = get_result_key(result)
+        if key not in baseline_results:
+            continue
+        baseline_seconds = baseline_results[key]["seconds"]
+        ratio = result["seconds"] / max(baseline_seconds, 1e-9)
+        comparison.append((key[0], key[1], baseline_seconds, result["seconds"], ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def main():
+    arguments = parse_arguments()
+    with open(arguments.baseline) as baseline_file, open(arguments.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+    comparison = compare_results(baseline=baseline, candidate=candidate, threshold=arguments.threshold)
+    print("{} -> {}".format(baseline["label"], candidate["label"]))
+    for benchmark, parameters, baseline_seconds, candidate_seconds, ratio, regression in comparison:
+        print("{:<8} {:<70} {:>10.3f}s {:>10.3f}s {:>7.2f}x{}".format(
+            benchmark, parameters, baseline_seconds, candidate_seconds, ratio, "  REGRESSION" if regression else ""))
+    return 1 if any(row[-1] for row in comparison) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
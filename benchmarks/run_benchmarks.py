@@ -0,0 +1,334 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from bq_external_table import blob_catalog, gcp_clients, gcp_interfacer
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+DEFAULT_OBJECT_COUNTS = [10, 100, 1000, 10000]
+FULL_OBJECT_COUNTS = [10, 100, 1000, 10000, 100000, 1000000]
+DEFAULT_FILE_SIZES = ["1KB", "1MB", "64MB"]
+FULL_FILE_SIZES = ["1KB", "1MB", "64MB", "1GB"]
+DEFAULT_LOAD_MODES = [gcp_interfacer.LOAD_MODE_PER_BLOB, gcp_interfacer.LOAD_MODE_BATCH]
+MAX_PER_BLOB_LOAD_OBJECTS = 10000
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+BUCKET_NAME = "benchmark-bucket"
+
+
+def parse_arguments():
+    """
+    Method to parse the benchmark arguments.
+
+    :return: Parsed arguments
+    """
+    parser = ArgumentParser(description="BQ External Table Benchmarks")
+    parser.add_argument("-o", "--output", dest="output", required=True, help="The JSON results file")
+    parser.add_argument("--full", dest="full", action="store_true",
+                        help="Run the full matrix, up to 1M objects and 1GB files")
+    parser.add_argument("--object-counts", dest="object_counts", type=parse_int_list,
+                        help="Comma separated object counts for the listing and loading benchmarks")
+    parser.add_argument("--file-sizes", dest="file_sizes", type=parse_size_list,
+                        help="Comma separated file sizes for the upload benchmark, e.g. 1KB,1MB")
+    parser.add_argument("--benchmarks", dest="benchmarks", default="list,upload,load",
+                        help="Comma separated benchmarks to run, among list, catalog, upload and load")
+    parser.add_argument("--gcs-latency", dest="gcs_latency", type=float, default=0.0,
+                        help="Seconds added to every fake Cloud Storage request")
+    parser.add_argument("--bigquery-latency", dest="bigquery_latency", type=float, default=0.0,
+                        help="Seconds added to every fake BigQuery API call")
+    parser.add_argument("--job-latency", dest="job_latency", type=float, default=0.0,
+                        help="Seconds every fake load job runs for")
+    parser.add_argument("--max-concurrent-jobs", dest="max_concurrent_jobs", type=int, default=10,
+                        help="Maximum number of load jobs in flight in the load benchmark")
+    parser.add_argument("--upload-file-count", dest="upload_file_count", type=int, default=3,
+                        help="Number of files uploaded per file size")
+    parser.add_argument("--repetitions", dest="repetitions", type=int, default=1,
+                        help="Number of times each benchmark is repeated")
+    parser.add_argument("--label", dest="label", help="The label of the measured version, the git revision by default")
+    return parser.parse_args()
+
+
+def parse_int_list(value):
+    """
+    Method that parses a comma separated list of integers.
+
+    :param value: The argument value
+    :return: The list of integers
+    """
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_size_list(value):
+    """
+    Method that parses a comma separated list of sizes with a B, KB, MB or GB unit.
+
+    :param value: The argument value
+    :return: The list of sizes in bytes
+    """
+    return [parse_size(item) for item in value.split(",") if item]
+
+
+def parse_size(value):
+    """
+    Method that parses a size with a B, KB, MB or GB unit.
+
+    :param value: The size, e.g. 64MB
+    :return: The size in bytes
+    """
+    value = value.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(value)
+
+
+def get_label():
+    """
+    Method that gets the git revision of the measured code.
+
+    :return: The short git revision, or "unknown"
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def time_repetitions(function, repetitions):
+    """
+    Method that times a function several times.
+
+    :param function: The callable to time, it returns a dictionary of extra measurements
+    :param repetitions: The number of runs
+    :return: The dictionary with the min, median and max seconds and the extra measurements of the last run
+    """
+    timings = []
+    measurements = {}
+    for _ in range(max(1, repetitions)):
+        start = time.perf_counter()
+        measurements = function() or {}
+        timings.append(time.perf_counter() - start)
+    measurements.update(seconds=min(timings), median_seconds=statistics.median(timings), max_seconds=max(timings))
+    return measurements
+
+
+def benchmark_listing(server, object_count, repetitions):
+    """
+    Method that times get_list_of_blobs over a prefix with object_count objects.
+
+    :param server: The FakeGCSServer
+    :param object_count: The number of objects under the prefix
+    :param repetitions: The number of runs
+    :return: The benchmark result
+    """
+    prefix = "list_{}/".format(object_count)
+    server.put_synthetic_objects(BUCKET_NAME, ("{}part-{:08d}.csv".format(prefix, index)
+                                              for index in range(object_count)), size=1024)
+
+    def run():
+        requests = server.request_count
+        listed = len(gcp_interfacer.get_list_of_blobs(bucket_name=BUCKET_NAME, blob_prefix=prefix))
+        return {"objects_listed": listed, "requests": server.request_count - requests}
+
+    result = {"benchmark": "list", "parameters": {"object_count": object_count}}
+    result.update(time_repetitions(run, repetitions))
+    result["objects_per_second"] = object_count / max(result["seconds"], 1e-9)
+    return result
+
+
+def benchmark_catalog(server, object_count, repetitions):
+    """
+    Method that times building a BlobCatalog over a prefix with object_count objects, and compares the memory it
+    retains with the one of a list of BlobDetails.
+
+    :param server: The FakeGCSServer
+    :param object_count: The number of objects under the prefix
+    :param repetitions: The number of runs
+    :return: The benchmark result
+    """
+    prefix = "list_{}/".format(object_count)
+    if prefix + "part-00000000.csv" not in server.list_object_names(BUCKET_NAME):
+        server.put_synthetic_objects(BUCKET_NAME, ("{}part-{:08d}.csv".format(prefix, index)
+                                                  for index in range(object_count)), size=1024)
+
+    def run():
+        catalog = blob_catalog.get_blob_catalog(bucket_name=BUCKET_NAME, blob_prefix=prefix)
+        return {"objects_listed": len(catalog), "batches": len(list(catalog.batch_by_size(max_bytes=1024 ** 2)))}
+
+    result = {"benchmark": "catalog", "parameters": {"object_count": object_count}}
+    result.update(time_repetitions(run, repetitions))
+    result["catalog_memory_bytes"] = measure_retained_memory(
+        lambda: blob_catalog.get_blob_catalog(bucket_name=BUCKET_NAME, blob_prefix=prefix))
+    result["list_memory_bytes"] = measure_retained_memory(
+        lambda: list(gcp_interfacer.iter_blob_details(bucket_name=BUCKET_NAME, blob_prefix=prefix)))
+    return result
+
+
+def measure_retained_memory(function):
+    """
+    Method that measures the memory retained by the result of a function, with tracemalloc.
+
+    :param function: The function
+    :return: The number of bytes allocated by the function and still held by its result
+    """
+    tracemalloc.start()
+    try:
+        retained = function()
+        memory_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del retained
+    return memory_bytes
+
+
+def benchmark_upload(file_size, file_count, repetitions):
+    """
+    Method that times upload_blob for files of the same size.
+
+    :param file_size: The size in bytes of each file
+    :param file_count: The number of files uploaded per run
+    :param repetitions: The number of runs
+    :return: The benchmark result
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        source_file_name = os.path.join(directory, "upload.bin")
+        with open(source_file_name, "wb") as source_file:
+            block = os.urandom(min(file_size, 1024 ** 2))
+            written = 0
+            while written < file_size:
+                written += source_file.write(block[:file_size - written])
+
+        def run():
+            for index in range(file_count):
+                gcp_interfacer.upload_blob(bucket_name=BUCKET_NAME, source_file_name=source_file_name,
+                                           destination_blob_name="upload_{}/{}.bin".format(file_size, index))
+
+        result = {"benchmark": "upload", "parameters": {"file_size": file_size, "file_count": file_count}}
+        result.update(time_repetitions(run, repetitions))
+        result["bytes_per_second"] = file_size * file_count / max(result["seconds"], 1e-9)
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_load(server, bigquery_client, object_count, load_mode, max_concurrent_jobs, repetitions):
+    """
+    Method that times load_bucket_data_into_bigquery_external_table over a prefix with object_count objects.
+
+    :param server: The FakeGCSServer
+    :param bigquery_client: The FakeBigQueryClient
+    :param object_count: The number of objects under the prefix
+    :param load_mode: The load mode
+    :param max_concurrent_jobs: The maximum number of load jobs in flight
+    :param repetitions: The number of runs
+    :return: The benchmark result
+    """
+    prefix = "load_{}/".format(object_count)
+    if prefix + "part-00000000.csv" not in server.list_object_names(BUCKET_NAME):
+        server.put_synthetic_objects(BUCKET_NAME, ("{}part-{:08d}.csv".format(prefix, index)
+                                                  for index in range(object_count)), size=1024)
+
+    def run():
+        api_calls = bigquery_client.api_call_count
+        list_of_results = gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+            bigquery_client=bigquery_client, dataset_name="benchmark_dataset", bucket_name=BUCKET_NAME,
+            table_id="benchmark_table", blob_prefix=prefix, max_concurrent_jobs=max_concurrent_jobs,
+            job_poll_interval=0.01, load_mode=load_mode)
+        return {"jobs": len(list_of_results), "bigquery_api_calls": bigquery_client.api_call_count - api_calls,
+                "input_bytes": sum(result.input_bytes or 0 for result in list_of_results)}
+
+    result = {"benchmark": "load", "parameters": {"object_count": object_count, "load_mode": load_mode,
+                                                  "max_concurrent_jobs": max_concurrent_jobs}}
+    result.update(time_repetitions(run, repetitions))
+    return result
+
+
+def run_benchmarks(benchmarks, object_counts, file_sizes, load_modes=None, gcs_latency=0.0, bigquery_latency=0.0,
+                   job_latency=0.0, max_concurrent_jobs=10, upload_file_count=3, repetitions=1, label=None):
+    """
+    Method that runs the benchmarks against a local fake GCS server and a stub BigQuery client.
+
+    :param benchmarks: The benchmarks to run, among "list", "catalog", "upload" and "load"
+    :param object_counts: The object counts of the listing and loading benchmarks
+    :param file_sizes: The file sizes in bytes of the upload benchmark
+    :param load_modes: The load modes of the loading benchmark
+    :param gcs_latency: Seconds added to every fake Cloud Storage request
+    :param bigquery_latency: Seconds added to every fake BigQuery API call
+    :param job_latency: Seconds every fake load job runs for
+    :param max_concurrent_jobs: Maximum number of load jobs in flight in the loading benchmark
+    :param upload_file_count: Number of files uploaded per file size
+    :param repetitions: Number of times each benchmark is repeated
+    :param label: The label of the measured version
+    :return: The dictionary with the environment, the settings and the list of results
+    """
+    results = []
+    with FakeGCSServer(latency=gcs_latency, store_data=False) as server:
+        server.create_bucket(BUCKET_NAME)
+        gcp_clients.configure_clients(storage_api_endpoint=server.endpoint, project="benchmark")
+        try:
+            if "list" in benchmarks:
+                for object_count in object_counts:
+                    results.append(benchmark_listing(server=server, object_count=object_count,
+                                                     repetitions=repetitions))
+            if "catalog" in benchmarks:
+                for object_count in object_counts:
+                    results.append(benchmark_catalog(server=server, object_count=object_count,
+                                                     repetitions=repetitions))
+            if "upload" in benchmarks:
+                for file_size in file_sizes:
+                    results.append(benchmark_upload(file_size=file_size, file_count=upload_file_count,
+                                                    repetitions=repetitions))
+            if "load" in benchmarks:
+                bigquery_client = FakeBigQueryClient(api_latency=bigquery_latency, job_latency=job_latency,
+                                                     gcs_server=server)
+                for object_count in object_counts:
+                    for load_mode in load_modes or DEFAULT_LOAD_MODES:
+                        if load_mode == gcp_interfacer.LOAD_MODE_PER_BLOB and object_count > MAX_PER_BLOB_LOAD_OBJECTS:
+                            continue
+                        results.append(benchmark_load(server=server, bigquery_client=bigquery_client,
+                                                      object_count=object_count, load_mode=load_mode,
+                                                      max_concurrent_jobs=max_concurrent_jobs,
+                                                      repetitions=repetitions))
+        finally:
+            gcp_clients.configure_clients()
+    return {"label": label or get_label(),
+            "created_at": time.time(),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpu_count": os.cpu_count()},
+            "settings": {"gcs_latency": gcs_latency, "bigquery_latency": bigquery_latency, "job_latency": job_latency,
+                         "repetitions": repetitions},
+            "results": results}
+
+
+def main():
+    arguments = parse_arguments()
+    benchmark_results = run_benchmarks(
+        benchmarks=arguments.benchmarks.split(","),
+        object_counts=arguments.object_counts or (FULL_OBJECT_COUNTS if arguments.full else DEFAULT_OBJECT_COUNTS),
+        file_sizes=arguments.file_sizes or [parse_size(size) for size in (FULL_FILE_SIZES if arguments.full
+                                                                          else DEFAULT_FILE_SIZES)],
+        gcs_latency=arguments.gcs_latency,
+        bigquery_latency=arguments.bigquery_latency,
+        job_latency=arguments.job_latency,
+        max_concurrent_jobs=arguments.max_concurrent_jobs,
+        upload_file_count=arguments.upload_file_count,
+        repetitions=arguments.repetitions,
+        label=arguments.label)
+    with open(arguments.output, "w") as output_file:
+        json.dump(benchmark_results, output_file, indent=2)
+    for result in benchmark_results["results"]:
+        print("{:<8} {:<70} {:>10.3f}s".format(result["benchmark"], json.dumps(result["parameters"]),
+                                              result["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,749 @@
+import asyncio
+import datetime
+import functools
+import json
+import mimetypes
+import os
+import time
+from urllib.parse import quote
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from google.api_core import exceptions
+from google.auth.transport.requests import Request
+from google.cloud import bigquery
+
+from bq_external_table import format_detection, gcp_clients, gcp_interfacer, manifest, metrics, resilience, scheduler
+from bq_external_table import partitioning, schema_inference
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+DEFAULT_MAX_CONCURRENT_OPERATIONS = 1000
+CONNECT_TIMEOUT = 60
+READ_TIMEOUT = 300
+
+
+class AsyncGCPSession(object):
+    """
+    Asynchronous session for the Cloud Storage JSON API and the BigQuery REST API, sharing one pool of HTTP
+    connections. Every request is bounded by a semaphore of max_concurrent_operations, waits for the rate limit of its
+    API and is retried like the synchronous calls, so that one event loop can keep tens of thousands of operations in
+    flight without a thread for each one.
+    """
+
+    def __init__(self, max_concurrent_operations=DEFAULT_MAX_CONCURRENT_OPERATIONS, pool_size=None):
+        if aiohttp is None:
+            raise ImportError("The async I/O backend needs aiohttp, install bq-external-table[async].")
+        self.max_concurrent_operations = max(1, max_concurrent_operations)
+        self.pool_size = pool_size or gcp_clients.get_pool_size()
+        self.storage_endpoint = gcp_clients.get_storage_api_endpoint()
+        self.bigquery_endpoint = gcp_clients.get_bigquery_api_endpoint()
+        self.credentials, self.project = gcp_clients.get_credentials()
+        self._semaphore = None
+        self._credentials_lock = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_operations)
+        self._credentials_lock = asyncio.Lock()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def get_auth_headers(self):
+        """
+        Method that gets the authorization headers of a request, refreshing the credentials in a worker thread when
+        they expired.
+
+        :return: The dictionary of headers.
+        """
+        async with self._credentials_lock:
+            if not self.credentials.valid:
+                await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, Request())
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def request(self, api, method, url, params=None, json_body=None, data=None, headers=None):
+        """
+        Method that sends a request, retrying transient errors with exponential backoff and jitter.
+
+        :param api: resilience.API_STORAGE or resilience.API_BIGQUERY.
+        :param method: The HTTP method.
+        :param url: The request URL.
+        :param params: Optional dictionary of query parameters.
+        :param json_body: Optional JSON body.
+        :param data: Optional callable that opens the body of the request, called again for each attempt.
+        :param headers: Optional dictionary of extra headers.
+        :return: The tuple with the HTTP status and the response body.
+        """
+        attempt = 0
+        while True:
+            await acquire(api)
+            try:
+                async with self._semaphore:
+                    request_headers = await self.get_auth_headers()
+                    request_headers.update(headers or {})
+                    body = data() if data else None
+                    try:
+                        with metrics.timer("async_request", api=api):
+                            async with self._session.request(method, url, params=params, json=json_body, data=body,
+                                                             headers=request_headers) as response:
+                                content = await response.read()
+                    finally:
+                        if hasattr(body, "close"):
+                            body.close()
+                if response.status >= 400:
+                    raise get_api_error(response.status, content)
+                return response.status, content
+            except (exceptions.GoogleAPIError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                attempt += 1
+                retryable = resilience.is_retryable_error(error) or \
+                    isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+                if not retryable or attempt >= resilience.get_max_attempts():
+                    raise
+                delay = resilience.get_backoff_delay(attempt)
+                metrics.increment("retries", api=api,
+                                  reason="throttled" if resilience.is_throttling_error(error) else "transient")
+                log.warning("Call to the {} API failed ({}), retry {} in {:.2f}s.".format(api, error, attempt, delay))
+                await asyncio.sleep(delay)
+
+    async def request_json(self, api, method, url, params=None, json_body=None):
+        """
+        Method that sends a request and decodes its JSON response.
+
+        :return: The decoded response, None when it is empty.
+        """
+        _, content = await self.request(api=api, method=method, url=url, params=params, json_body=json_body)
+        return json.loads(content.decode("utf-8")) if content else None
+
+
+async def acquire(api):
+    """
+    Method that waits, without blocking the event loop, until a call to an API is allowed by its rate limit.
+
+    :param api: resilience.API_STORAGE or resilience.API_BIGQUERY.
+    """
+    rate_limiter = resilience.get_rate_limiter(api)
+    if rate_limiter is None:
+        return
+    waited = 0.0
+    delay = rate_limiter.try_acquire()
+    while delay:
+        await asyncio.sleep(delay)
+        waited += delay
+        delay = rate_limiter.try_acquire()
+    if waited:
+        metrics.observe("rate_limit_wait", waited, api=api)
+
+
+def get_api_error(status, content):
+    """
+    Method that builds the google.api_core exception of a failed request, with the reasons of its JSON error.
+
+    :param status: The HTTP status.
+    :param content: The response body.
+    :return: The exception.
+    """
+    try:
+        error = json.loads(content.decode("utf-8")).get("error", {})
+    except (ValueError, AttributeError):
+        error = {}
+    if not isinstance(error, dict):
+        error = {"message": str(error)}
+    return exceptions.from_http_status(status, error.get("message") or "HTTP {}".format(status),
+                                       errors=error.get("errors", []))
+
+
+def get_object_url(session, bucket_name, blob_name=None, upload=False, download=False):
+    """
+    Method that gets the Cloud Storage JSON API URL of the objects of a bucket, or of one object.
+
+    :return: The URL.
+    """
+    url = "{}/{}storage/v1/b/{}/o".format(session.storage_endpoint,
+                                          "upload/" if upload else "download/" if download else "",
+                                          quote(bucket_name, safe=""))
+    return url + "/" + quote(blob_name, safe="") if blob_name is not None else url
+
+
+def get_jobs_url(session, project, job_id=None):
+    """
+    Method that gets the BigQuery REST API URL of the jobs of a project, or of one job.
+
+    :return: The URL.
+    """
+    url = "{}/bigquery/v2/projects/{}/jobs".format(session.bigquery_endpoint, quote(project, safe=""))
+    return url + "/" + quote(job_id, safe="") if job_id is not None else url
+
+
+async def iter_blob_pages(session, bucket_name, blob_prefix, delimiter=None, match_glob=None, page_size=None):
+    """
+    Method that lazily lists objects in a Cloud Storage bucket, one page at a time, like
+    gcp_interfacer.iter_blob_pages.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The name of the GCP bucket.
+    :param blob_prefix: The string prefix used to filter blobs to load.
+    :param delimiter: Optional delimiter that restricts the listing to the objects directly under the prefix.
+    :param match_glob: Optional glob pattern the object names must match.
+    :param page_size: Optional maximum number of objects per page.
+    :return: An asynchronous generator of lists of BlobDetails, one list per page.
+    """
+    params = {"fields": gcp_interfacer.BLOB_LISTING_FIELDS, "projection": "noAcl"}
+    for parameter, value in (("prefix", blob_prefix), ("delimiter", delimiter), ("matchGlob", match_glob),
+                             ("maxResults", page_size)):
+        if value:
+            params[parameter] = str(value)
+    while True:
+        with metrics.timer("gcs_list_page", bucket=bucket_name):
+            resource = await session.request_json(api=resilience.API_STORAGE, method="GET",
+                                                  url=get_object_url(session, bucket_name), params=params)
+        list_of_blob_details = [get_blob_details(item) for item in resource.get("items", [])]
+        metrics.increment("gcs_objects_listed", len(list_of_blob_details), bucket=bucket_name)
+        metrics.increment("gcs_bytes_listed", sum(blob_details.size or 0 for blob_details in list_of_blob_details),
+                          bucket=bucket_name)
+        yield list_of_blob_details
+        if not resource.get("nextPageToken"):
+            return
+        params["pageToken"] = resource["nextPageToken"]
+
+
+def get_blob_details(resource):
+    """
+    Method that gets the listing metadata of a Cloud Storage object from its JSON API resource.
+
+    :param resource: The object resource.
+    :return: The BlobDetails of the object.
+    """
+    updated = resource.get("updated")
+    return gcp_interfacer.BlobDetails(
+        name=resource["name"],
+        size=int(resource["size"]) if resource.get("size") is not None else None,
+        generation=int(resource["generation"]) if resource.get("generation") is not None else None,
+        content_type=resource.get("contentType"),
+        md5_hash=resource.get("md5Hash"),
+        crc32c=resource.get("crc32c"),
+        updated=datetime.datetime.fromisoformat(updated.replace("Z", "+00:00")) if updated else None)
+
+
+async def read_blob_range(session, bucket_name, blob_name, start, end):
+    """
+    Method that downloads a byte range of a Cloud Storage object.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The name of the GCP bucket.
+    :param blob_name: The name of the blob.
+    :param start: The first byte to read.
+    :param end: The last byte to read, included.
+    :return: The bytes read.
+    """
+    _, content = await session.request(api=resilience.API_STORAGE, method="GET",
+                                       url=get_object_url(session, bucket_name, blob_name, download=True),
+                                       params={"alt": "media"}, headers={"Range": "bytes={}-{}".format(start, end)})
+    return content
+
+
+async def upload_blob(session, bucket_name, source_file_name, destination_blob_name):
+    """
+    Method that uploads a local file to a Cloud Storage bucket with a single media request, streamed from the file.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The name of the GCP bucket.
+    :param source_file_name: The name of the source file.
+    :param destination_blob_name: The name of the destination blob.
+    :return: The BlobDetails of the uploaded blob.
+    """
+    content_type = mimetypes.guess_type(source_file_name)[0] or "application/octet-stream"
+    with metrics.timer("gcs_upload_blob"):
+        _, content = await session.request(api=resilience.API_STORAGE, method="POST",
+                                           url=get_object_url(session, bucket_name, upload=True),
+                                           params={"uploadType": "media", "name": destination_blob_name},
+                                           data=functools.partial(open, source_file_name, "rb"),
+                                           headers={"Content-Type": content_type})
+    metrics.increment("gcs_bytes_uploaded", os.path.getsize(source_file_name), bucket=bucket_name)
+    log.info("File {} uploaded to {}.".format(source_file_name, destination_blob_name))
+    return get_blob_details(json.loads(content.decode("utf-8")))
+
+
+async def upload_files(session, bucket_name, list_of_files):
+    """
+    Method that uploads local files concurrently, bounded by the session semaphore. A failed file does not stop the
+    other ones.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The name of the GCP bucket.
+    :param list_of_files: The list of (source file name, destination blob name) tuples.
+    :return: The list with the BlobDetails of each uploaded file, or the exception that made it fail.
+    """
+    return await asyncio.gather(*(upload_blob(session=session, bucket_name=bucket_name, source_file_name=source,
+                                              destination_blob_name=destination)
+                                  for source, destination in list_of_files), return_exceptions=True)
+
+
+async def detect_blob_format(session, bucket_name, blob_details):
+    """
+    Method that detects the format and compression of a blob, like format_detection.detect_blob_format, reading its
+    first bytes asynchronously when the extension and content type are inconclusive.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The bucket name.
+    :param blob_details: The BlobDetails of the blob.
+    :return: The BlobFormat, or None if the format is unknown or not supported by BigQuery.
+    """
+    source_format, compression = format_detection.get_format_from_name(blob_details.name)
+    if source_format is None:
+        source_format, content_type_compression = format_detection.get_format_from_content_type(
+            blob_details.content_type)
+        compression = compression or content_type_compression
+    if source_format is None and blob_details.size != 0:
+        try:
+            with metrics.timer("format_detection_read", bucket=bucket_name):
+                sample = await read_blob_range(session=session, bucket_name=bucket_name, blob_name=blob_details.name,
+                                               start=0, end=format_detection.MAGIC_BYTES_SAMPLE_SIZE - 1)
+        except exceptions.GoogleAPIError as error:
+            log.warning("Could not read gs://{}/{}: {}".format(bucket_name, blob_details.name, error))
+            return None
+        source_format, magic_bytes_compression = format_detection.get_format_from_magic_bytes(sample)
+        compression = compression or magic_bytes_compression
+    compression = compression or format_detection.COMPRESSION_NONE
+    if source_format is None or (compression != format_detection.COMPRESSION_NONE and
+                                 source_format not in format_detection.COMPRESSIBLE_FORMATS):
+        return None
+    return format_detection.BlobFormat(source_format=source_format, compression=compression)
+
+
+async def classify_blobs(session, bucket_name, list_of_blob_details):
+    """
+    Method that detects the format of the blobs of one listing page concurrently.
+
+    :param session: The AsyncGCPSession.
+    :param bucket_name: The bucket name.
+    :param list_of_blob_details: The list of BlobDetails.
+    :return: The list of (BlobFormat or None, BlobDetails) tuples.
+    """
+    list_of_formats = await asyncio.gather(*(detect_blob_format(session=session, bucket_name=bucket_name,
+                                                                blob_details=blob_details)
+                                             for blob_details in list_of_blob_details))
+    for blob_format, blob_details in zip(list_of_formats, list_of_blob_details):
+        metrics.increment("blobs_classified", bucket=bucket_name,
+                          format=blob_format.source_format if blob_format else "unsupported")
+        if blob_format is None:
+            log.warning("Skipping gs://{}/{}, its format is not supported.".format(bucket_name, blob_details.name))
+    return list(zip(list_of_formats, list_of_blob_details))
+
+
+async def submit_load_job(session, project, dataset_name, table_id, source_uris, job_config, job_id,
+                          on_throttle=None):
+    """
+    Method that submits a GCP BigQuery load job without waiting for it to finish. When a retried submission finds the
+    job already exists, that job is reused instead of loading the data twice. The existing job is looked up in the
+    location of the data set, where it runs.
+
+    :param session: The AsyncGCPSession.
+    :param project: The project of the job and of the table.
+    :param dataset_name: The data set name.
+    :param table_id: The table id.
+    :param source_uris: The gs:// URI, or list of URIs, to load.
+    :param job_config: The LoadJobConfig.
+    :param job_id: The id of the job.
+    :param on_throttle: Optional callable called when BigQuery throttles the submission.
+    :return: The submitted bigquery.LoadJob, detached from any client.
+    """
+    configuration = job_config.to_api_repr()
+    configuration["load"]["sourceUris"] = gcp_interfacer.as_list(source_uris)
+    configuration["load"]["destinationTable"] = {"projectId": project, "datasetId": dataset_name, "tableId": table_id}
+    resource = {"jobReference": {"projectId": project, "jobId": job_id}, "configuration": configuration}
+    with metrics.timer("bigquery_submit_job", table=table_id):
+        try:
+            job_resource = await session.request_json(api=resilience.API_BIGQUERY, method="POST",
+                                                      url=get_jobs_url(session, project), json_body=resource)
+        except exceptions.Conflict:
+            log.info("Job {} already exists, reusing it.".format(job_id))
+            job_resource = await get_job_resource(
+                session=session, project=project, job_id=job_id,
+                location=await get_dataset_location(session=session, project=project, dataset_name=dataset_name))
+        except exceptions.GoogleAPIError as error:
+            if on_throttle and resilience.is_throttling_error(error):
+                on_throttle()
+            raise
+    metrics.increment("bigquery_jobs_submitted", table=table_id)
+    log.info("Submitted job {} for {}".format(job_id, source_uris))
+    return bigquery.LoadJob.from_api_repr(job_resource, None)
+
+
+async def get_dataset_location(session, project, dataset_name):
+    """
+    Method that gets the location of a GCP BigQuery data set, which is the location of its load jobs.
+
+    :param session: The AsyncGCPSession.
+    :param project: The project of the data set.
+    :param dataset_name: The data set name.
+    :return: The location.
+    """
+    dataset_resource = await session.request_json(
+        api=resilience.API_BIGQUERY, method="GET",
+        url="{}/bigquery/v2/projects/{}/datasets/{}".format(session.bigquery_endpoint, quote(project, safe=""),
+                                                            quote(dataset_name, safe="")))
+    return dataset_resource.get("location")
+
+
+async def get_job_resource(session, project, job_id, location=None):
+    """
+    Method that gets the REST resource of a GCP BigQuery job.
+
+    :param session: The AsyncGCPSession.
+    :param project: The project of the job.
+    :param job_id: The id of the job.
+    :param location: Optional location of the job.
+    :return: The job resource.
+    """
+    return await session.request_json(api=resilience.API_BIGQUERY, method="GET",
+                                      url=get_jobs_url(session, project, job_id),
+                                      params={"location": location} if location else None)
+
+
+async def wait_for_job(session, load_job_details, job_poll_interval, table_id):
+    """
+    Method that polls a GCP BigQuery job until it is finished. Waiting does not hold a thread, so any number of jobs
+    can be polled at once.
+
+    :param session: The AsyncGCPSession.
+    :param load_job_details: The submitted bigquery.LoadJob.
+    :param job_poll_interval: The number of seconds to wait between polls.
+    :param table_id: The table id.
+    :return: The finished bigquery.LoadJob.
+    """
+    while load_job_details.state != "DONE":
+        await asyncio.sleep(job_poll_interval)
+        job_resource = await get_job_resource(session=session, project=load_job_details.project,
+                                              job_id=load_job_details.job_id, location=load_job_details.location)
+        metrics.increment("bigquery_job_polls", table=table_id)
+        load_job_details = bigquery.LoadJob.from_api_repr(job_resource, None)
+    return load_job_details
+
+
+async def run_load_jobs(session, project, dataset_name, table_id, list_of_sources, job_config=None,
+                        max_concurrent_jobs=gcp_interfacer.DEFAULT_MAX_CONCURRENT_JOBS,
+                        job_poll_interval=gcp_interfacer.DEFAULT_JOB_POLL_INTERVAL,
+                        on_job_submit=None, on_job_finish=None, on_job_retry=None):
+    """
+    Method that runs GCP BigQuery load jobs concurrently, like gcp_interfacer.run_load_jobs, with one coroutine per
+    job instead of a polling loop. At most max_concurrent_jobs jobs are in flight, fewer while BigQuery throttles.
+
+    :param session: The AsyncGCPSession.
+    :param project: The project of the jobs and of the table.
+    :param dataset_name: The data set name.
+    :param table_id: The table id.
+    :param list_of_sources: An iterable or asynchronous iterable of sources to load, each one a gs:// URI, a list of
+    URIs, or a LoadSource with its own job config.
+    :param job_config: The load job config of the sources that are not a LoadSource.
+    :param max_concurrent_jobs: The maximum number of load jobs running at the same time.
+    :param job_poll_interval: The number of seconds to wait between polls of each job.
+    :param on_job_submit: Optional callable called with the sources of each job right before it is submitted. It
+    returns the id to give to the job, or None to use a generated one.
+    :param on_job_finish: Optional callable called with the LoadJobResult of each job once it is finished.
+    :param on_job_retry: Optional callable called with the previous and the new job id when a job is run again.
+    :return: The list of LoadJobResult, in the same order as list_of_sources.
+    """
+    concurrency = resilience.AdaptiveConcurrency(maximum=max_concurrent_jobs)
+    job_id_prefix = gcp_interfacer.get_job_id_prefix(table_id)
+
+    async def run_job(index, source_uris, source_job_config):
+        job_id = await run_callback(on_job_submit, source_uris) or "{}_{}".format(job_id_prefix, index)
+        attempt = 1
+        try:
+            load_job_details = await submit_load_job(session=session, project=project, dataset_name=dataset_name,
+                                                     table_id=table_id, source_uris=source_uris,
+                                                     job_config=source_job_config, job_id=job_id,
+                                                     on_throttle=concurrency.on_throttle)
+            while True:
+                load_job_details = await wait_for_job(session=session, load_job_details=load_job_details,
+                                                      job_poll_interval=job_poll_interval, table_id=table_id)
+                error_result = load_job_details.error_result
+                if not resilience.is_retryable_job_error(error_result) or \
+                        attempt >= resilience.get_max_job_attempts():
+                    break
+                load_job_details = await retry_load_job(session=session, project=project,
+                                                        dataset_name=dataset_name, table_id=table_id,
+                                                        source_uris=source_uris, job_config=source_job_config,
+                                                        load_job_details=load_job_details, attempt=attempt,
+                                                        concurrency=concurrency, on_job_retry=on_job_retry)
+                attempt += 1
+        except exceptions.GoogleAPIError as error:
+            log.error("Could not run job {} for {}: {}".format(job_id, source_uris, error))
+            result = gcp_interfacer.LoadJobResult(source_uris=source_uris, job_id=job_id, succeeded=False,
+                                                  error=str(error), output_rows=None, input_bytes=None)
+        else:
+            result = gcp_interfacer.get_load_job_result(source_uris=source_uris, load_job_details=load_job_details)
+            gcp_interfacer.record_load_job_metrics(table_id=table_id, result=result,
+                                                   load_job_details=load_job_details)
+            if result.succeeded:
+                concurrency.on_success()
+                log.info("Job {} finished, loaded {} rows.".format(load_job_details.job_id,
+                                                                   load_job_details.output_rows))
+            else:
+                log.error("Job {} failed: {}".format(load_job_details.job_id, result.error))
+        await run_callback(on_job_finish, result)
+        return index, result
+
+    results = {}
+    in_flight = set()
+    index = 0
+    try:
+        async for source_uris in iterate(list_of_sources):
+            source_job_config = job_config
+            if isinstance(source_uris, gcp_interfacer.LoadSource):
+                source_uris, source_job_config = source_uris
+            while len(in_flight) >= concurrency.limit:
+                finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                results.update(task.result() for task in finished)
+            in_flight.add(asyncio.ensure_future(run_job(index, source_uris, source_job_config)))
+            index += 1
+        while in_flight:
+            finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_EXCEPTION)
+            results.update(task.result() for task in finished)
+    except BaseException:
+        # An unexpected error of a job, or of the sources, stops the jobs still in flight instead of orphaning them
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        raise
+
+    list_of_results = [results[index] for index in sorted(results)]
+    gcp_interfacer.log_load_jobs_report(table_id=table_id, list_of_results=list_of_results)
+    return list_of_results
+
+
+async def retry_load_job(session, project, dataset_name, table_id, source_uris, job_config, load_job_details, attempt,
+                         concurrency, on_job_retry=None):
+    """
+    Method that runs again a load job that failed with a transient error, like gcp_interfacer.retry_load_job.
+
+    :param session: The AsyncGCPSession.
+    :param project: The project of the job and of the table.
+    :param dataset_name: The data set name.
+    :param table_id: The table id.
+    :param source_uris: The gs:// URI, or list of URIs, of the job.
+    :param job_config: The LoadJobConfig.
+    :param load_job_details: The failed bigquery.LoadJob.
+    :param attempt: The number of times the job was run.
+    :param concurrency: The AdaptiveConcurrency of the jobs, reduced when the job was throttled.
+    :param on_job_retry: Optional callable called with the previous and the new job id.
+    :return: The new bigquery.LoadJob.
+    """
+    error_result = load_job_details.error_result
+    if error_result.get("reason") in resilience.THROTTLING_REASONS:
+        concurrency.on_throttle()
+    job_id = gcp_interfacer.get_retry_job_id(load_job_details.job_id, attempt)
+    log.warning("Job {} failed with a transient error ({}), running it again as {}.".format(
+        load_job_details.job_id, error_result.get("message"), job_id))
+    metrics.increment("bigquery_job_retries", table=table_id, reason=error_result.get("reason"))
+    await asyncio.sleep(resilience.get_backoff_delay(attempt))
+    await run_callback(on_job_retry, load_job_details.job_id, job_id)
+    try:
+        return await submit_load_job(session=session, project=project, dataset_name=dataset_name, table_id=table_id,
+                                     source_uris=source_uris, job_config=job_config, job_id=job_id,
+                                     on_throttle=concurrency.on_throttle)
+    except exceptions.GoogleAPIError:
+        await run_callback(on_job_retry, job_id, load_job_details.job_id)
+        raise
+
+
+async def run_callback(callback, *args):
+    """
+    Method that calls an optional synchronous callback, e.g. one that updates the SQLite manifest, in a worker thread,
+    so that it does not block the event loop.
+
+    :param callback: The callable, or None.
+    :param args: The arguments of the callable.
+    :return: The value returned by the callable, None without callable.
+    """
+    if callback is None:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, callback, *args)
+
+
+async def iterate(iterable):
+    """
+    Method that iterates over a synchronous or an asynchronous iterable.
+
+    :param iterable: The iterable.
+    :return: An asynchronous generator of its items.
+    """
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def load_bucket_data(session, dataset_name, bucket_name, table_id, blob_prefix,
+                           max_concurrent_jobs=gcp_interfacer.DEFAULT_MAX_CONCURRENT_JOBS,
+                           job_poll_interval=gcp_interfacer.DEFAULT_JOB_POLL_INTERVAL,
+                           load_mode=gcp_interfacer.LOAD_MODE_PER_BLOB,
+                           max_uris_per_job=gcp_interfacer.MAX_URIS_PER_LOAD_JOB,
+                           max_bytes_per_job=gcp_interfacer.MAX_BYTES_PER_LOAD_JOB,
+                           blob_delimiter=None, blob_glob=None, manifest_path=None, schema_cache_path=None,
+                           refresh_schema_cache=False, schema_sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES):
+    """
+    Method that loads the files with a prefix from a GCP storage bucket into a GCP BigQuery table, like
+    gcp_interfacer.load_bucket_data_into_bigquery_external_table. Load jobs are submitted while the bucket is still
+    being listed, and the formats of the blobs of each page are detected concurrently. The schema inference and the
+    SQLite manifest, which are blocking, run in worker threads.
+
+    :param session: The AsyncGCPSession.
+    :return: The list of LoadJobResult, one per submitted load job.
+    """
+    loop = asyncio.get_running_loop()
+    project = session.project or gcp_clients.get_bigquery_client().project
+    table_key = manifest.get_table_key(dataset_name=dataset_name, table_id=table_id) if manifest_path else None
+    blob_details_by_uri = {}
+    on_job_submit = on_job_finish = on_job_retry = None
+    if manifest_path:
+        on_job_submit, on_job_finish, on_job_retry = gcp_interfacer.get_manifest_callbacks(
+            manifest_path=manifest_path, bucket_name=bucket_name, table_key=table_key,
+            blob_details_by_uri=blob_details_by_uri,
+            location=await get_dataset_location(session=session, project=project, dataset_name=dataset_name))
+    job_configs = {}
+
+    async def resolve_job_configs(list_of_classified_blobs):
+        for blob_format, blob_details in list_of_classified_blobs:
+            if blob_format is not None and blob_format not in job_configs:
+                job_configs[blob_format] = await loop.run_in_executor(None, functools.partial(
+                    gcp_interfacer.get_load_job_config, blob_format=blob_format, bucket_name=bucket_name,
+                    blob_prefix=blob_prefix, blob_name=blob_details.name, schema_cache_path=schema_cache_path,
+                    refresh_schema_cache=refresh_schema_cache, schema_sample_bytes=schema_sample_bytes))
+
+    batcher = None
+    if load_mode == gcp_interfacer.LOAD_MODE_BATCH:
+        batcher = gcp_interfacer.LoadSourceBatcher(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                                   get_job_config=lambda blob_format, _: job_configs[blob_format],
+                                                   max_uris_per_job=max_uris_per_job,
+                                                   max_bytes_per_job=max_bytes_per_job,
+                                                   use_wildcard=not (blob_delimiter or blob_glob or manifest_path))
+
+    async def iter_load_sources():
+        async for list_of_blob_details in iter_blob_pages(session=session, bucket_name=bucket_name,
+                                                          blob_prefix=blob_prefix, delimiter=blob_delimiter,
+                                                          match_glob=blob_glob):
+            if manifest_path:
+                # Pages of up to 1000 blobs are filtered in chunks, within the SQLite limit of query variables
+                list_of_new_blob_details = []
+                for start in range(0, len(list_of_blob_details), manifest.FILTER_CHUNK_SIZE):
+                    list_of_new_blob_details.extend(await loop.run_in_executor(
+                        None, manifest.filter_new_blobs_chunk, manifest_path, bucket_name, table_key,
+                        list_of_blob_details[start:start + manifest.FILTER_CHUNK_SIZE]))
+                list_of_blob_details = list_of_new_blob_details
+                list_of_blob_details = list(gcp_interfacer.track_blob_uris(bucket_name=bucket_name,
+                                                                           list_of_blob_details=list_of_blob_details,
+                                                                           blob_details_by_uri=blob_details_by_uri))
+            list_of_classified_blobs = await classify_blobs(session=session, bucket_name=bucket_name,
+                                                            list_of_blob_details=list_of_blob_details)
+            await resolve_job_configs(list_of_classified_blobs)
+            for blob_format, blob_details in list_of_classified_blobs:
+                if batcher is not None:
+                    for load_source in batcher.add(blob_format, blob_details):
+                        yield load_source
+                elif blob_format is not None:
+                    yield gcp_interfacer.LoadSource(
+                        source_uris=gcp_interfacer.get_blob_uri(bucket_name=bucket_name, blob_name=blob_details.name),
+                        job_config=job_configs[blob_format])
+        for load_source in batcher.flush() if batcher is not None else []:
+            yield load_source
+
+    list_of_results = await run_load_jobs(session=session, project=project, dataset_name=dataset_name,
+                                          table_id=table_id, list_of_sources=iter_load_sources(),
+                                          max_concurrent_jobs=max_concurrent_jobs,
+                                          job_poll_interval=job_poll_interval, on_job_submit=on_job_submit,
+                                          on_job_finish=on_job_finish, on_job_retry=on_job_retry)
+    if not list_of_results:
+        log.info("No blobs to load with prefix {} in bucket {}.".format(blob_prefix, bucket_name))
+    return list_of_results
+
+
+async def load_tables(table_tasks, load_options):
+    """
+    Method that loads every configured bucket prefix into its BigQuery table from one event loop. The tables run
+    concurrently, bounded by the max_concurrent_tables and max_concurrent_tables_per_bucket options, and all their
+    requests share one AsyncGCPSession bounded by the max_concurrent_operations option. External table definitions,
+    which are a single call each, and partitioned tables, which load their partitions in parallel, run in worker
+    threads with the synchronous client.
+
+    :param table_tasks: The list of TableTask, in the order they should start.
+    :param load_options: The dictionary with the load options.
+    :return: The list of TableSummary, in the order of table_tasks.
+    """
+    table_semaphore = asyncio.Semaphore(max(1, load_options.get("max_concurrent_tables") or 1))
+    bucket_semaphores = {table_task.bucket_name: asyncio.Semaphore(
+        load_options.get("max_concurrent_tables_per_bucket") or len(table_tasks)) for table_task in table_tasks}
+    loop = asyncio.get_running_loop()
+
+    async def load_table(session, table_task):
+        table_details = table_task.table_details
+        if table_details.get("table_type", load_options.get("table_type")) == gcp_interfacer.TABLE_TYPE_EXTERNAL:
+            return await loop.run_in_executor(None, functools.partial(
+                gcp_interfacer.create_or_update_external_table,
+                bigquery_client=gcp_interfacer.get_bigquery_client(),
+                dataset_name=table_task.dataset_name,
+                bucket_name=table_task.bucket_name,
+                table_id=table_details.get("table_name"),
+                blob_prefix=table_details.get("blob_prefix"),
+                source_format=table_details.get("source_format"),
+                hive_partitioning=table_details.get("hive_partitioning"),
+                csv_options=table_details.get("csv_options"),
+                schema_cache_path=load_options.get("schema_cache_path"),
+                refresh_schema_cache=load_options.get("refresh_schema_cache"),
+                schema_sample_bytes=load_options.get("schema_sample_bytes")))
+        if table_details.get("partitioning"):
+            return await loop.run_in_executor(None, functools.partial(
+                partitioning.load_table_task, table_task=table_task, load_options=load_options))
+        return await load_bucket_data(
+            session=session,
+            dataset_name=table_task.dataset_name,
+            bucket_name=table_task.bucket_name,
+            table_id=table_details.get("table_name"),
+            blob_prefix=table_details.get("blob_prefix"),
+            max_concurrent_jobs=load_options.get("max_concurrent_jobs"),
+            job_poll_interval=load_options.get("job_poll_interval"),
+            load_mode=table_details.get("load_mode", load_options.get("load_mode")),
+            max_uris_per_job=load_options.get("max_uris_per_job"),
+            max_bytes_per_job=load_options.get("max_bytes_per_job"),
+            blob_delimiter=table_details.get("blob_delimiter"),
+            blob_glob=table_details.get("blob_glob"),
+            manifest_path=load_options.get("manifest_path"),
+            schema_cache_path=load_options.get("schema_cache_path"),
+            refresh_schema_cache=load_options.get("refresh_schema_cache"),
+            schema_sample_bytes=load_options.get("schema_sample_bytes"))
+
+    async def run_table(session, table_task):
+        async with bucket_semaphores[table_task.bucket_name], table_semaphore:
+            table_id = table_task.table_details.get("table_name")
+            log.info("Loading gs://{} into table {}.".format(table_task.bucket_name, table_id))
+            start = time.time()
+            with metrics.span("table_load", bucket=table_task.bucket_name, table=table_id) as span_attributes:
+                try:
+                    list_of_results = await load_table(session, table_task)
+                    error = None
+                except Exception as exception:
+                    log.exception("Loading table {} failed.".format(table_id))
+                    list_of_results = []
+                    error = str(exception)
+                summary = scheduler.get_table_summary(table_task=table_task, list_of_results=list_of_results,
+                                                      duration=time.time() - start, error=error)
+                span_attributes.update(jobs=summary.jobs, failed_jobs=summary.failed_jobs,
+                                       input_bytes=summary.input_bytes, output_rows=summary.output_rows)
+            return summary
+
+    async with AsyncGCPSession(max_concurrent_operations=load_options.get("max_concurrent_operations") or
+                               DEFAULT_MAX_CONCURRENT_OPERATIONS,
+                               pool_size=load_options.get("http_pool_size")) as session:
+        return list(await asyncio.gather(*(run_table(session, table_task) for table_task in table_tasks)))
@@ -0,0 +1,385 @@
+import base64
+import datetime
+import math
+import tempfile
+import threading
+from array import array
+
+from bq_external_table import gcp_interfacer
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+NO_EXTENSION = ""
+NO_PARTITION = None
+MD5_SIZE = 16
+
+
+class BlobCatalogSelection(object):
+    """
+    Lazily evaluated selection of the blobs of a BlobCatalog. Filtering, grouping and batching only compute the
+    indices of the selected blobs, and blobs are only decoded while they are iterated.
+    """
+
+    def __init__(self, catalog, indices):
+        self.catalog = catalog
+        self._indices = indices
+
+    def iter_indices(self):
+        """
+        Method that iterates over the catalog indices of the selected blobs, in listing order.
+
+        :return: An iterator of indices.
+        """
+        return iter(self._indices() if callable(self._indices) else self._indices)
+
+    def __iter__(self):
+        for index in self.iter_indices():
+            yield self.catalog.get(index)
+
+    def __len__(self):
+        if callable(self._indices):
+            return sum(1 for _ in self.iter_indices())
+        return len(self._indices)
+
+    def iter_names(self):
+        """
+        Method that iterates over the names of the selected blobs, without decoding their other details.
+
+        :return: A generator of blob names.
+        """
+        for index in self.iter_indices():
+            yield self.catalog.get_name(index)
+
+    def iter_uris(self):
+        """
+        Method that iterates over the gs:// URIs of the selected blobs.
+
+        :return: A generator of gs:// URIs.
+        """
+        for name in self.iter_names():
+            yield gcp_interfacer.get_blob_uri(bucket_name=self.catalog.bucket_name, blob_name=name)
+
+    def get_total_size(self):
+        """
+        Method that gets the total size of the selected blobs.
+
+        :return: The number of bytes.
+        """
+        sizes = self.catalog.sizes
+        return sum(max(sizes[index], 0) for index in self.iter_indices())
+
+    def first(self):
+        """
+        Method that gets the first selected blob.
+
+        :return: The BlobDetails, or None when nothing is selected.
+        """
+        index = next(self.iter_indices(), None)
+        return None if index is None else self.catalog.get(index)
+
+    def filter(self, prefix=None, extension=None, min_size=None, max_size=None, partitions=None, predicate=None):
+        """
+        Method that lazily narrows the selection. Every given criterion must match.
+
+        :param prefix: Optional prefix the blob names must start with.
+        :param extension: Optional extension, without the dot and case insensitive, e.g. "csv".
+        :param min_size: Optional minimum size in bytes.
+        :param max_size: Optional maximum size in bytes.
+        :param partitions: Optional dictionary of hive partition values the blobs must be under, e.g. {"dt": "2020"},
+        or of lists of accepted values, e.g. {"region": ["eu", "us"]}.
+        :param predicate: Optional callable called with the BlobDetails of each remaining blob.
+        :return: The narrowed BlobCatalogSelection.
+        """
+        catalog = self.catalog
+        extension = extension.lower() if extension is not None else None
+
+        def get_indices():
+            prefix_matches = {}
+            partition_matches = {}
+            for index in self.iter_indices():
+                size = catalog.sizes[index]
+                if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+                    continue
+                directory_id = catalog.directory_ids[index]
+                if prefix is not None:
+                    if directory_id not in prefix_matches:
+                        directory = catalog.directories[directory_id]
+                        prefix_matches[directory_id] = True if directory.startswith(prefix) else \
+                            None if prefix.startswith(directory) else False
+                    matches = prefix_matches[directory_id]
+                    if matches is False or (matches is None and not catalog.get_name(index).startswith(prefix)):
+                        continue
+                if partitions is not None:
+                    if directory_id not in partition_matches:
+                        directory_partitions = catalog.get_partitions(directory_id)
+                        partition_matches[directory_id] = all(
+                            directory_partitions.get(key) in value if isinstance(value, (list, tuple, set))
+                            else directory_partitions.get(key) == value for key, value in partitions.items())
+                    if not partition_matches[directory_id]:
+                        continue
+                if extension is not None and catalog.get_extension(index) != extension:
+                    continue
+                if predicate is not None and not predicate(catalog.get(index)):
+                    continue
+                yield index
+
+        return BlobCatalogSelection(catalog, get_indices)
+
+    def group_by_extension(self):
+        """
+        Method that groups the selected blobs by extension, in one pass. Each group only holds a compact array of
+        indices.
+
+        :return: A dictionary with the BlobCatalogSelection of each lower case extension, NO_EXTENSION for the blobs
+        without one, in the order the extensions are first found.
+        """
+        return self._group(self.catalog.get_extension)
+
+    def group_by_partition(self, partition_key):
+        """
+        Method that groups the selected blobs by the value of a hive partition key of their path, e.g. "dt" for
+        ".../dt=2020-01-01/part-0.csv". The partitions of each distinct directory are only parsed once.
+
+        :param partition_key: The partition key.
+        :return: A dictionary with the BlobCatalogSelection of each partition value, NO_PARTITION for the blobs not
+        partitioned by that key, in the order the values are first found.
+        """
+        catalog = self.catalog
+        return self._group(lambda index: catalog.get_partitions(catalog.directory_ids[index]).get(partition_key))
+
+    def _group(self, get_key):
+        groups = {}
+        for index in self.iter_indices():
+            groups.setdefault(get_key(index), array("L")).append(index)
+        return {key: BlobCatalogSelection(self.catalog, indices) for key, indices in groups.items()}
+
+    def batch_by_size(self, max_bytes, max_count=None):
+        """
+        Method that lazily splits the selected blobs into consecutive batches, e.g. the sources of load jobs, each
+        holding at most max_bytes bytes and max_count blobs. A blob larger than max_bytes gets a batch of its own.
+
+        :param max_bytes: The maximum number of bytes of a batch.
+        :param max_count: Optional maximum number of blobs of a batch.
+        :return: A generator of BlobCatalogSelection, one per batch.
+        """
+        sizes = self.catalog.sizes
+        batch = array("L")
+        batch_bytes = 0
+        for index in self.iter_indices():
+            size = max(sizes[index], 0)
+            if batch and ((max_count and len(batch) >= max_count) or batch_bytes + size > max_bytes):
+                yield BlobCatalogSelection(self.catalog, batch)
+                batch = array("L")
+                batch_bytes = 0
+            batch.append(index)
+            batch_bytes += size
+        if batch:
+            yield BlobCatalogSelection(self.catalog, batch)
+
+
+class BlobCatalog(BlobCatalogSelection):
+    """
+    Compact catalog of the blobs of a bucket, built from listing pages. Instead of one Python object per name and per
+    detail, the directories of the names are interned, the file names are stored as one UTF-8 byte buffer and the
+    other details in typed arrays, which takes a fraction of the memory of a list of BlobDetails. With spill_bytes,
+    the file names are moved to a temporary file once they take more than that many bytes. A catalog can be read from
+    several threads once it is built.
+    """
+
+    def __init__(self, bucket_name, spill_bytes=None):
+        super(BlobCatalog, self).__init__(self, lambda: range(len(self.sizes)))
+        self.bucket_name = bucket_name
+        self.directories = []
+        self.directory_ids = array("L")
+        self.sizes = array("q")
+        self.generations = array("q")
+        self.crc32cs = array("q")
+        self.updated = array("d")
+        self.content_type_ids = array("H")
+        self.content_types = []
+        self.md5_hashes = bytearray()
+        self._name_offsets = array("Q", [0])
+        self._names = bytearray()
+        self._names_file = None
+        self._names_file_lock = threading.Lock()
+        self._spill_bytes = spill_bytes
+        self._directory_index = {}
+        self._content_type_index = {}
+        self._partitions = {}
+
+    @classmethod
+    def from_pages(cls, bucket_name, pages, spill_bytes=None):
+        """
+        Method that builds a catalog from listing pages, e.g. of gcp_interfacer.iter_blob_pages.
+
+        :param bucket_name: The bucket name.
+        :param pages: An iterable of lists of BlobDetails.
+        :param spill_bytes: Optional number of bytes of file names kept in memory before spilling them to disk.
+        :return: The BlobCatalog.
+        """
+        catalog = cls(bucket_name=bucket_name, spill_bytes=spill_bytes)
+        for list_of_blob_details in pages:
+            catalog.add_page(list_of_blob_details)
+        log.info("Catalogued {} blobs of bucket {}, in {} directories.".format(len(catalog), bucket_name,
+                                                                               len(catalog.directories)))
+        return catalog
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Method that deletes the temporary file of the spilled names, if any.
+        """
+        if self._names_file is not None:
+            self._names_file.close()
+            self._names_file = None
+
+    def add_page(self, list_of_blob_details):
+        """
+        Method that adds the blobs of one listing page.
+
+        :param list_of_blob_details: The list of BlobDetails.
+        """
+        for blob_details in list_of_blob_details:
+            self.add(blob_details)
+
+    def add(self, blob_details):
+        """
+        Method that adds one blob.
+
+        :param blob_details: The BlobDetails.
+        """
+        directory, separator, file_name = blob_details.name.rpartition("/")
+        self.directory_ids.append(self._intern_directory(directory + separator))
+        self._write_name(file_name.encode("utf-8"))
+        self.sizes.append(blob_details.size if blob_details.size is not None else -1)
+        self.generations.append(blob_details.generation if blob_details.generation is not None else -1)
+        self.crc32cs.append(int.from_bytes(base64.b64decode(blob_details.crc32c), "big")
+                            if blob_details.crc32c else -1)
+        self.updated.append(blob_details.updated.timestamp() if blob_details.updated else math.nan)
+        content_type = blob_details.content_type
+        if content_type not in self._content_type_index:
+            self._content_type_index[content_type] = len(self.content_types)
+            self.content_types.append(content_type)
+        self.content_type_ids.append(self._content_type_index[content_type])
+        md5_hash = base64.b64decode(blob_details.md5_hash) if blob_details.md5_hash else b""
+        self.md5_hashes += md5_hash if len(md5_hash) == MD5_SIZE else bytes(MD5_SIZE)
+
+    def _intern_directory(self, directory):
+        if directory not in self._directory_index:
+            self._directory_index[directory] = len(self.directories)
+            self.directories.append(directory)
+        return self._directory_index[directory]
+
+    def _write_name(self, encoded_name):
+        if self._names_file is not None:
+            with self._names_file_lock:
+                self._names_file.seek(0, 2)
+                self._names_file.write(encoded_name)
+        else:
+            self._names += encoded_name
+            if self._spill_bytes is not None and len(self._names) > self._spill_bytes:
+                log.info("Spilling {} bytes of blob names of bucket {} to disk.".format(len(self._names),
+                                                                                       self.bucket_name))
+                self._names_file = tempfile.TemporaryFile()
+                self._names_file.write(self._names)
+                self._names = bytearray()
+        self._name_offsets.append(self._name_offsets[-1] + len(encoded_name))
+
+    def _read_file_name(self, index):
+        start, end = self._name_offsets[index], self._name_offsets[index + 1]
+        if self._names_file is not None:
+            with self._names_file_lock:
+                self._names_file.seek(start)
+                return self._names_file.read(end - start)
+        return self._names[start:end]
+
+    def get_name(self, index):
+        """
+        Method that gets the name of a blob.
+
+        :param index: The catalog index of the blob.
+        :return: The blob name.
+        """
+        return self.directories[self.directory_ids[index]] + self._read_file_name(index).decode("utf-8")
+
+    def get_extension(self, index):
+        """
+        Method that gets the extension of a blob, read from its file name only.
+
+        :param index: The catalog index of the blob.
+        :return: The lower case extension, NO_EXTENSION when there is none.
+        """
+        file_name = self._read_file_name(index)
+        dot = file_name.rfind(b".")
+        return file_name[dot + 1:].decode("utf-8").lower() if dot > 0 else NO_EXTENSION
+
+    def get_partitions(self, directory_id):
+        """
+        Method that gets the hive partitions of a directory, e.g. {"dt": "2020-01-01"} for "events/dt=2020-01-01/".
+
+        :param directory_id: The id of the interned directory.
+        :return: The dictionary of partition values, by key.
+        """
+        if directory_id not in self._partitions:
+            self._partitions[directory_id] = dict(segment.split("=", 1) for segment in
+                                                  self.directories[directory_id].split("/") if "=" in segment)
+        return self._partitions[directory_id]
+
+    def get(self, index):
+        """
+        Method that decodes the details of a blob.
+
+        :param index: The catalog index of the blob.
+        :return: The BlobDetails.
+        """
+        md5_hash = bytes(self.md5_hashes[index * MD5_SIZE:(index + 1) * MD5_SIZE])
+        updated = self.updated[index]
+        return gcp_interfacer.BlobDetails(
+            name=self.get_name(index),
+            size=self.sizes[index] if self.sizes[index] >= 0 else None,
+            generation=self.generations[index] if self.generations[index] >= 0 else None,
+            content_type=self.content_types[self.content_type_ids[index]],
+            md5_hash=base64.b64encode(md5_hash).decode() if any(md5_hash) else None,
+            crc32c=base64.b64encode(self.crc32cs[index].to_bytes(4, "big")).decode()
+            if self.crc32cs[index] >= 0 else None,
+            updated=datetime.datetime.fromtimestamp(updated, datetime.timezone.utc)
+            if not math.isnan(updated) else None)
+
+    def get_memory_size(self):
+        """
+        Method that gets the approximate number of bytes held in memory by the catalog arrays and buffers.
+
+        :return: The number of bytes.
+        """
+        arrays = (self.directory_ids, self.sizes, self.generations, self.crc32cs, self.updated,
+                  self.content_type_ids, self._name_offsets)
+        return sum(len(values) * values.itemsize for values in arrays) + len(self.md5_hashes) + len(self._names) + \
+            sum(len(directory) for directory in self.directories)
+
+
+def get_blob_catalog(bucket_name, blob_prefix, delimiter=None, match_glob=None, spill_bytes=None):
+    """
+    Method that lists the objects of a Cloud Storage bucket with a prefix into a compact BlobCatalog.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param blob_prefix: The string prefix used to filter blobs.
+    :param delimiter: Optional delimiter that restricts the listing to the objects directly under the prefix.
+    :param match_glob: Optional glob pattern the object names must match.
+    :param spill_bytes: Optional number of bytes of file names kept in memory before spilling them to disk.
+    :return: The BlobCatalog.
+    """
+    return BlobCatalog.from_pages(bucket_name=bucket_name,
+                                  pages=gcp_interfacer.iter_blob_pages(bucket_name=bucket_name,
+                                                                       blob_prefix=blob_prefix,
+                                                                       delimiter=delimiter,
+                                                                       match_glob=match_glob),
+                                  spill_bytes=spill_bytes)
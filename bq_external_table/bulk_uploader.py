@@ -0,0 +1,309 @@
+import json
+import mimetypes
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from google.api_core import exceptions
+
+from bq_external_table import gcp_clients, gcp_interfacer, metrics, resilience
+from bq_external_table.utils import logger, utils_functions
+
+log = logger.get_logger()
+
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_SIZE_MULTIPLE
+DEFAULT_MAX_CONCURRENT_UPLOADS = 8
+UPLOAD_STATE_FILE_NAME = ".bq_external_table_uploads.json"
+STATUS_UPLOADED = "uploaded"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+UploadResult = namedtuple("UploadResult", ["source_file_name", "blob_name", "size", "status", "error", "duration"])
+
+
+class UploadState(object):
+    """
+    Thread safe record of the resumable upload sessions in progress, persisted to a local JSON file so that an
+    interrupted bulk upload resumes each file from the last chunk the server received.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._sessions = {}
+        if os.path.isfile(state_path):
+            with open(state_path) as state_file:
+                self._sessions = json.load(state_file)
+
+    def get_session_url(self, source_file_name, size, modified_time):
+        """
+        Method that gets the resumable session of a file, if the file did not change since it was started.
+
+        :param source_file_name: The local file path.
+        :param size: The file size in bytes.
+        :param modified_time: The file modification time.
+        :return: The resumable session URL, or None.
+        """
+        with self._lock:
+            session = self._sessions.get(source_file_name)
+        if session and session["size"] == size and session["modified_time"] == modified_time:
+            return session["session_url"]
+        return None
+
+    def set_session_url(self, source_file_name, size, modified_time, session_url):
+        """
+        Method that records the resumable session of a file.
+
+        :param source_file_name: The local file path.
+        :param size: The file size in bytes.
+        :param modified_time: The file modification time.
+        :param session_url: The resumable session URL.
+        """
+        with self._lock:
+            self._sessions[source_file_name] = {"size": size, "modified_time": modified_time,
+                                                "session_url": session_url}
+            self._save()
+
+    def remove(self, source_file_name):
+        """
+        Method that forgets the resumable session of a file, once it is uploaded.
+
+        :param source_file_name: The local file path.
+        """
+        with self._lock:
+            if self._sessions.pop(source_file_name, None) is not None:
+                self._save()
+
+    def _save(self):
+        temporary_path = self.state_path + ".tmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump(self._sessions, state_file)
+        os.replace(temporary_path, self.state_path)
+
+
+def upload_directory(bucket_name, source_dir, destination_prefix="",
+                     max_concurrent_uploads=DEFAULT_MAX_CONCURRENT_UPLOADS, chunk_size=DEFAULT_CHUNK_SIZE,
+                     skip_existing=True, state_path=None):
+    """
+    Method that uploads every file of a local directory to a Cloud Storage bucket, several files at a time, with
+    chunked resumable uploads. Files whose checksum already matches the remote object are skipped and uploads
+    interrupted by a previous call resume where they stopped.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param source_dir: The local directory to upload.
+    :param destination_prefix: The prefix prepended to the relative path of each file to get its blob name.
+    :param max_concurrent_uploads: The maximum number of files uploaded at the same time.
+    :param chunk_size: The number of bytes sent per request, a multiple of 256 KiB.
+    :param skip_existing: Whether files with the same size and checksum as the remote object are skipped.
+    :param state_path: The local JSON file with the resumable sessions in progress, inside source_dir by default.
+    :return: The list of UploadResult, one per local file.
+    """
+    if chunk_size <= 0 or chunk_size % CHUNK_SIZE_MULTIPLE:
+        raise ValueError("The chunk size must be a positive multiple of {} bytes.".format(CHUNK_SIZE_MULTIPLE))
+    state_path = state_path or os.path.join(source_dir, UPLOAD_STATE_FILE_NAME)
+    upload_state = UploadState(state_path=state_path)
+    local_files = [(source_file_name, get_destination_blob_name(destination_prefix, relative_path))
+                   for source_file_name, relative_path in list_local_files(source_dir)
+                   if os.path.abspath(source_file_name) not in (os.path.abspath(state_path),
+                                                                os.path.abspath(state_path + ".tmp"))]
+    remote_blobs = {}
+    if skip_existing:
+        remote_blobs = {blob_details.name: blob_details for blob_details in gcp_interfacer.iter_blob_details(
+            bucket_name=bucket_name, blob_prefix=destination_prefix)}
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent_uploads)) as executor:
+        list_of_results = list(executor.map(
+            lambda local_file: upload_file(bucket_name=bucket_name,
+                                           source_file_name=local_file[0],
+                                           blob_name=local_file[1],
+                                           chunk_size=chunk_size,
+                                           upload_state=upload_state,
+                                           remote_blob_details=remote_blobs.get(local_file[1])),
+            local_files))
+    log_upload_report(list_of_results=list_of_results, duration=time.time() - start)
+    return list_of_results
+
+
+def list_local_files(source_dir):
+    """
+    Method that lists the files of a local directory and its subdirectories.
+
+    :param source_dir: The local directory.
+    :return: The sorted list of (file path, path relative to source_dir with "/" separators) tuples.
+    """
+    local_files = []
+    for directory, _, file_names in os.walk(source_dir):
+        for file_name in file_names:
+            source_file_name = os.path.join(directory, file_name)
+            relative_path = os.path.relpath(source_file_name, source_dir).replace(os.sep, "/")
+            local_files.append((source_file_name, relative_path))
+    return sorted(local_files)
+
+
+def get_destination_blob_name(destination_prefix, relative_path):
+    """
+    Method that gets the blob name of an uploaded file.
+
+    :param destination_prefix: The destination prefix, used as a folder when it does not end with "/".
+    :param relative_path: The path of the file relative to the uploaded directory.
+    :return: The blob name.
+    """
+    if not destination_prefix:
+        return relative_path
+    return "{}/{}".format(destination_prefix.rstrip("/"), relative_path)
+
+
+def is_already_uploaded(source_file_name, remote_blob_details):
+    """
+    Method that checks whether a local file matches a remote object, comparing the size and then the crc32c checksum,
+    or the md5 hash when crc32c is not available.
+
+    :param source_file_name: The local file path.
+    :param remote_blob_details: The BlobDetails of the remote object, or None if it does not exist.
+    :return: True if the remote object has the same content.
+    """
+    if remote_blob_details is None or remote_blob_details.size != os.path.getsize(source_file_name):
+        return False
+    if remote_blob_details.crc32c and utils_functions.google_crc32c is not None:
+        return remote_blob_details.crc32c == utils_functions.get_file_crc32c(source_file_name)
+    return remote_blob_details.md5_hash == utils_functions.get_file_md5_hash(source_file_name)
+
+
+def upload_file(bucket_name, source_file_name, blob_name, chunk_size, upload_state, remote_blob_details=None):
+    """
+    Method that uploads one local file with a chunked resumable upload, unless it already matches the remote object.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param source_file_name: The local file path.
+    :param blob_name: The destination blob name.
+    :param chunk_size: The number of bytes sent per request.
+    :param upload_state: The UploadState with the resumable sessions in progress.
+    :param remote_blob_details: The BlobDetails of the existing remote object, or None.
+    :return: The UploadResult.
+    """
+    start = time.time()
+    size = os.path.getsize(source_file_name)
+    try:
+        if is_already_uploaded(source_file_name=source_file_name, remote_blob_details=remote_blob_details):
+            log.info("Skipping {}, gs://{}/{} is up to date.".format(source_file_name, bucket_name, blob_name))
+            return UploadResult(source_file_name=source_file_name, blob_name=blob_name, size=size,
+                                status=STATUS_SKIPPED, error=None, duration=time.time() - start)
+        if size == 0:
+            gcp_clients.get_bucket(bucket_name).blob(blob_name).upload_from_string(b"")
+        else:
+            upload_file_chunks(bucket_name=bucket_name, source_file_name=source_file_name, blob_name=blob_name,
+                               size=size, chunk_size=chunk_size, upload_state=upload_state)
+        upload_state.remove(source_file_name)
+        log.info("File {} uploaded to {}.".format(source_file_name, blob_name))
+        return UploadResult(source_file_name=source_file_name, blob_name=blob_name, size=size,
+                            status=STATUS_UPLOADED, error=None, duration=time.time() - start)
+    except (exceptions.GoogleAPIError, OSError) as error:
+        log.error("Could not upload {}: {}".format(source_file_name, error))
+        return UploadResult(source_file_name=source_file_name, blob_name=blob_name, size=size,
+                            status=STATUS_FAILED, error=str(error), duration=time.time() - start)
+
+
+def upload_file_chunks(bucket_name, source_file_name, blob_name, size, chunk_size, upload_state):
+    """
+    Method that sends a local file through a resumable upload session, chunk by chunk. The session of a previous
+    interrupted upload is reused when the file did not change, starting from the last byte the server persisted. A
+    chunk that fails with a transient error is sent again from the last byte the server persisted, after a backoff.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param source_file_name: The local file path.
+    :param blob_name: The destination blob name.
+    :param size: The file size in bytes.
+    :param chunk_size: The number of bytes sent per request.
+    :param upload_state: The UploadState with the resumable sessions in progress.
+    """
+    modified_time = os.path.getmtime(source_file_name)
+    session = gcp_clients.get_http_session()
+    session_url = upload_state.get_session_url(source_file_name, size, modified_time)
+    offset = get_persisted_offset(session=session, session_url=session_url, size=size) if session_url else None
+    if offset is None:
+        content_type = mimetypes.guess_type(source_file_name)[0] or "application/octet-stream"
+        session_url = gcp_clients.get_bucket(bucket_name).blob(blob_name).create_resumable_upload_session(
+            content_type=content_type, size=size)
+        upload_state.set_session_url(source_file_name, size, modified_time, session_url)
+        offset = 0
+    else:
+        log.info("Resuming upload of {} at byte {}.".format(source_file_name, offset))
+
+    failed_attempts = 0
+    with open(source_file_name, "rb") as source_file:
+        while offset < size:
+            source_file.seek(offset)
+            chunk = source_file.read(chunk_size)
+            resilience.acquire(resilience.API_STORAGE)
+            try:
+                with metrics.timer("gcs_upload_chunk", bucket=bucket_name):
+                    response = session.put(session_url, data=chunk, headers={
+                        "Content-Range": "bytes {}-{}/{}".format(offset, offset + len(chunk) - 1, size)})
+                new_offset = get_offset_from_response(response=response, size=size)
+            except (exceptions.GoogleAPIError, requests.exceptions.RequestException) as error:
+                failed_attempts += 1
+                if not resilience.is_retryable_error(error) or failed_attempts >= resilience.get_max_attempts():
+                    raise
+                resilience.wait_before_retry(api=resilience.API_STORAGE, error=error, attempt=failed_attempts)
+                persisted_offset = get_persisted_offset(session=session, session_url=session_url, size=size)
+                if persisted_offset is None:
+                    raise
+                offset = persisted_offset
+                continue
+            failed_attempts = 0
+            metrics.increment("gcs_bytes_uploaded", new_offset - offset, bucket=bucket_name)
+            offset = new_offset
+
+
+def get_persisted_offset(session, session_url, size):
+    """
+    Method that asks a resumable session how many bytes the server persisted.
+
+    :param session: The HTTP session.
+    :param session_url: The resumable session URL.
+    :param size: The file size in bytes.
+    :return: The number of bytes persisted, or None if the session expired.
+    """
+    response = session.put(session_url, data=b"", headers={"Content-Range": "bytes */{}".format(size)})
+    if response.status_code in (404, 410):
+        return None
+    return get_offset_from_response(response=response, size=size)
+
+
+def get_offset_from_response(response, size):
+    """
+    Method that gets the next byte to send from the response to a resumable upload request.
+
+    :param response: The HTTP response.
+    :param size: The file size in bytes.
+    :return: The offset of the next byte to send, size when the upload is complete.
+    """
+    if response.status_code in (200, 201):
+        return size
+    if response.status_code != 308:
+        raise exceptions.from_http_response(response)
+    persisted_range = response.headers.get("Range")
+    return int(persisted_range.split("-")[-1]) + 1 if persisted_range else 0
+
+
+def log_upload_report(list_of_results, duration):
+    """
+    Method that logs the outcome and the throughput of a bulk upload.
+
+    :param list_of_results: The list of UploadResult.
+    :param duration: The number of seconds the bulk upload took.
+    """
+    uploaded = [result for result in list_of_results if result.status == STATUS_UPLOADED]
+    uploaded_bytes = sum(result.size for result in uploaded)
+    log.info("Uploaded {} files ({:.1f} MB) in {:.1f}s, {:.2f} MB/s. Skipped {} files, {} failed.".format(
+        len(uploaded), uploaded_bytes / 1024 ** 2, duration, uploaded_bytes / 1024 ** 2 / max(duration, 1e-6),
+        len([result for result in list_of_results if result.status == STATUS_SKIPPED]),
+        len([result for result in list_of_results if result.status == STATUS_FAILED])))
+    for result in list_of_results:
+        if result.status == STATUS_FAILED:
+            log.error("Upload of {} failed: {}".format(result.source_file_name, result.error))
@@ -0,0 +1,199 @@
+import csv
+import io
+import zlib
+from collections import namedtuple
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from bq_external_table import gcp_clients, metrics, resilience
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+COMPRESSION_NONE = "NONE"
+COMPRESSION_GZIP = "GZIP"
+MAGIC_BYTES_SAMPLE_SIZE = 4096
+EXTENSION_FORMATS = {
+    "csv": bigquery.SourceFormat.CSV,
+    "avro": bigquery.SourceFormat.AVRO,
+    "parquet": bigquery.SourceFormat.PARQUET,
+    "orc": bigquery.SourceFormat.ORC,
+    "json": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    "jsonl": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    "ndjson": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+}
+COMPRESSED_EXTENSIONS = {"gz", "gzip"}
+CONTENT_TYPE_FORMATS = {
+    "text/csv": bigquery.SourceFormat.CSV,
+    "application/csv": bigquery.SourceFormat.CSV,
+    "avro/binary": bigquery.SourceFormat.AVRO,
+    "application/avro": bigquery.SourceFormat.AVRO,
+    "application/x-avro": bigquery.SourceFormat.AVRO,
+    "application/vnd.apache.parquet": bigquery.SourceFormat.PARQUET,
+    "application/x-parquet": bigquery.SourceFormat.PARQUET,
+    "application/x-ndjson": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    "application/jsonl": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    "application/json": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+}
+COMPRESSED_CONTENT_TYPES = {"application/gzip", "application/x-gzip"}
+MAGIC_BYTES_FORMATS = (
+    (b"Obj\x01", bigquery.SourceFormat.AVRO),
+    (b"PAR1", bigquery.SourceFormat.PARQUET),
+)
+# The ORC header is only "ORC", followed by the binary protobuf streams of the first stripe or of the footer.
+ORC_MAGIC_BYTES = b"ORC"
+TEXT_CONTROL_CHARACTERS = b"\t\n\r"
+CSV_DELIMITERS = (",", "\t", ";", "|")
+GZIP_MAGIC_BYTES = b"\x1f\x8b"
+# BigQuery reads gzip compressed CSV and JSON files, the binary formats carry their own compression.
+COMPRESSIBLE_FORMATS = {bigquery.SourceFormat.CSV, bigquery.SourceFormat.NEWLINE_DELIMITED_JSON}
+
+BlobFormat = namedtuple("BlobFormat", ["source_format", "compression"])
+
+
+def classify_blobs(bucket_name, list_of_blob_details):
+    """
+    Method that lazily detects the format of each blob. Blobs of an unknown or unsupported format are logged and
+    yielded with a None format, so that callers can leave them out.
+
+    :param bucket_name: The bucket name.
+    :param list_of_blob_details: An iterable of BlobDetails.
+    :return: A generator of (BlobFormat or None, BlobDetails) tuples.
+    """
+    for blob_details in list_of_blob_details:
+        blob_format = detect_blob_format(bucket_name=bucket_name, blob_details=blob_details)
+        metrics.increment("blobs_classified", bucket=bucket_name,
+                          format=blob_format.source_format if blob_format else "unsupported")
+        if blob_format is None:
+            log.warning("Skipping gs://{}/{}, its format is not supported.".format(bucket_name, blob_details.name))
+        yield blob_format, blob_details
+
+
+def detect_blob_format(bucket_name, blob_details):
+    """
+    Method that detects the format and compression of a blob. The extension is used first, then the content type,
+    and only when both are inconclusive are the first bytes of the blob read to look for a known signature.
+
+    :param bucket_name: The bucket name.
+    :param blob_details: The BlobDetails of the blob.
+    :return: The BlobFormat, or None if the format is unknown or not supported by BigQuery.
+    """
+    source_format, compression = get_format_from_metadata(blob_details)
+    if source_format is None and blob_details.size != 0:
+        try:
+            with metrics.timer("format_detection_read", bucket=bucket_name):
+                resilience.acquire(resilience.API_STORAGE)
+                sample = gcp_clients.get_bucket(bucket_name).blob(blob_details.name).download_as_bytes(
+                    start=0, end=MAGIC_BYTES_SAMPLE_SIZE - 1, retry=resilience.get_storage_retry())
+        except exceptions.GoogleAPIError as error:
+            log.warning("Could not read gs://{}/{}: {}".format(bucket_name, blob_details.name, error))
+            return None
+        source_format, magic_bytes_compression = get_format_from_magic_bytes(sample)
+        compression = compression or magic_bytes_compression
+    compression = compression or COMPRESSION_NONE
+    if source_format is None or (compression != COMPRESSION_NONE and source_format not in COMPRESSIBLE_FORMATS):
+        return None
+    return BlobFormat(source_format=source_format, compression=compression)
+
+
+def get_format_from_metadata(blob_details):
+    """
+    Method that gets the format and compression of a blob from its listing metadata only, its extension first and
+    then its content type.
+
+    :param blob_details: The BlobDetails of the blob.
+    :return: The tuple with the source format and the compression, each one None when unknown.
+    """
+    source_format, compression = get_format_from_name(blob_details.name)
+    if source_format is None:
+        source_format, content_type_compression = get_format_from_content_type(blob_details.content_type)
+        compression = compression or content_type_compression
+    return source_format, compression
+
+
+def get_format_from_name(blob_name):
+    """
+    Method that gets the format and compression of a blob from its extensions, e.g. "csv.gz".
+
+    :param blob_name: The blob name.
+    :return: The tuple with the source format and the compression, each one None when unknown.
+    """
+    extensions = blob_name.rsplit("/", 1)[-1].lower().split(".")[1:]
+    compression = None
+    if extensions and extensions[-1] in COMPRESSED_EXTENSIONS:
+        compression = COMPRESSION_GZIP
+        extensions = extensions[:-1]
+    return (EXTENSION_FORMATS.get(extensions[-1]) if extensions else None), compression
+
+
+def get_format_from_content_type(content_type):
+    """
+    Method that gets the format and compression of a blob from its content type.
+
+    :param content_type: The content type of the blob, possibly None or with parameters.
+    :return: The tuple with the source format and the compression, each one None when unknown.
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in COMPRESSED_CONTENT_TYPES:
+        return None, COMPRESSION_GZIP
+    return CONTENT_TYPE_FORMATS.get(content_type), None
+
+
+def get_format_from_magic_bytes(sample):
+    """
+    Method that gets the format and compression of a blob from its first bytes. Gzip data is partially decompressed
+    to detect the format it holds. Text that does not start like a JSON object is only CSV when its rows are
+    delimited with a consistent number of columns.
+
+    :param sample: The first bytes of the blob.
+    :return: The tuple with the source format and the compression, each one None when unknown.
+    """
+    compression = None
+    if sample.startswith(GZIP_MAGIC_BYTES):
+        compression = COMPRESSION_GZIP
+        try:
+            sample = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(sample, MAGIC_BYTES_SAMPLE_SIZE)
+        except zlib.error:
+            return None, compression
+    for magic_bytes, source_format in MAGIC_BYTES_FORMATS:
+        if sample.startswith(magic_bytes):
+            return source_format, compression
+    if sample.startswith(ORC_MAGIC_BYTES) and any(byte < 0x20 and byte not in TEXT_CONTROL_CHARACTERS
+                                                  for byte in sample[len(ORC_MAGIC_BYTES):]):
+        return bigquery.SourceFormat.ORC, compression
+    try:
+        text = sample.decode("utf-8")
+    except UnicodeDecodeError as error:
+        # The sample may end in the middle of a multi byte character.
+        if error.start < len(sample) - 3:
+            return None, compression
+        text = sample[:error.start].decode("utf-8")
+    text = text.lstrip("\ufeff \t\r\n")
+    if not text or "\x00" in text:
+        return None, compression
+    if text.startswith("{"):
+        return bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, compression
+    if is_delimited_text(text):
+        return bigquery.SourceFormat.CSV, compression
+    return None, compression
+
+
+def is_delimited_text(text):
+    """
+    Method that checks whether text looks like CSV data: its rows have the same number of columns, at least two,
+    with one of the usual delimiters. The last line of the text, possibly cut by the sample, is ignored.
+
+    :param text: The decoded first bytes of a blob.
+    :return: Whether the text is delimited.
+    """
+    if "\n" in text.rstrip("\r\n"):
+        text = text[:text.rfind("\n") + 1]
+    for delimiter in CSV_DELIMITERS:
+        try:
+            rows = [row for row in csv.reader(io.StringIO(text), delimiter=delimiter) if row]
+        except csv.Error:
+            continue
+        if rows and len(rows[0]) > 1 and all(len(row) == len(rows[0]) for row in rows):
+            return True
+    return False
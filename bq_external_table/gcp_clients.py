@@ -0,0 +1,193 @@
+import os
+import threading
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+from bq_external_table import metrics
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_STORAGE_API_ENDPOINT = "https://storage.googleapis.com"
+DEFAULT_BIGQUERY_API_ENDPOINT = "https://bigquery.googleapis.com"
+CLIENT_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+
+_client_settings = {"pool_size": DEFAULT_POOL_SIZE, "storage_api_endpoint": None, "bigquery_api_endpoint": None,
+                    "project": None, "generation": 0}
+_credentials_lock = threading.Lock()
+_credentials = {}
+_thread_clients = threading.local()
+
+
+def configure_clients(pool_size=DEFAULT_POOL_SIZE, storage_api_endpoint=None, project=None,
+                      bigquery_api_endpoint=None):
+    """
+    Method that sets how the shared GCP clients are built. Clients created before the call are discarded.
+
+    :param pool_size: The maximum number of pooled HTTP connections kept by each client.
+    :param storage_api_endpoint: Optional Cloud Storage API endpoint, e.g. a local fake server. Anonymous credentials
+    are used when it is set.
+    :param project: Optional project, used instead of the one of the application default credentials.
+    :param bigquery_api_endpoint: Optional BigQuery API endpoint, e.g. a local fake server. Anonymous credentials are
+    used when it is set.
+    """
+    _client_settings["pool_size"] = pool_size
+    _client_settings["storage_api_endpoint"] = storage_api_endpoint
+    _client_settings["bigquery_api_endpoint"] = bigquery_api_endpoint
+    _client_settings["project"] = project
+    reset_clients()
+
+
+def reset_clients():
+    """
+    Method that discards the cached credentials and the clients of every thread, e.g. after the GCP application
+    credentials change.
+    """
+    with _credentials_lock:
+        _credentials.clear()
+        _client_settings["generation"] += 1
+
+
+def get_credentials():
+    """
+    Method that loads the GCP application default credentials, once per process.
+
+    :return: The tuple with the GCP credentials and the default project.
+    """
+    with _credentials_lock:
+        if _credentials.get("pid") != os.getpid():
+            if _client_settings["storage_api_endpoint"] or _client_settings["bigquery_api_endpoint"]:
+                credentials, project = AnonymousCredentials(), None
+            else:
+                log.info("Loading GCP credentials.")
+                with metrics.timer("client_setup", client="credentials"):
+                    credentials, project = google.auth.default(scopes=CLIENT_SCOPES)
+            _credentials.update(pid=os.getpid(), credentials=credentials,
+                                project=_client_settings["project"] or project)
+        return _credentials["credentials"], _credentials["project"]
+
+
+def get_authorized_session():
+    """
+    Method that builds an authorized HTTP session with a connection pool of the configured size.
+
+    :return: The authorized HTTP session.
+    """
+    credentials, _ = get_credentials()
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=_client_settings["pool_size"], pool_maxsize=_client_settings["pool_size"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_pool_size():
+    """
+    Method that gets the configured maximum number of pooled HTTP connections of each client.
+
+    :return: The pool size.
+    """
+    return _client_settings["pool_size"]
+
+
+def get_storage_api_endpoint():
+    """
+    Method that gets the Cloud Storage API endpoint the clients are built for.
+
+    :return: The endpoint URL, without a trailing "/".
+    """
+    return (_client_settings["storage_api_endpoint"] or DEFAULT_STORAGE_API_ENDPOINT).rstrip("/")
+
+
+def get_bigquery_api_endpoint():
+    """
+    Method that gets the BigQuery API endpoint the clients are built for.
+
+    :return: The endpoint URL, without a trailing "/".
+    """
+    return (_client_settings["bigquery_api_endpoint"] or DEFAULT_BIGQUERY_API_ENDPOINT).rstrip("/")
+
+
+def get_thread_clients():
+    """
+    Method that gets the cache of clients of the current thread. The cache is emptied after reset_clients and in forked
+    processes, because HTTP sessions can not be shared between processes.
+
+    :return: The dictionary of cached clients of the current thread.
+    """
+    cache_key = (os.getpid(), _client_settings["generation"])
+    if getattr(_thread_clients, "cache_key", None) != cache_key:
+        _thread_clients.cache_key = cache_key
+        _thread_clients.clients = {}
+    return _thread_clients.clients
+
+
+def get_storage_client():
+    """
+    Method that gets the GCP storage client of the current thread, creating it on first use.
+
+    :return: The GCP storage client object.
+    """
+    clients = get_thread_clients()
+    if "storage" not in clients:
+        log.info("Getting storage client instance.")
+        credentials, project = get_credentials()
+        with metrics.timer("client_setup", client="storage"):
+            if _client_settings["storage_api_endpoint"]:
+                clients["storage"] = storage.Client(project=project, credentials=credentials,
+                                                    client_options={"api_endpoint": _client_settings[
+                                                        "storage_api_endpoint"]},
+                                                    _http=get_authorized_session())
+            else:
+                clients["storage"] = storage.Client(project=project, _http=get_authorized_session())
+    return clients["storage"]
+
+
+def get_bigquery_client():
+    """
+    Method that gets the GCP Big Query client of the current thread, creating it on first use.
+
+    :return: The GCP Big Query client object.
+    """
+    clients = get_thread_clients()
+    if "bigquery" not in clients:
+        log.info("Getting BigQuery client instance.")
+        credentials, project = get_credentials()
+        with metrics.timer("client_setup", client="bigquery"):
+            if _client_settings["bigquery_api_endpoint"]:
+                clients["bigquery"] = bigquery.Client(project=project, credentials=credentials,
+                                                      client_options={"api_endpoint": _client_settings[
+                                                          "bigquery_api_endpoint"]},
+                                                      _http=get_authorized_session())
+            else:
+                clients["bigquery"] = bigquery.Client(project=project, _http=get_authorized_session())
+    return clients["bigquery"]
+
+
+def get_http_session():
+    """
+    Method that gets the authorized HTTP session of the current thread, used for raw requests such as resumable
+    upload chunks.
+
+    :return: The authorized HTTP session.
+    """
+    clients = get_thread_clients()
+    if "http_session" not in clients:
+        clients["http_session"] = get_authorized_session()
+    return clients["http_session"]
+
+
+def get_bucket(bucket_name):
+    """
+    Method that gets a reference to a GCP storage bucket, without fetching its metadata.
+
+    :param bucket_name: The name of the GCP bucket.
+    :return: The GCP storage bucket object.
+    """
+    return get_storage_client().bucket(bucket_name)
@@ -1,12 +1,37 @@
+import datetime
+import itertools
 import os
+import re
+import time
+import uuid
+from collections import namedtuple
 
-from google.cloud import storage
+from google.api_core import exceptions
 from google.cloud import bigquery
 
+from bq_external_table import format_detection, gcp_clients, manifest, metrics, resilience, schema_inference
 from bq_external_table.utils import logger
 
 log = logger.get_logger()
 
+DEFAULT_MAX_CONCURRENT_JOBS = 1
+DEFAULT_JOB_POLL_INTERVAL = 1.0
+LOAD_MODE_PER_BLOB = "per_blob"
+LOAD_MODE_BATCH = "batch"
+TABLE_TYPE_NATIVE = "native"
+TABLE_TYPE_EXTERNAL = "external"
+MAX_URIS_PER_LOAD_JOB = 10000
+MAX_BYTES_PER_LOAD_JOB = 15 * 1024 ** 4
+PARTITION_TYPE_DAY = "DAY"
+
+BLOB_LISTING_FIELDS = "items(name,size,generation,contentType,md5Hash,crc32c,updated),prefixes,nextPageToken"
+
+BlobDetails = namedtuple("BlobDetails", ["name", "size", "generation", "content_type", "md5_hash", "crc32c",
+                                         "updated"])
+LoadJobResult = namedtuple("LoadJobResult", ["source_uris", "job_id", "succeeded", "error", "output_rows",
+                                             "input_bytes"])
+LoadSource = namedtuple("LoadSource", ["source_uris", "job_config"])
+
 
 def authenticate_gcp(credentials_file_path):
     """
@@ -16,41 +41,42 @@ def authenticate_gcp(credentials_file_path):
     """
     log.info("Authenticating into GCP.")
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_file_path
+    gcp_clients.reset_clients()
 
 
 def get_bigquery_client():
     """
-    Method that gets the GCP Big Query client object.
+    Method that gets the GCP Big Query client object, shared by the calls made from the same thread.
 
     :return: The GCP Big Query client object
     """
-    log.info("Getting BigQuery client instance.")
-    return bigquery.Client()
+    return gcp_clients.get_bigquery_client()
 
 
+@metrics.timed("gcs_create_bucket")
 def create_gcp_storage_bucket(bucket_name):
     """
     Method that creates a GCP storage bucket.
 
     :param bucket_name: The name of the GCP bucket.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.create_bucket(bucket_name)
+    bucket = gcp_clients.get_storage_client().create_bucket(bucket_name)
     log.info('Bucket {} created'.format(bucket.name))
 
 
+@metrics.timed("gcs_delete_bucket")
 def delete_gcp_storage_bucket(bucket_name):
     """
     Method that deletes a GCP storage bucket. Bucket must be empty.
 
     :param bucket_name: The name of the GCP bucket.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = gcp_clients.get_bucket(bucket_name)
     bucket.delete()
     log.info('Bucket {} deleted'.format(bucket.name))
 
 
+@metrics.timed("gcs_upload_blob")
 def upload_blob(bucket_name, source_file_name, destination_blob_name):
     """
     Method that uploads objects to Cloud Storage bucket
@@ -59,10 +85,11 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
     :param destination_blob_name: The name of the destination blob.
     :param source_file_name: The name of the source file.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = gcp_clients.get_bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
+    resilience.acquire(resilience.API_STORAGE)
+    blob.upload_from_filename(source_file_name, retry=resilience.get_storage_retry())
+    metrics.increment("gcs_bytes_uploaded", os.path.getsize(source_file_name), bucket=bucket_name)
     log.info('File {} uploaded to {}.'.format(source_file_name, destination_blob_name))
 
 
@@ -74,9 +101,72 @@ def get_list_of_blobs(bucket_name, blob_prefix):
     :param blob_prefix: The string prefix used to filter blobs to load.
     :return The list of objects in the bucket.
     """
-    return [blob.name for blob in storage.Client().list_blobs(bucket_name) if blob.name.startswith(blob_prefix)]
+    return [blob_details.name for blob_details in iter_blob_details(bucket_name=bucket_name, blob_prefix=blob_prefix)]
+
+
+def iter_blob_pages(bucket_name, blob_prefix, delimiter=None, match_glob=None, page_size=None):
+    """
+    Method that lazily lists objects in a Cloud Storage bucket, one page at a time. The prefix, delimiter and glob are
+    filtered by the API and only the metadata fields in BLOB_LISTING_FIELDS are requested. Throttled or failed page
+    requests are retried.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param blob_prefix: The string prefix used to filter blobs to load.
+    :param delimiter: Optional delimiter, e.g. "/", that restricts the listing to the objects directly under the prefix.
+    :param match_glob: Optional glob pattern, e.g. "**.csv", the object names must match.
+    :param page_size: Optional maximum number of objects per page.
+    :return: A generator of lists of BlobDetails, one list per page.
+    """
+    list_blobs_arguments = {"prefix": blob_prefix or None, "delimiter": delimiter, "fields": BLOB_LISTING_FIELDS,
+                            "retry": resilience.get_storage_retry()}
+    if match_glob:
+        list_blobs_arguments["match_glob"] = match_glob
+    if page_size:
+        list_blobs_arguments["page_size"] = page_size
+    pages = iter(gcp_clients.get_storage_client().list_blobs(bucket_name, **list_blobs_arguments).pages)
+    while True:
+        resilience.acquire(resilience.API_STORAGE)
+        with metrics.timer("gcs_list_page", bucket=bucket_name):
+            page = next(pages, None)
+            list_of_blob_details = None if page is None else [get_blob_details(blob) for blob in page]
+        if list_of_blob_details is None:
+            return
+        metrics.increment("gcs_objects_listed", len(list_of_blob_details), bucket=bucket_name)
+        metrics.increment("gcs_bytes_listed", sum(blob_details.size or 0 for blob_details in list_of_blob_details),
+                          bucket=bucket_name)
+        yield list_of_blob_details
+
+
+def iter_blob_details(bucket_name, blob_prefix, delimiter=None, match_glob=None, page_size=None):
+    """
+    Method that lazily lists the metadata of objects in a Cloud Storage bucket, according to a certain prefix. Objects
+    are yielded as soon as their listing page arrives.
+
+    :param bucket_name: The name of the GCP bucket.
+    :param blob_prefix: The string prefix used to filter blobs to load.
+    :param delimiter: Optional delimiter, e.g. "/", that restricts the listing to the objects directly under the prefix.
+    :param match_glob: Optional glob pattern, e.g. "**.csv", the object names must match.
+    :param page_size: Optional maximum number of objects per page.
+    :return: A generator of BlobDetails.
+    """
+    for page in iter_blob_pages(bucket_name=bucket_name, blob_prefix=blob_prefix, delimiter=delimiter,
+                                match_glob=match_glob, page_size=page_size):
+        for blob_details in page:
+            yield blob_details
 
 
+def get_blob_details(blob):
+    """
+    Method that gets the listing metadata of a Cloud Storage object.
+
+    :param blob: The GCP storage blob.
+    :return: The BlobDetails of the blob.
+    """
+    return BlobDetails(name=blob.name, size=blob.size, generation=blob.generation, content_type=blob.content_type,
+                       md5_hash=blob.md5_hash, crc32c=blob.crc32c, updated=blob.updated)
+
+
+@metrics.timed("gcs_delete_blob")
 def delete_blob(bucket_name, blob_name):
     """
     Method that deletes objects in Cloud Storage bucket
@@ -84,13 +174,13 @@ def delete_blob(bucket_name, blob_name):
     :param bucket_name: The name of the GCP bucket.
     :param blob_name: The name of the blob.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = gcp_clients.get_bucket(bucket_name)
     blob = bucket.blob(blob_name)
     blob.delete()
     log.info('Blob {} deleted.'.format(blob_name))
 
 
+@metrics.timed("bigquery_create_dataset")
 def create_bigquery_dataset(bigquery_client, dataset_name, dataset_location):
     """
     Method that creates a GCP BigQuery data set.
@@ -106,6 +196,18 @@ def create_bigquery_dataset(bigquery_client, dataset_name, dataset_location):
     log.info("Created dataset {}.{}".format(bigquery_client.project, dataset.dataset_id))
 
 
+def get_dataset_location(bigquery_client, dataset_ref):
+    """
+    Method that gets the location of a data set, which is also the location of the jobs that load its tables.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param dataset_ref: The data set reference.
+    :return: The location, e.g. "US" or "europe-west2".
+    """
+    return resilience.call_with_retry(api=resilience.API_BIGQUERY, function=bigquery_client.get_dataset,
+                                      args=(dataset_ref,)).location
+
+
 def get_dataset_id(bigquery_client, dataset_name):
     """
     Method that gets the GCP BigQuery dataset id, from its name.
@@ -117,6 +219,7 @@ def get_dataset_id(bigquery_client, dataset_name):
     return "{}.{}".format(bigquery_client.project, dataset_name)
 
 
+@metrics.timed("bigquery_delete_dataset")
 def delete_bigquery_dataset(bigquery_client, dataset_name):
     """
     Method that deletes a GCP BigQuery data set.
@@ -129,59 +232,725 @@ def delete_bigquery_dataset(bigquery_client, dataset_name):
     log.info("Deleted dataset '{}'.".format(dataset_id))
 
 
-def load_bucket_data_into_bigquery_external_table(bigquery_client, dataset_name, bucket_name, table_id, blob_prefix):
+def load_bucket_data_into_bigquery_external_table(bigquery_client, dataset_name, bucket_name, table_id, blob_prefix,
+                                                  max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS,
+                                                  job_poll_interval=DEFAULT_JOB_POLL_INTERVAL,
+                                                  load_mode=LOAD_MODE_PER_BLOB,
+                                                  max_uris_per_job=MAX_URIS_PER_LOAD_JOB,
+                                                  max_bytes_per_job=MAX_BYTES_PER_LOAD_JOB,
+                                                  blob_delimiter=None, blob_glob=None, manifest_path=None,
+                                                  schema_cache_path=None, refresh_schema_cache=False,
+                                                  schema_sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES,
+                                                  list_of_blob_details=None, partitioning=None):
     """
     Method that loads raw data of files with a prefix from a GCP storage bucket into a GCP BigQuery external table.
+    Load jobs are submitted while the bucket is still being listed. The format and compression of each blob are
+    detected, and the blobs of each format are loaded by their own jobs, with a job config suited to that format.
 
     :param bigquery_client: The GCP BigQuery client.
     :param dataset_name: The name of the data set.
     :param bucket_name: The name of the bucket.
     :param table_id: The table id.
     :param blob_prefix: The string prefix used to select the blobs to load.
+    :param max_concurrent_jobs: The maximum number of load jobs running at the same time.
+    :param job_poll_interval: The number of seconds to wait between polls of the running jobs.
+    :param load_mode: LOAD_MODE_PER_BLOB to run one load job per blob, LOAD_MODE_BATCH to group the blobs into as
+    few load jobs as possible.
+    :param max_uris_per_job: The maximum number of source URIs in one batched load job.
+    :param max_bytes_per_job: The maximum number of bytes loaded by one batched load job.
+    :param blob_delimiter: Optional delimiter that restricts the load to the objects directly under the prefix.
+    :param blob_glob: Optional glob pattern the names of the objects to load must match.
+    :param manifest_path: Optional local path of the manifest of ingested blobs. When set, only the blobs that are new
+    or changed since the previous runs are loaded.
+    :param schema_cache_path: Optional local path of the schema cache. When set, the schema of CSV data is inferred
+    locally from a sample of the first blob and cached per prefix, instead of being autodetected by every load job.
+    :param refresh_schema_cache: Whether the cached schema of the prefix is inferred again.
+    :param schema_sample_bytes: The maximum number of bytes sampled to infer the schema.
+    :param list_of_blob_details: Optional iterable of the BlobDetails to load, e.g. the blobs of one partition, instead
+    of listing the prefix.
+    :param partitioning: Optional dictionary with the "partition_type", "field", "clustering_fields" and
+    "write_disposition" of the destination table, see get_load_job_config.
+    :return: The list of LoadJobResult, one per submitted load job.
     """
     dataset_ref = bigquery_client.dataset(dataset_name)
-    job_config = bigquery.LoadJobConfig()
-    list_of_blobs = get_list_of_blobs(bucket_name=bucket_name, blob_prefix=blob_prefix)
-    if get_blob_type(list_of_blobs) == "CSV":
-        job_config.source_format = bigquery.SourceFormat.CSV
-        job_config.autodetect = True
+    use_wildcard = list_of_blob_details is None and not (blob_delimiter or blob_glob or manifest_path)
+    if list_of_blob_details is None:
+        list_of_blob_details = iter_blob_details(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                                 delimiter=blob_delimiter, match_glob=blob_glob)
+    on_job_submit = on_job_finish = on_job_retry = None
+    if manifest_path:
+        table_key = manifest.get_table_key(dataset_name=dataset_name, table_id=table_id)
+        blob_details_by_uri = {}
+        list_of_blob_details = track_blob_uris(bucket_name=bucket_name,
+                                               list_of_blob_details=manifest.filter_new_blobs(
+                                                   manifest_path=manifest_path,
+                                                   bucket_name=bucket_name,
+                                                   table_key=table_key,
+                                                   list_of_blob_details=list_of_blob_details),
+                                               blob_details_by_uri=blob_details_by_uri)
+        on_job_submit, on_job_finish, on_job_retry = get_manifest_callbacks(
+            manifest_path=manifest_path,
+            bucket_name=bucket_name,
+            table_key=table_key,
+            blob_details_by_uri=blob_details_by_uri,
+            location=get_dataset_location(bigquery_client=bigquery_client, dataset_ref=dataset_ref))
+    job_configs = {}
+
+    def get_job_config(blob_format, blob_details):
+        if blob_format not in job_configs:
+            job_configs[blob_format] = get_load_job_config(blob_format=blob_format,
+                                                           bucket_name=bucket_name,
+                                                           blob_prefix=blob_prefix,
+                                                           blob_name=blob_details.name,
+                                                           schema_cache_path=schema_cache_path,
+                                                           refresh_schema_cache=refresh_schema_cache,
+                                                           schema_sample_bytes=schema_sample_bytes,
+                                                           partitioning=partitioning)
+        return job_configs[blob_format]
+
+    list_of_classified_blobs = format_detection.classify_blobs(bucket_name=bucket_name,
+                                                               list_of_blob_details=list_of_blob_details)
+    if load_mode == LOAD_MODE_BATCH:
+        list_of_sources = batch_load_sources(bucket_name=bucket_name,
+                                             blob_prefix=blob_prefix,
+                                             list_of_classified_blobs=list_of_classified_blobs,
+                                             get_job_config=get_job_config,
+                                             max_uris_per_job=max_uris_per_job,
+                                             max_bytes_per_job=max_bytes_per_job,
+                                             use_wildcard=use_wildcard)
     else:
-        job_config.source_format = bigquery.SourceFormat.AVRO
+        list_of_sources = (LoadSource(source_uris=get_blob_uri(bucket_name=bucket_name, blob_name=blob_details.name),
+                                      job_config=get_job_config(blob_format, blob_details))
+                           for blob_format, blob_details in list_of_classified_blobs if blob_format is not None)
+    if partitioning and partitioning.get("write_disposition") == bigquery.WriteDisposition.WRITE_TRUNCATE:
+        # Only the first job replaces the partition, the next ones, run one at a time after it, append to it.
+        list_of_sources = append_after_first_source(list_of_sources)
+        max_concurrent_jobs = 1
+    first_source = next(list_of_sources, None)
+    if first_source is None:
+        log.info("No blobs to load with prefix {} in bucket {}.".format(blob_prefix, bucket_name))
+        return []
+
+    return run_load_jobs(bigquery_client=bigquery_client,
+                         list_of_source_uris=itertools.chain([first_source], list_of_sources),
+                         dataset_ref=dataset_ref,
+                         job_config=None,
+                         table_id=table_id,
+                         max_concurrent_jobs=max_concurrent_jobs,
+                         job_poll_interval=job_poll_interval,
+                         on_job_submit=on_job_submit,
+                         on_job_finish=on_job_finish,
+                         on_job_retry=on_job_retry)
+
+
+@metrics.timed("bigquery_define_external_table")
+def create_or_update_external_table(bigquery_client, dataset_name, bucket_name, table_id, blob_prefix,
+                                    source_format=None, hive_partitioning=None, csv_options=None,
+                                    schema_cache_path=None, refresh_schema_cache=False,
+                                    schema_sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES):
+    """
+    Method that defines a GCP BigQuery external table over the files with a prefix in a GCP storage bucket. No data is
+    copied: the table reads the gs://bucket/prefix* files when it is queried. An existing table is updated.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param dataset_name: The name of the data set.
+    :param bucket_name: The name of the bucket.
+    :param table_id: The table id.
+    :param blob_prefix: The string prefix used to select the blobs of the table.
+    :param source_format: Optional "CSV", "AVRO", "PARQUET", "ORC" or "NEWLINE_DELIMITED_JSON", detected from the
+    first blob when missing.
+    :param hive_partitioning: Optional dictionary with the hive partitioning "mode" (AUTO, STRINGS or CUSTOM), the
+    "source_uri_prefix" and "require_partition_filter". The source URI prefix defaults to the folder of the prefix.
+    :param csv_options: Optional dictionary with the "skip_leading_rows", "field_delimiter", "allow_jagged_rows",
+    "allow_quoted_newlines" and "quote_character" of CSV files.
+    :param schema_cache_path: Optional local path of the schema cache, used for CSV files instead of autodetection.
+    :param refresh_schema_cache: Whether the cached schema of the prefix is inferred again.
+    :param schema_sample_bytes: The maximum number of bytes sampled to infer the schema.
+    :return: An empty list, as no load job is run.
+    """
+    first_blob_details = next(iter_blob_details(bucket_name=bucket_name, blob_prefix=blob_prefix, page_size=1), None)
+    if first_blob_details is None:
+        log.info("No blobs with prefix {} in bucket {}.".format(blob_prefix, bucket_name))
+        return []
+    blob_format = format_detection.detect_blob_format(bucket_name=bucket_name, blob_details=first_blob_details)
+    compression = blob_format.compression if blob_format else format_detection.COMPRESSION_NONE
+    source_format = (source_format or (blob_format.source_format if blob_format
+                                       else get_blob_type([first_blob_details.name]))).upper()
+    external_config = bigquery.ExternalConfig(source_format)
+    external_config.source_uris = [get_blob_uri(bucket_name=bucket_name, blob_name=blob_prefix + "*")]
+    if compression != format_detection.COMPRESSION_NONE:
+        external_config.compression = compression
+    schema = None
+    if source_format == bigquery.ExternalSourceFormat.CSV:
+        csv_options = dict(csv_options or {})
+        csv_schema = None
+        if schema_cache_path and compression == format_detection.COMPRESSION_NONE:
+            csv_schema = schema_inference.get_csv_schema(bucket_name=bucket_name,
+                                                         blob_prefix=blob_prefix,
+                                                         blob_name=first_blob_details.name,
+                                                         schema_cache_path=schema_cache_path,
+                                                         sample_bytes=schema_sample_bytes,
+                                                         refresh=refresh_schema_cache)
+        if csv_schema is not None:
+            schema, skip_leading_rows = csv_schema
+            csv_options.setdefault("skip_leading_rows", skip_leading_rows)
+        else:
+            external_config.autodetect = True
+        for option, value in csv_options.items():
+            setattr(external_config.options, option, value)
+    elif source_format != bigquery.ExternalSourceFormat.PARQUET:
+        external_config.autodetect = True
+    if hive_partitioning:
+        hive_partitioning_options = bigquery.HivePartitioningOptions()
+        hive_partitioning_options.mode = hive_partitioning.get("mode", "AUTO")
+        hive_partitioning_options.source_uri_prefix = hive_partitioning.get(
+            "source_uri_prefix",
+            get_blob_uri(bucket_name=bucket_name, blob_name=blob_prefix[:blob_prefix.rfind("/") + 1]))
+        hive_partitioning_options.require_partition_filter = hive_partitioning.get("require_partition_filter", False)
+        external_config.hive_partitioning = hive_partitioning_options
+
+    table = bigquery.Table(bigquery_client.dataset(dataset_name).table(table_id))
+    table.external_data_configuration = external_config
+    if schema:
+        table.schema = schema
+    try:
+        bigquery_client.create_table(table)
+        log.info("Created external table {} over {}.".format(table_id, external_config.source_uris[0]))
+    except exceptions.Conflict:
+        bigquery_client.update_table(table, ["external_data_configuration"] + (["schema"] if schema else []))
+        log.info("Updated external table {} over {}.".format(table_id, external_config.source_uris[0]))
+    return []
+
+
+def track_blob_uris(bucket_name, list_of_blob_details, blob_details_by_uri):
+    """
+    Method that records the BlobDetails of each blob by its gs:// URI while they are consumed.
+
+    :param bucket_name: The bucket name.
+    :param list_of_blob_details: An iterable of BlobDetails.
+    :param blob_details_by_uri: The dictionary filled with the BlobDetails of each URI.
+    :return: A generator of the same BlobDetails.
+    """
+    for blob_details in list_of_blob_details:
+        blob_details_by_uri[get_blob_uri(bucket_name=bucket_name, blob_name=blob_details.name)] = blob_details
+        yield blob_details
+
+
+def get_manifest_callbacks(manifest_path, bucket_name, table_key, blob_details_by_uri, location=None):
+    """
+    Method that builds the run_load_jobs callbacks that keep the manifest of ingested blobs up to date. The blobs of a
+    job are recorded as pending before the job is submitted, so that an interrupted run can be reconciled, and as
+    loaded once the job succeeds.
+
+    :param manifest_path: The local path of the manifest of ingested blobs.
+    :param bucket_name: The bucket name.
+    :param table_key: The manifest key of the table.
+    :param blob_details_by_uri: The dictionary with the BlobDetails of each URI.
+    :param location: The location of the data set of the table, recorded with the pending jobs.
+    :return: The tuple with the on_job_submit, on_job_finish and on_job_retry callbacks.
+    """
+    def on_job_submit(source_uris):
+        job_id = manifest.new_job_id()
+        manifest.mark_pending(manifest_path=manifest_path,
+                              bucket_name=bucket_name,
+                              table_key=table_key,
+                              job_id=job_id,
+                              list_of_blob_details=[blob_details_by_uri[uri] for uri in as_list(source_uris)],
+                              location=location)
+        return job_id
+
+    def on_job_finish(result):
+        if result.succeeded:
+            manifest.mark_loaded(manifest_path=manifest_path, job_id=result.job_id)
+        else:
+            manifest.discard_job(manifest_path=manifest_path, job_id=result.job_id)
+        for uri in as_list(result.source_uris):
+            blob_details_by_uri.pop(uri, None)
+
+    def on_job_retry(job_id, new_job_id):
+        manifest.move_job(manifest_path=manifest_path, job_id=job_id, new_job_id=new_job_id)
+
+    return on_job_submit, on_job_finish, on_job_retry
+
+
+def as_list(source_uris):
+    """
+    Method that gets the sources of a load job as a list of URIs.
+
+    :param source_uris: The gs:// URI, or list of URIs, of the load job.
+    :return: The list of URIs.
+    """
+    return [source_uris] if isinstance(source_uris, str) else list(source_uris)
+
+
+class LoadSourceBatcher(object):
+    """
+    Push based grouping of blobs of possibly different formats into as few load jobs as possible, each job loading
+    blobs of a single format. Blobs are added one at a time, from a synchronous or an asynchronous listing, and the
+    load sources are returned as soon as each one is full. When use_wildcard is set and all the blobs have the same
+    format and fit in one job, a single gs://bucket/prefix* wildcard is used.
+    """
+
+    def __init__(self, bucket_name, blob_prefix, get_job_config, max_uris_per_job=MAX_URIS_PER_LOAD_JOB,
+                 max_bytes_per_job=MAX_BYTES_PER_LOAD_JOB, use_wildcard=True):
+        self.bucket_name = bucket_name
+        self.blob_prefix = blob_prefix
+        self.get_job_config = get_job_config
+        self.max_uris_per_job = max_uris_per_job
+        self.max_bytes_per_job = max_bytes_per_job
+        self._wildcard_candidates = [] if use_wildcard else None
+        self._wildcard_bytes = 0
+        self._batches = {}
+
+    def add(self, blob_format, blob_details):
+        """
+        Method that adds one blob.
+
+        :param blob_format: The BlobFormat of the blob, None to leave it out.
+        :param blob_details: The BlobDetails of the blob.
+        :return: The list of LoadSource that are full.
+        """
+        if self._wildcard_candidates is None:
+            return self._add_to_batch(blob_format, blob_details)
+        self._wildcard_candidates.append((blob_format, blob_details))
+        self._wildcard_bytes += blob_details.size or 0
+        if self._wildcard_bytes > self.max_bytes_per_job or blob_format is None or \
+                blob_format != self._wildcard_candidates[0][0]:
+            return self._stop_wildcard()
+        return []
+
+    def flush(self):
+        """
+        Method that ends the grouping, once every blob was added.
+
+        :return: The list of the remaining LoadSource.
+        """
+        if self._wildcard_candidates is not None and len(self._wildcard_candidates) > 1:
+            self._wildcard_candidates, wildcard_candidates = None, self._wildcard_candidates
+            return [LoadSource(source_uris=[get_blob_uri(bucket_name=self.bucket_name,
+                                                         blob_name=self.blob_prefix + "*")],
+                               job_config=self.get_job_config(*wildcard_candidates[0]))]
+        list_of_sources = self._stop_wildcard() if self._wildcard_candidates is not None else []
+        for job_config, batch, _ in self._batches.values():
+            if batch:
+                list_of_sources.append(LoadSource(source_uris=batch, job_config=job_config))
+        self._batches = {}
+        return list_of_sources
+
+    def _stop_wildcard(self):
+        self._wildcard_candidates, wildcard_candidates = None, self._wildcard_candidates
+        list_of_sources = []
+        for blob_format, blob_details in wildcard_candidates:
+            list_of_sources.extend(self._add_to_batch(blob_format, blob_details))
+        return list_of_sources
+
+    def _add_to_batch(self, blob_format, blob_details):
+        if blob_format is None:
+            return []
+        if blob_format not in self._batches:
+            self._batches[blob_format] = (self.get_job_config(blob_format, blob_details), [], 0)
+        job_config, batch, batch_bytes = self._batches[blob_format]
+        blob_size = blob_details.size or 0
+        list_of_sources = []
+        if batch and (len(batch) >= self.max_uris_per_job or batch_bytes + blob_size > self.max_bytes_per_job):
+            list_of_sources.append(LoadSource(source_uris=batch, job_config=job_config))
+            batch = []
+            batch_bytes = 0
+        batch.append(get_blob_uri(bucket_name=self.bucket_name, blob_name=blob_details.name))
+        self._batches[blob_format] = (job_config, batch, batch_bytes + blob_size)
+        return list_of_sources
+
+
+def append_after_first_source(list_of_sources):
+    """
+    Method that keeps the write disposition of the first load source, e.g. WRITE_TRUNCATE, and makes the next ones
+    append their data, so that the jobs that load the same partition do not replace the rows of each other.
+
+    :param list_of_sources: The iterable of LoadSource.
+    :return: The generator of LoadSource.
+    """
+    for index, load_source in enumerate(list_of_sources):
+        if index > 0:
+            job_config = bigquery.LoadJobConfig.from_api_repr(load_source.job_config.to_api_repr())
+            job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+            load_source = load_source._replace(job_config=job_config)
+        yield load_source
+
+
+def batch_load_sources(bucket_name, blob_prefix, list_of_classified_blobs, get_job_config,
+                       max_uris_per_job=MAX_URIS_PER_LOAD_JOB, max_bytes_per_job=MAX_BYTES_PER_LOAD_JOB,
+                       use_wildcard=True):
+    """
+    Method that lazily groups blobs of possibly different formats into as few load jobs as possible, each job loading
+    blobs of a single format, with a LoadSourceBatcher.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :param list_of_classified_blobs: An iterable of (BlobFormat, BlobDetails) tuples with every blob under the prefix.
+    Blobs with a None format are left out.
+    :param get_job_config: The callable that gets the load job config of a format, called with the BlobFormat and
+    the BlobDetails of its first blob.
+    :param max_uris_per_job: The maximum number of source URIs in one load job.
+    :param max_bytes_per_job: The maximum number of bytes loaded by one load job.
+    :param use_wildcard: Whether the prefix wildcard selects exactly the blobs in list_of_classified_blobs.
+    :return: A generator of LoadSource.
+    """
+    batcher = LoadSourceBatcher(bucket_name=bucket_name, blob_prefix=blob_prefix, get_job_config=get_job_config,
+                                max_uris_per_job=max_uris_per_job, max_bytes_per_job=max_bytes_per_job,
+                                use_wildcard=use_wildcard)
+    for blob_format, blob_details in list_of_classified_blobs:
+        for load_source in batcher.add(blob_format, blob_details):
+            yield load_source
+    for load_source in batcher.flush():
+        yield load_source
+
+
+def get_load_job_config(blob_format, bucket_name, blob_prefix, blob_name, schema_cache_path=None,
+                        refresh_schema_cache=False, schema_sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES,
+                        partitioning=None):
+    """
+    Method that builds the load job config of the blobs of one format. The schema of uncompressed CSV data comes from
+    the local schema cache when one is configured, CSV and JSON data are otherwise autodetected, and the binary
+    formats carry their own schema. With partitioning, the destination table is created as a time partitioned and
+    optionally clustered table.
 
-    for blob in list_of_blobs:
-        load_job(bigquery_client=bigquery_client,
-                 bucket_name=bucket_name,
-                 file_name=blob,
-                 dataset_ref=dataset_ref,
-                 job_config=job_config,
-                 table_id=table_id)
+    :param blob_format: The BlobFormat of the blobs.
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :param blob_name: The name of a blob of that format, sampled when the schema is inferred.
+    :param schema_cache_path: Optional local path of the schema cache.
+    :param refresh_schema_cache: Whether the cached schema of the prefix is inferred again.
+    :param schema_sample_bytes: The maximum number of bytes sampled to infer the schema.
+    :param partitioning: Optional dictionary with the "partition_type" (DAY, HOUR, MONTH or YEAR, default DAY), the
+    "field" (partitioned by ingestion time when missing), the "clustering_fields" and the "write_disposition" of the
+    destination table.
+    :return: The LoadJobConfig.
+    """
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = blob_format.source_format
+    if blob_format.source_format == bigquery.SourceFormat.AVRO:
+        # Keeps the DATE and TIMESTAMP columns of Avro files, e.g. converted from CSV, instead of raw integers.
+        job_config.use_avro_logical_types = True
+    if partitioning:
+        job_config.time_partitioning = bigquery.TimePartitioning(
+            type_=partitioning.get("partition_type", PARTITION_TYPE_DAY), field=partitioning.get("field"))
+        if partitioning.get("clustering_fields"):
+            job_config.clustering_fields = partitioning.get("clustering_fields")
+        if partitioning.get("write_disposition"):
+            job_config.write_disposition = partitioning.get("write_disposition")
+    csv_schema = None
+    if blob_format.source_format == bigquery.SourceFormat.CSV and schema_cache_path and \
+            blob_format.compression == format_detection.COMPRESSION_NONE:
+        # Without a schema, e.g. sampled from an empty blob, the load falls back to autodetection.
+        csv_schema = schema_inference.get_csv_schema(
+            bucket_name=bucket_name,
+            blob_prefix=blob_prefix,
+            blob_name=blob_name,
+            schema_cache_path=schema_cache_path,
+            sample_bytes=schema_sample_bytes,
+            refresh=refresh_schema_cache)
+    if csv_schema is not None:
+        job_config.schema, job_config.skip_leading_rows = csv_schema
+    elif blob_format.source_format in format_detection.COMPRESSIBLE_FORMATS:
+        job_config.autodetect = True
+    log.info("Loading {} blobs of gs://{}/{} as {}.".format(
+        "{} compressed".format(blob_format.compression) if blob_format.compression != format_detection.COMPRESSION_NONE
+        else "uncompressed", bucket_name, blob_prefix, blob_format.source_format))
+    return job_config
 
 
 def get_blob_type(list_of_blobs):
     """
-    Method that gets the type of objects in a bucket.
+    Method that gets the type of objects in a bucket, from the extension of the first one.
 
-    :param list_of_blobs: The list with all the objects in a bucket.
+    :param list_of_blobs: An iterable of the names of the objects in a bucket.
     :return: The bucket object type.
     """
-    return [blob.split(".")[-1] for blob in list_of_blobs][0].upper()
+    return next(iter(list_of_blobs)).rsplit(".", 1)[-1].upper()
 
 
-def load_job(bigquery_client, bucket_name, file_name, dataset_ref, job_config, table_id):
+def get_blob_uri(bucket_name, blob_name):
     """
-    Method that runs a GCP BigQuery load job.
+    Method that gets the GCP storage URI of a blob.
 
-    :param bigquery_client: The GCP BigQuery client.
     :param bucket_name: The bucket name.
-    :param file_name: The file name.
+    :param blob_name: The blob name.
+    :return: The gs:// URI of the blob.
+    """
+    return "gs://{}/{}".format(bucket_name, blob_name)
+
+
+def submit_load_job(bigquery_client, source_uris, dataset_ref, job_config, table_id, job_id=None, on_throttle=None):
+    """
+    Method that submits a GCP BigQuery load job without waiting for it to finish. Transient errors are retried with
+    the same job id, so when a submission that looked failed actually created the job, that job is reused instead of
+    loading the data twice. The existing job is looked up in the location of the data set, where it runs.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param source_uris: The gs:// URI, or list of URIs, to load.
     :param dataset_ref: The data set reference.
     :param job_config: The load job config.
     :param table_id: The table id.
+    :param job_id: Optional id for the job, generated by BigQuery when missing.
+    :param on_throttle: Optional callable called every time BigQuery throttles the submission.
+    :return: The submitted load job.
+    """
+    with metrics.timer("bigquery_submit_job", table=table_id):
+        try:
+            load_job_details = resilience.call_with_retry(
+                api=resilience.API_BIGQUERY,
+                function=bigquery_client.load_table_from_uri,
+                args=(source_uris, dataset_ref.table(table_id)),
+                kwargs={"job_id": job_id, "job_config": job_config},
+                on_throttle=on_throttle)
+        except exceptions.Conflict:
+            if job_id is None:
+                raise
+            log.info("Job {} already exists, reusing it.".format(job_id))
+            load_job_details = resilience.call_with_retry(
+                api=resilience.API_BIGQUERY,
+                function=bigquery_client.get_job,
+                args=(job_id,),
+                kwargs={"location": get_dataset_location(bigquery_client=bigquery_client, dataset_ref=dataset_ref)},
+                on_throttle=on_throttle)
+    metrics.increment("bigquery_jobs_submitted", table=table_id)
+    log.info("Submitted job {} for {}".format(load_job_details.job_id, source_uris))
+    return load_job_details
+
+
+def get_load_job_result(source_uris, load_job_details):
+    """
+    Method that builds the result of a finished GCP BigQuery load job.
+
+    :param source_uris: The gs:// URI, or list of URIs, loaded by the job.
+    :param load_job_details: The finished load job.
+    :return: The LoadJobResult of the job.
+    """
+    error_result = load_job_details.error_result
+    return LoadJobResult(source_uris=source_uris,
+                         job_id=load_job_details.job_id,
+                         succeeded=error_result is None,
+                         error=error_result.get("message") if error_result else None,
+                         output_rows=load_job_details.output_rows,
+                         input_bytes=load_job_details.input_file_bytes)
+
+
+def run_load_jobs(bigquery_client, list_of_source_uris, dataset_ref, job_config, table_id,
+                  max_concurrent_jobs=DEFAULT_MAX_CONCURRENT_JOBS, job_poll_interval=DEFAULT_JOB_POLL_INTERVAL,
+                  on_job_submit=None, on_job_finish=None, on_job_retry=None):
+    """
+    Method that runs GCP BigQuery load jobs concurrently. At most max_concurrent_jobs jobs are in flight at any time,
+    fewer while BigQuery throttles, all of them are polled together and a failed job does not stop the remaining
+    ones. Every job gets a deterministic id, so that retried submissions do not duplicate it, and jobs that fail with
+    a transient error are run again.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param list_of_source_uris: The list of sources to load, each one a gs:// URI, a list of URIs, or a LoadSource
+    with its own job config.
+    :param dataset_ref: The data set reference.
+    :param job_config: The load job config of the sources that are not a LoadSource.
+    :param table_id: The table id.
+    :param max_concurrent_jobs: The maximum number of load jobs running at the same time.
+    :param job_poll_interval: The number of seconds to wait between polls of the running jobs.
+    :param on_job_submit: Optional callable called with the sources of each job right before it is submitted. It
+    returns the id to give to the job, or None to use a generated one.
+    :param on_job_finish: Optional callable called with the LoadJobResult of each job once it is finished.
+    :param on_job_retry: Optional callable called with the previous and the new job id when a job is run again.
+    :return: The list of LoadJobResult, in the same order as list_of_source_uris.
+    """
+    concurrency = resilience.AdaptiveConcurrency(maximum=max_concurrent_jobs)
+    job_id_prefix = get_job_id_prefix(table_id)
+    pending_sources = iter(enumerate(list_of_source_uris))
+    in_flight = {}
+    results = {}
+    sources_exhausted = False
+    while True:
+        while not sources_exhausted and len(in_flight) < concurrency.limit:
+            index, source_uris = next(pending_sources, (None, None))
+            if index is None:
+                sources_exhausted = True
+                break
+            source_job_config = job_config
+            if isinstance(source_uris, LoadSource):
+                source_uris, source_job_config = source_uris
+            job_id = on_job_submit(source_uris) if on_job_submit else None
+            job_id = job_id or "{}_{}".format(job_id_prefix, index)
+            try:
+                in_flight[index] = (source_uris, source_job_config, 1,
+                                    submit_load_job(bigquery_client=bigquery_client,
+                                                    source_uris=source_uris,
+                                                    dataset_ref=dataset_ref,
+                                                    job_config=source_job_config,
+                                                    table_id=table_id,
+                                                    job_id=job_id,
+                                                    on_throttle=concurrency.on_throttle))
+            except exceptions.GoogleAPIError as error:
+                log.error("Could not submit job for {}: {}".format(source_uris, error))
+                results[index] = LoadJobResult(source_uris=source_uris, job_id=job_id, succeeded=False,
+                                               error=str(error), output_rows=None, input_bytes=None)
+                if on_job_finish:
+                    on_job_finish(results[index])
+        if not in_flight:
+            break
+
+        with metrics.timer("bigquery_poll_jobs", table=table_id):
+            finished = [index for index, (_, _, _, load_job_details) in in_flight.items()
+                        if resilience.call_with_retry(api=resilience.API_BIGQUERY, function=load_job_details.done,
+                                                      on_throttle=concurrency.on_throttle)]
+        metrics.increment("bigquery_job_polls", len(in_flight), table=table_id)
+        for index in finished:
+            source_uris, source_job_config, attempt, load_job_details = in_flight.pop(index)
+            error_result = load_job_details.error_result
+            if resilience.is_retryable_job_error(error_result) and attempt < resilience.get_max_job_attempts():
+                retried_job = retry_load_job(bigquery_client=bigquery_client,
+                                             source_uris=source_uris,
+                                             dataset_ref=dataset_ref,
+                                             job_config=source_job_config,
+                                             table_id=table_id,
+                                             load_job_details=load_job_details,
+                                             attempt=attempt,
+                                             concurrency=concurrency,
+                                             on_job_retry=on_job_retry)
+                if retried_job is not None:
+                    in_flight[index] = (source_uris, source_job_config, attempt + 1, retried_job)
+                    continue
+            results[index] = get_load_job_result(source_uris=source_uris, load_job_details=load_job_details)
+            record_load_job_metrics(table_id=table_id, result=results[index], load_job_details=load_job_details)
+            if results[index].succeeded:
+                concurrency.on_success()
+                log.info("Job {} finished, loaded {} rows.".format(load_job_details.job_id,
+                                                                   load_job_details.output_rows))
+            else:
+                log.error("Job {} failed: {}".format(load_job_details.job_id, results[index].error))
+            if on_job_finish:
+                on_job_finish(results[index])
+        if not finished:
+            time.sleep(job_poll_interval)
+
+    list_of_results = [results[index] for index in sorted(results)]
+    log_load_jobs_report(table_id=table_id, list_of_results=list_of_results)
+    return list_of_results
+
+
+def get_job_id_prefix(table_id):
+    """
+    Method that gets a prefix for the ids of the load jobs of one run_load_jobs call, unique to that call.
+
+    :param table_id: The table id.
+    :return: The job id prefix.
+    """
+    return "bq_external_table_{}_{}".format("".join(character if character.isalnum() or character in "_-" else "_"
+                                                    for character in str(table_id))[:100], uuid.uuid4().hex)
+
+
+def get_retry_job_id(job_id, attempt):
+    """
+    Method that gets the id of a load job run again, derived from the id of the first run of the job.
+
+    :param job_id: The id of the failed job, itself possibly a job run again.
+    :param attempt: The number of times the job was run.
+    :return: The new job id.
+    """
+    return "{}_retry{}".format(re.sub(r"_retry\d+$", "", job_id), attempt)
+
+
+def retry_load_job(bigquery_client, source_uris, dataset_ref, job_config, table_id, load_job_details, attempt,
+                   concurrency, on_job_retry=None):
+    """
+    Method that runs again a load job that failed with a transient error. The new job id is derived from the failed
+    one, so that a retried submission does not duplicate the new job either.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param source_uris: The gs:// URI, or list of URIs, of the job.
+    :param dataset_ref: The data set reference.
+    :param job_config: The load job config.
+    :param table_id: The table id.
+    :param load_job_details: The failed load job.
+    :param attempt: The number of times the job was run.
+    :param concurrency: The AdaptiveConcurrency of the jobs, reduced when the job was throttled.
+    :param on_job_retry: Optional callable called with the previous and the new job id.
+    :return: The new load job, or None if it could not be submitted.
+    """
+    error_result = load_job_details.error_result
+    if error_result.get("reason") in resilience.THROTTLING_REASONS:
+        concurrency.on_throttle()
+    job_id = get_retry_job_id(load_job_details.job_id, attempt)
+    log.warning("Job {} failed with a transient error ({}), running it again as {}.".format(
+        load_job_details.job_id, error_result.get("message"), job_id))
+    metrics.increment("bigquery_job_retries", table=table_id, reason=error_result.get("reason"))
+    time.sleep(resilience.get_backoff_delay(attempt))
+    if on_job_retry:
+        on_job_retry(load_job_details.job_id, job_id)
+    try:
+        return submit_load_job(bigquery_client=bigquery_client, source_uris=source_uris, dataset_ref=dataset_ref,
+                               job_config=job_config, table_id=table_id, job_id=job_id,
+                               on_throttle=concurrency.on_throttle)
+    except exceptions.GoogleAPIError as error:
+        log.error("Could not run job {} again: {}".format(load_job_details.job_id, error))
+        if on_job_retry:
+            on_job_retry(job_id, load_job_details.job_id)
+        return None
+
+
+def record_load_job_metrics(table_id, result, load_job_details):
+    """
+    Method that records the statistics of a finished GCP BigQuery load job: its outcome, bytes, rows and slot time,
+    and how long it waited in the BigQuery queue and ran.
+
+    :param table_id: The table id.
+    :param result: The LoadJobResult of the job.
+    :param load_job_details: The finished load job.
+    """
+    metrics.increment("bigquery_jobs_finished", table=table_id, status="succeeded" if result.succeeded else "failed")
+    metrics.increment("bigquery_bytes_loaded", get_number(result.input_bytes) or 0, table=table_id)
+    metrics.increment("bigquery_rows_loaded", get_number(result.output_rows) or 0, table=table_id)
+    metrics.increment("bigquery_slot_millis", get_job_slot_millis(load_job_details) or 0, table=table_id)
+    created, started, ended = [getattr(load_job_details, name, None) for name in ("created", "started", "ended")]
+    if isinstance(created, datetime.datetime) and isinstance(started, datetime.datetime):
+        metrics.observe("bigquery_job_pending", (started - created).total_seconds(), table=table_id)
+    if isinstance(started, datetime.datetime) and isinstance(ended, datetime.datetime):
+        metrics.observe("bigquery_job_running", (ended - started).total_seconds(), table=table_id)
+
+
+def get_job_slot_millis(load_job_details):
+    """
+    Method that gets the slot milliseconds consumed by a GCP BigQuery job, from its statistics.
+
+    :param load_job_details: The finished job.
+    :return: The slot milliseconds, or None when they are not reported.
+    """
+    slot_millis = get_number(getattr(load_job_details, "slot_millis", None))
+    if slot_millis is None:
+        job_properties = getattr(load_job_details, "_properties", None)
+        if isinstance(job_properties, dict):
+            slot_millis = get_number(job_properties.get("statistics", {}).get("totalSlotMs"))
+    return slot_millis
+
+
+def get_number(value):
+    """
+    Method that reads a job statistic, reported as a number or as a numeric string.
+
+    :param value: The statistic.
+    :return: The integer value, or None when the statistic is missing or not numeric.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+def log_load_jobs_report(table_id, list_of_results):
+    """
+    Method that logs the per job success or failure of a set of GCP BigQuery load jobs.
+
+    :param table_id: The table id.
+    :param list_of_results: The list of LoadJobResult.
     """
-    uri = "gs://{}/{}".format(bucket_name, file_name)
-    load_job_details = bigquery_client.load_table_from_uri(uri, dataset_ref.table(table_id), job_config=job_config)
-    log.info("Starting job {}".format(load_job_details.job_id))
-    load_job_details.result()
-    log.info("Job finished.")
-    destination_table = bigquery_client.get_table(dataset_ref.table(table_id))
-    log.info("Loaded {} rows.".format(destination_table.num_rows))
+    failed = [result for result in list_of_results if not result.succeeded]
+    log.info("Table {}: {} of {} load jobs succeeded.".format(table_id, len(list_of_results) - len(failed),
+                                                             len(list_of_results)))
+    for result in failed:
+        log.error("Table {}: job {} for {} failed: {}".format(table_id, result.job_id, result.source_uris,
+                                                             result.error))
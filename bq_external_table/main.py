@@ -1,22 +1,356 @@
-from bq_external_table import gcp_interfacer
-from bq_external_table.set_run_variables import set_run_variables
+import asyncio
+import json
+import os
+import signal
+import threading
+
+from bq_external_table import async_interfacer, bulk_uploader, gcp_clients, gcp_interfacer, manifest, metrics
+from bq_external_table import partitioning, planner, preprocessing, resilience, scheduler, sharding, watcher
+from bq_external_table.set_run_variables import set_run_variables, set_datasets, set_load_options
 from bq_external_table.utils import logger, utils_functions
 from bq_external_table.utils import args_parser
 
 log = logger.get_logger()
 
+IO_BACKEND_THREADS = "threads"
+IO_BACKEND_ASYNC = "async"
+
 
 def main():
     arguments = args_parser.parse_arguments()
-    log_location, credentials_file_path, dataset_name, buckets = set_run_variables(
-        json_config=utils_functions.load_json_config(path=arguments.json_config))
+    json_config = utils_functions.load_json_config(path=arguments.json_config)
+    log_location, credentials_file_path, _, _ = set_run_variables(json_config=json_config)
+    load_options = set_load_options(json_config=json_config)
+    setup_run(log_location=log_location, credentials_file_path=credentials_file_path, load_options=load_options)
+    if arguments.command == "merge-summaries":
+        return run_merge_summaries_command(arguments=arguments, load_options=load_options)
+    if arguments.command == "upload":
+        return run_upload_command(arguments=arguments, load_options=load_options)
+    datasets = set_datasets(json_config=json_config)
+    if arguments.shard:
+        datasets = sharding.select_shard(datasets=datasets, shard=arguments.shard,
+                                         shard_by=load_options.get("shard_by"))
+        log.info("Running shard {} of {}: {} tables.".format(arguments.shard.index, arguments.shard.count,
+                                                             len(scheduler.get_dataset_table_tasks(datasets))))
+    if arguments.command == "manifest":
+        return run_manifest_command(manifest_action=arguments.manifest_action,
+                                    datasets=datasets,
+                                    load_options=load_options)
+    load_options["refresh_schema_cache"] = arguments.refresh_schema_cache
+    if arguments.command == "watch":
+        return run_watch_command(arguments=arguments, datasets=datasets, load_options=load_options)
+    if arguments.processes:
+        load_options["worker_processes"] = arguments.processes
+    if arguments.plan:
+        return run_plan_command(datasets=datasets, load_options=load_options, plan_path=arguments.plan_path)
+    return load_datasets(datasets=datasets, load_options=load_options, log_location=log_location,
+                         credentials_file_path=credentials_file_path)
+
+
+def setup_run(log_location, credentials_file_path, load_options):
+    """
+    Method that sets up the logger, the GCP clients and the retries of a process.
+
+    :param log_location: The log file location.
+    :param credentials_file_path: The path of the GCP credentials file.
+    :param load_options: The dictionary with the load options.
+    """
     logger.setup_logger(log_location)
+    gcp_clients.configure_clients(pool_size=load_options.get("http_pool_size"))
+    resilience.configure(max_attempts=load_options.get("max_retry_attempts"),
+                         max_job_attempts=load_options.get("max_job_attempts"),
+                         initial_delay=load_options.get("retry_initial_delay"),
+                         max_delay=load_options.get("retry_max_delay"),
+                         storage_requests_per_second=load_options.get("storage_requests_per_second"),
+                         bigquery_requests_per_second=load_options.get("bigquery_requests_per_second"))
     gcp_interfacer.authenticate_gcp(credentials_file_path=credentials_file_path)
-    bigquery_client = gcp_interfacer.get_bigquery_client()
-    for bucket, blobs in buckets.items():
-        for blob_details in blobs:
-            gcp_interfacer.load_bucket_data_into_bigquery_external_table(bigquery_client=bigquery_client,
-                                                                         dataset_name=dataset_name,
-                                                                         bucket_name=bucket,
-                                                                         table_id=blob_details.get("table_name"),
-                                                                         blob_prefix=blob_details.get("blob_prefix"))
+
+
+def load_datasets(datasets, load_options, log_location=None, credentials_file_path=None):
+    """
+    Method that loads every configured bucket prefix of every data set into its BigQuery table. With more than one
+    worker_processes, the tables are split into shards loaded by separate processes, whose summaries and metrics
+    are merged.
+
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name.
+    :param load_options: The dictionary with the load options.
+    :param log_location: The log file location, set up again in the worker processes.
+    :param credentials_file_path: The path of the GCP credentials file, set up again in the worker processes.
+    :return: The process exit code, 1 if any table or load job failed.
+    """
+    manifest_path = load_options.get("manifest_path")
+    if manifest_path:
+        manifest.reconcile_pending_jobs(manifest_path=manifest_path,
+                                        bigquery_client=gcp_interfacer.get_bigquery_client())
+    worker_processes = load_options.get("worker_processes") or 1
+    with metrics.span("run", datasets=len(datasets), processes=worker_processes) as span_attributes:
+        if worker_processes > 1:
+            list_of_summaries = sharding.run_worker_processes(
+                datasets=datasets,
+                worker_processes=worker_processes,
+                run_worker=run_worker,
+                worker_arguments=(load_options, log_location, credentials_file_path),
+                shard_by=load_options.get("shard_by"))
+        else:
+            list_of_summaries = load_tables(table_tasks=scheduler.get_dataset_table_tasks(datasets=datasets),
+                                            load_options=load_options)
+        span_attributes.update(tables=len(list_of_summaries))
+    if load_options.get("history_path"):
+        planner.record_run_history(history_path=load_options.get("history_path"),
+                                   table_tasks=scheduler.get_dataset_table_tasks(datasets=datasets),
+                                   list_of_summaries=list_of_summaries,
+                                   load_options=load_options)
+    return report_run(list_of_summaries=list_of_summaries, load_options=load_options)
+
+
+def run_worker(datasets, load_options, log_location, credentials_file_path):
+    """
+    Method that loads one shard of the tables in a worker process.
+
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name, of the shard.
+    :param load_options: The dictionary with the load options.
+    :param log_location: The log file location.
+    :param credentials_file_path: The path of the GCP credentials file.
+    :return: The tuple with the list of TableSummary and the snapshot of the metrics of the worker.
+    """
+    setup_run(log_location=log_location, credentials_file_path=credentials_file_path, load_options=load_options)
+    metrics.reset()
+    list_of_summaries = load_tables(table_tasks=scheduler.get_dataset_table_tasks(datasets=datasets),
+                                    load_options=load_options)
+    return list_of_summaries, metrics.get_registry().snapshot()
+
+
+def load_tables(table_tasks, load_options):
+    """
+    Method that loads tables into BigQuery, running independent tables in parallel, on a pool of threads or, with
+    the "async" io_backend, on one event loop.
+
+    :param table_tasks: The list of TableTask, in the order they should start.
+    :param load_options: The dictionary with the load options.
+    :return: The list of TableSummary, in the order of table_tasks.
+    """
+    if load_options.get("io_backend") == IO_BACKEND_ASYNC:
+        return asyncio.run(async_interfacer.load_tables(table_tasks=table_tasks, load_options=load_options))
+
+    def load_table(table_task):
+        table_details = table_task.table_details
+        if table_details.get("table_type", load_options.get("table_type")) == gcp_interfacer.TABLE_TYPE_EXTERNAL:
+            return gcp_interfacer.create_or_update_external_table(
+                bigquery_client=gcp_interfacer.get_bigquery_client(),
+                dataset_name=table_task.dataset_name,
+                bucket_name=table_task.bucket_name,
+                table_id=table_details.get("table_name"),
+                blob_prefix=table_details.get("blob_prefix"),
+                source_format=table_details.get("source_format"),
+                hive_partitioning=table_details.get("hive_partitioning"),
+                csv_options=table_details.get("csv_options"),
+                schema_cache_path=load_options.get("schema_cache_path"),
+                refresh_schema_cache=load_options.get("refresh_schema_cache"),
+                schema_sample_bytes=load_options.get("schema_sample_bytes"))
+        if table_details.get("partitioning"):
+            return partitioning.load_table_task(table_task=table_task, load_options=load_options)
+        return gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+            bigquery_client=gcp_interfacer.get_bigquery_client(),
+            dataset_name=table_task.dataset_name,
+            bucket_name=table_task.bucket_name,
+            table_id=table_details.get("table_name"),
+            blob_prefix=table_details.get("blob_prefix"),
+            max_concurrent_jobs=load_options.get("max_concurrent_jobs"),
+            job_poll_interval=load_options.get("job_poll_interval"),
+            load_mode=table_details.get("load_mode", load_options.get("load_mode")),
+            max_uris_per_job=load_options.get("max_uris_per_job"),
+            max_bytes_per_job=load_options.get("max_bytes_per_job"),
+            blob_delimiter=table_details.get("blob_delimiter"),
+            blob_glob=table_details.get("blob_glob"),
+            manifest_path=load_options.get("manifest_path"),
+            schema_cache_path=load_options.get("schema_cache_path"),
+            refresh_schema_cache=load_options.get("refresh_schema_cache"),
+            schema_sample_bytes=load_options.get("schema_sample_bytes"))
+
+    def run_table(table_task):
+        with metrics.span("table_load", bucket=table_task.bucket_name,
+                          table=table_task.table_details.get("table_name")) as span_attributes:
+            list_of_results = load_table(table_task)
+            span_attributes.update(jobs=len(list_of_results),
+                                   failed_jobs=len([result for result in list_of_results if not result.succeeded]),
+                                   input_bytes=sum(result.input_bytes or 0 for result in list_of_results),
+                                   output_rows=sum(result.output_rows or 0 for result in list_of_results))
+            return list_of_results
+
+    return scheduler.run_table_tasks(
+        table_tasks=table_tasks,
+        run_table=run_table,
+        max_concurrent_tables=load_options.get("max_concurrent_tables"),
+        max_concurrent_tables_per_bucket=load_options.get("max_concurrent_tables_per_bucket"))
+
+
+def report_run(list_of_summaries, load_options):
+    """
+    Method that logs and writes the summary and metrics of a run.
+
+    :param list_of_summaries: The list of TableSummary.
+    :param load_options: The dictionary with the load options.
+    :return: The process exit code, 1 if any table or load job failed.
+    """
+    scheduler.log_run_summary(list_of_summaries=list_of_summaries)
+    if load_options.get("summary_path"):
+        scheduler.write_run_summary(summary_path=load_options.get("summary_path"),
+                                    list_of_summaries=list_of_summaries)
+    write_metrics(load_options=load_options)
+    failed_tables = [summary for summary in list_of_summaries if summary.error or summary.failed_jobs]
+    if failed_tables:
+        log.error("{} tables had failures.".format(len(failed_tables)))
+        return 1
+    return 0
+
+
+def write_metrics(load_options):
+    """
+    Method that exports the metrics of the run to the configured JSON-lines and Prometheus text files.
+
+    :param load_options: The dictionary with the load options.
+    """
+    if load_options.get("metrics_path"):
+        metrics.write_json_lines(metrics_path=load_options.get("metrics_path"))
+    if load_options.get("prometheus_path"):
+        metrics.write_prometheus(prometheus_path=load_options.get("prometheus_path"))
+
+
+def run_manifest_command(manifest_action, datasets, load_options):
+    """
+    Method that inspects or rebuilds the manifest of ingested blobs.
+
+    :param manifest_action: "inspect" or "rebuild".
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name.
+    :param load_options: The dictionary with the load options.
+    :return: The process exit code.
+    """
+    manifest_path = load_options.get("manifest_path")
+    if not manifest_path:
+        log.error("The config has no manifest_path.")
+        return 1
+    if manifest_action == "rebuild":
+        for table_task in scheduler.get_dataset_table_tasks(datasets=datasets):
+            table_details = table_task.table_details
+            table_key = manifest.get_table_key(dataset_name=table_task.dataset_name,
+                                               table_id=table_details.get("table_name"))
+            recorded = manifest.rebuild_table(manifest_path=manifest_path,
+                                              bucket_name=table_task.bucket_name,
+                                              table_key=table_key,
+                                              list_of_blob_details=gcp_interfacer.iter_blob_details(
+                                                  bucket_name=table_task.bucket_name,
+                                                  blob_prefix=table_details.get("blob_prefix"),
+                                                  delimiter=table_details.get("blob_delimiter"),
+                                                  match_glob=table_details.get("blob_glob")))
+            log.info("Recorded {} blobs of bucket {} as loaded into {}.".format(recorded, table_task.bucket_name,
+                                                                               table_key))
+    for table_key, bucket, status, blob_count, updated_at in manifest.inspect(manifest_path=manifest_path):
+        log.info("{} <- gs://{}: {} {} blobs, last updated {}.".format(
+            table_key, bucket, blob_count, status, utils_functions.format_timestamp(updated_at)))
+    return 0
+
+
+def run_plan_command(datasets, load_options, plan_path=None):
+    """
+    Method that plans the load of every table without submitting any load job, from the metadata of the blobs and
+    the timings recorded in the history_path by earlier runs.
+
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name.
+    :param load_options: The dictionary with the load options.
+    :param plan_path: Optional local path the JSON plan is written to, printed when missing.
+    :return: The process exit code, 1 if any table could not be planned.
+    """
+    list_of_table_plans = planner.plan_tables(table_tasks=scheduler.get_dataset_table_tasks(datasets=datasets),
+                                              load_options=load_options,
+                                              history=planner.read_history(load_options.get("history_path")))
+    plan = planner.get_run_plan(list_of_table_plans=list_of_table_plans, load_options=load_options)
+    planner.log_plan(plan)
+    if plan_path:
+        planner.write_plan(plan_path=plan_path, plan=plan)
+    else:
+        print(json.dumps(plan, indent=2))
+    return 1 if any(table_plan.error for table_plan in list_of_table_plans) else 0
+
+
+def run_merge_summaries_command(arguments, load_options):
+    """
+    Method that merges the run summaries written by the shards of a run, e.g. on separate hosts, into one.
+
+    :param arguments: The parsed arguments of the merge-summaries command.
+    :param load_options: The dictionary with the load options.
+    :return: The process exit code, 1 if any table or load job of any shard failed.
+    """
+    list_of_summaries = [summary for summary_path in arguments.summary_paths
+                         for summary in scheduler.read_run_summary(summary_path=summary_path)]
+    log.info("Merged {} summaries, {} tables.".format(len(arguments.summary_paths), len(list_of_summaries)))
+    return report_run(list_of_summaries=list_of_summaries,
+                      load_options=dict(load_options, summary_path=arguments.output_path or
+                                        load_options.get("summary_path"), metrics_path=None, prometheus_path=None))
+
+
+def run_watch_command(arguments, datasets, load_options):
+    """
+    Method that keeps the configured tables fresh until the process is interrupted, loading their new objects in
+    micro-batches as their notifications arrive or as incremental listings find them.
+
+    :param arguments: The parsed arguments of the watch command.
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name.
+    :param load_options: The dictionary with the load options.
+    :return: The process exit code, 1 if any micro-batch failed.
+    """
+    watch_options = dict(load_options.get("watch") or {})
+    if arguments.subscription:
+        watch_options["subscription"] = arguments.subscription
+    if arguments.batch_window is not None:
+        watch_options["batch_window_seconds"] = arguments.batch_window
+    manifest_path = load_options.get("manifest_path")
+    if manifest_path:
+        manifest.reconcile_pending_jobs(manifest_path=manifest_path,
+                                        bigquery_client=gcp_interfacer.get_bigquery_client())
+    table_tasks = scheduler.get_dataset_table_tasks(datasets=datasets)
+    stop_event = threading.Event()
+
+    def stop(signal_number, _):
+        log.info("Received signal {}, loading the pending micro-batches before stopping.".format(signal_number))
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    list_of_summaries = watcher.watch(table_tasks=table_tasks,
+                                      source=watcher.get_notification_source(table_tasks=table_tasks,
+                                                                             watch_options=watch_options,
+                                                                             load_options=load_options),
+                                      load_options=load_options,
+                                      watch_options=watch_options,
+                                      stop_event=stop_event,
+                                      exit_when_idle=arguments.exit_when_idle)
+    return report_run(list_of_summaries=list_of_summaries, load_options=load_options)
+
+
+def run_upload_command(arguments, load_options):
+    """
+    Method that uploads a local directory to a bucket.
+
+    :param arguments: The parsed arguments of the upload command.
+    :param load_options: The dictionary with the load options.
+    :return: The process exit code, 1 if any file failed to upload or was quarantined by the preprocessing.
+    """
+    source_dir = arguments.source_dir
+    list_of_preprocess_results = []
+    if getattr(arguments, "preprocess", None):
+        preprocessing_options = dict(load_options.get("preprocessing") or {})
+        preprocessing_options.setdefault("output_dir", source_dir.rstrip(os.sep) + "_preprocessed")
+        list_of_preprocess_results = preprocessing.preprocess_directory(source_dir=source_dir,
+                                                                        output_format=arguments.preprocess,
+                                                                        **preprocessing_options)
+        source_dir = preprocessing_options["output_dir"]
+    list_of_results = bulk_uploader.upload_directory(bucket_name=arguments.bucket_name,
+                                                     source_dir=source_dir,
+                                                     destination_prefix=arguments.destination_prefix,
+                                                     max_concurrent_uploads=arguments.max_concurrent_uploads,
+                                                     chunk_size=arguments.chunk_size_mb * 1024 * 1024,
+                                                     skip_existing=arguments.skip_existing,
+                                                     state_path=arguments.state_path)
+    write_metrics(load_options=load_options)
+    return 1 if any(result.status == bulk_uploader.STATUS_FAILED for result in list_of_results) or \
+        any(result.status == preprocessing.STATUS_QUARANTINED for result in list_of_preprocess_results) else 0
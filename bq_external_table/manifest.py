@@ -0,0 +1,247 @@
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+
+from google.api_core import exceptions
+
+from bq_external_table import resilience
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+STATUS_PENDING = "pending"
+STATUS_LOADED = "loaded"
+FILTER_CHUNK_SIZE = 500
+
+CREATE_INGESTED_BLOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS ingested_blobs (
+    bucket_name TEXT NOT NULL,
+    blob_name TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    md5_hash TEXT,
+    table_key TEXT NOT NULL,
+    job_id TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    location TEXT,
+    PRIMARY KEY (bucket_name, blob_name, generation, table_key)
+)
+"""
+CREATE_JOB_ID_INDEX = "CREATE INDEX IF NOT EXISTS ingested_blobs_job_id ON ingested_blobs (job_id)"
+
+
+def connect(manifest_path):
+    """
+    Method that opens the manifest of ingested blobs, creating it if needed.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :return: The SQLite connection.
+    """
+    connection = sqlite3.connect(manifest_path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(CREATE_INGESTED_BLOBS_TABLE)
+    # Manifests written before the location of the jobs was recorded get the column, NULL for their old jobs.
+    if "location" not in [column[1] for column in connection.execute("PRAGMA table_info(ingested_blobs)")]:
+        connection.execute("ALTER TABLE ingested_blobs ADD COLUMN location TEXT")
+    connection.execute(CREATE_JOB_ID_INDEX)
+    return connection
+
+
+def get_table_key(dataset_name, table_id):
+    """
+    Method that gets the key of a BigQuery table in the manifest.
+
+    :param dataset_name: The name of the data set.
+    :param table_id: The table id.
+    :return: The table key.
+    """
+    return "{}.{}".format(dataset_name, table_id)
+
+
+def new_job_id():
+    """
+    Method that generates the id of a load job, so that it can be recorded before the job is submitted.
+
+    :return: The job id.
+    """
+    return "bq_external_table_load_{}".format(uuid.uuid4().hex)
+
+
+def filter_new_blobs(manifest_path, bucket_name, table_key, list_of_blob_details):
+    """
+    Method that lazily filters out the blobs already loaded into a table. A blob is considered loaded when the
+    manifest has the same object name with the same generation or the same md5 hash.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param bucket_name: The bucket name.
+    :param table_key: The table key.
+    :param list_of_blob_details: An iterable of BlobDetails.
+    :return: A generator of the BlobDetails that still need to be loaded.
+    """
+    chunk = []
+    for blob_details in list_of_blob_details:
+        chunk.append(blob_details)
+        if len(chunk) >= FILTER_CHUNK_SIZE:
+            for new_blob_details in filter_new_blobs_chunk(manifest_path, bucket_name, table_key, chunk):
+                yield new_blob_details
+            chunk = []
+    for new_blob_details in filter_new_blobs_chunk(manifest_path, bucket_name, table_key, chunk):
+        yield new_blob_details
+
+
+def filter_new_blobs_chunk(manifest_path, bucket_name, table_key, chunk):
+    """
+    Method that filters out the blobs of a chunk that were already loaded into a table.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param bucket_name: The bucket name.
+    :param table_key: The table key.
+    :param chunk: The list of BlobDetails.
+    :return: The list of the BlobDetails that still need to be loaded.
+    """
+    if not chunk:
+        return []
+    with closing(connect(manifest_path)) as connection:
+        rows = connection.execute(
+            "SELECT blob_name, generation, md5_hash FROM ingested_blobs "
+            "WHERE bucket_name = ? AND table_key = ? AND status = ? AND blob_name IN ({})".format(
+                ",".join("?" * len(chunk))),
+            [bucket_name, table_key, STATUS_LOADED] + [blob_details.name for blob_details in chunk]).fetchall()
+    loaded_generations = {(blob_name, generation) for blob_name, generation, _ in rows}
+    loaded_md5_hashes = {(blob_name, md5_hash) for blob_name, _, md5_hash in rows if md5_hash}
+    return [blob_details for blob_details in chunk
+            if (blob_details.name, blob_details.generation) not in loaded_generations
+            and (blob_details.name, blob_details.md5_hash) not in loaded_md5_hashes]
+
+
+def mark_pending(manifest_path, bucket_name, table_key, job_id, list_of_blob_details, location=None):
+    """
+    Method that records the blobs about to be loaded by a job, before the job is submitted.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param bucket_name: The bucket name.
+    :param table_key: The table key.
+    :param job_id: The id of the load job.
+    :param list_of_blob_details: The list of BlobDetails loaded by the job.
+    :param location: The location the job runs in, the one of its data set, needed to find a job of a regional data
+    set again.
+    """
+    updated_at = time.time()
+    with closing(connect(manifest_path)) as connection, connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO ingested_blobs "
+            "(bucket_name, blob_name, generation, md5_hash, table_key, job_id, status, updated_at, location) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(bucket_name, blob_details.name, blob_details.generation or 0, blob_details.md5_hash, table_key, job_id,
+              STATUS_PENDING, updated_at, location) for blob_details in list_of_blob_details])
+
+
+def mark_loaded(manifest_path, job_id):
+    """
+    Method that records the blobs of a successful load job as loaded.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param job_id: The id of the load job.
+    """
+    with closing(connect(manifest_path)) as connection, connection:
+        connection.execute("UPDATE ingested_blobs SET status = ?, updated_at = ? WHERE job_id = ?",
+                           (STATUS_LOADED, time.time(), job_id))
+
+
+def move_job(manifest_path, job_id, new_job_id):
+    """
+    Method that moves the pending blobs of a load job to the job that runs it again.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param job_id: The id of the previous load job.
+    :param new_job_id: The id of the new load job.
+    """
+    with closing(connect(manifest_path)) as connection, connection:
+        connection.execute("UPDATE ingested_blobs SET job_id = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                           (new_job_id, time.time(), job_id, STATUS_PENDING))
+
+
+def discard_job(manifest_path, job_id):
+    """
+    Method that removes the blobs of a failed or missing load job, so that the next run loads them again.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param job_id: The id of the load job.
+    """
+    with closing(connect(manifest_path)) as connection, connection:
+        connection.execute("DELETE FROM ingested_blobs WHERE job_id = ? AND status = ?", (job_id, STATUS_PENDING))
+
+
+def reconcile_pending_jobs(manifest_path, bigquery_client):
+    """
+    Method that settles the load jobs left pending by an interrupted run. Jobs that finished successfully have their
+    blobs marked as loaded, jobs that failed or were never created have their blobs removed from the manifest, and
+    jobs still running are waited for. Jobs whose state cannot be got keep their blobs pending until the next run.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param bigquery_client: The GCP BigQuery client.
+    """
+    with closing(connect(manifest_path)) as connection:
+        pending_jobs = connection.execute(
+            "SELECT DISTINCT job_id, location FROM ingested_blobs WHERE status = ?", (STATUS_PENDING,)).fetchall()
+    for job_id, location in pending_jobs:
+        load_job_details = None
+        try:
+            load_job_details = resilience.call_with_retry(api=resilience.API_BIGQUERY, function=bigquery_client.get_job,
+                                                          args=(job_id,), kwargs={"location": location})
+            if not resilience.call_with_retry(api=resilience.API_BIGQUERY, function=load_job_details.done):
+                log.info("Waiting for pending job {}.".format(job_id))
+                load_job_details.result()
+        except exceptions.NotFound:
+            log.info("Pending job {} was never created.".format(job_id))
+            discard_job(manifest_path=manifest_path, job_id=job_id)
+            continue
+        except (exceptions.GoogleAPIError,) + resilience.RETRYABLE_EXCEPTIONS as error:
+            # A failed job raises from result() with its error result set, anything else leaves its state unknown
+            if load_job_details is None or not load_job_details.error_result:
+                log.error("Could not settle pending job {}, its blobs stay pending: {}".format(job_id, error))
+                continue
+        if load_job_details.error_result:
+            log.info("Pending job {} failed, its blobs will be loaded again.".format(job_id))
+            discard_job(manifest_path=manifest_path, job_id=job_id)
+        else:
+            log.info("Pending job {} succeeded.".format(job_id))
+            mark_loaded(manifest_path=manifest_path, job_id=job_id)
+
+
+def rebuild_table(manifest_path, bucket_name, table_key, list_of_blob_details):
+    """
+    Method that replaces the manifest entries of a table with the given blobs, all marked as loaded. Used when a table
+    already holds the data of the blobs currently in the bucket.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :param bucket_name: The bucket name.
+    :param table_key: The table key.
+    :param list_of_blob_details: An iterable of BlobDetails.
+    :return: The number of blobs recorded.
+    """
+    updated_at = time.time()
+    with closing(connect(manifest_path)) as connection, connection:
+        connection.execute("DELETE FROM ingested_blobs WHERE bucket_name = ? AND table_key = ?",
+                           (bucket_name, table_key))
+        cursor = connection.executemany(
+            "INSERT OR REPLACE INTO ingested_blobs "
+            "(bucket_name, blob_name, generation, md5_hash, table_key, job_id, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, NULL, ?, ?)",
+            ((bucket_name, blob_details.name, blob_details.generation or 0, blob_details.md5_hash, table_key,
+              STATUS_LOADED, updated_at) for blob_details in list_of_blob_details))
+        return cursor.rowcount
+
+
+def inspect(manifest_path):
+    """
+    Method that summarises the manifest contents.
+
+    :param manifest_path: The local path of the SQLite manifest file.
+    :return: The list of (table key, bucket name, status, number of blobs, last update time) tuples.
+    """
+    with closing(connect(manifest_path)) as connection:
+        return connection.execute(
+            "SELECT table_key, bucket_name, status, COUNT(*), MAX(updated_at) FROM ingested_blobs "
+            "GROUP BY table_key, bucket_name, status ORDER BY table_key, bucket_name, status").fetchall()
@@ -0,0 +1,284 @@
+import functools
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+PROMETHEUS_PREFIX = "bq_external_table_"
+INVALID_METRIC_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe store of the counters, timers and spans of a run. Counters and timers are aggregated per name and
+    labels, so their memory does not grow with the number of calls, while every span is kept as an event.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._spans = []
+
+    def increment(self, name, value=1, **labels):
+        """
+        Method that adds a value to a counter.
+
+        :param name: The counter name.
+        :param value: The value to add.
+        :param labels: The labels of the counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Method that records one duration of a timer.
+
+        :param name: The timer name.
+        :param seconds: The measured duration.
+        :param labels: The labels of the timer.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            count, total, maximum = self._timers.get(key, (0, 0.0, 0.0))
+            self._timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def add_span(self, span_event):
+        """
+        Method that records a finished span.
+
+        :param span_event: The dictionary describing the span.
+        """
+        with self._lock:
+            self._spans.append(span_event)
+
+    def merge(self, snapshot):
+        """
+        Method that adds the metrics of another registry, e.g. the one of a worker process.
+
+        :param snapshot: The snapshot of the other registry.
+        """
+        counters, timers, spans = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (count, total, maximum) in timers.items():
+                merged_count, merged_total, merged_maximum = self._timers.get(key, (0, 0.0, 0.0))
+                self._timers[key] = (merged_count + count, merged_total + total, max(merged_maximum, maximum))
+            self._spans.extend(spans)
+
+    def get_counter(self, name, **labels):
+        """
+        Method that gets the value of a counter.
+
+        :return: The counter value, 0 if it was never incremented.
+        """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_timer(self, name, **labels):
+        """
+        Method that gets the aggregated durations of a timer.
+
+        :return: The tuple with the number of observations, their total and their maximum, in seconds.
+        """
+        with self._lock:
+            return self._timers.get((name, tuple(sorted(labels.items()))), (0, 0.0, 0.0))
+
+    def snapshot(self):
+        """
+        Method that gets a consistent copy of every metric.
+
+        :return: The tuple with the counters and timers dictionaries, keyed by (name, labels), and the list of spans.
+        """
+        with self._lock:
+            return dict(self._counters), dict(self._timers), list(self._spans)
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    """
+    Method that gets the registry the metrics of the run are recorded in.
+
+    :return: The MetricsRegistry.
+    """
+    return _registry
+
+
+def reset():
+    """
+    Method that discards every recorded metric.
+    """
+    global _registry
+    _registry = MetricsRegistry()
+
+
+def increment(name, value=1, **labels):
+    """
+    Method that adds a value to a counter of the current registry.
+
+    :param name: The counter name.
+    :param value: The value to add.
+    :param labels: The labels of the counter.
+    """
+    _registry.increment(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    """
+    Method that records one duration of a timer of the current registry.
+
+    :param name: The timer name.
+    :param seconds: The measured duration.
+    :param labels: The labels of the timer.
+    """
+    _registry.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Context manager that times the block it wraps, whether it succeeds or raises.
+
+    :param name: The timer name.
+    :param labels: The labels of the timer.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name):
+    """
+    Decorator that times every call of a function.
+
+    :param name: The timer name.
+    :return: The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Context manager that records the block it wraps as a span, e.g. the load of one table. The block can add
+    attributes to the yielded dictionary, e.g. the number of loaded rows. The duration is also recorded as a timer.
+
+    :param name: The span name.
+    :param labels: The labels of the span.
+    """
+    attributes = {}
+    start_time = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attributes
+    except Exception as exception:
+        error = str(exception)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        observe(name, duration, **labels)
+        _registry.add_span({"type": "span", "name": name, "labels": labels, "start": start_time,
+                            "duration": duration, "attributes": attributes, "error": error})
+
+
+def write_json_lines(metrics_path):
+    """
+    Method that writes every metric as a JSON-lines file: one line per span, then one line per counter and timer.
+
+    :param metrics_path: The local path of the JSON-lines file.
+    """
+    counters, timers, spans = _registry.snapshot()
+    with open(metrics_path, "w") as metrics_file:
+        for span_event in spans:
+            metrics_file.write(json.dumps(span_event, default=str) + "\n")
+        for (name, labels), value in sorted(counters.items()):
+            metrics_file.write(json.dumps({"type": "counter", "name": name, "labels": dict(labels),
+                                           "value": value}) + "\n")
+        for (name, labels), (count, total, maximum) in sorted(timers.items()):
+            metrics_file.write(json.dumps({"type": "timer", "name": name, "labels": dict(labels), "count": count,
+                                           "sum_seconds": total, "max_seconds": maximum}) + "\n")
+    log.info("Metrics written to {}.".format(metrics_path))
+
+
+def format_prometheus():
+    """
+    Method that formats the counters and timers in the Prometheus text exposition format. Counters are exposed with a
+    "_total" suffix and timers as summaries in seconds, with an extra "_max" gauge.
+
+    :return: The Prometheus text.
+    """
+    counters, timers, _ = _registry.snapshot()
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        metric_name = get_prometheus_name(name) + "_total"
+        lines.append("# TYPE {} counter".format(metric_name))
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append("{}{} {}".format(metric_name, format_prometheus_labels(labels), value))
+    for name in sorted({name for name, _ in timers}):
+        metric_name = get_prometheus_name(name) + "_seconds"
+        lines.append("# TYPE {} summary".format(metric_name))
+        maximums = []
+        for (timer_name, labels), (count, total, maximum) in sorted(timers.items()):
+            if timer_name == name:
+                lines.append("{}_count{} {}".format(metric_name, format_prometheus_labels(labels), count))
+                lines.append("{}_sum{} {}".format(metric_name, format_prometheus_labels(labels), total))
+                maximums.append("{}_max{} {}".format(metric_name, format_prometheus_labels(labels), maximum))
+        lines.append("# TYPE {}_max gauge".format(metric_name))
+        lines.extend(maximums)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(prometheus_path):
+    """
+    Method that writes the counters and timers as a Prometheus text file, e.g. for the node exporter textfile
+    collector.
+
+    :param prometheus_path: The local path of the Prometheus text file.
+    """
+    with open(prometheus_path, "w") as prometheus_file:
+        prometheus_file.write(format_prometheus())
+    log.info("Prometheus metrics written to {}.".format(prometheus_path))
+
+
+def get_prometheus_name(name):
+    """
+    Method that gets a valid Prometheus metric name.
+
+    :param name: The metric name.
+    :return: The prefixed metric name.
+    """
+    return PROMETHEUS_PREFIX + INVALID_METRIC_NAME_CHARACTERS.sub("_", name)
+
+
+def format_prometheus_labels(labels):
+    """
+    Method that formats the labels of a Prometheus sample.
+
+    :param labels: The sorted tuple of (label, value) pairs.
+    :return: The formatted labels, an empty string when there is none.
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(INVALID_METRIC_NAME_CHARACTERS.sub("_", label),
+                                           str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                          for label, value in labels) + "}"
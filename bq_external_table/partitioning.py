@@ -0,0 +1,345 @@
+import datetime
+import itertools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import bigquery
+
+from bq_external_table import blob_catalog, gcp_interfacer, metrics
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+PARTITION_TYPE_HOUR = "HOUR"
+PARTITION_TYPE_DAY = gcp_interfacer.PARTITION_TYPE_DAY
+PARTITION_TYPE_MONTH = "MONTH"
+PARTITION_TYPE_YEAR = "YEAR"
+DECORATOR_FORMATS = {PARTITION_TYPE_HOUR: "%Y%m%d%H", PARTITION_TYPE_DAY: "%Y%m%d", PARTITION_TYPE_MONTH: "%Y%m",
+                     PARTITION_TYPE_YEAR: "%Y"}
+DEFAULT_DATE_FORMAT = "%Y-%m-%d"
+DEFAULT_MAX_CONCURRENT_PARTITIONS = 4
+
+Partition = namedtuple("Partition", ["value", "start", "decorator", "blobs"])
+
+
+def truncate(moment, partition_type):
+    """
+    Method that truncates a datetime to the start of its partition.
+
+    :param moment: The datetime.
+    :param partition_type: HOUR, DAY, MONTH or YEAR.
+    :return: The datetime of the start of the partition.
+    """
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if partition_type == PARTITION_TYPE_HOUR:
+        return moment
+    moment = moment.replace(hour=0)
+    if partition_type == PARTITION_TYPE_MONTH:
+        return moment.replace(day=1)
+    if partition_type == PARTITION_TYPE_YEAR:
+        return moment.replace(month=1, day=1)
+    return moment
+
+
+def get_next_partition_start(partition_start, partition_type):
+    """
+    Method that gets the start of the partition following another one.
+
+    :param partition_start: The datetime of the start of the partition.
+    :param partition_type: HOUR, DAY, MONTH or YEAR.
+    :return: The datetime of the start of the next partition.
+    """
+    if partition_type == PARTITION_TYPE_HOUR:
+        return partition_start + datetime.timedelta(hours=1)
+    if partition_type == PARTITION_TYPE_MONTH:
+        return partition_start.replace(year=partition_start.year + partition_start.month // 12,
+                                       month=partition_start.month % 12 + 1)
+    if partition_type == PARTITION_TYPE_YEAR:
+        return partition_start.replace(year=partition_start.year + 1)
+    return partition_start + datetime.timedelta(days=1)
+
+
+def get_partition_start(value, date_format=DEFAULT_DATE_FORMAT, partition_type=PARTITION_TYPE_DAY):
+    """
+    Method that parses the value of a hive partition, e.g. "2020-01-01" of "dt=2020-01-01", into the start of its
+    partition.
+
+    :param value: The partition value.
+    :param date_format: The strptime format of the values.
+    :param partition_type: HOUR, DAY, MONTH or YEAR.
+    :return: The datetime of the start of the partition, or None when the value does not match the format.
+    """
+    try:
+        return truncate(datetime.datetime.strptime(value, date_format), partition_type)
+    except ValueError:
+        return None
+
+
+def get_partition_decorator(partition_start, partition_type=PARTITION_TYPE_DAY):
+    """
+    Method that gets the BigQuery partition decorator of a partition, e.g. "20200101" for a DAY partition.
+
+    :param partition_start: The datetime of the start of the partition.
+    :param partition_type: HOUR, DAY, MONTH or YEAR.
+    :return: The partition decorator, without the "$".
+    """
+    return partition_start.strftime(DECORATOR_FORMATS[partition_type])
+
+
+def get_partitioned_table_id(table_id, decorator):
+    """
+    Method that gets the id of one partition of a table, e.g. "events$20200101".
+
+    :param table_id: The table id.
+    :param decorator: The partition decorator.
+    :return: The table id with the partition decorator.
+    """
+    return "{}${}".format(table_id, decorator)
+
+
+def get_date_range(partitioning, today=None):
+    """
+    Method that gets the range of partitions selected by a partitioning config, from its ISO "start_date" and
+    "end_date", both inclusive, or from its "last_days", the number of days up to and including today.
+
+    :param partitioning: The partitioning dictionary of a table.
+    :param today: Optional datetime of the current day, in UTC, used by "last_days".
+    :return: The tuple with the first and the last partition start, each one None when unbounded.
+    """
+    partition_type = partitioning.get("partition_type", PARTITION_TYPE_DAY)
+    start = end = None
+    if partitioning.get("start_date"):
+        start = truncate(datetime.datetime.fromisoformat(partitioning.get("start_date")), partition_type)
+    if partitioning.get("end_date"):
+        end = truncate(datetime.datetime.fromisoformat(partitioning.get("end_date")), partition_type)
+    if partitioning.get("last_days"):
+        today = today or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        start = truncate(today - datetime.timedelta(days=partitioning.get("last_days") - 1), partition_type)
+        end = end or truncate(today, partition_type)
+    return start, end
+
+
+def iter_partition_starts(start, end, partition_type=PARTITION_TYPE_DAY):
+    """
+    Method that iterates over the partitions of a bounded range.
+
+    :param start: The datetime of the first partition start.
+    :param end: The datetime of the last partition start.
+    :param partition_type: HOUR, DAY, MONTH or YEAR.
+    :return: A generator of the datetimes of the partition starts.
+    """
+    partition_start = start
+    while partition_start <= end:
+        yield partition_start
+        partition_start = get_next_partition_start(partition_start, partition_type)
+
+
+def get_partition_catalog(bucket_name, blob_prefix, partitioning, blob_delimiter=None, blob_glob=None, today=None):
+    """
+    Method that lists the blobs a partitioned table could load into a BlobCatalog.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix of the blobs of the table.
+    :param partitioning: The partitioning dictionary of the table.
+    :param blob_delimiter: Optional delimiter of the listing.
+    :param blob_glob: Optional glob pattern the object names must match.
+    :param today: Optional datetime of the current day, in UTC.
+    :return: The BlobCatalog.
+    """
+    return blob_catalog.BlobCatalog.from_pages(
+        bucket_name=bucket_name,
+        pages=iter_partition_pages(bucket_name=bucket_name, blob_prefix=blob_prefix, partitioning=partitioning,
+                                   blob_delimiter=blob_delimiter, blob_glob=blob_glob, today=today))
+
+
+def iter_partition_pages(bucket_name, blob_prefix, partitioning, blob_delimiter=None, blob_glob=None, today=None):
+    """
+    Method that lists the blobs a partitioned table could load, one page at a time. With "list_partitions" and a
+    bounded date range, only the "<blob_prefix><key>=<value>/" folders of the partitions in the range are listed,
+    instead of the whole history under the prefix.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix of the blobs of the table, the folder holding the partition folders when
+    "list_partitions" is set.
+    :param partitioning: The partitioning dictionary of the table.
+    :param blob_delimiter: Optional delimiter of the listing.
+    :param blob_glob: Optional glob pattern the object names must match.
+    :param today: Optional datetime of the current day, in UTC.
+    :return: An iterator of lists of BlobDetails, one list per page.
+    """
+    start, end = get_date_range(partitioning=partitioning, today=today)
+    if not (partitioning.get("list_partitions") and start and end):
+        return gcp_interfacer.iter_blob_pages(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                              delimiter=blob_delimiter, match_glob=blob_glob)
+    partition_type = partitioning.get("partition_type", PARTITION_TYPE_DAY)
+    date_format = partitioning.get("date_format", DEFAULT_DATE_FORMAT)
+    partition_prefixes = sorted(set("{}{}={}/".format(blob_prefix or "", partitioning["key"],
+                                                      partition_start.strftime(date_format))
+                                    for partition_start in iter_partition_starts(start, end, partition_type)))
+    log.info("Listing {} partition folders of gs://{}/{}.".format(len(partition_prefixes), bucket_name, blob_prefix))
+    return itertools.chain.from_iterable(
+        gcp_interfacer.iter_blob_pages(bucket_name=bucket_name, blob_prefix=partition_prefix,
+                                       delimiter=blob_delimiter, match_glob=blob_glob)
+        for partition_prefix in partition_prefixes)
+
+
+def discover_partitions(catalog, partitioning, today=None):
+    """
+    Method that groups the blobs of a catalog by the partition of their "<key>=<value>" path segment. Blobs outside
+    of any partition, with a value that is not a date of the "date_format", outside of the date range or not matching
+    the "filters" on the other partition keys, e.g. {"region": ["eu", "us"]}, are left out.
+
+    :param catalog: The BlobCatalog.
+    :param partitioning: The partitioning dictionary of the table.
+    :param today: Optional datetime of the current day, in UTC.
+    :return: The list of Partition, from the oldest to the newest.
+    """
+    partition_key = partitioning["key"]
+    partition_type = partitioning.get("partition_type", PARTITION_TYPE_DAY)
+    date_format = partitioning.get("date_format", DEFAULT_DATE_FORMAT)
+    start, end = get_date_range(partitioning=partitioning, today=today)
+    selection = catalog.filter(partitions=partitioning.get("filters")) if partitioning.get("filters") else catalog
+    partitions = []
+    for value, blobs in selection.group_by_partition(partition_key).items():
+        if value is blob_catalog.NO_PARTITION:
+            log.warning("Skipping {} blobs of gs://{} outside of a {}= partition.".format(
+                len(blobs), catalog.bucket_name, partition_key))
+            continue
+        partition_start = get_partition_start(value=value, date_format=date_format, partition_type=partition_type)
+        if partition_start is None:
+            log.warning("Skipping partition {}={} of gs://{}, not a {} date.".format(
+                partition_key, value, catalog.bucket_name, date_format))
+            continue
+        if (start and partition_start < start) or (end and partition_start > end):
+            continue
+        partitions.append(Partition(value=value, start=partition_start,
+                                    decorator=get_partition_decorator(partition_start, partition_type), blobs=blobs))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def load_partitioned_table(bigquery_client, dataset_name, bucket_name, table_id, blob_prefix, partitioning,
+                           max_concurrent_partitions=DEFAULT_MAX_CONCURRENT_PARTITIONS, blob_delimiter=None,
+                           blob_glob=None, today=None, **load_arguments):
+    """
+    Method that loads the hive partitions of a prefix, e.g. ".../dt=2020-01-01/", into the matching partitions of a
+    time partitioned and optionally clustered BigQuery table, e.g. "table$20200101". Each partition is loaded by its
+    own load jobs, and max_concurrent_partitions partitions are loaded at the same time.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param dataset_name: The name of the data set.
+    :param bucket_name: The name of the bucket.
+    :param table_id: The table id.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :param partitioning: The partitioning dictionary of the table, with the partition "key" of the paths and the
+    optional "date_format", "partition_type", "start_date", "end_date", "last_days", "filters", "list_partitions",
+    "field", "clustering_fields" and "write_disposition".
+    :param max_concurrent_partitions: The maximum number of partitions loaded at the same time.
+    :param blob_delimiter: Optional delimiter that restricts the load to the objects directly under the prefix.
+    :param blob_glob: Optional glob pattern the names of the objects to load must match.
+    :param today: Optional datetime of the current day, in UTC.
+    :param load_arguments: The other arguments of gcp_interfacer.load_bucket_data_into_bigquery_external_table.
+    :return: The list of LoadJobResult of every partition, from the oldest partition to the newest.
+    """
+    with get_partition_catalog(bucket_name=bucket_name, blob_prefix=blob_prefix, partitioning=partitioning,
+                               blob_delimiter=blob_delimiter, blob_glob=blob_glob, today=today) as catalog:
+        return load_catalog_partitions(bigquery_client=bigquery_client, dataset_name=dataset_name, catalog=catalog,
+                                       table_id=table_id, blob_prefix=blob_prefix, partitioning=partitioning,
+                                       max_concurrent_partitions=max_concurrent_partitions, today=today,
+                                       **load_arguments)
+
+
+def load_catalog_partitions(bigquery_client, dataset_name, catalog, table_id, blob_prefix, partitioning,
+                            max_concurrent_partitions=DEFAULT_MAX_CONCURRENT_PARTITIONS, today=None,
+                            **load_arguments):
+    """
+    Method that loads the blobs of a catalog, e.g. a listed prefix or a micro-batch of new objects, into the
+    partitions of a table they belong to. With the WRITE_TRUNCATE write disposition each partition is loaded by a
+    single batch job when possible, and it cannot be combined with a manifest, which only loads the new blobs of a
+    partition.
+
+    :param bigquery_client: The GCP BigQuery client.
+    :param dataset_name: The name of the data set.
+    :param catalog: The BlobCatalog of the blobs to load.
+    :param table_id: The table id.
+    :param blob_prefix: The string prefix of the blobs of the table.
+    :param partitioning: The partitioning dictionary of the table.
+    :param max_concurrent_partitions: The maximum number of partitions loaded at the same time.
+    :param today: Optional datetime of the current day, in UTC.
+    :param load_arguments: The other arguments of gcp_interfacer.load_bucket_data_into_bigquery_external_table.
+    :return: The list of LoadJobResult of every partition, from the oldest partition to the newest.
+    """
+    if partitioning.get("write_disposition") == bigquery.WriteDisposition.WRITE_TRUNCATE and \
+            load_arguments.get("manifest_path"):
+        raise ValueError("The WRITE_TRUNCATE write disposition of table {} replaces whole partitions with the new "
+                         "blobs of the manifest, remove the manifest or the write disposition.".format(table_id))
+    load_arguments["load_mode"] = get_partition_load_mode(partitioning=partitioning,
+                                                          load_mode=load_arguments.get("load_mode"))
+    bucket_name = catalog.bucket_name
+    partitions = discover_partitions(catalog=catalog, partitioning=partitioning, today=today)
+    if not partitions:
+        log.info("No partitions to load with prefix {} in bucket {}.".format(blob_prefix, bucket_name))
+        return []
+    log.info("Loading {} partitions of gs://{}/{} into table {}, from {} to {}.".format(
+        len(partitions), bucket_name, blob_prefix, table_id, partitions[0].decorator, partitions[-1].decorator))
+    metrics.increment("partitions_discovered", len(partitions), table=table_id)
+
+    def load_partition(partition):
+        return gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+            bigquery_client=bigquery_client,
+            dataset_name=dataset_name,
+            bucket_name=bucket_name,
+            table_id=get_partitioned_table_id(table_id=table_id, decorator=partition.decorator),
+            blob_prefix=blob_prefix,
+            list_of_blob_details=partition.blobs,
+            partitioning=partitioning,
+            **load_arguments)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent_partitions or 1, len(partitions)))) as executor:
+        return [result for list_of_results in executor.map(load_partition, partitions)
+                for result in list_of_results]
+
+
+def get_partition_load_mode(partitioning, load_mode):
+    """
+    Method that gets the load mode of the partitions of a table. Partitions replaced with WRITE_TRUNCATE are loaded
+    in batch mode, so that a single job replaces each partition when the job limits allow it.
+
+    :param partitioning: The partitioning dictionary of the table.
+    :param load_mode: The load mode of the table.
+    :return: LOAD_MODE_PER_BLOB or LOAD_MODE_BATCH.
+    """
+    if partitioning.get("write_disposition") == bigquery.WriteDisposition.WRITE_TRUNCATE:
+        return gcp_interfacer.LOAD_MODE_BATCH
+    return load_mode
+
+
+def load_table_task(table_task, load_options):
+    """
+    Method that loads the table of a TableTask with a "partitioning" config, using the load options of the run.
+
+    :param table_task: The TableTask.
+    :param load_options: The dictionary with the load options.
+    :return: The list of LoadJobResult of every partition.
+    """
+    table_details = table_task.table_details
+    table_partitioning = table_details.get("partitioning")
+    return load_partitioned_table(
+        bigquery_client=gcp_interfacer.get_bigquery_client(),
+        dataset_name=table_task.dataset_name,
+        bucket_name=table_task.bucket_name,
+        table_id=table_details.get("table_name"),
+        blob_prefix=table_details.get("blob_prefix"),
+        partitioning=table_partitioning,
+        max_concurrent_partitions=table_partitioning.get("max_concurrent_partitions",
+                                                         load_options.get("max_concurrent_partitions")),
+        blob_delimiter=table_details.get("blob_delimiter"),
+        blob_glob=table_details.get("blob_glob"),
+        max_concurrent_jobs=load_options.get("max_concurrent_jobs"),
+        job_poll_interval=load_options.get("job_poll_interval"),
+        load_mode=table_details.get("load_mode", load_options.get("load_mode")),
+        max_uris_per_job=load_options.get("max_uris_per_job"),
+        max_bytes_per_job=load_options.get("max_bytes_per_job"),
+        manifest_path=load_options.get("manifest_path"),
+        schema_cache_path=load_options.get("schema_cache_path"),
+        refresh_schema_cache=load_options.get("refresh_schema_cache"),
+        schema_sample_bytes=load_options.get("schema_sample_bytes"))
@@ -0,0 +1,386 @@
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from bq_external_table import blob_catalog, format_detection, gcp_interfacer, manifest, metrics, partitioning
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+# Used until a history_path holds the timings of earlier runs.
+DEFAULT_JOB_SECONDS = 30.0
+DEFAULT_JOB_BYTES = 1024 ** 3
+DEFAULT_LIST_PAGE_SECONDS = 0.2
+HISTORY_SAMPLES = 20
+TABLE_DAILY_LOAD_JOBS = 1500
+PROJECT_DAILY_LOAD_JOBS = 100000
+UNDETECTED_FORMAT = "UNDETECTED"
+
+TablePlan = namedtuple("TablePlan", ["dataset_name", "bucket_name", "table_id", "table_type", "blobs", "input_bytes",
+                                     "jobs", "partitions", "list_requests", "format_detection_reads", "skipped_blobs",
+                                     "largest_job_bytes", "estimated_seconds", "history_runs", "error"])
+JobTimings = namedtuple("JobTimings", ["seconds_per_job", "bytes_per_job", "runs"])
+
+
+def read_history(history_path):
+    """
+    Method that reads the timings recorded by earlier runs.
+
+    :param history_path: The local path of the JSON history file, possibly None or missing.
+    :return: The dictionary with the "tables" samples, [jobs, input bytes, job seconds] per run and table key, and
+    the average "list_page_seconds".
+    """
+    if not history_path or not os.path.exists(history_path):
+        return {"tables": {}, "list_page_seconds": None}
+    with open(history_path) as history_file:
+        history = json.load(history_file)
+    history.setdefault("tables", {})
+    history.setdefault("list_page_seconds", None)
+    return history
+
+
+def record_run_history(history_path, table_tasks, list_of_summaries, load_options):
+    """
+    Method that adds the timings of a run to the history read by the planner. The job seconds of a table are its
+    duration times the number of jobs it ran at the same time, so that the plan can estimate other concurrencies.
+    Tables that failed or ran no job are not recorded.
+
+    :param history_path: The local path of the JSON history file.
+    :param table_tasks: The list of TableTask of the run.
+    :param list_of_summaries: The list of TableSummary of the run.
+    :param load_options: The dictionary with the load options.
+    """
+    history = read_history(history_path)
+    table_details_by_key = {(table_task.dataset_name, table_task.bucket_name, table_task.table_details.get(
+        "table_name")): table_task.table_details for table_task in table_tasks}
+    for summary in list_of_summaries:
+        table_details = table_details_by_key.get((summary.dataset_name, summary.bucket_name, summary.table_id))
+        if table_details is None or summary.error or summary.failed_jobs or not summary.jobs:
+            continue
+        concurrency = min(summary.jobs, get_job_concurrency(table_details=table_details, load_options=load_options))
+        samples = history["tables"].setdefault(manifest.get_table_key(dataset_name=summary.dataset_name,
+                                                                      table_id=summary.table_id), [])
+        samples.append([summary.jobs, summary.input_bytes or 0, summary.duration * concurrency])
+        del samples[:-HISTORY_SAMPLES]
+    list_page_seconds = get_average_seconds("gcs_list_page")
+    if list_page_seconds is not None:
+        history["list_page_seconds"] = list_page_seconds
+    with open(history_path, "w") as history_file:
+        json.dump(history, history_file, indent=2)
+    log.info("Run timings recorded in {}.".format(history_path))
+
+
+def get_average_seconds(timer_name):
+    """
+    Method that gets the average duration of a timer of the run, across all its labels.
+
+    :param timer_name: The timer name.
+    :return: The average number of seconds, or None when the timer was never observed.
+    """
+    _, timers, _ = metrics.get_registry().snapshot()
+    count = total = 0
+    for (name, _), (timer_count, timer_total, _) in timers.items():
+        if name == timer_name:
+            count += timer_count
+            total += timer_total
+    return total / count if count else None
+
+
+def get_job_concurrency(table_details, load_options):
+    """
+    Method that gets the maximum number of load jobs of a table running at the same time.
+
+    :param table_details: The table details.
+    :param load_options: The dictionary with the load options.
+    :return: The maximum number of concurrent jobs.
+    """
+    concurrency = max(1, load_options.get("max_concurrent_jobs") or 1)
+    table_partitioning = table_details.get("partitioning")
+    if table_partitioning:
+        concurrency *= max(1, table_partitioning.get("max_concurrent_partitions",
+                                                     load_options.get("max_concurrent_partitions")) or 1)
+    return concurrency
+
+
+def get_job_timings(history, table_key):
+    """
+    Method that gets the average seconds and bytes of the load jobs of a table from the history, or of every table
+    of the history when that one was never recorded.
+
+    :param history: The history dictionary.
+    :param table_key: The table key.
+    :return: The JobTimings, with the default timings when the history is empty.
+    """
+    samples = history["tables"].get(table_key) or [sample for table_samples in history["tables"].values()
+                                                   for sample in table_samples]
+    jobs = sum(sample[0] for sample in samples)
+    if not jobs:
+        return JobTimings(seconds_per_job=DEFAULT_JOB_SECONDS, bytes_per_job=DEFAULT_JOB_BYTES, runs=0)
+    return JobTimings(seconds_per_job=sum(sample[2] for sample in samples) / jobs,
+                      bytes_per_job=sum(sample[1] for sample in samples) / jobs,
+                      runs=len(history["tables"].get(table_key) or []))
+
+
+def estimate_job_seconds(job_bytes, job_timings):
+    """
+    Method that estimates how long a load job runs: a job takes at least the average time of the jobs of the table,
+    and longer in proportion to its bytes when it is larger than the average job.
+
+    :param job_bytes: The number of bytes of the job.
+    :param job_timings: The JobTimings of the table.
+    :return: The estimated number of seconds.
+    """
+    if not job_timings.bytes_per_job:
+        return job_timings.seconds_per_job
+    return job_timings.seconds_per_job * max(1.0, job_bytes / job_timings.bytes_per_job)
+
+
+def iter_planned_jobs(bucket_name, blob_prefix, list_of_classified_blobs, load_mode, max_uris_per_job,
+                      max_bytes_per_job, use_wildcard):
+    """
+    Method that groups blobs into the load jobs that would be submitted, with the same batching as the load.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :param list_of_classified_blobs: An iterable of (format, BlobDetails) tuples, None formats being left out.
+    :param load_mode: LOAD_MODE_PER_BLOB or LOAD_MODE_BATCH.
+    :param max_uris_per_job: The maximum number of source URIs in one batched load job.
+    :param max_bytes_per_job: The maximum number of bytes loaded by one batched load job.
+    :param use_wildcard: Whether a gs://bucket/prefix* wildcard can select the blobs.
+    :return: A generator of the number of bytes of each job.
+    """
+    if load_mode != gcp_interfacer.LOAD_MODE_BATCH:
+        for blob_format, blob_details in list_of_classified_blobs:
+            if blob_format is not None:
+                yield blob_details.size or 0
+        return
+    batcher = gcp_interfacer.LoadSourceBatcher(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                               get_job_config=lambda blob_format, blob_details: blob_format,
+                                               max_uris_per_job=max_uris_per_job,
+                                               max_bytes_per_job=max_bytes_per_job, use_wildcard=use_wildcard)
+    pending_sizes = {}
+
+    def get_job_bytes(load_source):
+        if len(load_source.source_uris) == 1 and load_source.source_uris[0].endswith("*"):
+            job_bytes = sum(pending_sizes.values())
+            pending_sizes.clear()
+            return job_bytes
+        return sum(pending_sizes.pop(uri) for uri in load_source.source_uris)
+
+    for blob_format, blob_details in list_of_classified_blobs:
+        if blob_format is not None:
+            pending_sizes[gcp_interfacer.get_blob_uri(bucket_name=bucket_name,
+                                                      blob_name=blob_details.name)] = blob_details.size or 0
+        for load_source in batcher.add(blob_format, blob_details):
+            yield get_job_bytes(load_source)
+    for load_source in batcher.flush():
+        yield get_job_bytes(load_source)
+
+
+def plan_table(table_task, load_options, history):
+    """
+    Method that plans the load of one table without loading anything: the prefix is listed, only its metadata is
+    read, and the blobs are grouped into the jobs that would be submitted. Blobs whose format is not given by their
+    extension or content type are counted as one format, as their first bytes would be read to detect it.
+
+    :param table_task: The TableTask.
+    :param load_options: The dictionary with the load options.
+    :param history: The history dictionary.
+    :return: The TablePlan.
+    """
+    table_details = table_task.table_details
+    table_id = table_details.get("table_name")
+    bucket_name = table_task.bucket_name
+    blob_prefix = table_details.get("blob_prefix")
+    table_type = table_details.get("table_type", load_options.get("table_type"))
+    list_page_seconds = history.get("list_page_seconds") or DEFAULT_LIST_PAGE_SECONDS
+    job_timings = get_job_timings(history=history, table_key=manifest.get_table_key(
+        dataset_name=table_task.dataset_name, table_id=table_id))
+    plan = TablePlan(dataset_name=table_task.dataset_name, bucket_name=bucket_name, table_id=table_id,
+                     table_type=table_type, blobs=0, input_bytes=0, jobs=0, partitions=0, list_requests=0,
+                     format_detection_reads=0, skipped_blobs=0, largest_job_bytes=0, estimated_seconds=0.0,
+                     history_runs=job_timings.runs, error=None)
+    if table_type == gcp_interfacer.TABLE_TYPE_EXTERNAL:
+        return plan._replace(list_requests=1, estimated_seconds=list_page_seconds)
+
+    list_requests = [0]
+
+    def count_pages(pages):
+        for page in pages:
+            list_requests[0] += 1
+            yield page
+
+    table_partitioning = table_details.get("partitioning")
+    if table_partitioning:
+        pages = partitioning.iter_partition_pages(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                                  partitioning=table_partitioning,
+                                                  blob_delimiter=table_details.get("blob_delimiter"),
+                                                  blob_glob=table_details.get("blob_glob"))
+    else:
+        pages = gcp_interfacer.iter_blob_pages(bucket_name=bucket_name, blob_prefix=blob_prefix,
+                                               delimiter=table_details.get("blob_delimiter"),
+                                               match_glob=table_details.get("blob_glob"))
+    manifest_path = load_options.get("manifest_path")
+    if manifest_path and not os.path.exists(manifest_path):
+        manifest_path = None
+    counts = {"blobs": 0, "format_detection_reads": 0, "skipped_blobs": 0}
+
+    def classify(list_of_blob_details, group_table_id):
+        if manifest_path:
+            # The blobs of a partition are recorded under the key of its decorated table, e.g. "table$20200101".
+            list_of_blob_details = manifest.filter_new_blobs(
+                manifest_path=manifest_path, bucket_name=bucket_name,
+                table_key=manifest.get_table_key(dataset_name=table_task.dataset_name, table_id=group_table_id),
+                list_of_blob_details=list_of_blob_details)
+        for blob_details in list_of_blob_details:
+            source_format, compression = format_detection.get_format_from_metadata(blob_details)
+            if source_format is None and blob_details.size:
+                counts["format_detection_reads"] += 1
+                source_format = UNDETECTED_FORMAT
+            if source_format is None or (compression and compression != format_detection.COMPRESSION_NONE and
+                                         source_format not in format_detection.COMPRESSIBLE_FORMATS and
+                                         source_format != UNDETECTED_FORMAT):
+                counts["skipped_blobs"] += 1
+                yield None, blob_details
+                continue
+            counts["blobs"] += 1
+            yield format_detection.BlobFormat(source_format=source_format,
+                                              compression=compression or format_detection.COMPRESSION_NONE), \
+                blob_details
+
+    load_mode = table_details.get("load_mode", load_options.get("load_mode"))
+    if table_partitioning:
+        load_mode = partitioning.get_partition_load_mode(partitioning=table_partitioning, load_mode=load_mode)
+    with blob_catalog.BlobCatalog.from_pages(bucket_name=bucket_name, pages=count_pages(pages)) as catalog:
+        if table_partitioning:
+            groups = [(partitioning.get_partitioned_table_id(table_id=table_id, decorator=partition.decorator),
+                       partition.blobs) for partition in partitioning.discover_partitions(
+                catalog=catalog, partitioning=table_partitioning)]
+        else:
+            groups = [(table_id, catalog)]
+        use_wildcard = not (table_partitioning or table_details.get("blob_delimiter") or
+                            table_details.get("blob_glob") or load_options.get("manifest_path"))
+        list_of_job_bytes = [job_bytes for group_table_id, group in groups for job_bytes in iter_planned_jobs(
+            bucket_name=bucket_name,
+            blob_prefix=blob_prefix,
+            list_of_classified_blobs=classify(group, group_table_id),
+            load_mode=load_mode,
+            max_uris_per_job=load_options.get("max_uris_per_job") or gcp_interfacer.MAX_URIS_PER_LOAD_JOB,
+            max_bytes_per_job=load_options.get("max_bytes_per_job") or gcp_interfacer.MAX_BYTES_PER_LOAD_JOB,
+            use_wildcard=use_wildcard)]
+    list_of_job_seconds = [estimate_job_seconds(job_bytes=job_bytes, job_timings=job_timings)
+                           for job_bytes in list_of_job_bytes]
+    concurrency = min(len(list_of_job_seconds), get_job_concurrency(table_details=table_details,
+                                                                    load_options=load_options)) or 1
+    return plan._replace(blobs=counts["blobs"], input_bytes=sum(list_of_job_bytes), jobs=len(list_of_job_bytes),
+                         partitions=len(groups) if table_partitioning else 0, list_requests=list_requests[0],
+                         format_detection_reads=counts["format_detection_reads"],
+                         skipped_blobs=counts["skipped_blobs"], largest_job_bytes=max(list_of_job_bytes, default=0),
+                         estimated_seconds=list_requests[0] * list_page_seconds +
+                         max(sum(list_of_job_seconds) / concurrency, max(list_of_job_seconds, default=0.0)))
+
+
+def plan_tables(table_tasks, load_options, history):
+    """
+    Method that plans the load of every table, listing max_concurrent_tables tables at the same time. A table that
+    cannot be planned gets a TablePlan with its error.
+
+    :param table_tasks: The list of TableTask.
+    :param load_options: The dictionary with the load options.
+    :param history: The history dictionary.
+    :return: The list of TablePlan, in the order of table_tasks.
+    """
+    def plan(table_task):
+        try:
+            return plan_table(table_task=table_task, load_options=load_options, history=history)
+        except Exception as exception:
+            log.exception("Planning table {} failed.".format(table_task.table_details.get("table_name")))
+            return TablePlan(dataset_name=table_task.dataset_name, bucket_name=table_task.bucket_name,
+                             table_id=table_task.table_details.get("table_name"), table_type=None, blobs=0,
+                             input_bytes=0, jobs=0, partitions=0, list_requests=0, format_detection_reads=0,
+                             skipped_blobs=0, largest_job_bytes=0, estimated_seconds=0.0, history_runs=0,
+                             error=str(exception))
+
+    with ThreadPoolExecutor(max_workers=max(1, load_options.get("max_concurrent_tables") or 1)) as executor:
+        return list(executor.map(plan, table_tasks))
+
+
+def get_run_plan(list_of_table_plans, load_options):
+    """
+    Method that sums up the table plans into the plan of the run, with its totals, its use of the BigQuery load job
+    quotas and its expected duration given the table concurrency and worker processes.
+
+    :param list_of_table_plans: The list of TablePlan.
+    :param load_options: The dictionary with the load options.
+    :return: The JSON serialisable plan dictionary.
+    """
+    table_concurrency = max(1, load_options.get("max_concurrent_tables") or 1) * \
+        max(1, load_options.get("worker_processes") or 1)
+    list_of_seconds = [table_plan.estimated_seconds for table_plan in list_of_table_plans]
+    jobs = sum(table_plan.jobs for table_plan in list_of_table_plans)
+    jobs_per_table = {}
+    for table_plan in list_of_table_plans:
+        table_key = manifest.get_table_key(dataset_name=table_plan.dataset_name, table_id=table_plan.table_id)
+        jobs_per_table[table_key] = jobs_per_table.get(table_key, 0) + table_plan.jobs
+    warnings = ["Table {} needs {} load jobs, over the {} per table and day.".format(
+        table_key, table_jobs, TABLE_DAILY_LOAD_JOBS) for table_key, table_jobs in jobs_per_table.items()
+        if table_jobs > TABLE_DAILY_LOAD_JOBS]
+    if jobs > PROJECT_DAILY_LOAD_JOBS:
+        warnings.append("The run needs {} load jobs, over the {} per project and day.".format(
+            jobs, PROJECT_DAILY_LOAD_JOBS))
+    warnings.extend("Table {} could not be planned: {}".format(table_plan.table_id, table_plan.error)
+                    for table_plan in list_of_table_plans if table_plan.error)
+    warnings.extend("Table {} has no history, its duration uses default timings.".format(table_plan.table_id)
+                    for table_plan in list_of_table_plans if not table_plan.history_runs and table_plan.jobs)
+    return {
+        "tables": [table_plan._asdict() for table_plan in list_of_table_plans],
+        "totals": {
+            "tables": len(list_of_table_plans),
+            "blobs": sum(table_plan.blobs for table_plan in list_of_table_plans),
+            "input_bytes": sum(table_plan.input_bytes for table_plan in list_of_table_plans),
+            "jobs": jobs,
+            "estimated_seconds": max(sum(list_of_seconds) / table_concurrency, max(list_of_seconds, default=0.0)),
+        },
+        "quota": {
+            "load_jobs": jobs,
+            "project_daily_load_jobs": PROJECT_DAILY_LOAD_JOBS,
+            "max_load_jobs_per_table": max(jobs_per_table.values(), default=0),
+            "table_daily_load_jobs": TABLE_DAILY_LOAD_JOBS,
+            "list_requests": sum(table_plan.list_requests for table_plan in list_of_table_plans),
+            "format_detection_reads": sum(table_plan.format_detection_reads for table_plan in list_of_table_plans),
+        },
+        "warnings": warnings,
+    }
+
+
+def log_plan(plan):
+    """
+    Method that logs a run plan, per table and in total.
+
+    :param plan: The plan dictionary.
+    """
+    for table in plan["tables"]:
+        log.info("Plan for table {} from gs://{}: {} blobs, {} bytes, {} jobs{}, ~{:.0f}s{}.".format(
+            manifest.get_table_key(dataset_name=table["dataset_name"], table_id=table["table_id"]),
+            table["bucket_name"], table["blobs"], table["input_bytes"], table["jobs"],
+            " over {} partitions".format(table["partitions"]) if table["partitions"] else "",
+            table["estimated_seconds"], ", error: {}".format(table["error"]) if table["error"] else ""))
+    totals = plan["totals"]
+    log.info("Plan: {} tables, {} blobs, {} bytes, {} load jobs, {} list requests, ~{:.0f}s.".format(
+        totals["tables"], totals["blobs"], totals["input_bytes"], totals["jobs"], plan["quota"]["list_requests"],
+        totals["estimated_seconds"]))
+    for warning in plan["warnings"]:
+        log.warning(warning)
+
+
+def write_plan(plan_path, plan):
+    """
+    Method that writes a run plan as a JSON file.
+
+    :param plan_path: The local path of the JSON plan file.
+    :param plan: The plan dictionary.
+    """
+    with open(plan_path, "w") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    log.info("Plan written to {}.".format(plan_path))
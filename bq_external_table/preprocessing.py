@@ -0,0 +1,408 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from bq_external_table import bulk_uploader, metrics, schema_inference
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMAT_AVRO = "avro"
+OUTPUT_FORMAT_PARQUET = "parquet"
+DEFAULT_COMPRESSIONS = {OUTPUT_FORMAT_CSV: "gzip", OUTPUT_FORMAT_AVRO: "deflate", OUTPUT_FORMAT_PARQUET: "snappy"}
+DEFAULT_CHUNK_ROWS = 50000
+DEFAULT_MAX_BAD_ROWS = 0
+DEFAULT_PROCESSES = 4
+MAX_REPORTED_BAD_ROWS = 10
+CSV_EXTENSIONS = (".csv", ".csv.gz")
+STATUS_CONVERTED = "converted"
+STATUS_COPIED = "copied"
+STATUS_QUARANTINED = "quarantined"
+AVRO_TYPES = {
+    schema_inference.TYPE_BOOLEAN: "boolean",
+    schema_inference.TYPE_INTEGER: "long",
+    schema_inference.TYPE_FLOAT: "double",
+    schema_inference.TYPE_DATE: {"type": "int", "logicalType": "date"},
+    schema_inference.TYPE_TIMESTAMP: {"type": "long", "logicalType": "timestamp-micros"},
+    schema_inference.TYPE_STRING: "string",
+}
+
+PreprocessResult = namedtuple("PreprocessResult", ["source_file_name", "output_file_name", "status", "rows",
+                                                   "bad_rows", "input_bytes", "output_bytes", "error", "duration"])
+
+
+class InvalidFileError(Exception):
+    """
+    Error raised when a CSV file cannot be loaded as it is, e.g. because of a wrong header or too many bad rows.
+    """
+
+    def __init__(self, message, bad_rows=()):
+        super(InvalidFileError, self).__init__(message)
+        self.bad_rows = list(bad_rows)
+
+
+def preprocess_directory(source_dir, output_dir=None, quarantine_dir=None, output_format=OUTPUT_FORMAT_CSV,
+                         compression=None, expected_header=None, max_bad_rows=DEFAULT_MAX_BAD_ROWS,
+                         chunk_rows=DEFAULT_CHUNK_ROWS, sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES,
+                         processes=DEFAULT_PROCESSES):
+    """
+    Method that validates, and optionally compresses or converts, the CSV files of a local directory before they are
+    uploaded, several files at a time in a pool of processes. Each file is streamed chunk_rows rows at a time, so the
+    memory used does not depend on its size. Files that are not CSV are copied unchanged, and CSV files that fail the
+    validation are copied to the quarantine directory with a report of their errors instead.
+
+    :param source_dir: The local directory with the files to preprocess.
+    :param output_dir: The local directory the preprocessed files are written to, with the same relative paths.
+    Defaults to "<source_dir>_preprocessed".
+    :param quarantine_dir: The local directory the invalid files are copied to. Defaults to "<source_dir>_quarantine".
+    :param output_format: OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_AVRO or OUTPUT_FORMAT_PARQUET.
+    :param compression: The compression of the output files, "gzip" or "none" for CSV, an Avro codec, e.g. "deflate",
+    or a Parquet compression, e.g. "snappy" or "zstd". Defaults to DEFAULT_COMPRESSIONS of the format.
+    :param expected_header: Optional list of the column names the header of every file must have.
+    :param max_bad_rows: The maximum number of rows of a file with the wrong number of columns or, when converted,
+    a value that does not fit the type of its column. They are left out, and files with more are quarantined.
+    :param chunk_rows: The number of rows held in memory at a time per file.
+    :param sample_bytes: The maximum number of bytes of each file read to infer the types of its columns.
+    :param processes: The number of worker processes.
+    :return: The list of PreprocessResult, one per local file.
+    """
+    if output_format not in DEFAULT_COMPRESSIONS:
+        raise ValueError("Unknown output format {}, expected csv, avro or parquet.".format(output_format))
+    if output_format == OUTPUT_FORMAT_AVRO and fastavro is None:
+        raise ImportError("Converting to Avro requires fastavro, install the avro extra.")
+    if output_format == OUTPUT_FORMAT_PARQUET and pyarrow is None:
+        raise ImportError("Converting to Parquet requires pyarrow, install the parquet extra.")
+    source_dir = source_dir.rstrip(os.sep)
+    output_dir = output_dir or source_dir + "_preprocessed"
+    quarantine_dir = quarantine_dir or source_dir + "_quarantine"
+    options = {"output_format": output_format, "compression": compression or DEFAULT_COMPRESSIONS[output_format],
+               "expected_header": expected_header, "max_bad_rows": max_bad_rows, "chunk_rows": chunk_rows,
+               "sample_bytes": sample_bytes}
+    local_files = [(source_file_name, relative_path)
+                   for source_file_name, relative_path in bulk_uploader.list_local_files(source_dir)
+                   if os.path.basename(relative_path) != bulk_uploader.UPLOAD_STATE_FILE_NAME]
+
+    start = time.time()
+    # Worker processes are spawned rather than forked, so that they do not inherit locks held by other threads.
+    with ProcessPoolExecutor(max_workers=max(1, min(processes or 1, len(local_files) or 1)),
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        list_of_results = list(executor.map(preprocess_file,
+                                            [source_file_name for source_file_name, _ in local_files],
+                                            [relative_path for _, relative_path in local_files],
+                                            [output_dir] * len(local_files),
+                                            [quarantine_dir] * len(local_files),
+                                            [options] * len(local_files)))
+    for result in list_of_results:
+        metrics.increment("preprocessed_files", status=result.status)
+        metrics.increment("preprocessed_rows", result.rows)
+        metrics.increment("preprocessed_bad_rows", result.bad_rows)
+        metrics.increment("preprocessed_input_bytes", result.input_bytes)
+        metrics.increment("preprocessed_output_bytes", result.output_bytes)
+    log_preprocess_report(list_of_results=list_of_results, duration=time.time() - start)
+    return list_of_results
+
+
+def preprocess_file(source_file_name, relative_path, output_dir, quarantine_dir, options):
+    """
+    Method that preprocesses one local file, in a worker process.
+
+    :param source_file_name: The local file path.
+    :param relative_path: The path of the file relative to the preprocessed directory.
+    :param output_dir: The local directory of the preprocessed files.
+    :param quarantine_dir: The local directory of the invalid files.
+    :param options: The dictionary with the output_format, compression, expected_header, max_bad_rows, chunk_rows
+    and sample_bytes.
+    :return: The PreprocessResult.
+    """
+    start = time.time()
+    input_bytes = os.path.getsize(source_file_name)
+    if not relative_path.lower().endswith(CSV_EXTENSIONS) or not input_bytes:
+        output_file_name = os.path.join(output_dir, relative_path)
+        os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
+        shutil.copyfile(source_file_name, output_file_name)
+        return PreprocessResult(source_file_name=source_file_name, output_file_name=output_file_name,
+                                status=STATUS_COPIED, rows=0, bad_rows=0, input_bytes=input_bytes,
+                                output_bytes=input_bytes, error=None, duration=time.time() - start)
+    output_file_name = os.path.join(output_dir, get_output_relative_path(
+        relative_path=relative_path, output_format=options["output_format"], compression=options["compression"]))
+    os.makedirs(os.path.dirname(output_file_name), exist_ok=True)
+    bad_rows = []
+    # Besides OSError, a truncated gzip file raises EOFError and a corrupt one zlib.error.
+    try:
+        fields, has_header = get_csv_fields(source_file_name=source_file_name,
+                                            expected_header=options["expected_header"],
+                                            sample_bytes=options["sample_bytes"],
+                                            typed=options["output_format"] != OUTPUT_FORMAT_CSV)
+        chunks = iter_row_chunks(source_file_name=source_file_name, fields=fields, has_header=has_header,
+                                 max_bad_rows=options["max_bad_rows"],
+                                 chunk_rows=options["chunk_rows"], bad_rows=bad_rows,
+                                 typed=options["output_format"] != OUTPUT_FORMAT_CSV)
+        rows = write_chunks(output_file_name=output_file_name, fields=fields, has_header=has_header, chunks=chunks,
+                            output_format=options["output_format"], compression=options["compression"])
+    except (InvalidFileError, csv.Error, UnicodeDecodeError, OSError, EOFError, zlib.error) as error:
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        quarantine_file(source_file_name=source_file_name, relative_path=relative_path,
+                        quarantine_dir=quarantine_dir, error=str(error),
+                        bad_rows=getattr(error, "bad_rows", bad_rows))
+        return PreprocessResult(source_file_name=source_file_name, output_file_name=None, status=STATUS_QUARANTINED,
+                                rows=0, bad_rows=len(getattr(error, "bad_rows", bad_rows)), input_bytes=input_bytes,
+                                output_bytes=0, error=str(error), duration=time.time() - start)
+    return PreprocessResult(source_file_name=source_file_name, output_file_name=output_file_name,
+                            status=STATUS_CONVERTED, rows=rows, bad_rows=len(bad_rows), input_bytes=input_bytes,
+                            output_bytes=os.path.getsize(output_file_name), error=None, duration=time.time() - start)
+
+
+def get_output_relative_path(relative_path, output_format, compression):
+    """
+    Method that gets the relative path of the preprocessed version of a CSV file.
+
+    :param relative_path: The relative path of the CSV file, ending with ".csv" or ".csv.gz".
+    :param output_format: The output format.
+    :param compression: The output compression.
+    :return: The relative path of the output file.
+    """
+    base_path = relative_path[:-len(".csv.gz")] if relative_path.lower().endswith(".csv.gz") \
+        else relative_path[:-len(".csv")]
+    if output_format == OUTPUT_FORMAT_CSV:
+        return base_path + (".csv.gz" if compression == "gzip" else ".csv")
+    return "{}.{}".format(base_path, output_format)
+
+
+def open_csv(source_file_name):
+    """
+    Method that opens a local CSV file, gzip compressed or not, as text.
+
+    :param source_file_name: The local file path.
+    :return: The file object.
+    """
+    if source_file_name.lower().endswith(".gz"):
+        return gzip.open(source_file_name, "rt", encoding="utf-8", newline="")
+    return open(source_file_name, encoding="utf-8", newline="")
+
+
+def get_csv_fields(source_file_name, expected_header=None, sample_bytes=schema_inference.DEFAULT_SAMPLE_BYTES,
+                   typed=True):
+    """
+    Method that gets the columns of a CSV file from a sample of its first bytes, the same way the schema of CSV data
+    is inferred for the load jobs.
+
+    :param source_file_name: The local file path.
+    :param expected_header: Optional list of the column names the header must have.
+    :param sample_bytes: The maximum number of bytes read.
+    :param typed: Whether the types of the columns are inferred, or every column is a STRING.
+    :return: The tuple with the list of {"name", "type"} fields and whether the file has a header row.
+    """
+    with open_csv(source_file_name) as csv_file:
+        sample = csv_file.read(sample_bytes)
+        if csv_file.read(1):
+            sample = sample[:sample.rfind("\n") + 1]
+    rows = [row for row in csv.reader(io.StringIO(sample)) if row]
+    if not rows:
+        raise InvalidFileError("The file has no rows.")
+    if expected_header is not None and rows[0] != list(expected_header):
+        raise InvalidFileError("The header {} is not the expected {}.".format(rows[0], list(expected_header)))
+    # Rows with another number of columns than the first one are bad rows, left out of the types of the columns.
+    valid_sample = io.StringIO()
+    csv.writer(valid_sample).writerows(row for row in rows if len(row) == len(rows[0]))
+    fields, has_header = schema_inference.infer_csv_schema(valid_sample.getvalue().encode("utf-8"))
+    if expected_header is not None:
+        has_header = True
+        fields = [dict(field, name=name) for field, name in zip(fields, schema_inference.get_column_names(
+            header=expected_header, column_count=len(expected_header)))]
+    if not typed:
+        fields = [dict(field, type=schema_inference.TYPE_STRING) for field in fields]
+    return fields, has_header
+
+
+def iter_row_chunks(source_file_name, fields, has_header, max_bad_rows=DEFAULT_MAX_BAD_ROWS,
+                    chunk_rows=DEFAULT_CHUNK_ROWS, bad_rows=None, typed=True):
+    """
+    Method that streams the rows of a CSV file, chunk_rows at a time, checking their number of columns and, when
+    typed, converting their values to the types of the columns. Bad rows are left out and recorded.
+
+    :param source_file_name: The local file path.
+    :param fields: The list of {"name", "type"} fields.
+    :param has_header: Whether the first row is a header, skipped.
+    :param max_bad_rows: The maximum number of bad rows before the file is rejected.
+    :param chunk_rows: The number of rows per chunk.
+    :param bad_rows: Optional list filled with the (line number, error) of each bad row.
+    :param typed: Whether the values are converted to the types of the columns.
+    :return: A generator of lists of rows, each row a list of values.
+    """
+    bad_rows = [] if bad_rows is None else bad_rows
+    column_types = [field["type"] for field in fields]
+    chunk = []
+    with open_csv(source_file_name) as csv_file:
+        reader = csv.reader(csv_file)
+        if has_header:
+            next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            try:
+                if len(row) != len(column_types):
+                    raise ValueError("{} columns instead of {}".format(len(row), len(column_types)))
+                chunk.append([parse_value(value, column_type) for value, column_type in zip(row, column_types)]
+                             if typed else row)
+            except ValueError as error:
+                bad_rows.append((reader.line_num, str(error)))
+                if len(bad_rows) > max_bad_rows:
+                    raise InvalidFileError("More than {} bad rows.".format(max_bad_rows), bad_rows)
+                continue
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_value(value, column_type):
+    """
+    Method that converts a CSV value to the Python value of its BigQuery type.
+
+    :param value: The CSV value.
+    :param column_type: The BigQuery type of the column.
+    :return: The converted value, None for an empty value.
+    """
+    value = value.strip()
+    if not value:
+        return None
+    if column_type == schema_inference.TYPE_BOOLEAN:
+        if value.lower() not in schema_inference.BOOLEAN_VALUES:
+            raise ValueError("{} is not a {}".format(value, column_type))
+        return value.lower() == "true"
+    if column_type == schema_inference.TYPE_INTEGER:
+        return int(value)
+    if column_type == schema_inference.TYPE_FLOAT:
+        return float(value)
+    if column_type == schema_inference.TYPE_DATE:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    if column_type == schema_inference.TYPE_TIMESTAMP:
+        timestamp = datetime.datetime.fromisoformat(value[:-len(" UTC")] + "+00:00" if value.endswith(" UTC")
+                                                    else value)
+        if timestamp.tzinfo is None:
+            return timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp.astimezone(datetime.timezone.utc)
+    return value
+
+
+def write_chunks(output_file_name, fields, has_header, chunks, output_format, compression):
+    """
+    Method that writes the chunks of rows of a CSV file in the output format.
+
+    :param output_file_name: The local path of the output file.
+    :param fields: The list of {"name", "type"} fields.
+    :param has_header: Whether a CSV output starts with a header row.
+    :param chunks: An iterable of lists of rows.
+    :param output_format: The output format.
+    :param compression: The output compression.
+    :return: The number of rows written.
+    """
+    rows = 0
+    if output_format == OUTPUT_FORMAT_AVRO:
+        names = [field["name"] for field in fields]
+
+        def iter_records():
+            for chunk in chunks:
+                for row in chunk:
+                    yield dict(zip(names, row))
+                nonlocal rows
+                rows += len(chunk)
+
+        schema = fastavro.parse_schema({"type": "record", "name": "Row", "fields": [
+            {"name": field["name"], "type": ["null", AVRO_TYPES[field["type"]]], "default": None}
+            for field in fields]})
+        with open(output_file_name, "wb") as output_file:
+            fastavro.writer(output_file, schema, iter_records(), codec=compression)
+    elif output_format == OUTPUT_FORMAT_PARQUET:
+        schema = pyarrow.schema([(field["name"], get_arrow_type(field["type"])) for field in fields])
+        with pyarrow.parquet.ParquetWriter(output_file_name, schema, compression=compression) as writer:
+            for chunk in chunks:
+                writer.write_table(pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in chunk],
+                                                             schema=schema))
+                rows += len(chunk)
+    else:
+        with (gzip.open(output_file_name, "wt", encoding="utf-8", newline="") if compression == "gzip"
+              else open(output_file_name, "w", encoding="utf-8", newline="")) as output_file:
+            writer = csv.writer(output_file)
+            if has_header:
+                writer.writerow([field["name"] for field in fields])
+            for chunk in chunks:
+                writer.writerows(chunk)
+                rows += len(chunk)
+    return rows
+
+
+def get_arrow_type(column_type):
+    """
+    Method that gets the Arrow type of a BigQuery type.
+
+    :param column_type: The BigQuery type.
+    :return: The pyarrow DataType.
+    """
+    return {schema_inference.TYPE_BOOLEAN: pyarrow.bool_(),
+            schema_inference.TYPE_INTEGER: pyarrow.int64(),
+            schema_inference.TYPE_FLOAT: pyarrow.float64(),
+            schema_inference.TYPE_DATE: pyarrow.date32(),
+            schema_inference.TYPE_TIMESTAMP: pyarrow.timestamp("us", tz="UTC")}.get(column_type, pyarrow.string())
+
+
+def quarantine_file(source_file_name, relative_path, quarantine_dir, error, bad_rows):
+    """
+    Method that copies an invalid file to the quarantine directory, next to a JSON report of its errors.
+
+    :param source_file_name: The local file path.
+    :param relative_path: The path of the file relative to the preprocessed directory.
+    :param quarantine_dir: The local directory of the invalid files.
+    :param error: The error that rejected the file.
+    :param bad_rows: The list of (line number, error) of its bad rows.
+    """
+    quarantined_file_name = os.path.join(quarantine_dir, relative_path)
+    os.makedirs(os.path.dirname(quarantined_file_name), exist_ok=True)
+    shutil.copyfile(source_file_name, quarantined_file_name)
+    with open(quarantined_file_name + ".error.json", "w") as report_file:
+        json.dump({"source_file_name": source_file_name, "error": error, "bad_row_count": len(bad_rows),
+                   "bad_rows": [{"line": line, "error": row_error}
+                                for line, row_error in bad_rows[:MAX_REPORTED_BAD_ROWS]]}, report_file, indent=2)
+
+
+def log_preprocess_report(list_of_results, duration):
+    """
+    Method that logs the outcome and the size reduction of a preprocessing run.
+
+    :param list_of_results: The list of PreprocessResult.
+    :param duration: The number of seconds the preprocessing took.
+    """
+    converted = [result for result in list_of_results if result.status == STATUS_CONVERTED]
+    input_bytes = sum(result.input_bytes for result in converted)
+    output_bytes = sum(result.output_bytes for result in converted)
+    log.info("Preprocessed {} CSV files, {} rows ({} bad rows left out), {:.1f} MB to {:.1f} MB in {:.1f}s. "
+             "Copied {} other files, quarantined {}.".format(
+                 len(converted), sum(result.rows for result in converted),
+                 sum(result.bad_rows for result in converted), input_bytes / 1024 ** 2, output_bytes / 1024 ** 2,
+                 duration, len([result for result in list_of_results if result.status == STATUS_COPIED]),
+                 len([result for result in list_of_results if result.status == STATUS_QUARANTINED])))
+    for result in list_of_results:
+        if result.status == STATUS_QUARANTINED:
+            log.error("Quarantined {}: {}".format(result.source_file_name, result.error))
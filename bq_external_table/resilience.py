@@ -0,0 +1,285 @@
+import random
+import threading
+import time
+
+import requests
+from google.api_core import exceptions
+from google.api_core import retry as api_core_retry
+
+from bq_external_table import metrics
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+API_STORAGE = "storage"
+API_BIGQUERY = "bigquery"
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_MAX_JOB_ATTEMPTS = 3
+DEFAULT_INITIAL_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+DEFAULT_DELAY_MULTIPLIER = 2.0
+STORAGE_REQUEST_TIMEOUT = 60.0
+RETRYABLE_EXCEPTIONS = (exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.BadGateway,
+                        exceptions.ServiceUnavailable, exceptions.GatewayTimeout,
+                        requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError)
+THROTTLING_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+RETRYABLE_REASONS = THROTTLING_REASONS | {"backendError", "internalError", "jobBackendError", "jobInternalError"}
+
+_retry_settings = {"max_attempts": DEFAULT_MAX_ATTEMPTS, "max_job_attempts": DEFAULT_MAX_JOB_ATTEMPTS,
+                   "initial_delay": DEFAULT_INITIAL_DELAY, "max_delay": DEFAULT_MAX_DELAY,
+                   "multiplier": DEFAULT_DELAY_MULTIPLIER}
+_rate_limiters = {}
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket that limits the rate of the calls to an API. Up to burst calls can be made at once, then
+    one call every 1 / rate seconds.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Method that takes one token, waiting until one is available.
+
+        :return: The number of seconds waited.
+        """
+        waited = 0.0
+        delay = self.try_acquire()
+        while delay:
+            time.sleep(delay)
+            waited += delay
+            delay = self.try_acquire()
+        return waited
+
+    def try_acquire(self):
+        """
+        Method that takes one token if one is available, without waiting.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class AdaptiveConcurrency(object):
+    """
+    Additive increase, multiplicative decrease limit of the calls in flight. The limit is halved every time the API
+    throttles, and grows back by one after as many successes as the current limit, up to its maximum.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = self.maximum
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def on_throttle(self):
+        """
+        Method that reduces the limit after the API throttled a call.
+        """
+        with self._lock:
+            reduced_limit = max(self.minimum, self.limit // 2)
+            if reduced_limit < self.limit:
+                log.warning("Throttled, reducing the concurrency from {} to {}.".format(self.limit, reduced_limit))
+                metrics.increment("concurrency_reductions")
+            self.limit = reduced_limit
+            self._successes = 0
+
+    def on_success(self):
+        """
+        Method that records a successful call, increasing the limit after enough of them.
+        """
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+
+
+def configure(max_attempts=DEFAULT_MAX_ATTEMPTS, max_job_attempts=DEFAULT_MAX_JOB_ATTEMPTS,
+              initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY, multiplier=DEFAULT_DELAY_MULTIPLIER,
+              storage_requests_per_second=None, bigquery_requests_per_second=None):
+    """
+    Method that sets how the calls to the storage and BigQuery APIs are retried and rate limited.
+
+    :param max_attempts: The maximum number of attempts of an API call.
+    :param max_job_attempts: The maximum number of times a load job that failed with a transient error is run.
+    :param initial_delay: The maximum number of seconds to wait before the first retry.
+    :param max_delay: The maximum number of seconds to wait before any retry.
+    :param multiplier: The factor the maximum wait grows by after each retry.
+    :param storage_requests_per_second: Optional maximum rate of the calls to the storage API, from all threads.
+    :param bigquery_requests_per_second: Optional maximum rate of the calls to the BigQuery API, from all threads.
+    """
+    _retry_settings.update(max_attempts=max(1, max_attempts), max_job_attempts=max(1, max_job_attempts),
+                           initial_delay=initial_delay, max_delay=max_delay, multiplier=multiplier)
+    _rate_limiters.clear()
+    for api, requests_per_second in ((API_STORAGE, storage_requests_per_second),
+                                     (API_BIGQUERY, bigquery_requests_per_second)):
+        if requests_per_second:
+            _rate_limiters[api] = TokenBucket(rate=requests_per_second)
+
+
+def get_max_attempts():
+    """
+    Method that gets the maximum number of attempts of an API call.
+
+    :return: The maximum number of attempts.
+    """
+    return _retry_settings["max_attempts"]
+
+
+def get_max_job_attempts():
+    """
+    Method that gets the maximum number of times a load job that failed with a transient error is run.
+
+    :return: The maximum number of job attempts.
+    """
+    return _retry_settings["max_job_attempts"]
+
+
+def get_rate_limiter(api):
+    """
+    Method that gets the rate limit of an API.
+
+    :param api: API_STORAGE or API_BIGQUERY.
+    :return: The TokenBucket, or None when the API is not rate limited.
+    """
+    return _rate_limiters.get(api)
+
+
+def acquire(api):
+    """
+    Method that waits until a call to an API is allowed by its rate limit.
+
+    :param api: API_STORAGE or API_BIGQUERY.
+    """
+    rate_limiter = _rate_limiters.get(api)
+    if rate_limiter is not None:
+        waited = rate_limiter.acquire()
+        if waited:
+            metrics.observe("rate_limit_wait", waited, api=api)
+
+
+def get_error_reasons(error):
+    """
+    Method that gets the reasons of a GCP API error, e.g. "rateLimitExceeded".
+
+    :param error: The exception.
+    :return: The set of reasons.
+    """
+    errors = getattr(error, "errors", None) or []
+    return {error_details.get("reason") for error_details in errors if isinstance(error_details, dict)}
+
+
+def is_retryable_error(error):
+    """
+    Method that checks whether a failed API call can be retried: throttling, server errors and connection errors.
+
+    :param error: The exception.
+    :return: True if the call can be retried.
+    """
+    return isinstance(error, RETRYABLE_EXCEPTIONS) or bool(get_error_reasons(error) & RETRYABLE_REASONS)
+
+
+def is_throttling_error(error):
+    """
+    Method that checks whether a failed API call was throttled.
+
+    :param error: The exception.
+    :return: True if the API throttled the call.
+    """
+    return isinstance(error, exceptions.TooManyRequests) or bool(get_error_reasons(error) & THROTTLING_REASONS)
+
+
+def is_retryable_job_error(error_result):
+    """
+    Method that checks whether a failed job can be run again, because it failed with a transient error.
+
+    :param error_result: The error result of the job.
+    :return: True if the job can be run again.
+    """
+    return bool(error_result) and error_result.get("reason") in RETRYABLE_REASONS
+
+
+def get_backoff_delay(attempt):
+    """
+    Method that gets the wait before a retry, an exponential backoff with full jitter.
+
+    :param attempt: The number of attempts already failed, starting at 1.
+    :return: The number of seconds to wait.
+    """
+    max_delay = min(_retry_settings["max_delay"],
+                    _retry_settings["initial_delay"] * _retry_settings["multiplier"] ** (attempt - 1))
+    return random.uniform(0, max_delay)
+
+
+def wait_before_retry(api, error, attempt):
+    """
+    Method that records a retry and waits before it.
+
+    :param api: API_STORAGE or API_BIGQUERY.
+    :param error: The exception of the failed attempt.
+    :param attempt: The number of attempts already failed, starting at 1.
+    """
+    delay = get_backoff_delay(attempt)
+    metrics.increment("retries", api=api, reason="throttled" if is_throttling_error(error) else "transient")
+    log.warning("Call to the {} API failed ({}), retry {} in {:.2f}s.".format(api, error, attempt, delay))
+    time.sleep(delay)
+
+
+def call_with_retry(api, function, args=(), kwargs=None, on_throttle=None):
+    """
+    Method that calls an API within its rate limit, retrying transient errors with exponential backoff and jitter.
+
+    :param api: API_STORAGE or API_BIGQUERY.
+    :param function: The callable that calls the API.
+    :param args: The positional arguments of the callable.
+    :param kwargs: The keyword arguments of the callable.
+    :param on_throttle: Optional callable called every time the API throttles the call.
+    :return: The result of the callable.
+    """
+    attempt = 0
+    while True:
+        acquire(api)
+        try:
+            return function(*args, **(kwargs or {}))
+        except Exception as error:
+            attempt += 1
+            if not is_retryable_error(error) or attempt >= _retry_settings["max_attempts"]:
+                raise
+            if on_throttle and is_throttling_error(error):
+                on_throttle()
+            wait_before_retry(api=api, error=error, attempt=attempt)
+
+
+def get_storage_retry():
+    """
+    Method that gets the retry policy given to the storage client calls, with the configured backoff.
+
+    :return: The google.api_core Retry.
+    """
+    def on_error(error):
+        metrics.increment("retries", api=API_STORAGE, reason="throttled" if is_throttling_error(error) else "transient")
+        log.warning("Call to the storage API failed ({}), retrying.".format(error))
+
+    return api_core_retry.Retry(predicate=is_retryable_error,
+                                initial=_retry_settings["initial_delay"],
+                                maximum=_retry_settings["max_delay"],
+                                multiplier=_retry_settings["multiplier"],
+                                timeout=(_retry_settings["max_delay"] + STORAGE_REQUEST_TIMEOUT) *
+                                _retry_settings["max_attempts"],
+                                on_error=on_error)
@@ -0,0 +1,166 @@
+import json
+import time
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+DEFAULT_MAX_CONCURRENT_TABLES = 1
+
+TableTask = namedtuple("TableTask", ["bucket_name", "table_details", "priority", "position", "dataset_name"],
+                       defaults=(None,))
+TableSummary = namedtuple("TableSummary", ["bucket_name", "table_id", "duration", "jobs", "failed_jobs",
+                                           "input_bytes", "output_rows", "error", "dataset_name"],
+                          defaults=(None,))
+
+
+def get_table_tasks(buckets, dataset_name=None):
+    """
+    Method that gets the table loads of a config, in the order they should start. Tables with a lower "priority"
+    start first, tables with the same priority keep the config order.
+
+    :param buckets: The dictionary with the list of table details of each bucket.
+    :param dataset_name: Optional name of the data set of the tables.
+    :return: The sorted list of TableTask.
+    """
+    return get_dataset_table_tasks(datasets={dataset_name: buckets})
+
+
+def get_dataset_table_tasks(datasets):
+    """
+    Method that gets the table loads of every data set of a config, in the order they should start, so that the
+    tables of different data sets share the same workers.
+
+    :param datasets: The dictionary with the list of table details of each bucket, per data set name.
+    :return: The sorted list of TableTask.
+    """
+    table_tasks = []
+    for dataset_name, buckets in datasets.items():
+        for bucket_name, blobs in buckets.items():
+            for table_details in blobs:
+                table_tasks.append(TableTask(bucket_name=bucket_name,
+                                             table_details=table_details,
+                                             priority=table_details.get("priority", 0),
+                                             position=len(table_tasks),
+                                             dataset_name=dataset_name))
+    return sorted(table_tasks, key=lambda table_task: (table_task.priority, table_task.position))
+
+
+def run_table_tasks(table_tasks, run_table, max_concurrent_tables=DEFAULT_MAX_CONCURRENT_TABLES,
+                    max_concurrent_tables_per_bucket=None):
+    """
+    Method that runs table loads over a pool of workers. A table starts as soon as a worker is free and its bucket is
+    under its own limit, so a slow table only holds up its own worker.
+
+    :param table_tasks: The list of TableTask, in the order they should start.
+    :param run_table: The callable that loads one table. It is called with a TableTask and returns its list of
+    LoadJobResult.
+    :param max_concurrent_tables: The maximum number of tables loaded at the same time.
+    :param max_concurrent_tables_per_bucket: The maximum number of tables of the same bucket loaded at the same time,
+    no limit when None.
+    :return: The list of TableSummary, in the order of table_tasks.
+    """
+    pending_tasks = list(table_tasks)
+    running_per_bucket = defaultdict(int)
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent_tables)) as executor:
+        in_flight = {}
+        while pending_tasks or in_flight:
+            for table_task in list(pending_tasks):
+                if len(in_flight) >= max(1, max_concurrent_tables):
+                    break
+                if max_concurrent_tables_per_bucket and \
+                        running_per_bucket[table_task.bucket_name] >= max_concurrent_tables_per_bucket:
+                    continue
+                pending_tasks.remove(table_task)
+                running_per_bucket[table_task.bucket_name] += 1
+                in_flight[executor.submit(run_timed_table_task, table_task, run_table)] = table_task
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_task = in_flight.pop(future)
+                running_per_bucket[table_task.bucket_name] -= 1
+                summaries[table_task.position] = future.result()
+    return [summaries[table_task.position] for table_task in table_tasks]
+
+
+def run_timed_table_task(table_task, run_table):
+    """
+    Method that loads one table and summarises the outcome. Errors are recorded in the summary instead of raised, so
+    that they do not stop the other tables.
+
+    :param table_task: The TableTask.
+    :param run_table: The callable that loads one table.
+    :return: The TableSummary.
+    """
+    table_id = table_task.table_details.get("table_name")
+    log.info("Loading gs://{} into table {}.".format(table_task.bucket_name, table_id))
+    start = time.time()
+    try:
+        list_of_results = run_table(table_task)
+        error = None
+    except Exception as exception:
+        log.exception("Loading table {} failed.".format(table_id))
+        list_of_results = []
+        error = str(exception)
+    return get_table_summary(table_task=table_task, list_of_results=list_of_results, duration=time.time() - start,
+                             error=error)
+
+
+def get_table_summary(table_task, list_of_results, duration, error=None):
+    """
+    Method that summarises the load of one table.
+
+    :param table_task: The TableTask.
+    :param list_of_results: The list of LoadJobResult of the table.
+    :param duration: The number of seconds the load took.
+    :param error: Optional error that stopped the load.
+    :return: The TableSummary.
+    """
+    return TableSummary(bucket_name=table_task.bucket_name,
+                        table_id=table_task.table_details.get("table_name"),
+                        duration=duration,
+                        jobs=len(list_of_results),
+                        failed_jobs=len([result for result in list_of_results if not result.succeeded]),
+                        input_bytes=sum(result.input_bytes or 0 for result in list_of_results),
+                        output_rows=sum(result.output_rows or 0 for result in list_of_results),
+                        error=error,
+                        dataset_name=table_task.dataset_name)
+
+
+def log_run_summary(list_of_summaries):
+    """
+    Method that logs the per table timings, bytes and rows of a run.
+
+    :param list_of_summaries: The list of TableSummary.
+    """
+    for summary in list_of_summaries:
+        log.info("Table {} from gs://{}: {:.1f}s, {} jobs ({} failed), {} bytes, {} rows{}.".format(
+            "{}.{}".format(summary.dataset_name, summary.table_id) if summary.dataset_name else summary.table_id,
+            summary.bucket_name, summary.duration, summary.jobs, summary.failed_jobs, summary.input_bytes,
+            summary.output_rows, ", error: {}".format(summary.error) if summary.error else ""))
+
+
+def write_run_summary(summary_path, list_of_summaries):
+    """
+    Method that writes the per table summary of a run as a JSON file.
+
+    :param summary_path: The local path of the JSON summary file.
+    :param list_of_summaries: The list of TableSummary.
+    """
+    with open(summary_path, "w") as summary_file:
+        json.dump({"tables": [summary._asdict() for summary in list_of_summaries]}, summary_file, indent=2)
+    log.info("Run summary written to {}.".format(summary_path))
+
+
+def read_run_summary(summary_path):
+    """
+    Method that reads the per table summary of a run written by write_run_summary, e.g. by another shard.
+
+    :param summary_path: The local path of the JSON summary file.
+    :return: The list of TableSummary.
+    """
+    with open(summary_path) as summary_file:
+        tables = json.load(summary_file).get("tables", [])
+    return [TableSummary(**{field: table.get(field) for field in TableSummary._fields}) for table in tables]
@@ -0,0 +1,253 @@
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from google.cloud import bigquery
+
+from bq_external_table import gcp_clients, metrics, resilience
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+DEFAULT_SAMPLE_BYTES = 1024 * 1024
+TYPE_BOOLEAN = "BOOLEAN"
+TYPE_INTEGER = "INTEGER"
+TYPE_FLOAT = "FLOAT"
+TYPE_DATE = "DATE"
+TYPE_TIMESTAMP = "TIMESTAMP"
+TYPE_STRING = "STRING"
+BOOLEAN_VALUES = {"true", "false"}
+TIMESTAMP_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S.%f")
+INTEGER_PATTERN = re.compile(r"^[+-]?\d+$")
+FLOAT_PATTERN = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+INVALID_COLUMN_CHARACTERS = re.compile(r"[^0-9a-zA-Z_]")
+
+_schema_cache_lock = threading.Lock()
+
+
+def get_csv_schema(bucket_name, blob_prefix, blob_name, schema_cache_path, sample_bytes=DEFAULT_SAMPLE_BYTES,
+                   refresh=False):
+    """
+    Method that gets the explicit schema of the CSV files of a prefix. The schema is read from the local schema cache
+    or, when missing or refreshed, inferred from a sample of the first bytes of a blob and stored in the cache. A blank
+    blob gives no schema, so that the schema is autodetected, and nothing is cached, so that another blob is sampled
+    by the next load.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :param blob_name: The name of the blob to sample when the schema is not cached.
+    :param schema_cache_path: The local path of the JSON schema cache.
+    :param sample_bytes: The maximum number of bytes read from the blob.
+    :param refresh: Whether the cached schema is ignored and inferred again.
+    :return: The tuple with the list of BigQuery SchemaField and the number of header rows to skip, or None when the
+    blob has no rows.
+    """
+    cache_key = get_cache_key(bucket_name=bucket_name, blob_prefix=blob_prefix)
+    cached_schema = None if refresh else read_schema_cache(schema_cache_path).get(cache_key)
+    metrics.increment("schema_cache_lookups", result="miss" if cached_schema is None else "hit")
+    if cached_schema is None:
+        with metrics.timer("schema_inference", bucket=bucket_name):
+            sample, complete = read_blob_sample(bucket_name=bucket_name, blob_name=blob_name,
+                                                sample_bytes=sample_bytes)
+            fields, has_header = infer_csv_schema(sample=sample, complete=complete)
+        if not fields or not sample.strip():
+            log.warning("Could not infer the schema of gs://{}/{} from {}, which has no rows.".format(
+                bucket_name, blob_prefix, blob_name))
+            return None
+        cached_schema = {"fields": fields, "skip_leading_rows": 1 if has_header else 0, "source": blob_name,
+                         "inferred_at": time.time()}
+        write_schema_cache(schema_cache_path=schema_cache_path, cache_key=cache_key, cached_schema=cached_schema)
+        log.info("Inferred schema of gs://{}/{} from {}.".format(bucket_name, blob_prefix, blob_name))
+    return [bigquery.SchemaField(field["name"], field["type"], mode="NULLABLE") for field in cached_schema["fields"]], \
+        cached_schema["skip_leading_rows"]
+
+
+def get_cache_key(bucket_name, blob_prefix):
+    """
+    Method that gets the key of a prefix in the schema cache.
+
+    :param bucket_name: The bucket name.
+    :param blob_prefix: The string prefix used to select the blobs to load.
+    :return: The cache key.
+    """
+    return "gs://{}/{}".format(bucket_name, blob_prefix)
+
+
+def read_schema_cache(schema_cache_path):
+    """
+    Method that reads the local schema cache.
+
+    :param schema_cache_path: The local path of the JSON schema cache.
+    :return: The dictionary with the cached schema of each prefix.
+    """
+    with _schema_cache_lock:
+        if not os.path.isfile(schema_cache_path):
+            return {}
+        with open(schema_cache_path) as schema_cache_file:
+            return json.load(schema_cache_file)
+
+
+def write_schema_cache(schema_cache_path, cache_key, cached_schema):
+    """
+    Method that stores the schema of a prefix in the local schema cache.
+
+    :param schema_cache_path: The local path of the JSON schema cache.
+    :param cache_key: The cache key of the prefix.
+    :param cached_schema: The dictionary with the inferred fields, the header rows to skip and the sampled blob.
+    """
+    with _schema_cache_lock:
+        schema_cache = {}
+        if os.path.isfile(schema_cache_path):
+            with open(schema_cache_path) as schema_cache_file:
+                schema_cache = json.load(schema_cache_file)
+        schema_cache[cache_key] = cached_schema
+        temporary_path = schema_cache_path + ".tmp"
+        with open(temporary_path, "w") as schema_cache_file:
+            json.dump(schema_cache, schema_cache_file, indent=2)
+        os.replace(temporary_path, schema_cache_path)
+
+
+def read_blob_sample(bucket_name, blob_name, sample_bytes=DEFAULT_SAMPLE_BYTES):
+    """
+    Method that reads the first bytes of a blob with a ranged read.
+
+    :param bucket_name: The bucket name.
+    :param blob_name: The blob name.
+    :param sample_bytes: The maximum number of bytes to read.
+    :return: The tuple with the bytes read and whether they are the whole blob.
+    """
+    resilience.acquire(resilience.API_STORAGE)
+    sample = gcp_clients.get_bucket(bucket_name).blob(blob_name).download_as_bytes(
+        start=0, end=sample_bytes, retry=resilience.get_storage_retry())
+    return sample[:sample_bytes], len(sample) <= sample_bytes
+
+
+def infer_csv_schema(sample, complete=True):
+    """
+    Method that infers the column names and types of CSV data. The first row is used as header when none of its values
+    look like a number, a boolean or a date while the column of some of them does. When every value is text, the
+    first row cannot be told apart from the data and is kept as data.
+
+    :param sample: The first bytes of the CSV data.
+    :param complete: Whether the sample holds the whole file. When not, its last, possibly truncated, line is ignored.
+    :return: The tuple with the list of {"name", "type"} fields and whether the data has a header row.
+    """
+    text = sample.decode("utf-8", errors="replace")
+    if not complete:
+        text = text[:text.rfind("\n") + 1]
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    if not rows:
+        return [], False
+    column_count = max(len(row) for row in rows)
+    column_types = [None] * column_count
+    for row in rows[1:]:
+        for index, value in enumerate(row):
+            value = value.strip()
+            if value:
+                column_types[index] = merge_types(column_types[index], infer_value_type(value))
+    has_header = all(value.strip() and infer_value_type(value.strip()) == TYPE_STRING for value in rows[0]) and \
+        any(column_type not in (None, TYPE_STRING) for column_type in column_types)
+    header = rows[0] if has_header else []
+    if not has_header:
+        for index, value in enumerate(rows[0]):
+            value = value.strip()
+            if value:
+                column_types[index] = merge_types(column_types[index], infer_value_type(value))
+    names = get_column_names(header=header, column_count=column_count)
+    return [{"name": name, "type": column_type or TYPE_STRING} for name, column_type in zip(names, column_types)], \
+        has_header
+
+
+def infer_value_type(value):
+    """
+    Method that infers the BigQuery type of a single CSV value.
+
+    :param value: The stripped, non empty, CSV value.
+    :return: The BigQuery type.
+    """
+    if value.lower() in BOOLEAN_VALUES:
+        return TYPE_BOOLEAN
+    if INTEGER_PATTERN.match(value):
+        return TYPE_INTEGER if -2 ** 63 <= int(value) < 2 ** 63 else TYPE_FLOAT
+    if FLOAT_PATTERN.match(value):
+        return TYPE_FLOAT
+    if is_date(value):
+        return TYPE_DATE
+    if is_timestamp(value):
+        return TYPE_TIMESTAMP
+    return TYPE_STRING
+
+
+def is_date(value):
+    """
+    Method that checks whether a CSV value is a YYYY-MM-DD date.
+
+    :param value: The CSV value.
+    :return: True if the value is a date.
+    """
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+
+def is_timestamp(value):
+    """
+    Method that checks whether a CSV value is a timestamp, with an optional "Z" or UTC offset suffix.
+
+    :param value: The CSV value.
+    :return: True if the value is a timestamp.
+    """
+    value = re.sub(r"(Z|[+-]\d{2}:?\d{2}| UTC)$", "", value)
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            datetime.datetime.strptime(value, timestamp_format)
+            return True
+        except ValueError:
+            continue
+    return False
+
+
+def merge_types(current_type, value_type):
+    """
+    Method that widens the type of a column to fit a new value.
+
+    :param current_type: The type of the column so far, None when no value was seen.
+    :param value_type: The type of the new value.
+    :return: The widened type.
+    """
+    if current_type is None or current_type == value_type:
+        return value_type
+    if {current_type, value_type} == {TYPE_INTEGER, TYPE_FLOAT}:
+        return TYPE_FLOAT
+    if {current_type, value_type} == {TYPE_DATE, TYPE_TIMESTAMP}:
+        return TYPE_TIMESTAMP
+    return TYPE_STRING
+
+
+def get_column_names(header, column_count):
+    """
+    Method that gets valid and unique BigQuery column names from a CSV header.
+
+    :param header: The list of header values, empty when the data has no header.
+    :param column_count: The number of columns.
+    :return: The list of column names.
+    """
+    names = []
+    for index in range(column_count):
+        name = INVALID_COLUMN_CHARACTERS.sub("_", header[index].strip()) if index < len(header) else ""
+        if not name or name[0].isdigit():
+            name = "_{}".format(name) if name else "column_{}".format(index)
+        unique_name = name
+        suffix = 1
+        while unique_name.lower() in {existing.lower() for existing in names}:
+            unique_name = "{}_{}".format(name, suffix)
+            suffix += 1
+        names.append(unique_name)
+    return names
@@ -1,3 +1,7 @@
+from bq_external_table import async_interfacer, gcp_clients, gcp_interfacer, partitioning, resilience, scheduler, \
+    schema_inference, sharding
+
+
 def set_run_variables(json_config):
     """
     Method that sets the variables required for the GCP actions.
@@ -8,3 +12,64 @@ def set_run_variables(json_config):
     """
     return json_config.get("log_location"), json_config.get("credentials_file_path"), json_config.get(
         "dataset_name"), json_config.get("buckets")
+
+
+def set_datasets(json_config):
+    """
+    Method that sets the tables to load into each data set. Besides the "dataset_name" and "buckets" of the config,
+    a "datasets" dictionary can map more data set names to their own buckets, so that one run covers many data sets.
+
+    :param json_config: The actions config json.
+    :return: A dictionary with the dictionary of the list of table details of each bucket, per data set name.
+    """
+    datasets = {}
+    if json_config.get("dataset_name") and json_config.get("buckets"):
+        datasets[json_config.get("dataset_name")] = {bucket: list(blobs)
+                                                     for bucket, blobs in json_config.get("buckets").items()}
+    for dataset_name, buckets in (json_config.get("datasets") or {}).items():
+        dataset_buckets = datasets.setdefault(dataset_name, {})
+        for bucket, blobs in buckets.items():
+            dataset_buckets.setdefault(bucket, []).extend(blobs)
+    return datasets
+
+
+def set_load_options(json_config):
+    """
+    Method that sets the optional variables that tune how the load jobs are run.
+
+    :param json_config: The actions config json.
+    :return: A dictionary with the load options, using the defaults for the ones missing from the config.
+    """
+    return {
+        "max_concurrent_jobs": json_config.get("max_concurrent_jobs", gcp_interfacer.DEFAULT_MAX_CONCURRENT_JOBS),
+        "job_poll_interval": json_config.get("job_poll_interval", gcp_interfacer.DEFAULT_JOB_POLL_INTERVAL),
+        "load_mode": json_config.get("load_mode", gcp_interfacer.LOAD_MODE_PER_BLOB),
+        "max_uris_per_job": json_config.get("max_uris_per_job", gcp_interfacer.MAX_URIS_PER_LOAD_JOB),
+        "max_bytes_per_job": json_config.get("max_bytes_per_job", gcp_interfacer.MAX_BYTES_PER_LOAD_JOB),
+        "http_pool_size": json_config.get("http_pool_size", gcp_clients.DEFAULT_POOL_SIZE),
+        "manifest_path": json_config.get("manifest_path"),
+        "max_concurrent_tables": json_config.get("max_concurrent_tables", scheduler.DEFAULT_MAX_CONCURRENT_TABLES),
+        "max_concurrent_tables_per_bucket": json_config.get("max_concurrent_tables_per_bucket"),
+        "max_concurrent_partitions": json_config.get("max_concurrent_partitions",
+                                                      partitioning.DEFAULT_MAX_CONCURRENT_PARTITIONS),
+        "summary_path": json_config.get("summary_path"),
+        "history_path": json_config.get("history_path"),
+        "schema_cache_path": json_config.get("schema_cache_path"),
+        "schema_sample_bytes": json_config.get("schema_sample_bytes", schema_inference.DEFAULT_SAMPLE_BYTES),
+        "table_type": json_config.get("table_type", gcp_interfacer.TABLE_TYPE_NATIVE),
+        "metrics_path": json_config.get("metrics_path"),
+        "prometheus_path": json_config.get("prometheus_path"),
+        "max_retry_attempts": json_config.get("max_retry_attempts", resilience.DEFAULT_MAX_ATTEMPTS),
+        "max_job_attempts": json_config.get("max_job_attempts", resilience.DEFAULT_MAX_JOB_ATTEMPTS),
+        "retry_initial_delay": json_config.get("retry_initial_delay", resilience.DEFAULT_INITIAL_DELAY),
+        "retry_max_delay": json_config.get("retry_max_delay", resilience.DEFAULT_MAX_DELAY),
+        "storage_requests_per_second": json_config.get("storage_requests_per_second"),
+        "bigquery_requests_per_second": json_config.get("bigquery_requests_per_second"),
+        "io_backend": json_config.get("io_backend", "threads"),
+        "max_concurrent_operations": json_config.get("max_concurrent_operations",
+                                                      async_interfacer.DEFAULT_MAX_CONCURRENT_OPERATIONS),
+        "worker_processes": json_config.get("worker_processes", 1),
+        "shard_by": json_config.get("shard_by", sharding.SHARD_BY_BUCKET),
+        "preprocessing": json_config.get("preprocessing"),
+        "watch": json_config.get("watch")
+    }
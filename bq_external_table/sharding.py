@@ -0,0 +1,137 @@
+import hashlib
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bq_external_table import metrics, scheduler
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+SHARD_BY_BUCKET = "bucket"
+SHARD_BY_TABLE = "table"
+
+Shard = namedtuple("Shard", ["index", "count"])
+
+
+def parse_shard(value):
+    """
+    Method that parses a shard given as "i/N", the shard i, starting at 0, of N shards.
+
+    :param value: The shard string.
+    :return: The Shard.
+    """
+    index, separator, count = value.partition("/")
+    if not separator or not index.isdigit() or not count.isdigit() or not 0 <= int(index) < int(count):
+        raise ValueError("{} is not a shard, expected i/N with 0 <= i < N.".format(value))
+    return Shard(index=int(index), count=int(count))
+
+
+def get_shard_key(dataset_name, bucket_name, table_details, shard_by=SHARD_BY_BUCKET):
+    """
+    Method that gets the key a table is sharded by. Sharding by bucket keeps the tables of a bucket in the same shard,
+    so that the per bucket limits still apply, sharding by table spreads them evenly.
+
+    :param dataset_name: The data set name.
+    :param bucket_name: The bucket name.
+    :param table_details: The table details.
+    :param shard_by: SHARD_BY_BUCKET or SHARD_BY_TABLE.
+    :return: The shard key.
+    """
+    if shard_by == SHARD_BY_TABLE:
+        return "{}/{}/{}".format(dataset_name, bucket_name, table_details.get("table_name"))
+    return bucket_name
+
+
+def get_shard_index(shard_key, shard_count):
+    """
+    Method that gets the shard of a key. The hash is stable across processes and hosts, unlike the built-in hash.
+
+    :param shard_key: The shard key.
+    :param shard_count: The number of shards.
+    :return: The shard index, from 0 to shard_count - 1.
+    """
+    return int(hashlib.md5(shard_key.encode("utf-8")).hexdigest(), 16) % shard_count
+
+
+def select_shard(datasets, shard, shard_by=SHARD_BY_BUCKET):
+    """
+    Method that selects the tables of one shard.
+
+    :param datasets: The dictionary with the buckets of each data set.
+    :param shard: The Shard.
+    :param shard_by: SHARD_BY_BUCKET or SHARD_BY_TABLE.
+    :return: The dictionary with the buckets of each data set, restricted to the tables of the shard.
+    """
+    return split_datasets(datasets=datasets, shard_count=shard.count, shard_by=shard_by)[shard.index]
+
+
+def split_datasets(datasets, shard_count, shard_by=SHARD_BY_BUCKET):
+    """
+    Method that splits the tables of every data set into shards. Data sets and buckets without a table in a shard are
+    left out of it.
+
+    :param datasets: The dictionary with the buckets of each data set.
+    :param shard_count: The number of shards.
+    :param shard_by: SHARD_BY_BUCKET or SHARD_BY_TABLE.
+    :return: The list with the dictionary of the buckets of each data set, per shard.
+    """
+    shards = [{} for _ in range(shard_count)]
+    for dataset_name, buckets in datasets.items():
+        for bucket_name, blobs in buckets.items():
+            for table_details in blobs:
+                shard_index = get_shard_index(get_shard_key(dataset_name=dataset_name, bucket_name=bucket_name,
+                                                            table_details=table_details, shard_by=shard_by),
+                                              shard_count)
+                shards[shard_index].setdefault(dataset_name, {}).setdefault(bucket_name, []).append(table_details)
+    return shards
+
+
+def run_worker_processes(datasets, worker_processes, run_worker, worker_arguments=(), shard_by=SHARD_BY_BUCKET):
+    """
+    Method that loads the tables of every data set with a pool of worker processes, one shard per process, and merges
+    their summaries and metrics. A worker that dies only fails the tables of its own shard.
+
+    :param datasets: The dictionary with the buckets of each data set.
+    :param worker_processes: The number of worker processes.
+    :param run_worker: The picklable callable that loads one shard. It is called with the dictionary of the shard
+    followed by worker_arguments, and returns the list of TableSummary and the snapshot of its metrics.
+    :param worker_arguments: The extra picklable arguments of run_worker.
+    :param shard_by: SHARD_BY_BUCKET or SHARD_BY_TABLE.
+    :return: The list of TableSummary of every shard, in shard order.
+    """
+    shards = [shard for shard in split_datasets(datasets=datasets, shard_count=worker_processes, shard_by=shard_by)
+              if shard]
+    summaries = {}
+    # Worker processes are spawned rather than forked, so that they do not inherit locks held by other threads.
+    with ProcessPoolExecutor(max_workers=max(1, len(shards)), mp_context=multiprocessing.get_context("spawn")) \
+            as executor:
+        futures = {executor.submit(run_worker, shard, *worker_arguments): shard_index
+                   for shard_index, shard in enumerate(shards)}
+        for future in as_completed(futures):
+            shard_index = futures[future]
+            try:
+                list_of_summaries, metrics_snapshot = future.result()
+                metrics.get_registry().merge(metrics_snapshot)
+            except Exception as exception:
+                log.error("Worker of shard {} failed: {}".format(shard_index, exception))
+                list_of_summaries = get_failed_summaries(shards[shard_index], error=str(exception))
+            summaries[shard_index] = list_of_summaries
+            log.info("Shard {} of {} finished, {} tables.".format(shard_index, len(shards), len(list_of_summaries)))
+    return [summary for shard_index in sorted(summaries) for summary in summaries[shard_index]]
+
+
+def get_failed_summaries(datasets, error):
+    """
+    Method that gets the summaries of tables that could not be loaded at all.
+
+    :param datasets: The dictionary with the buckets of each data set.
+    :param error: The error that stopped them.
+    :return: The list of TableSummary.
+    """
+    return [scheduler.TableSummary(bucket_name=bucket_name, table_id=table_details.get("table_name"), duration=0.0,
+                                   jobs=0, failed_jobs=0, input_bytes=0, output_rows=0, error=error,
+                                   dataset_name=dataset_name)
+            for dataset_name, buckets in datasets.items()
+            for bucket_name, blobs in buckets.items()
+            for table_details in blobs]
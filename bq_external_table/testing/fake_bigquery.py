@@ -0,0 +1,262 @@
+import datetime
+import fnmatch
+import threading
+import time
+import uuid
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+MULTI_REGION_LOCATIONS = ("US", "EU")
+
+
+class FakeLoadJob(object):
+    """
+    Stand-in for a BigQuery load job that finishes after the duration computed by its FakeBigQueryClient.
+    """
+
+    def __init__(self, client, job_id, source_uris, destination, job_config, input_files, input_bytes, duration,
+                 error):
+        self.client = client
+        self.location = client.location
+        self.job_id = job_id
+        self.source_uris = source_uris
+        self.destination = destination
+        self.job_config = job_config
+        self.input_files = input_files
+        self.input_file_bytes = input_bytes
+        self.output_rows = input_bytes // client.bytes_per_row if client.bytes_per_row else 0
+        self.slot_millis = int(duration * 1000)
+        self.created_at = time.time()
+        self.ends_at = self.created_at + duration
+        self._error = error
+
+    @property
+    def created(self):
+        """
+        The job creation time.
+        """
+        return datetime.datetime.fromtimestamp(self.created_at, datetime.timezone.utc)
+
+    @property
+    def started(self):
+        """
+        The job start time, the fake jobs start as soon as they are created.
+        """
+        return self.created
+
+    @property
+    def ended(self):
+        """
+        The job end time, None while running.
+        """
+        if self.state != "DONE":
+            return None
+        return datetime.datetime.fromtimestamp(self.ends_at, datetime.timezone.utc)
+
+    @property
+    def state(self):
+        """
+        The job state, "RUNNING" or "DONE".
+        """
+        return "DONE" if time.time() >= self.ends_at else "RUNNING"
+
+    @property
+    def error_result(self):
+        """
+        The error of a failed job, None while running or when it succeeded.
+        """
+        if self._error and self.state == "DONE":
+            return {"reason": self.client.failure_reason, "message": self._error}
+        return None
+
+    def done(self, *args, **kwargs):
+        """
+        Method that polls the job, paying the API latency like a real jobs.get call.
+
+        :return: True if the job is finished.
+        """
+        self.client.simulate_api_call()
+        return self.state == "DONE"
+
+    def result(self, *args, **kwargs):
+        """
+        Method that waits for the job to finish.
+
+        :return: The job itself.
+        """
+        time.sleep(max(0.0, self.ends_at - time.time()))
+        if self.error_result:
+            raise exceptions.BadRequest(self._error)
+        return self
+
+
+class FakeBigQueryClient(object):
+    """
+    Stand-in for the subset of the BigQuery client used by this application, with injectable latency. Every API call
+    waits api_latency seconds and every load job runs for job_latency seconds, plus the time to read its input at
+    bytes_per_second when set. When a FakeGCSServer is given, the size of the loaded objects is resolved from it,
+    wildcards included. A fraction of the jobs, failure_rate, fails with failure_reason. A fraction of the API calls,
+    fault_rate, raises a rateLimitExceeded error. With lost_responses, the faulty job submissions still create the
+    job, like a request whose response never arrived. Every data set is in location and, like BigQuery, the jobs of a
+    location other than the US and EU multi-regions are only found when their location is given.
+    """
+
+    def __init__(self, project="fake-project", api_latency=0.0, job_latency=0.0, bytes_per_second=None,
+                 bytes_per_row=100, gcs_server=None, failure_rate=0.0, failure_reason="invalid", fault_rate=0.0,
+                 lost_responses=False, location="US"):
+        self.project = project
+        self.location = location
+        self.failure_reason = failure_reason
+        self.fault_rate = fault_rate
+        self.lost_responses = lost_responses
+        self.fault_count = 0
+        self.api_latency = api_latency
+        self.job_latency = job_latency
+        self.bytes_per_second = bytes_per_second
+        self.bytes_per_row = bytes_per_row
+        self.gcs_server = gcs_server
+        self.failure_rate = failure_rate
+        self.api_call_count = 0
+        self.jobs = {}
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def simulate_api_call(self, raise_fault=True):
+        """
+        Method that accounts for, and waits the latency of, one API call.
+
+        :param raise_fault: Whether an injected fault is raised, or only returned.
+        :return: True if the call is an injected fault.
+        """
+        with self._lock:
+            self.api_call_count += 1
+            fault = int(self.api_call_count * self.fault_rate) > int((self.api_call_count - 1) * self.fault_rate)
+            self.fault_count += fault
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if fault and raise_fault:
+            raise get_rate_limit_error()
+        return fault
+
+    def dataset(self, dataset_name):
+        """
+        Method that gets a reference to a data set of the fake project.
+
+        :return: The DatasetReference.
+        """
+        return bigquery.DatasetReference(self.project, dataset_name)
+
+    def load_table_from_uri(self, source_uris, destination, job_id=None, job_id_prefix=None, job_config=None,
+                            **kwargs):
+        """
+        Method that submits a fake load job.
+
+        :return: The FakeLoadJob.
+        """
+        fault = self.simulate_api_call(raise_fault=not self.lost_responses)
+        source_uris = [source_uris] if isinstance(source_uris, str) else list(source_uris)
+        job_id = job_id or "{}{}".format(job_id_prefix or "fake_job_", uuid.uuid4().hex)
+        input_files, input_bytes = self.resolve_source_uris(source_uris)
+        duration = self.job_latency + (input_bytes / self.bytes_per_second if self.bytes_per_second else 0.0)
+        with self._lock:
+            if job_id in self.jobs:
+                raise exceptions.Conflict("Already Exists: Job {}:{}".format(self.project, job_id))
+            job_index = len(self.jobs)
+            fails = int((job_index + 1) * self.failure_rate) > int(job_index * self.failure_rate)
+            error = "Injected load failure" if fails else None
+            self.jobs[job_id] = FakeLoadJob(client=self, job_id=job_id, source_uris=source_uris,
+                                            destination=destination, job_config=job_config, input_files=input_files,
+                                            input_bytes=input_bytes, duration=duration, error=error)
+        if fault:
+            raise get_rate_limit_error()
+        return self.jobs[job_id]
+
+    def resolve_source_uris(self, source_uris):
+        """
+        Method that gets the number of files and bytes selected by gs:// URIs, from the fake GCS server.
+
+        :param source_uris: The list of gs:// URIs, possibly with wildcards.
+        :return: The tuple with the number of files and the number of bytes.
+        """
+        if self.gcs_server is None:
+            return len(source_uris), 0
+        input_files = 0
+        input_bytes = 0
+        with self.gcs_server._lock:
+            for uri in source_uris:
+                bucket_name, _, blob_pattern = uri[len("gs://"):].partition("/")
+                objects = self.gcs_server._buckets.get(bucket_name, {})
+                if "*" in blob_pattern:
+                    matches = [blob for name, blob in objects.items() if fnmatch.fnmatchcase(name, blob_pattern)]
+                else:
+                    matches = [objects[blob_pattern]] if blob_pattern in objects else []
+                input_files += len(matches)
+                input_bytes += sum(blob.size for blob in matches)
+        return input_files, input_bytes
+
+    def get_dataset(self, dataset_ref, **kwargs):
+        """
+        Method that gets a data set of the fake project.
+
+        :return: The Dataset.
+        """
+        self.simulate_api_call()
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.location = self.location
+        return dataset
+
+    def get_job(self, job_id, location=None, **kwargs):
+        """
+        Method that gets a submitted fake job.
+
+        :return: The FakeLoadJob.
+        """
+        self.simulate_api_call()
+        if job_id not in self.jobs or (location is None and self.location not in MULTI_REGION_LOCATIONS):
+            raise exceptions.NotFound("Not found: Job {}:{}".format(self.project, job_id))
+        return self.jobs[job_id]
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        """
+        Method that records a table definition.
+
+        :return: The table.
+        """
+        self.simulate_api_call()
+        with self._lock:
+            if table.reference in self.tables and not exists_ok:
+                raise exceptions.Conflict("Already Exists: Table {}".format(table.reference))
+            self.tables[table.reference] = table
+        return table
+
+    def update_table(self, table, fields, **kwargs):
+        """
+        Method that replaces a table definition.
+
+        :return: The table.
+        """
+        self.simulate_api_call()
+        self.tables[table.reference] = table
+        return table
+
+    def get_table(self, table, **kwargs):
+        """
+        Method that gets a recorded table definition.
+
+        :return: The table.
+        """
+        self.simulate_api_call()
+        if table not in self.tables:
+            raise exceptions.NotFound("Not found: Table {}".format(table))
+        return self.tables[table]
+
+
+def get_rate_limit_error():
+    """
+    Method that builds the error BigQuery raises when it throttles a call.
+
+    :return: The exception.
+    """
+    return exceptions.Forbidden("Exceeded rate limits: too many api requests per user per method for this user_id",
+                                errors=[{"reason": "rateLimitExceeded", "message": "Exceeded rate limits"}])
@@ -0,0 +1,153 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse, unquote
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+
+JOBS_PATH_PATTERN = re.compile(r"^/bigquery/v2/projects/([^/]+)/jobs(?:/([^/]+))?$")
+DATASET_PATH_PATTERN = re.compile(r"^/bigquery/v2/projects/([^/]+)/datasets/([^/]+)$")
+
+
+class FakeBigQueryServer(object):
+    """
+    In-process stand-in for the jobs resource of the BigQuery REST API, backed by a FakeBigQueryClient: load jobs can
+    be inserted and polled over HTTP, with the latency, failures and faults of the client.
+    """
+
+    def __init__(self, client=None, host="127.0.0.1", port=0):
+        self.client = client or FakeBigQueryClient()
+        self._server = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """
+        The base URL of the server, to use as the BigQuery API endpoint.
+        """
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """
+        Method that starts serving requests in a background thread.
+
+        :return: The server itself.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Method that stops the server and releases its port.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def _handle(self, method):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                url = urlparse(self.path)
+                dataset_match = DATASET_PATH_PATTERN.match(url.path)
+                if method == "GET" and dataset_match:
+                    return self._send_json(200, {"kind": "bigquery#dataset", "location": server.client.location,
+                                                 "datasetReference": {"projectId": unquote(dataset_match.group(1)),
+                                                                      "datasetId": unquote(dataset_match.group(2))}})
+                match = JOBS_PATH_PATTERN.match(url.path)
+                if not match:
+                    return self._send_error(404, "Not Found", "notFound")
+                try:
+                    if method == "POST" and match.group(2) is None:
+                        load_job = self._insert_job(json.loads(body.decode()))
+                    elif method == "GET" and match.group(2) is not None:
+                        load_job = server.client.get_job(unquote(match.group(2)),
+                                                         location=parse_qs(url.query).get("location", [None])[0])
+                    else:
+                        return self._send_error(405, "Method not allowed", "invalid")
+                except exceptions.GoogleAPIError as error:
+                    return self._send_error(error.code, error.message,
+                                            (error.errors or [{}])[0].get("reason", "invalid"))
+                self._send_json(200, get_job_resource(server.client.project, load_job))
+
+            def _insert_job(self, resource):
+                load_configuration = resource["configuration"]["load"]
+                destination = load_configuration["destinationTable"]
+                job_config = bigquery.LoadJobConfig.from_api_repr(
+                    {"load": {key: value for key, value in load_configuration.items()
+                              if key not in ("sourceUris", "destinationTable")}})
+                return server.client.load_table_from_uri(
+                    load_configuration["sourceUris"],
+                    bigquery.DatasetReference(destination["projectId"], destination["datasetId"]).table(
+                        destination["tableId"]),
+                    job_id=resource.get("jobReference", {}).get("jobId"),
+                    job_config=job_config)
+
+            def _send_json(self, status, payload):
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _send_error(self, status, message, reason):
+                self._send_json(status, {"error": {"code": status, "message": message,
+                                                   "errors": [{"message": message, "reason": reason}]}})
+
+        return Handler
+
+
+def get_job_resource(project, load_job):
+    """
+    Method that gets the REST resource of a fake load job.
+
+    :param project: The project of the job.
+    :param load_job: The FakeLoadJob.
+    :return: The job resource.
+    """
+    state = load_job.state
+    resource = {
+        "kind": "bigquery#job",
+        "id": "{}:{}.{}".format(project, load_job.location, load_job.job_id),
+        "jobReference": {"projectId": project, "jobId": load_job.job_id, "location": load_job.location},
+        "configuration": {"load": {"sourceUris": load_job.source_uris}},
+        "status": {"state": state},
+        "statistics": {"creationTime": str(int(load_job.created_at * 1000)),
+                       "startTime": str(int(load_job.created_at * 1000))},
+    }
+    if state == "DONE":
+        resource["statistics"]["endTime"] = str(int(load_job.ends_at * 1000))
+        resource["statistics"]["totalSlotMs"] = str(load_job.slot_millis)
+        resource["statistics"]["load"] = {"inputFiles": str(load_job.input_files),
+                                          "inputFileBytes": str(load_job.input_file_bytes),
+                                          "outputRows": str(load_job.output_rows)}
+        if load_job.error_result:
+            resource["status"]["errorResult"] = load_job.error_result
+            resource["status"]["errors"] = [load_job.error_result]
+    return resource
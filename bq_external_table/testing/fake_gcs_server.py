@@ -0,0 +1,480 @@
+import base64
+import bisect
+import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+DEFAULT_PAGE_SIZE = 1000
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class FakeObject(object):
+    """
+    Compact record of a stored object, so that listings of millions of synthetic objects fit in memory.
+    """
+    __slots__ = ("name", "bucket", "size", "data", "md5_hash", "crc32c", "content_type", "generation", "updated")
+
+    def __init__(self, name, bucket, size, data, md5_hash, crc32c, content_type, generation, updated):
+        self.name = name
+        self.bucket = bucket
+        self.size = size
+        self.data = data
+        self.md5_hash = md5_hash
+        self.crc32c = crc32c
+        self.content_type = content_type
+        self.generation = generation
+        self.updated = updated
+
+
+class FakeGCSServer(object):
+    """
+    In-process stand-in for the subset of the Cloud Storage JSON API used by this application: buckets, object
+    listing with prefix, delimiter, glob and pagination, metadata, ranged downloads, deletes and simple, multipart and
+    resumable uploads. Every request can be delayed by a fixed latency. With store_data disabled, uploaded content is
+    checksummed and dropped, so that very large uploads do not fill the memory. A fraction of the requests, fault_rate,
+    evenly spread, fails with the fault_status HTTP status, 429 by default, to exercise retries.
+    """
+
+    def __init__(self, latency=0.0, store_data=True, host="127.0.0.1", port=0, fault_rate=0.0, fault_status=429):
+        self.latency = latency
+        self.store_data = store_data
+        self.fault_rate = fault_rate
+        self.fault_status = fault_status
+        self.fault_count = 0
+        self.request_count = 0
+        self._buckets = {}
+        self._sorted_names = {}
+        self._uploads = {}
+        self._lock = threading.RLock()
+        self._generation = int(time.time() * 1000000)
+        self._server = ThreadingHTTPServer((host, port), self._get_handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """
+        The base URL of the server, to use as the Cloud Storage API endpoint.
+        """
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """
+        Method that starts serving requests in a background thread.
+
+        :return: The server itself.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Method that stops the server and releases its port.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def create_bucket(self, bucket_name):
+        """
+        Method that creates an empty bucket, if it does not exist.
+
+        :param bucket_name: The name of the bucket.
+        """
+        with self._lock:
+            self._buckets.setdefault(bucket_name, {})
+            self._sorted_names.pop(bucket_name, None)
+
+    def put_object(self, bucket_name, blob_name, data, content_type="application/octet-stream"):
+        """
+        Method that stores an object.
+
+        :param bucket_name: The name of the bucket.
+        :param blob_name: The name of the object.
+        :param data: The object content, or an int to create a synthetic object of that size whose content is only
+        generated, as zeros, when it is downloaded.
+        :param content_type: The content type of the object.
+        :return: The stored object.
+        """
+        if isinstance(data, int):
+            size, data, md5_hash, crc32c = data, None, None, None
+        else:
+            size, md5_hash, crc32c = len(data), get_md5_hash(data), get_crc32c(data)
+            data = bytes(data) if self.store_data else None
+        with self._lock:
+            self._generation += 1
+            blob = FakeObject(name=blob_name, bucket=bucket_name, size=size, data=data, md5_hash=md5_hash,
+                              crc32c=crc32c, content_type=content_type, generation=self._generation,
+                              updated=get_timestamp())
+            self._buckets.setdefault(bucket_name, {})[blob_name] = blob
+            self._sorted_names.pop(bucket_name, None)
+            return blob
+
+    def put_synthetic_objects(self, bucket_name, blob_names, size, content_type="application/octet-stream"):
+        """
+        Method that stores many synthetic objects of the same size at once, e.g. to benchmark listings.
+
+        :param bucket_name: The name of the bucket.
+        :param blob_names: The iterable of object names.
+        :param size: The size in bytes of each object.
+        :param content_type: The content type of the objects.
+        """
+        updated = get_timestamp()
+        with self._lock:
+            objects = self._buckets.setdefault(bucket_name, {})
+            for blob_name in blob_names:
+                self._generation += 1
+                objects[blob_name] = FakeObject(name=blob_name, bucket=bucket_name, size=size, data=None,
+                                                md5_hash=None, crc32c=None, content_type=content_type,
+                                                generation=self._generation, updated=updated)
+            self._sorted_names.pop(bucket_name, None)
+
+    def get_object_data(self, bucket_name, blob_name):
+        """
+        Method that gets the content of an object.
+
+        :param bucket_name: The name of the bucket.
+        :param blob_name: The name of the object.
+        :return: The object content.
+        """
+        with self._lock:
+            blob = self._buckets[bucket_name][blob_name]
+            return blob.data if blob.data is not None else bytes(blob.size)
+
+    def list_object_names(self, bucket_name):
+        """
+        Method that lists the names of the objects of a bucket.
+
+        :param bucket_name: The name of the bucket.
+        :return: The sorted list of object names.
+        """
+        with self._lock:
+            return list(self._get_sorted_names(bucket_name))
+
+    def _get_sorted_names(self, bucket_name):
+        if bucket_name not in self._sorted_names:
+            self._sorted_names[bucket_name] = sorted(self._buckets[bucket_name])
+        return self._sorted_names[bucket_name]
+
+    def _list_objects(self, bucket_name, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        glob_pattern = compile_glob(query["matchGlob"]) if query.get("matchGlob") else None
+        page_size = int(query.get("maxResults", DEFAULT_PAGE_SIZE))
+        page_token = query.get("pageToken")
+        with self._lock:
+            names = self._get_sorted_names(bucket_name)
+            position = bisect.bisect_right(names, page_token) if page_token else bisect.bisect_left(names, prefix)
+            items, prefixes, last_name = [], [], None
+            while position < len(names) and len(items) + len(prefixes) < page_size:
+                name = names[position]
+                if not name.startswith(prefix):
+                    break
+                last_name = name
+                position += 1
+                if delimiter and delimiter in name[len(prefix):]:
+                    common_prefix = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                    if common_prefix not in prefixes:
+                        prefixes.append(common_prefix)
+                    position = bisect.bisect_left(names, common_prefix + "\U0010ffff")
+                    last_name = common_prefix + "\U0010ffff"
+                    continue
+                if glob_pattern and not glob_pattern.match(name):
+                    continue
+                items.append(get_object_resource(self._buckets[bucket_name][name]))
+            more = position < len(names) and names[position].startswith(prefix)
+        response = {"kind": "storage#objects", "items": items}
+        if prefixes:
+            response["prefixes"] = prefixes
+        if more:
+            response["nextPageToken"] = last_name
+        return response
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+            def _handle(self, method):
+                with server._lock:
+                    server.request_count += 1
+                    fault = int(server.request_count * server.fault_rate) > \
+                        int((server.request_count - 1) * server.fault_rate)
+                    server.fault_count += fault
+                if server.latency:
+                    time.sleep(server.latency)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if fault:
+                    return self._send_error(server.fault_status, "Injected fault",
+                                            "rateLimitExceeded" if server.fault_status == 429 else "backendError")
+                url = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    self._route(method, url.path, query, body)
+                except KeyError:
+                    self._send_error(404, "Not Found", "notFound")
+
+            def _route(self, method, path, query, body):
+                if path.startswith("/upload/storage/v1/b/") and path.endswith("/o"):
+                    bucket_name = unquote(path[len("/upload/storage/v1/b/"):-len("/o")])
+                    self._upload(method, bucket_name, query, body)
+                    return
+                if path.startswith("/upload/resumable/"):
+                    self._resumable_chunk(path[len("/upload/resumable/"):], body)
+                    return
+                download = path.startswith("/download/")
+                path = path[len("/download"):] if download else path
+                if path.rstrip("/") == "/storage/v1/b":
+                    bucket_name = json.loads(body.decode())["name"] if method == "POST" else None
+                    if method != "POST":
+                        return self._send_error(405, "Method not allowed", "invalid")
+                    if bucket_name in server._buckets:
+                        return self._send_error(409, "Bucket already exists", "conflict")
+                    server.create_bucket(bucket_name)
+                    return self._send_json(200, get_bucket_resource(bucket_name))
+                match = re.match(r"^/storage/v1/b/([^/]+)(/o(?:/(.+))?)?$", path)
+                if not match:
+                    return self._send_error(404, "Not Found", "notFound")
+                bucket_name = unquote(match.group(1))
+                blob_name = unquote(match.group(3)) if match.group(3) else None
+                objects = server._buckets[bucket_name]
+                if match.group(2) is None:
+                    if method == "DELETE":
+                        if objects:
+                            return self._send_error(409, "The bucket you tried to delete is not empty.", "conflict")
+                        with server._lock:
+                            del server._buckets[bucket_name]
+                        return self._send_empty(204)
+                    return self._send_json(200, get_bucket_resource(bucket_name))
+                if blob_name is None:
+                    return self._send_json(200, server._list_objects(bucket_name, query))
+                blob = objects[blob_name]
+                if method == "DELETE":
+                    with server._lock:
+                        del objects[blob_name]
+                        server._sorted_names.pop(bucket_name, None)
+                    return self._send_empty(204)
+                if download or query.get("alt") == "media":
+                    return self._download(bucket_name, blob)
+                return self._send_json(200, get_object_resource(blob))
+
+            def _download(self, bucket_name, blob):
+                data = server.get_object_data(bucket_name, blob.name)
+                range_match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+                headers = {"x-goog-generation": str(blob.generation)}
+                if range_match:
+                    start = int(range_match.group(1))
+                    end = min(int(range_match.group(2)) if range_match.group(2) else len(data) - 1, len(data) - 1)
+                    headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, len(data))
+                    return self._send(206, data[start:end + 1], "application/octet-stream", headers)
+                if blob.md5_hash and blob.data is not None:
+                    headers["X-Goog-Hash"] = "crc32c={},md5={}".format(blob.crc32c, blob.md5_hash) \
+                        if blob.crc32c else "md5={}".format(blob.md5_hash)
+                return self._send(200, data, blob.content_type, headers)
+
+            def _upload(self, method, bucket_name, query, body):
+                if bucket_name not in server._buckets:
+                    return self._send_error(404, "Bucket not found", "notFound")
+                upload_type = query.get("uploadType", "media")
+                if upload_type == "media":
+                    blob = server.put_object(bucket_name, query["name"], body,
+                                             self.headers.get("Content-Type", "application/octet-stream"))
+                    return self._send_json(200, get_object_resource(blob))
+                if upload_type == "multipart":
+                    metadata, content_type, data = parse_multipart(self.headers.get("Content-Type"), body)
+                    blob = server.put_object(bucket_name, metadata.get("name") or query.get("name"), data,
+                                             metadata.get("contentType") or content_type)
+                    return self._send_json(200, get_object_resource(blob))
+                metadata = json.loads(body.decode()) if body else {}
+                upload_id = uuid.uuid4().hex
+                with server._lock:
+                    server._uploads[upload_id] = {
+                        "bucket": bucket_name, "name": metadata.get("name") or query.get("name"),
+                        "contentType": metadata.get("contentType") or self.headers.get(
+                            "X-Upload-Content-Type", "application/octet-stream"),
+                        "data": bytearray()
+                    }
+                location = "{}/upload/resumable/{}".format(server.endpoint, upload_id)
+                return self._send(200, b"", "text/plain", {"Location": location})
+
+            def _resumable_chunk(self, upload_id, body):
+                upload = server._uploads[upload_id]
+                content_range = CONTENT_RANGE_PATTERN.match(self.headers.get("Content-Range", "bytes */*"))
+                if content_range is None:
+                    return self._send_error(400, "Invalid Content-Range", "invalid")
+                start, _, total = content_range.groups()
+                with server._lock:
+                    if start is not None:
+                        if int(start) != len(upload["data"]):
+                            return self._send_error(400, "Chunk does not start at the persisted offset", "invalid")
+                        upload["data"].extend(body)
+                    if total != "*" and int(total) == len(upload["data"]):
+                        blob = server.put_object(upload["bucket"], upload["name"], bytes(upload["data"]),
+                                                 upload["contentType"])
+                        del server._uploads[upload_id]
+                        return self._send_json(200, get_object_resource(blob))
+                    received = len(upload["data"])
+                headers = {"Range": "bytes=0-{}".format(received - 1)} if received else {}
+                return self._send(308, b"", "text/plain", headers)
+
+            def _send_json(self, status, payload):
+                self._send(status, json.dumps(payload).encode(), "application/json", {})
+
+            def _send_error(self, status, message, reason):
+                self._send_json(status, {"error": {"code": status, "message": message,
+                                                   "errors": [{"message": message, "reason": reason}]}})
+
+            def _send_empty(self, status):
+                self._send(status, b"", "text/plain", {})
+
+            def _send(self, status, payload, content_type, headers):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+def get_timestamp():
+    """
+    Method that gets the current time in the RFC 3339 format of the Cloud Storage API.
+
+    :return: The formatted timestamp.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def get_md5_hash(data):
+    """
+    Method that gets the base64 md5 hash of an object content.
+
+    :param data: The object content.
+    :return: The base64 encoded md5 hash.
+    """
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def get_crc32c(data):
+    """
+    Method that gets the base64 crc32c checksum of an object content.
+
+    :param data: The object content.
+    :return: The base64 encoded crc32c checksum, or None if google-crc32c is not installed.
+    """
+    if google_crc32c is None:
+        return None
+    return base64.b64encode(google_crc32c.value(data).to_bytes(4, "big")).decode()
+
+
+def get_bucket_resource(bucket_name):
+    """
+    Method that gets the JSON API resource of a bucket.
+
+    :param bucket_name: The name of the bucket.
+    :return: The bucket resource.
+    """
+    return {"kind": "storage#bucket", "id": bucket_name, "name": bucket_name, "location": "US",
+            "storageClass": "STANDARD", "metageneration": "1"}
+
+
+def get_object_resource(blob):
+    """
+    Method that gets the JSON API resource of an object.
+
+    :param blob: The FakeObject.
+    :return: The object resource.
+    """
+    resource = {"kind": "storage#object", "id": "{}/{}/{}".format(blob.bucket, blob.name, blob.generation),
+                "name": blob.name, "bucket": blob.bucket, "size": str(blob.size), "generation": str(blob.generation),
+                "metageneration": "1", "contentType": blob.content_type, "updated": blob.updated,
+                "timeCreated": blob.updated}
+    if blob.md5_hash:
+        resource["md5Hash"] = blob.md5_hash
+    if blob.crc32c:
+        resource["crc32c"] = blob.crc32c
+    return resource
+
+
+def parse_multipart(content_type, body):
+    """
+    Method that splits a multipart upload body into its metadata and media parts.
+
+    :param content_type: The Content-Type header with the multipart boundary.
+    :param body: The request body.
+    :return: The tuple with the metadata dictionary, the media content type and the media bytes.
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = [part for part in body.split(b"--" + boundary) if part.strip(b"\r\n") not in (b"", b"--")]
+    metadata_headers, metadata = parts[0].lstrip(b"\r\n").split(b"\r\n\r\n", 1)
+    media_headers, data = parts[1].lstrip(b"\r\n").split(b"\r\n\r\n", 1)
+    media_content_type = re.search(rb"content-type:\s*([^\r\n]+)", media_headers, re.IGNORECASE)
+    return json.loads(metadata.decode()), \
+        media_content_type.group(1).decode() if media_content_type else None, \
+        data[:-2] if data.endswith(b"\r\n") else data
+
+
+def compile_glob(pattern):
+    """
+    Method that translates a Cloud Storage matchGlob pattern, where "*" stops at "/" and "**" does not, to a regex.
+
+    :param pattern: The glob pattern.
+    :return: The compiled regular expression.
+    """
+    regex = ""
+    position = 0
+    while position < len(pattern):
+        if pattern.startswith("**", position):
+            regex += ".*"
+            position += 2
+        elif pattern[position] == "*":
+            regex += "[^/]*"
+            position += 1
+        elif pattern[position] == "?":
+            regex += "[^/]"
+            position += 1
+        else:
+            regex += re.escape(pattern[position])
+            position += 1
+    return re.compile(regex + r"\Z")
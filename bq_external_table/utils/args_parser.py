@@ -1,5 +1,6 @@
 import os
 
+from bq_external_table import sharding
 from bq_external_table.utils import logger
 from argparse import ArgumentParser, ArgumentTypeError
 
@@ -15,6 +16,58 @@ def parse_arguments():
 
     parser.add_argument("-j", "--json_config", dest="json_config", help="The JSON Config File Location",
                         type=json_config_file, required=True)
+    parser.add_argument("--refresh-schema-cache", dest="refresh_schema_cache", action="store_true",
+                        help="Infer again the cached CSV schemas of the loaded prefixes")
+    parser.add_argument("--shard", dest="shard", type=shard_argument,
+                        help="Only run the shard i/N of the tables, e.g. 0/4, to split a config across hosts")
+    parser.add_argument("--processes", dest="processes", type=int,
+                        help="The number of worker processes the tables are split into, overrides worker_processes")
+    parser.add_argument("--plan", dest="plan", action="store_true",
+                        help="Plan the load without running it: list the prefixes, group the blobs into load jobs "
+                             "and estimate bytes, jobs, quota use and duration")
+    parser.add_argument("--plan-output", dest="plan_path",
+                        help="The file the JSON plan is written to, printed when missing")
+
+    subparsers = parser.add_subparsers(dest="command",
+                                       help="The command to run, the configured tables are loaded when missing")
+    manifest_parser = subparsers.add_parser("manifest", help="Inspect or rebuild the manifest of ingested blobs")
+    manifest_parser.add_argument("manifest_action", choices=["inspect", "rebuild"],
+                                 help="inspect summarises the manifest, rebuild marks every blob currently matching "
+                                      "the config as loaded")
+
+    upload_parser = subparsers.add_parser("upload", help="Upload a local directory to a bucket")
+    upload_parser.add_argument("--source-dir", dest="source_dir", required=True, help="The local directory to upload")
+    upload_parser.add_argument("--bucket", dest="bucket_name", required=True, help="The destination bucket")
+    upload_parser.add_argument("--destination-prefix", dest="destination_prefix", default="",
+                               help="The prefix of the uploaded blob names")
+    upload_parser.add_argument("--max-concurrent-uploads", dest="max_concurrent_uploads", type=int, default=8,
+                               help="The maximum number of files uploaded at the same time")
+    upload_parser.add_argument("--chunk-size-mb", dest="chunk_size_mb", type=int, default=8,
+                               help="The size in MB of each resumable upload chunk")
+    upload_parser.add_argument("--no-skip-existing", dest="skip_existing", action="store_false",
+                               help="Upload files even when the remote object has the same checksum")
+    upload_parser.add_argument("--state-path", dest="state_path",
+                               help="The local file that records the uploads in progress, inside the source "
+                                    "directory by default")
+    upload_parser.add_argument("--preprocess", dest="preprocess", choices=["csv", "avro", "parquet"],
+                               help="Validate the CSV files before the upload, compressing them or converting them "
+                                    "to Avro or Parquet, and quarantine the invalid ones")
+
+    watch_parser = subparsers.add_parser("watch", help="Keep loading the new objects of the configured tables in "
+                                                       "micro-batches, until interrupted")
+    watch_parser.add_argument("--subscription", dest="subscription",
+                              help="The Pub/Sub subscription of the bucket notifications, "
+                                   "projects/<PROJECT>/subscriptions/<NAME>, the prefixes are polled when missing")
+    watch_parser.add_argument("--batch-window", dest="batch_window", type=float,
+                              help="The maximum number of seconds a new object waits for its micro-batch")
+    watch_parser.add_argument("--exit-when-idle", dest="exit_when_idle", action="store_true",
+                              help="Stop once no new object is pending, instead of watching until interrupted")
+
+    merge_parser = subparsers.add_parser("merge-summaries",
+                                         help="Merge the run summaries written by the shards of a run")
+    merge_parser.add_argument("summary_paths", nargs="+", help="The summary files of the shards")
+    merge_parser.add_argument("--output", dest="output_path",
+                              help="The merged summary file, the configured summary_path by default")
 
     log.info("Parsing arguments")
     return parser.parse_args()
@@ -35,6 +88,19 @@ def json_config_file(value):
         raise ArgumentTypeError
 
 
+def shard_argument(value):
+    """
+    Method that parses a shard argument and raises an Exception if it is not valid
+    :param value: The shard that was passed as argument, i/N
+    :return: The Shard
+    """
+    try:
+        return sharding.parse_shard(value)
+    except ValueError as error:
+        log.error(str(error))
+        raise ArgumentTypeError(str(error))
+
+
 def is_json_file_location_valid(json_file_path):
     """
     Method that checks if the json_file_path is indeed a json file.
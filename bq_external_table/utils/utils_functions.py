@@ -1,8 +1,16 @@
+import base64
+import datetime
+import hashlib
 import json
 import os
 
 from bq_external_table.utils import logger
 
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
 log = logger.get_logger()
 
 
@@ -32,3 +40,45 @@ def open_json_file(path):
     else:
         log.info("File " + path + " does not exist")
         return None
+
+
+def format_timestamp(timestamp):
+    """
+    Method to format a unix timestamp as an ISO 8601 UTC date time
+
+    :param timestamp: The unix timestamp in seconds
+    :return: The formatted date time
+    """
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def get_file_md5_hash(path, block_size=1024 * 1024):
+    """
+    Method to compute the md5 hash of a file, in the base64 format used by Cloud Storage
+
+    :param path: Path of the file
+    :param block_size: Number of bytes read at a time
+    :return: The base64 encoded md5 hash
+    """
+    md5_hash = hashlib.md5()
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(block_size), b""):
+            md5_hash.update(block)
+    return base64.b64encode(md5_hash.digest()).decode()
+
+
+def get_file_crc32c(path, block_size=1024 * 1024):
+    """
+    Method to compute the crc32c checksum of a file, in the base64 format used by Cloud Storage
+
+    :param path: Path of the file
+    :param block_size: Number of bytes read at a time
+    :return: The base64 encoded crc32c checksum, or None if google-crc32c is not installed
+    """
+    if google_crc32c is None:
+        return None
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(block_size), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode()
@@ -0,0 +1,674 @@
+import json
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:
+    pubsub_v1 = None
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from bq_external_table import async_interfacer, blob_catalog, gcp_interfacer, metrics, partitioning, resilience, \
+    scheduler
+from bq_external_table.utils import logger
+
+log = logger.get_logger()
+
+EVENT_OBJECT_FINALIZE = "OBJECT_FINALIZE"
+DEFAULT_BATCH_WINDOW_SECONDS = 30.0
+DEFAULT_BATCH_MAX_BLOBS = 1000
+DEFAULT_BATCH_MAX_BYTES = 10 * 1024 ** 3
+DEFAULT_POLL_INTERVAL = 60.0
+DEFAULT_POLL_OVERLAP_SECONDS = 60.0
+DEFAULT_LOOKBACK_DAYS = 1
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_ACK_DEADLINE_SECONDS = 600
+MAX_ACK_IDS_PER_REQUEST = 1000
+IDLE_PULL_TIMEOUT = 1.0
+
+ObjectEvent = namedtuple("ObjectEvent", ["bucket_name", "blob_details", "ack_id", "received"])
+MicroBatch = namedtuple("MicroBatch", ["table_task", "events"])
+
+
+def get_object_event(attributes, data, ack_id=None):
+    """
+    Method that parses a Cloud Storage notification, in the JSON_API_V1 payload format.
+
+    :param attributes: The dictionary of the message attributes, with the "eventType" and "bucketId".
+    :param data: The message data, the JSON object resource.
+    :param ack_id: The id the message is acknowledged with.
+    :return: The ObjectEvent, None when the notification is not about a new object.
+    """
+    if attributes.get("eventType") != EVENT_OBJECT_FINALIZE:
+        return None
+    resource = json.loads(data.decode("utf-8") if isinstance(data, bytes) else data)
+    return ObjectEvent(bucket_name=attributes.get("bucketId") or resource.get("bucket"),
+                       blob_details=async_interfacer.get_blob_details(resource), ack_id=ack_id, received=time.time())
+
+
+class QueueNotificationSource(object):
+    """
+    Local stand-in for a Pub/Sub subscription of Cloud Storage notifications, e.g. for tests or to feed the watcher
+    from another thread. Messages that are requeued are delivered again, like unacknowledged Pub/Sub messages.
+    """
+
+    def __init__(self):
+        self._messages = queue.Queue()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def publish(self, attributes, data):
+        """
+        Method that publishes one notification.
+
+        :param attributes: The dictionary of the message attributes.
+        :param data: The message data.
+        """
+        self._messages.put((attributes, data))
+
+    def publish_object(self, bucket_name, resource):
+        """
+        Method that publishes the OBJECT_FINALIZE notification of a new object.
+
+        :param bucket_name: The bucket name.
+        :param resource: The dictionary of the JSON object resource, with at least its "name".
+        """
+        self.publish(attributes={"eventType": EVENT_OBJECT_FINALIZE, "bucketId": bucket_name,
+                                 "objectId": resource["name"], "payloadFormat": "JSON_API_V1"},
+                     data=json.dumps(dict(resource, bucket=bucket_name)))
+
+    def pull(self, timeout, max_messages=DEFAULT_MAX_MESSAGES):
+        """
+        Method that waits up to timeout seconds for notifications.
+
+        :param timeout: The maximum number of seconds to wait for the first notification.
+        :param max_messages: The maximum number of notifications returned.
+        :return: The list of ObjectEvent.
+        """
+        try:
+            messages = [self._messages.get(timeout=max(timeout, 0.001))]
+        except queue.Empty:
+            return []
+        while len(messages) < max_messages:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                break
+        list_of_events = []
+        with self._lock:
+            for attributes, data in messages:
+                ack_id = uuid.uuid4().hex
+                event = get_object_event(attributes=attributes, data=data, ack_id=ack_id)
+                # Notifications that are not about a new object are acknowledged right away.
+                if event is not None:
+                    self._in_flight[ack_id] = (attributes, data)
+                    list_of_events.append(event)
+        return list_of_events
+
+    def acknowledge(self, ack_ids):
+        """
+        Method that acknowledges notifications, so that they are not delivered again.
+
+        :param ack_ids: The ack ids of the notifications.
+        """
+        with self._lock:
+            for ack_id in ack_ids:
+                self._in_flight.pop(ack_id, None)
+
+    def requeue(self, ack_ids):
+        """
+        Method that gives notifications back, so that they are delivered again.
+
+        :param ack_ids: The ack ids of the notifications.
+        """
+        with self._lock:
+            for ack_id in ack_ids:
+                if ack_id in self._in_flight:
+                    self._messages.put(self._in_flight.pop(ack_id))
+
+    def get_in_flight_count(self):
+        """
+        Method that counts the notifications delivered but neither acknowledged nor requeued.
+
+        :return: The number of notifications.
+        """
+        with self._lock:
+            return len(self._in_flight)
+
+
+class PubSubNotificationSource(object):
+    """
+    Source of the Cloud Storage notifications of a Pub/Sub subscription, pulled synchronously. The ack deadline of
+    every pulled message is extended to ack_deadline_seconds, so that it is not delivered again while its micro-batch
+    waits and loads.
+    """
+
+    def __init__(self, subscription_path, ack_deadline_seconds=DEFAULT_ACK_DEADLINE_SECONDS):
+        if pubsub_v1 is None:
+            raise ImportError("Watching a Pub/Sub subscription requires google-cloud-pubsub, install the pubsub extra.")
+        self.subscription_path = subscription_path
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self.subscriber = pubsub_v1.SubscriberClient()
+
+    def pull(self, timeout, max_messages=DEFAULT_MAX_MESSAGES):
+        """
+        Method that waits up to timeout seconds for notifications.
+
+        :param timeout: The maximum number of seconds to wait.
+        :param max_messages: The maximum number of notifications returned.
+        :return: The list of ObjectEvent.
+        """
+        try:
+            response = self.subscriber.pull(request={"subscription": self.subscription_path,
+                                                     "max_messages": max_messages}, timeout=max(timeout, 1.0))
+        except exceptions.DeadlineExceeded:
+            return []
+        ack_ids = [received_message.ack_id for received_message in response.received_messages]
+        for ack_ids_chunk in iter_chunks(ack_ids):
+            self.subscriber.modify_ack_deadline(request={"subscription": self.subscription_path,
+                                                         "ack_ids": ack_ids_chunk,
+                                                         "ack_deadline_seconds": self.ack_deadline_seconds})
+        list_of_events = [get_object_event(attributes=dict(received_message.message.attributes),
+                                           data=received_message.message.data, ack_id=received_message.ack_id)
+                          for received_message in response.received_messages]
+        # Notifications that are not about a new object are acknowledged right away.
+        self.acknowledge([ack_id for ack_id, event in zip(ack_ids, list_of_events) if event is None])
+        return [event for event in list_of_events if event is not None]
+
+    def acknowledge(self, ack_ids):
+        """
+        Method that acknowledges notifications, so that they are not delivered again.
+
+        :param ack_ids: The ack ids of the notifications.
+        """
+        for ack_ids_chunk in iter_chunks(list(ack_ids)):
+            self.subscriber.acknowledge(request={"subscription": self.subscription_path, "ack_ids": ack_ids_chunk})
+
+    def requeue(self, ack_ids):
+        """
+        Method that gives notifications back, so that Pub/Sub delivers them again right away.
+
+        :param ack_ids: The ack ids of the notifications.
+        """
+        for ack_ids_chunk in iter_chunks(list(ack_ids)):
+            self.subscriber.modify_ack_deadline(request={"subscription": self.subscription_path,
+                                                         "ack_ids": ack_ids_chunk, "ack_deadline_seconds": 0})
+
+
+class PollingNotificationSource(object):
+    """
+    Source of the new objects of the watched tables, found by listing their prefixes every poll_interval seconds,
+    for buckets without notifications. Only the objects updated since the previous poll, minus overlap_seconds for
+    clock skew, are returned. Partitioned tables with "list_partitions" only list the partitions of the last
+    lookback_days days, instead of their whole history. The objects of failed loads, which the watermark has already
+    passed, are kept and returned again by the next poll.
+    """
+
+    def __init__(self, table_tasks, poll_interval=DEFAULT_POLL_INTERVAL, overlap_seconds=DEFAULT_POLL_OVERLAP_SECONDS,
+                 lookback_days=DEFAULT_LOOKBACK_DAYS, catch_up=False):
+        self.table_tasks = table_tasks
+        self.poll_interval = poll_interval
+        self.overlap_seconds = overlap_seconds
+        self.lookback_days = lookback_days
+        self._watermark = None if catch_up else time.time()
+        self._recent_generations = {}
+        self._in_flight = {}
+        self._requeued = []
+        self._next_poll = time.time() if catch_up else time.time() + poll_interval
+
+    def pull(self, timeout, max_messages=None):
+        """
+        Method that lists the watched prefixes when the next poll is due within timeout seconds.
+
+        :param timeout: The maximum number of seconds to wait.
+        :param max_messages: Unused, every new object of a poll is returned.
+        :return: The list of ObjectEvent.
+        """
+        wait = self._next_poll - time.time()
+        if wait > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self._next_poll = time.time() + self.poll_interval
+        return self.poll()
+
+    def poll(self):
+        """
+        Method that lists the watched prefixes once.
+
+        :return: The list of ObjectEvent of the objects updated since the previous poll, and of the requeued ones.
+        """
+        poll_start = time.time()
+        since = None if self._watermark is None else self._watermark - self.overlap_seconds
+        recent_generations = {}
+        list_of_events = []
+        for bucket_name, pages in self.iter_listings():
+            for page in pages:
+                for blob_details in page:
+                    updated = blob_details.updated.timestamp() if blob_details.updated else poll_start
+                    key = (bucket_name, blob_details.name)
+                    # Only the objects inside the overlap can be listed again by the next poll.
+                    if updated >= poll_start - self.overlap_seconds:
+                        recent_generations[key] = blob_details.generation
+                    if (since is not None and updated < since) or \
+                            self._recent_generations.get(key) == blob_details.generation:
+                        continue
+                    list_of_events.append(ObjectEvent(bucket_name=bucket_name, blob_details=blob_details,
+                                                      ack_id=uuid.uuid4().hex, received=poll_start))
+        listed = set((event.bucket_name, event.blob_details.name) for event in list_of_events)
+        # A requeued object listed again, e.g. overwritten since, is only returned once, with its latest details.
+        list_of_events.extend(event._replace(received=poll_start) for event in self._requeued
+                              if (event.bucket_name, event.blob_details.name) not in listed)
+        self._requeued = []
+        self._in_flight.update((event.ack_id, event) for event in list_of_events)
+        self._watermark = poll_start
+        self._recent_generations = recent_generations
+        metrics.increment("watch_polls")
+        log.info("Polled {} watched tables in {:.1f}s, {} new objects.".format(
+            len(self.table_tasks), time.time() - poll_start, len(list_of_events)))
+        return list_of_events
+
+    def iter_listings(self):
+        """
+        Method that lists each distinct watched prefix.
+
+        :return: A generator of (bucket name, iterator of listing pages) tuples.
+        """
+        listed = set()
+        for table_task in self.table_tasks:
+            table_details = table_task.table_details
+            table_partitioning = table_details.get("partitioning")
+            listing_key = (table_task.bucket_name, table_details.get("blob_prefix"),
+                           table_details.get("blob_delimiter"), table_details.get("blob_glob"),
+                           json.dumps(table_partitioning, sort_keys=True))
+            if listing_key in listed:
+                continue
+            listed.add(listing_key)
+            if table_partitioning and table_partitioning.get("list_partitions"):
+                pages = partitioning.iter_partition_pages(
+                    bucket_name=table_task.bucket_name, blob_prefix=table_details.get("blob_prefix"),
+                    partitioning=dict(table_partitioning, last_days=self.lookback_days, end_date=None),
+                    blob_delimiter=table_details.get("blob_delimiter"), blob_glob=table_details.get("blob_glob"))
+            else:
+                pages = gcp_interfacer.iter_blob_pages(bucket_name=table_task.bucket_name,
+                                                       blob_prefix=table_details.get("blob_prefix"),
+                                                       delimiter=table_details.get("blob_delimiter"),
+                                                       match_glob=table_details.get("blob_glob"))
+            yield table_task.bucket_name, pages
+
+    def acknowledge(self, ack_ids):
+        """
+        Method that forgets the events of loaded objects.
+
+        :param ack_ids: The ack ids of the events.
+        """
+        for ack_id in ack_ids:
+            self._in_flight.pop(ack_id, None)
+
+    def requeue(self, ack_ids):
+        """
+        Method that keeps the events of the objects of failed loads, to be returned again by the next poll.
+
+        :param ack_ids: The ack ids of the events.
+        """
+        self._requeued.extend(self._in_flight.pop(ack_id) for ack_id in ack_ids if ack_id in self._in_flight)
+
+    def get_in_flight_count(self):
+        """
+        Method that counts the events returned but neither acknowledged nor requeued.
+
+        :return: The number of events.
+        """
+        return len(self._in_flight)
+
+
+class MicroBatcher(object):
+    """
+    Groups the new objects of each table into micro-batches. A batch is due window_seconds after its first object
+    arrived, or as soon as it holds max_blobs objects or max_bytes bytes, so that new data is loaded within the
+    window while busy tables still get large, quota friendly load jobs.
+    """
+
+    def __init__(self, window_seconds=DEFAULT_BATCH_WINDOW_SECONDS, max_blobs=DEFAULT_BATCH_MAX_BLOBS,
+                 max_bytes=DEFAULT_BATCH_MAX_BYTES):
+        self.window_seconds = window_seconds
+        self.max_blobs = max_blobs
+        self.max_bytes = max_bytes
+        self._batches = OrderedDict()
+
+    def __len__(self):
+        return sum(len(batch.events) for batch in self._batches.values())
+
+    def add(self, table_task, event):
+        """
+        Method that adds a new object to the batch of a table.
+
+        :param table_task: The TableTask of the table.
+        :param event: The ObjectEvent of the object.
+        """
+        key = (table_task.dataset_name, table_task.bucket_name, table_task.table_details.get("table_name"))
+        self._batches.setdefault(key, MicroBatch(table_task=table_task, events=[])).events.append(event)
+
+    def get_wait(self, now, default):
+        """
+        Method that gets the number of seconds until the next batch is due.
+
+        :param now: The current time.
+        :param default: The number of seconds returned when no batch is pending.
+        :return: The number of seconds, 0 when a batch is already due.
+        """
+        if not self._batches:
+            return default
+        return max(0.0, min(batch.events[0].received + self.window_seconds - now for batch in self._batches.values()))
+
+    def pop_due(self, now, flush=False):
+        """
+        Method that removes the batches that are due.
+
+        :param now: The current time.
+        :param flush: Whether every pending batch is due, e.g. on shutdown.
+        :return: The list of MicroBatch, each one split to hold at most max_blobs objects and max_bytes bytes.
+        """
+        list_of_batches = []
+        for key, batch in list(self._batches.items()):
+            size = sum(event.blob_details.size or 0 for event in batch.events)
+            if flush or now >= batch.events[0].received + self.window_seconds or len(batch.events) >= self.max_blobs \
+                    or size >= self.max_bytes:
+                del self._batches[key]
+                list_of_batches.extend(self.split(batch))
+        return list_of_batches
+
+    def split(self, batch):
+        """
+        Method that splits a batch into batches of at most max_blobs objects and max_bytes bytes.
+
+        :param batch: The MicroBatch.
+        :return: The list of MicroBatch.
+        """
+        list_of_batches = [MicroBatch(table_task=batch.table_task, events=[])]
+        size = 0
+        for event in batch.events:
+            event_size = event.blob_details.size or 0
+            if list_of_batches[-1].events and (len(list_of_batches[-1].events) >= self.max_blobs or
+                                               size + event_size > self.max_bytes):
+                list_of_batches.append(MicroBatch(table_task=batch.table_task, events=[]))
+                size = 0
+            list_of_batches[-1].events.append(event)
+            size += event_size
+        return list_of_batches
+
+
+def compile_glob(pattern):
+    """
+    Method that translates a Cloud Storage matchGlob pattern, where "*" stops at "/" and "**" does not, to a regex.
+
+    :param pattern: The glob pattern.
+    :return: The compiled regular expression.
+    """
+    regex = ""
+    position = 0
+    while position < len(pattern):
+        if pattern.startswith("**", position):
+            regex += ".*"
+            position += 2
+        elif pattern[position] in "*?":
+            regex += "[^/]*" if pattern[position] == "*" else "[^/]"
+            position += 1
+        else:
+            regex += re.escape(pattern[position])
+            position += 1
+    return re.compile(regex + r"\Z")
+
+
+def get_watched_table_tasks(table_tasks, load_options):
+    """
+    Method that selects the tables the watcher loads. External tables read the bucket at query time, so they are
+    always fresh and left out.
+
+    :param table_tasks: The list of TableTask of the config.
+    :param load_options: The dictionary with the load options.
+    :return: The list of TableTask.
+    """
+    return [table_task for table_task in table_tasks
+            if table_task.table_details.get("table_type", load_options.get("table_type"))
+            != gcp_interfacer.TABLE_TYPE_EXTERNAL]
+
+
+def route_event(table_tasks, event, compiled_globs):
+    """
+    Method that finds the tables a new object belongs to, from their bucket, prefix, delimiter and glob.
+
+    :param table_tasks: The list of watched TableTask.
+    :param event: The ObjectEvent.
+    :param compiled_globs: The dictionary of the compiled patterns of the blob_glob of the tables.
+    :return: The list of TableTask.
+    """
+    name = event.blob_details.name
+    list_of_table_tasks = []
+    for table_task in table_tasks:
+        table_details = table_task.table_details
+        blob_prefix = table_details.get("blob_prefix") or ""
+        if table_task.bucket_name != event.bucket_name or not name.startswith(blob_prefix):
+            continue
+        if table_details.get("blob_delimiter") and table_details.get("blob_delimiter") in name[len(blob_prefix):]:
+            continue
+        blob_glob = table_details.get("blob_glob")
+        if blob_glob and not compiled_globs.setdefault(blob_glob, compile_glob(blob_glob)).match(name):
+            continue
+        list_of_table_tasks.append(table_task)
+    return list_of_table_tasks
+
+
+def load_micro_batch(bigquery_client, batch, load_options):
+    """
+    Method that loads one micro-batch of new objects into its table, as few batched load jobs as possible, or into
+    the partitions they belong to for a partitioned table.
+
+    :param bigquery_client: The GCP BigQuery client, kept warm across batches.
+    :param batch: The MicroBatch.
+    :param load_options: The dictionary with the load options.
+    :return: The list of LoadJobResult.
+    """
+    table_task = batch.table_task
+    table_details = table_task.table_details
+    list_of_blob_details = [event.blob_details for event in batch.events]
+    load_arguments = dict(max_concurrent_jobs=load_options.get("max_concurrent_jobs"),
+                          job_poll_interval=load_options.get("job_poll_interval"),
+                          load_mode=gcp_interfacer.LOAD_MODE_BATCH,
+                          max_uris_per_job=load_options.get("max_uris_per_job"),
+                          max_bytes_per_job=load_options.get("max_bytes_per_job"),
+                          manifest_path=load_options.get("manifest_path"),
+                          schema_cache_path=load_options.get("schema_cache_path"),
+                          schema_sample_bytes=load_options.get("schema_sample_bytes"))
+    table_partitioning = table_details.get("partitioning")
+    if table_partitioning:
+        # A micro-batch only holds the new objects of its partitions, so it must not replace their rows.
+        table_partitioning = dict(table_partitioning, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        with blob_catalog.BlobCatalog(bucket_name=table_task.bucket_name) as catalog:
+            catalog.add_page(list_of_blob_details)
+            return partitioning.load_catalog_partitions(
+                bigquery_client=bigquery_client,
+                dataset_name=table_task.dataset_name,
+                catalog=catalog,
+                table_id=table_details.get("table_name"),
+                blob_prefix=table_details.get("blob_prefix"),
+                partitioning=table_partitioning,
+                max_concurrent_partitions=table_partitioning.get("max_concurrent_partitions",
+                                                                 load_options.get("max_concurrent_partitions")),
+                **load_arguments)
+    return gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+        bigquery_client=bigquery_client,
+        dataset_name=table_task.dataset_name,
+        bucket_name=table_task.bucket_name,
+        table_id=table_details.get("table_name"),
+        blob_prefix=table_details.get("blob_prefix"),
+        list_of_blob_details=list_of_blob_details,
+        **load_arguments)
+
+
+def watch(table_tasks, source, load_options, watch_options=None, stop_event=None, exit_when_idle=False,
+          bigquery_client=None):
+    """
+    Method that keeps the tables fresh: it waits for the new objects of their prefixes, from notifications or
+    incremental listings, groups them into micro-batches and loads each batch as soon as it is due, with the same
+    clients for the whole run. Notifications are acknowledged once every table of their object is loaded, and given
+    back to be delivered again when a load fails. With a manifest, objects delivered twice are only loaded once.
+    Failed pulls, e.g. while the network is down, are logged and retried with backoff.
+
+    :param table_tasks: The list of TableTask of the config.
+    :param source: The QueueNotificationSource, PubSubNotificationSource or PollingNotificationSource.
+    :param load_options: The dictionary with the load options.
+    :param watch_options: Optional dictionary with the "batch_window_seconds", "batch_max_blobs" and
+    "batch_max_bytes" of the micro-batches.
+    :param stop_event: Optional threading.Event that stops the watcher, once the pending batches are loaded.
+    :param exit_when_idle: Whether the watcher stops as soon as no object is pending, e.g. to catch up once.
+    :param bigquery_client: Optional GCP BigQuery client, created once for the whole run when missing.
+    :return: The list of TableSummary, one per loaded table, with the totals of its micro-batches.
+    """
+    watch_options = watch_options or {}
+    stop_event = stop_event or threading.Event()
+    watched_table_tasks = get_watched_table_tasks(table_tasks=table_tasks, load_options=load_options)
+    batcher = MicroBatcher(window_seconds=watch_options.get("batch_window_seconds", DEFAULT_BATCH_WINDOW_SECONDS),
+                           max_blobs=watch_options.get("batch_max_blobs", DEFAULT_BATCH_MAX_BLOBS),
+                           max_bytes=watch_options.get("batch_max_bytes", DEFAULT_BATCH_MAX_BYTES))
+    bigquery_client = bigquery_client or gcp_interfacer.get_bigquery_client()
+    compiled_globs = {}
+    pending_acks = {}
+    failed_acks = set()
+    summaries_by_table = OrderedDict()
+    batch_count = 0
+    failed_pulls = 0
+    in_flight = {}
+    log.info("Watching {} tables, with micro-batches of up to {}s.".format(len(watched_table_tasks),
+                                                                          batcher.window_seconds))
+
+    def settle(batch, summary):
+        nonlocal batch_count
+        batch_count += 1
+        succeeded = summary.error is None and not summary.failed_jobs
+        metrics.increment("watch_batches", table=summary.table_id, succeeded=succeeded)
+        if succeeded:
+            loaded = time.time()
+            for event in batch.events:
+                updated = event.blob_details.updated
+                metrics.observe("watch_freshness", loaded - (updated.timestamp() if updated else event.received),
+                                table=summary.table_id)
+        for event in batch.events:
+            if event.ack_id is None:
+                continue
+            if not succeeded:
+                failed_acks.add(event.ack_id)
+            pending_acks[event.ack_id] -= 1
+            if not pending_acks[event.ack_id]:
+                del pending_acks[event.ack_id]
+                if event.ack_id in failed_acks:
+                    failed_acks.discard(event.ack_id)
+                    source.requeue([event.ack_id])
+                else:
+                    source.acknowledge([event.ack_id])
+        add_table_summary(summaries_by_table=summaries_by_table, summary=summary)
+
+    with ThreadPoolExecutor(max_workers=max(1, load_options.get("max_concurrent_tables") or 1)) as executor:
+        while True:
+            stopping = stop_event.is_set()
+            if not stopping:
+                timeout = batcher.get_wait(now=time.time(), default=IDLE_PULL_TIMEOUT)
+                if in_flight:
+                    # Finished batches are acknowledged, and their failures requeued, without waiting for new objects.
+                    timeout = min(timeout, load_options.get("job_poll_interval") or IDLE_PULL_TIMEOUT)
+                try:
+                    list_of_events = source.pull(timeout=timeout)
+                    failed_pulls = 0
+                except (exceptions.GoogleAPIError, OSError) as error:
+                    failed_pulls += 1
+                    delay = resilience.get_backoff_delay(failed_pulls)
+                    log.error("Could not pull new objects, trying again in {:.1f}s: {}".format(delay, error))
+                    metrics.increment("watch_pull_errors")
+                    stop_event.wait(delay)
+                    list_of_events = []
+                metrics.increment("watch_events", len(list_of_events))
+                for event in list_of_events:
+                    routed_table_tasks = route_event(table_tasks=watched_table_tasks, event=event,
+                                                     compiled_globs=compiled_globs)
+                    if event.ack_id is not None:
+                        if routed_table_tasks:
+                            pending_acks[event.ack_id] = pending_acks.get(event.ack_id, 0) + len(routed_table_tasks)
+                        else:
+                            source.acknowledge([event.ack_id])
+                    for table_task in routed_table_tasks:
+                        batcher.add(table_task=table_task, event=event)
+                if exit_when_idle and not failed_pulls and not list_of_events and not in_flight:
+                    stopping = True
+            for batch in batcher.pop_due(now=time.time(), flush=stopping):
+                log.info("Loading a micro-batch of {} new objects into table {}.".format(
+                    len(batch.events), batch.table_task.table_details.get("table_name")))
+                in_flight[executor.submit(scheduler.run_timed_table_task, batch.table_task,
+                                          lambda table_task, batch=batch: load_micro_batch(
+                                              bigquery_client=bigquery_client, batch=batch,
+                                              load_options=load_options))] = batch
+            for future in [future for future in in_flight if future.done() or stopping]:
+                settle(batch=in_flight.pop(future), summary=future.result())
+            if stopping and not in_flight and not len(batcher):
+                break
+    log.info("Stopped watching after {} micro-batches.".format(batch_count))
+    return list(summaries_by_table.values())
+
+
+def add_table_summary(summaries_by_table, summary):
+    """
+    Method that adds the TableSummary of a micro-batch to the totals of its table, so that a long running watcher
+    keeps one summary per table instead of one per batch.
+
+    :param summaries_by_table: The dictionary of the TableSummary totals by table, updated in place.
+    :param summary: The TableSummary of the micro-batch.
+    """
+    key = (summary.dataset_name, summary.bucket_name, summary.table_id)
+    total = summaries_by_table.get(key)
+    if total is not None:
+        summary = total._replace(duration=total.duration + summary.duration, jobs=total.jobs + summary.jobs,
+                                 failed_jobs=total.failed_jobs + summary.failed_jobs,
+                                 input_bytes=total.input_bytes + summary.input_bytes,
+                                 output_rows=total.output_rows + summary.output_rows,
+                                 error=summary.error or total.error)
+    summaries_by_table[key] = summary
+
+
+def get_notification_source(table_tasks, watch_options, load_options):
+    """
+    Method that builds the source of new objects of the watcher: the Pub/Sub "subscription" of the watch options,
+    or incremental listings every "poll_interval" seconds when there is none.
+
+    :param table_tasks: The list of TableTask of the config.
+    :param watch_options: The dictionary with the watch options.
+    :param load_options: The dictionary with the load options.
+    :return: The PubSubNotificationSource or PollingNotificationSource.
+    """
+    if watch_options.get("subscription"):
+        return PubSubNotificationSource(subscription_path=watch_options.get("subscription"),
+                                        ack_deadline_seconds=watch_options.get("ack_deadline_seconds",
+                                                                               DEFAULT_ACK_DEADLINE_SECONDS))
+    # Without a manifest, the objects already in the buckets cannot be told apart from the loaded ones.
+    return PollingNotificationSource(
+        table_tasks=get_watched_table_tasks(table_tasks=table_tasks, load_options=load_options),
+        poll_interval=watch_options.get("poll_interval", DEFAULT_POLL_INTERVAL),
+        overlap_seconds=watch_options.get("poll_overlap_seconds", DEFAULT_POLL_OVERLAP_SECONDS),
+        lookback_days=watch_options.get("lookback_days", DEFAULT_LOOKBACK_DAYS),
+        catch_up=bool(load_options.get("manifest_path")))
+
+
+def iter_chunks(ack_ids, chunk_size=MAX_ACK_IDS_PER_REQUEST):
+    """
+    Method that splits ack ids into the chunks of one request.
+
+    :param ack_ids: The list of ack ids.
+    :param chunk_size: The maximum number of ack ids per chunk.
+    :return: A generator of lists of ack ids.
+    """
+    for start in range(0, len(ack_ids), chunk_size):
+        yield ack_ids[start:start + chunk_size]
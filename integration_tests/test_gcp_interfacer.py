@@ -103,7 +103,7 @@ class TestGCPInterfacer(unittest.TestCase):
                                                                               bucket_name=self.bucket_name,
                                                                               table_id=self.table_name,
                                                                               blob_prefix=destination_blob_name[0:3])
-        self.assertIsNone(actual)
+        self.assertTrue(all(result.succeeded for result in actual))
         gcp_interfacer.delete_blob(bucket_name=self.bucket_name, blob_name=destination_blob_name)
         gcp_interfacer.delete_gcp_storage_bucket(bucket_name=self.bucket_name)
         gcp_interfacer.delete_bigquery_dataset(bigquery_client=self.bigquery_client, dataset_name=self.dataset_name)
@@ -134,7 +134,7 @@ class TestGCPInterfacer(unittest.TestCase):
                                                                               bucket_name=self.bucket_name,
                                                                               table_id=self.table_name,
                                                                               blob_prefix=destination_blob_name_1[0:3])
-        self.assertIsNone(actual)
+        self.assertTrue(all(result.succeeded for result in actual))
         gcp_interfacer.delete_blob(bucket_name=self.bucket_name, blob_name=destination_blob_name_1)
         gcp_interfacer.delete_blob(bucket_name=self.bucket_name, blob_name=destination_blob_name_2)
         gcp_interfacer.delete_gcp_storage_bucket(bucket_name=self.bucket_name)
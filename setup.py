@@ -3,12 +3,14 @@ from setuptools import setup
 setup(
     name='bq-external-table',
     version='0.0.1',
-    packages=["bq_external_table"],
+    packages=["bq_external_table", "bq_external_table.utils", "bq_external_table.testing"],
     license='marionete',
     author='marionete',
     author_email='',
     description='This application deals with data migration between GCP buckets and BigQuery external tables.',
-    install_requires=["google-cloud-storage==1.20.0", "google-cloud-bigquery==1.20.0"],
+    install_requires=["google-cloud-storage==2.10.0", "google-cloud-bigquery==3.4.0"],
+    extras_require={"async": ["aiohttp"], "avro": ["fastavro"], "parquet": ["pyarrow"],
+                    "pubsub": ["google-cloud-pubsub"]},
     entry_points={
         'console_scripts': [
             'bq-external-table = bq_external_table.main:main'
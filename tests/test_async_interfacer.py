@@ -0,0 +1,183 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from google.cloud import bigquery
+
+from bq_external_table import async_interfacer, gcp_clients, gcp_interfacer, manifest, metrics, resilience, scheduler
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+from bq_external_table.testing.fake_bigquery_server import FakeBigQueryServer
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+@unittest.skipIf(async_interfacer.aiohttp is None, "aiohttp is not installed")
+class TestAsyncInterfacer(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+        self.gcs_server = FakeGCSServer().start()
+        self.gcs_server.create_bucket("bucket")
+        self.bigquery_client = FakeBigQueryClient(project="test", job_latency=0.05, gcs_server=self.gcs_server)
+        self.bigquery_server = FakeBigQueryServer(client=self.bigquery_client).start()
+        gcp_clients.configure_clients(storage_api_endpoint=self.gcs_server.endpoint, project="test",
+                                      bigquery_api_endpoint=self.bigquery_server.endpoint)
+
+    def tearDown(self):
+        self.gcs_server.stop()
+        self.bigquery_server.stop()
+        gcp_clients.configure_clients()
+        resilience.configure()
+        metrics.reset()
+
+    def run_with_session(self, function, **kwargs):
+        async def run():
+            async with async_interfacer.AsyncGCPSession(max_concurrent_operations=50) as session:
+                return await function(session=session, **kwargs)
+        return asyncio.run(run())
+
+    def test_iter_blob_pages_lists_every_page(self):
+        self.gcs_server.put_synthetic_objects("bucket", ["data/part-{:03d}.csv".format(index) for index in range(25)],
+                                              size=10)
+        self.gcs_server.put_object("bucket", "other/file.csv", b"a,b\n")
+
+        async def list_pages(session):
+            return [page async for page in async_interfacer.iter_blob_pages(session=session, bucket_name="bucket",
+                                                                            blob_prefix="data/", page_size=10)]
+        pages = self.run_with_session(list_pages)
+        self.assertEqual([10, 10, 5], [len(page) for page in pages])
+        self.assertEqual(("data/part-000.csv", 10), (pages[0][0].name, pages[0][0].size))
+        self.assertIsNotNone(pages[0][0].updated)
+
+    def test_upload_files_uploads_concurrently(self):
+        with tempfile.TemporaryDirectory() as directory:
+            list_of_files = []
+            for index in range(20):
+                path = os.path.join(directory, "file_{}.csv".format(index))
+                with open(path, "wb") as local_file:
+                    local_file.write("a,b\n{},2\n".format(index).encode())
+                list_of_files.append((path, "uploads/file_{}.csv".format(index)))
+            actual = self.run_with_session(async_interfacer.upload_files, bucket_name="bucket",
+                                           list_of_files=list_of_files)
+        self.assertEqual(20, len([blob_details for blob_details in actual
+                                  if isinstance(blob_details, gcp_interfacer.BlobDetails)]))
+        self.assertEqual(b"a,b\n7,2\n", self.gcs_server.get_object_data("bucket", "uploads/file_7.csv"))
+
+    def test_load_bucket_data_runs_one_job_per_blob(self):
+        for index in range(30):
+            self.gcs_server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        self.gcs_server.put_object("bucket", "data/part-999.bin", b"\x00\x01\x02")
+        actual = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                       bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                       max_concurrent_jobs=30, job_poll_interval=0.01)
+        self.assertEqual(30, len(actual))
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertEqual("gs://bucket/data/part-000.csv", actual[0].source_uris)
+        self.assertEqual(8, actual[0].input_bytes)
+        self.assertEqual(30, len(self.bigquery_client.jobs))
+        self.assertEqual(30, metrics.get_registry().get_counter("bigquery_jobs_finished", table="table",
+                                                                status="succeeded"))
+
+    def test_load_bucket_data_batches_blobs_and_retries_faults(self):
+        self.bigquery_client.fault_rate = 0.2
+        for index in range(10):
+            self.gcs_server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        actual = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                       bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                       load_mode=gcp_interfacer.LOAD_MODE_BATCH, max_uris_per_job=4,
+                                       job_poll_interval=0.01, blob_glob="**.csv")
+        self.assertEqual([4, 4, 2], [len(result.source_uris) for result in actual])
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertEqual(3, len(self.bigquery_client.jobs))
+
+    def test_load_bucket_data_retries_jobs_failed_with_a_transient_error(self):
+        self.bigquery_client.failure_rate = 0.5
+        self.bigquery_client.failure_reason = "backendError"
+        for index in range(2):
+            self.gcs_server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        actual = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                       bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                       max_concurrent_jobs=2, job_poll_interval=0.01)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertTrue(any("_retry" in result.job_id for result in actual))
+
+    def test_load_bucket_data_skips_blobs_in_the_manifest(self):
+        for index in range(3):
+            self.gcs_server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        with tempfile.TemporaryDirectory() as directory:
+            manifest_path = os.path.join(directory, "manifest.db")
+            first = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                          bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                          job_poll_interval=0.01, manifest_path=manifest_path)
+            self.gcs_server.put_object("bucket", "data/part-003.csv", b"a,b\n1,2\n")
+            second = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                           bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                           job_poll_interval=0.01, manifest_path=manifest_path)
+            self.assertEqual(3, len(first))
+            self.assertEqual(["gs://bucket/data/part-003.csv"], [result.source_uris for result in second])
+            self.assertEqual([("dataset.table", "bucket", manifest.STATUS_LOADED, 4)],
+                             [row[:4] for row in manifest.inspect(manifest_path=manifest_path)])
+
+    def test_load_bucket_data_filters_pages_in_manifest_chunks(self):
+        for index in range(5):
+            self.gcs_server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(manifest, "FILTER_CHUNK_SIZE", 2), \
+                mock.patch.object(manifest, "filter_new_blobs_chunk", wraps=manifest.filter_new_blobs_chunk) as \
+                filter_new_blobs_chunk:
+            actual = self.run_with_session(async_interfacer.load_bucket_data, dataset_name="dataset",
+                                           bucket_name="bucket", table_id="table", blob_prefix="data/",
+                                           job_poll_interval=0.01,
+                                           manifest_path=os.path.join(directory, "manifest.db"))
+        self.assertEqual(5, len(actual))
+        self.assertEqual([2, 2, 1], [len(call.args[3]) for call in filter_new_blobs_chunk.call_args_list])
+
+    def test_run_load_jobs_cancels_the_other_jobs_on_an_unexpected_error(self):
+        finished_jobs = []
+
+        def on_job_submit(source_uris):
+            if source_uris == "gs://bucket/b.csv":
+                raise ValueError("Unexpected")
+
+        with self.assertRaises(ValueError):
+            self.run_with_session(async_interfacer.run_load_jobs, project="test", dataset_name="dataset",
+                                  table_id="table",
+                                  list_of_sources=["gs://bucket/a.csv", "gs://bucket/b.csv", "gs://bucket/c.csv"],
+                                  job_config=bigquery.LoadJobConfig(), max_concurrent_jobs=3, job_poll_interval=0.01,
+                                  on_job_submit=on_job_submit, on_job_finish=finished_jobs.append)
+        self.assertEqual([], finished_jobs)
+
+    def test_run_load_jobs_calls_the_callbacks_off_the_event_loop(self):
+        callback_threads = []
+
+        def on_job(*args):
+            callback_threads.append(threading.current_thread())
+
+        actual = self.run_with_session(async_interfacer.run_load_jobs, project="test", dataset_name="dataset",
+                                       table_id="table", list_of_sources=["gs://bucket/a.csv", "gs://bucket/b.csv"],
+                                       job_config=bigquery.LoadJobConfig(), job_poll_interval=0.01,
+                                       on_job_submit=on_job, on_job_finish=on_job)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertEqual(4, len(callback_threads))
+        self.assertNotIn(threading.main_thread(), callback_threads)
+
+    def test_load_tables_runs_every_table_from_one_event_loop(self):
+        for table in ("first", "second"):
+            for index in range(3):
+                self.gcs_server.put_object("bucket", "{}/part-{}.csv".format(table, index), b"a,b\n1,2\n")
+        buckets = {"bucket": [{"table_name": "first", "blob_prefix": "first/"},
+                              {"table_name": "second", "blob_prefix": "second/", "load_mode": "batch"},
+                              {"table_name": "missing", "blob_prefix": "missing/"}]}
+        load_options = {"max_concurrent_jobs": 5, "job_poll_interval": 0.01, "max_concurrent_tables": 3,
+                        "load_mode": "per_blob", "max_uris_per_job": 10000, "max_bytes_per_job": 10 ** 12}
+        actual = asyncio.run(async_interfacer.load_tables(
+            table_tasks=scheduler.get_table_tasks(buckets=buckets, dataset_name="dataset"), load_options=load_options))
+        self.assertEqual([("first", 3), ("second", 1), ("missing", 0)],
+                         [(summary.table_id, summary.jobs) for summary in actual])
+        self.assertTrue(all(summary.error is None and summary.failed_jobs == 0 for summary in actual))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from benchmarks import compare_benchmarks, run_benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_run_benchmarks_measures_every_benchmark(self):
+        actual = run_benchmarks.run_benchmarks(benchmarks=["list", "upload", "load"], object_counts=[5],
+                                               file_sizes=[1024], upload_file_count=1, label="test")
+        self.assertEqual("test", actual["label"])
+        self.assertEqual(["list", "upload", "load", "load"], [result["benchmark"] for result in actual["results"]])
+        self.assertEqual(5, actual["results"][0]["objects_listed"])
+        self.assertEqual([5, 1], [result["jobs"] for result in actual["results"][2:]])
+
+    def test_parse_size(self):
+        self.assertEqual([10, 2048, 64 * 1024 ** 2, 1024 ** 3], run_benchmarks.parse_size_list("10,2KB,64MB,1gb"))
+
+    def test_compare_results_flags_regressions(self):
+        baseline = {"results": [{"benchmark": "list", "parameters": {"object_count": 10}, "seconds": 1.0},
+                                {"benchmark": "list", "parameters": {"object_count": 20}, "seconds": 1.0}]}
+        candidate = {"results": [{"benchmark": "list", "parameters": {"object_count": 10}, "seconds": 1.1},
+                                 {"benchmark": "list", "parameters": {"object_count": 20}, "seconds": 1.5},
+                                 {"benchmark": "list", "parameters": {"object_count": 30}, "seconds": 1.0}]}
+        actual = compare_benchmarks.compare_results(baseline=baseline, candidate=candidate, threshold=0.2)
+        self.assertEqual([False, True], [row[-1] for row in actual])
@@ -0,0 +1,102 @@
+import base64
+import datetime
+import hashlib
+import unittest
+
+from bq_external_table import blob_catalog, gcp_clients, gcp_interfacer
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+def blob_details(name, size=10, **kwargs):
+    details = {"generation": 1, "content_type": "text/csv",
+               "md5_hash": base64.b64encode(hashlib.md5(name.encode()).digest()).decode(),
+               "crc32c": base64.b64encode(b"\x01\x02\x03\x04").decode(),
+               "updated": datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)}
+    details.update(kwargs)
+    return gcp_interfacer.BlobDetails(name=name, size=size, **details)
+
+
+class TestBlobCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.list_of_blob_details = [
+            blob_details("events/dt=2020-01-01/part-0.csv", size=100),
+            blob_details("events/dt=2020-01-01/part-1.CSV", size=300),
+            blob_details("events/dt=2020-01-02/part-0.parquet", size=50, content_type="application/octet-stream"),
+            blob_details("events/dt=2020-01-02/_SUCCESS", size=0, md5_hash=None, crc32c=None, updated=None),
+            blob_details("other/part-0.csv", size=1000),
+        ]
+        self.catalog = blob_catalog.BlobCatalog.from_pages(bucket_name="bucket",
+                                                           pages=[self.list_of_blob_details[:2],
+                                                                  self.list_of_blob_details[2:]])
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_blobs_are_decoded_back_to_their_details(self):
+        self.assertEqual(5, len(self.catalog))
+        self.assertEqual(self.list_of_blob_details, list(self.catalog))
+        self.assertEqual(3, len(self.catalog.directories))
+        self.assertEqual(1450, self.catalog.get_total_size())
+
+    def test_filter_is_lazy_and_combines_criteria(self):
+        selection = self.catalog.filter(prefix="events/dt=2020-01-0", extension="csv")
+        self.catalog.add(blob_details("events/dt=2020-01-03/part-0.csv"))
+        self.assertEqual(["events/dt=2020-01-01/part-0.csv", "events/dt=2020-01-01/part-1.CSV",
+                          "events/dt=2020-01-03/part-0.csv"], list(selection.iter_names()))
+        self.assertEqual(["gs://bucket/other/part-0.csv"],
+                         list(self.catalog.filter(min_size=500).iter_uris()))
+        self.assertEqual(["events/dt=2020-01-02/part-0.parquet"],
+                         list(self.catalog.filter(partitions={"dt": "2020-01-02"}, min_size=1).iter_names()))
+        self.assertEqual(1, len(self.catalog.filter(predicate=lambda details: details.updated is None)))
+
+    def test_group_by_extension_and_partition(self):
+        by_extension = self.catalog.group_by_extension()
+        self.assertEqual(["csv", "parquet", blob_catalog.NO_EXTENSION], list(by_extension))
+        self.assertEqual(3, len(by_extension["csv"]))
+        by_partition = self.catalog.group_by_partition("dt")
+        self.assertEqual(["2020-01-01", "2020-01-02", blob_catalog.NO_PARTITION], list(by_partition))
+        self.assertEqual(["other/part-0.csv"], list(by_partition[blob_catalog.NO_PARTITION].iter_names()))
+
+    def test_batch_by_size(self):
+        batches = list(self.catalog.batch_by_size(max_bytes=400))
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        self.assertEqual([400, 50, 1000], [batch.get_total_size() for batch in batches])
+        self.assertEqual([2, 2, 1], [len(batch) for batch in self.catalog.batch_by_size(max_bytes=10 ** 6,
+                                                                                         max_count=2)])
+
+    def test_names_spill_to_disk(self):
+        with blob_catalog.BlobCatalog.from_pages(bucket_name="bucket", pages=[self.list_of_blob_details],
+                                                 spill_bytes=16) as catalog:
+            self.assertIsNotNone(catalog._names_file)
+            self.assertEqual(self.list_of_blob_details, list(catalog))
+            self.assertEqual("parquet", catalog.get_extension(2))
+
+    def test_get_blob_type_reads_the_first_name_only(self):
+        self.assertEqual("CSV", gcp_interfacer.get_blob_type(self.catalog.iter_names()))
+
+
+class TestGetBlobCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+
+    def test_get_blob_catalog_lists_every_page(self):
+        self.server.put_synthetic_objects("bucket", ["data/part-{:04d}.csv".format(index) for index in range(1500)],
+                                          size=10)
+        self.server.put_object("bucket", "other/file.csv", b"a,b\n")
+        catalog = blob_catalog.get_blob_catalog(bucket_name="bucket", blob_prefix="data/")
+        self.assertEqual(1500, len(catalog))
+        self.assertEqual(15000, catalog.get_total_size())
+        self.assertEqual(list(gcp_interfacer.iter_blob_details(bucket_name="bucket", blob_prefix="data/")),
+                         list(catalog))
+
+
+if __name__ == '__main__':
+    unittest.main()
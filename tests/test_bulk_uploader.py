@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bq_external_table import bulk_uploader, gcp_clients
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+CHUNK_SIZE = bulk_uploader.CHUNK_SIZE_MULTIPLE
+
+
+class TestBulkUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+        self.source_dir = tempfile.mkdtemp()
+        self.files = {"a.csv": os.urandom(10), "nested/b.avro": os.urandom(CHUNK_SIZE * 2 + 100), "empty.csv": b""}
+        for relative_path, data in self.files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.source_dir, relative_path)), exist_ok=True)
+            with open(os.path.join(self.source_dir, relative_path), "wb") as local_file:
+                local_file.write(data)
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+        shutil.rmtree(self.source_dir)
+
+    def upload(self):
+        return bulk_uploader.upload_directory(bucket_name="bucket", source_dir=self.source_dir,
+                                              destination_prefix="staging", max_concurrent_uploads=2,
+                                              chunk_size=CHUNK_SIZE)
+
+    def test_upload_directory_uploads_every_file_in_chunks(self):
+        actual = self.upload()
+        self.assertEqual({bulk_uploader.STATUS_UPLOADED}, {result.status for result in actual})
+        for relative_path, data in self.files.items():
+            self.assertEqual(data, self.server.get_object_data("bucket", "staging/" + relative_path))
+
+    def test_upload_directory_skips_files_already_uploaded(self):
+        self.upload()
+        with open(os.path.join(self.source_dir, "a.csv"), "wb") as local_file:
+            local_file.write(b"changed!!!")
+        actual = {result.blob_name: result.status for result in self.upload()}
+        self.assertEqual({"staging/a.csv": bulk_uploader.STATUS_UPLOADED,
+                          "staging/empty.csv": bulk_uploader.STATUS_SKIPPED,
+                          "staging/nested/b.avro": bulk_uploader.STATUS_SKIPPED}, actual)
+
+    def test_upload_directory_resumes_interrupted_uploads(self):
+        source_file_name = os.path.join(self.source_dir, "nested/b.avro")
+        data = self.files["nested/b.avro"]
+        state_path = os.path.join(self.source_dir, bulk_uploader.UPLOAD_STATE_FILE_NAME)
+        session_url = gcp_clients.get_bucket("bucket").blob("staging/nested/b.avro").create_resumable_upload_session(
+            size=len(data))
+        gcp_clients.get_http_session().put(session_url, data=data[:CHUNK_SIZE], headers={
+            "Content-Range": "bytes 0-{}/{}".format(CHUNK_SIZE - 1, len(data))})
+        bulk_uploader.UploadState(state_path).set_session_url(source_file_name, len(data),
+                                                              os.path.getmtime(source_file_name), session_url)
+
+        with self.assertLogs(level="INFO") as logs:
+            self.upload()
+        self.assertIn("Resuming upload of {} at byte {}.".format(source_file_name, CHUNK_SIZE), "\n".join(logs.output))
+        self.assertEqual(data, self.server.get_object_data("bucket", "staging/nested/b.avro"))
+        self.assertEqual({}, bulk_uploader.UploadState(state_path)._sessions)
+
+    def test_upload_directory_rejects_invalid_chunk_size(self):
+        self.assertRaises(ValueError, bulk_uploader.upload_directory, "bucket", self.source_dir, chunk_size=1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
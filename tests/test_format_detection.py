@@ -0,0 +1,61 @@
+import gzip
+import unittest
+
+from bq_external_table import format_detection, gcp_clients, gcp_interfacer
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+def fake_blob_details(name, size=10, content_type=None):
+    return gcp_interfacer.BlobDetails(name=name, size=size, generation=1, content_type=content_type, md5_hash=None,
+                                      crc32c=None, updated=None)
+
+
+class TestFormatDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+
+    def detect(self, name, content_type=None):
+        return format_detection.detect_blob_format(bucket_name="bucket",
+                                                   blob_details=fake_blob_details(name, content_type=content_type))
+
+    def test_detect_blob_format_from_extension_without_reading_the_blob(self):
+        self.assertEqual(("CSV", "GZIP"), self.detect("raw/part-0.csv.gz"))
+        self.assertEqual(("PARQUET", "NONE"), self.detect("raw/part-0.PARQUET"))
+        self.assertEqual(("NEWLINE_DELIMITED_JSON", "NONE"), self.detect("raw/part-0.jsonl"))
+        self.assertEqual(("AVRO", "NONE"), self.detect("raw/part-0", content_type="avro/binary"))
+        self.assertEqual(0, self.server.request_count)
+
+    def test_detect_blob_format_from_magic_bytes(self):
+        self.server.put_object("bucket", "raw/avro", b"Obj\x01" + b"\x00" * 20)
+        self.server.put_object("bucket", "raw/json.gz", gzip.compress(b'{"a": 1}\n{"a": 2}\n'))
+        self.server.put_object("bucket", "raw/data.txt", b"a,b\n1,2\n")
+        self.server.put_object("bucket", "raw/binary.bin", b"\x00\x01\x02\xff\xfe" * 10)
+        self.assertEqual(("AVRO", "NONE"), self.detect("raw/avro"))
+        self.assertEqual(("NEWLINE_DELIMITED_JSON", "GZIP"), self.detect("raw/json.gz"))
+        self.assertEqual(("CSV", "NONE"), self.detect("raw/data.txt"))
+        self.assertIsNone(self.detect("raw/binary.bin"))
+
+    def test_only_delimited_text_is_detected_as_csv(self):
+        self.assertEqual(("CSV", None), format_detection.get_format_from_magic_bytes(b"a\tb\n1\t2\n3\t"))
+        self.assertEqual(("CSV", None), format_detection.get_format_from_magic_bytes(b"ORC,1\nORC,2\n"))
+        self.assertEqual((None, None), format_detection.get_format_from_magic_bytes(b"Started\nStopped, done\n"))
+        self.assertEqual((None, "GZIP"), format_detection.get_format_from_magic_bytes(gzip.compress(b"a,b\n1,2,3\n")))
+
+    def test_orc_is_detected_from_its_header_and_binary_stripes(self):
+        self.assertEqual(("ORC", None), format_detection.get_format_from_magic_bytes(
+            b"ORC\x11\x00\x00\n\x06\x12\x04\x08\x03P\x00"))
+        self.assertEqual((None, None), format_detection.get_format_from_magic_bytes(b"ORCHESTRA\nSTRINGS\n"))
+
+    def test_compressed_binary_formats_are_not_supported(self):
+        self.assertIsNone(self.detect("raw/part-0.parquet.gz"))
+
+
+if __name__ == '__main__':
+    unittest.main()
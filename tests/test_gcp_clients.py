@@ -0,0 +1,42 @@
+import threading
+import unittest
+from unittest import mock
+
+from bq_external_table import gcp_clients
+
+
+@mock.patch("bq_external_table.gcp_clients.get_credentials", return_value=(mock.Mock(), "project"))
+@mock.patch("bq_external_table.gcp_clients.storage.Client", side_effect=lambda **kwargs: mock.Mock())
+class TestGCPClients(unittest.TestCase):
+
+    def setUp(self):
+        gcp_clients.configure_clients(pool_size=4)
+
+    def test_get_storage_client_is_reused_in_the_same_thread(self, storage_client, get_credentials):
+        self.assertIs(gcp_clients.get_storage_client(), gcp_clients.get_storage_client())
+        self.assertEqual(1, storage_client.call_count)
+
+    def test_get_storage_client_is_not_shared_between_threads(self, storage_client, get_credentials):
+        clients = []
+        thread = threading.Thread(target=lambda: clients.append(gcp_clients.get_storage_client()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(clients[0], gcp_clients.get_storage_client())
+
+    def test_reset_clients_discards_cached_clients(self, storage_client, get_credentials):
+        client = gcp_clients.get_storage_client()
+        gcp_clients.reset_clients()
+        self.assertIsNot(client, gcp_clients.get_storage_client())
+
+    def test_get_authorized_session_uses_the_configured_pool_size(self, storage_client, get_credentials):
+        session = gcp_clients.get_authorized_session()
+        self.assertEqual(4, session.get_adapter("https://storage.googleapis.com")._pool_maxsize)
+
+    def test_get_bucket_does_not_fetch_metadata(self, storage_client, get_credentials):
+        gcp_clients.get_bucket("bucket")
+        gcp_clients.get_storage_client().bucket.assert_called_once_with("bucket")
+        gcp_clients.get_storage_client().get_bucket.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+
+from bq_external_table import format_detection, gcp_interfacer
+
+
+def fake_blob_details(name, size):
+    return gcp_interfacer.BlobDetails(name=name, size=size, generation=1, content_type=None, md5_hash=None,
+                                      crc32c=None, updated=None)
+
+
+def fake_load_job(job_id, polls_until_done=1, error_result=None, output_rows=10, input_bytes=100):
+    load_job_details = mock.Mock(job_id=job_id, error_result=error_result, output_rows=output_rows,
+                                 input_file_bytes=input_bytes)
+    load_job_details.done.side_effect = [False] * (polls_until_done - 1) + [True]
+    return load_job_details
+
+
+class TestRunLoadJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.bigquery_client = mock.Mock()
+        self.dataset_ref = mock.Mock()
+        self.list_of_source_uris = ["gs://bucket/file_{}.csv".format(index) for index in range(5)]
+
+    def test_run_load_jobs_respects_max_concurrent_jobs(self):
+        in_flight = []
+        max_in_flight = []
+
+        def load_table_from_uri(source_uris, destination, job_id, job_config):
+            load_job_details = fake_load_job(job_id=source_uris, polls_until_done=2)
+            done = load_job_details.done.side_effect
+
+            def done_side_effect():
+                finished = next(done)
+                if finished:
+                    in_flight.remove(source_uris)
+                return finished
+
+            load_job_details.done.side_effect = done_side_effect
+            in_flight.append(source_uris)
+            max_in_flight.append(len(in_flight))
+            return load_job_details
+
+        self.bigquery_client.load_table_from_uri.side_effect = load_table_from_uri
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=self.bigquery_client,
+                                              list_of_source_uris=self.list_of_source_uris,
+                                              dataset_ref=self.dataset_ref,
+                                              job_config=None,
+                                              table_id="table",
+                                              max_concurrent_jobs=2,
+                                              job_poll_interval=0)
+        self.assertEqual(2, max(max_in_flight))
+        self.assertEqual(self.list_of_source_uris, [result.source_uris for result in actual])
+        self.assertTrue(all(result.succeeded for result in actual))
+
+    def test_run_load_jobs_reports_failed_jobs_without_aborting(self):
+        self.bigquery_client.load_table_from_uri.side_effect = [
+            fake_load_job(job_id="job_0"),
+            fake_load_job(job_id="job_1", error_result={"reason": "invalid", "message": "Bad row"}),
+            fake_load_job(job_id="job_2"),
+            fake_load_job(job_id="job_3"),
+            fake_load_job(job_id="job_4")
+        ]
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=self.bigquery_client,
+                                              list_of_source_uris=self.list_of_source_uris,
+                                              dataset_ref=self.dataset_ref,
+                                              job_config=None,
+                                              table_id="table",
+                                              max_concurrent_jobs=3,
+                                              job_poll_interval=0)
+        self.assertEqual([True, False, True, True, True], [result.succeeded for result in actual])
+        self.assertEqual("Bad row", actual[1].error)
+
+
+class TestBatchLoadSources(unittest.TestCase):
+
+    def batch(self, list_of_blob_details, **kwargs):
+        csv_format = format_detection.BlobFormat(source_format="CSV", compression=format_detection.COMPRESSION_NONE)
+        return list(gcp_interfacer.batch_load_sources(
+            bucket_name="bucket", blob_prefix="user",
+            list_of_classified_blobs=((csv_format, blob_details) for blob_details in list_of_blob_details),
+            get_job_config=lambda blob_format, blob_details: blob_format.source_format, **kwargs))
+
+    def test_batch_load_sources_uses_wildcard_when_under_limits(self):
+        actual = self.batch(fake_blob_details("user_{}.csv".format(index), 10) for index in range(20000))
+        self.assertEqual([gcp_interfacer.LoadSource(source_uris=["gs://bucket/user*"], job_config="CSV")], actual)
+
+    def test_batch_load_sources_respects_uri_and_byte_limits(self):
+        actual = self.batch((fake_blob_details("user_{}.csv".format(index), 40) for index in range(7)),
+                            max_uris_per_job=2, max_bytes_per_job=100)
+        self.assertEqual([2, 2, 2, 1], [len(load_source.source_uris) for load_source in actual])
+        self.assertEqual("gs://bucket/user_0.csv", actual[0].source_uris[0])
+
+    def test_batch_load_sources_without_wildcard(self):
+        actual = self.batch([fake_blob_details("user_{}.csv".format(index), 10) for index in range(3)],
+                            use_wildcard=False)
+        self.assertEqual([["gs://bucket/user_0.csv", "gs://bucket/user_1.csv", "gs://bucket/user_2.csv"]],
+                         [load_source.source_uris for load_source in actual])
+
+    def test_batch_load_sources_without_blobs(self):
+        self.assertEqual([], self.batch([]))
+
+
+class TestIterBlobPages(unittest.TestCase):
+
+    @mock.patch("bq_external_table.gcp_clients.get_storage_client")
+    def test_iter_blob_pages_pushes_prefix_to_the_api(self, storage_client):
+        blob = mock.Mock(size=10, generation=2, content_type="text/csv", md5_hash="md5", crc32c="crc", updated=None)
+        blob.name = "user/data.csv"
+        storage_client.return_value.list_blobs.return_value.pages = iter([[blob], []])
+        actual = list(gcp_interfacer.iter_blob_pages(bucket_name="bucket", blob_prefix="user/", match_glob="**.csv"))
+        storage_client.return_value.list_blobs.assert_called_once_with(
+            "bucket", prefix="user/", delimiter=None, fields=gcp_interfacer.BLOB_LISTING_FIELDS, match_glob="**.csv",
+            retry=mock.ANY)
+        self.assertEqual([[fake_blob_details("user/data.csv", 10)._replace(
+            generation=2, content_type="text/csv", md5_hash="md5", crc32c="crc")], []], actual)
+
+
+class TestIncrementalLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.directory, "manifest.sqlite")
+        self.bigquery_client = mock.Mock()
+        self.bigquery_client.load_table_from_uri.side_effect = lambda source_uris, destination, job_id, job_config: \
+            fake_load_job(job_id=job_id)
+        self.bigquery_client.get_dataset.return_value.location = "US"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, list_of_blob_details):
+        with mock.patch("bq_external_table.gcp_interfacer.iter_blob_details",
+                        return_value=iter(list_of_blob_details)):
+            return gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+                bigquery_client=self.bigquery_client, dataset_name="dataset", bucket_name="bucket",
+                table_id="table", blob_prefix="user", job_poll_interval=0, manifest_path=self.manifest_path)
+
+    def test_load_with_manifest_only_loads_new_blobs(self):
+        first_run = self.load([fake_blob_details("user_1.csv", 10), fake_blob_details("user_2.csv", 10)])
+        second_run = self.load([fake_blob_details("user_1.csv", 10), fake_blob_details("user_2.csv", 10),
+                                fake_blob_details("user_3.csv", 10)])
+        self.assertEqual(["gs://bucket/user_1.csv", "gs://bucket/user_2.csv"],
+                         [result.source_uris for result in first_run])
+        self.assertEqual(["gs://bucket/user_3.csv"], [result.source_uris for result in second_run])
+        self.assertEqual([], self.load([fake_blob_details("user_3.csv", 10)]))
+
+
+class TestMixedFormatLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.bigquery_client = mock.Mock()
+        self.bigquery_client.load_table_from_uri.side_effect = lambda source_uris, destination, job_id, job_config: \
+            fake_load_job(job_id="job_{}".format(len(self.bigquery_client.load_table_from_uri.call_args_list)))
+
+    def load(self, list_of_blob_details, load_mode):
+        with mock.patch("bq_external_table.gcp_interfacer.iter_blob_details",
+                        return_value=iter(list_of_blob_details)):
+            return gcp_interfacer.load_bucket_data_into_bigquery_external_table(
+                bigquery_client=self.bigquery_client, dataset_name="dataset", bucket_name="bucket",
+                table_id="table", blob_prefix="raw/", job_poll_interval=0, load_mode=load_mode)
+
+    def test_batch_load_runs_one_job_per_format(self):
+        actual = self.load([fake_blob_details("raw/a.csv", 10), fake_blob_details("raw/b.parquet", 10),
+                            fake_blob_details("raw/c.csv.gz", 10), fake_blob_details("raw/d.csv", 10),
+                            fake_blob_details("raw/e.parquet.gz", 10)], load_mode=gcp_interfacer.LOAD_MODE_BATCH)
+        self.assertEqual([["gs://bucket/raw/a.csv", "gs://bucket/raw/d.csv"], ["gs://bucket/raw/b.parquet"],
+                          ["gs://bucket/raw/c.csv.gz"]], [result.source_uris for result in actual])
+        job_configs = [call[1]["job_config"] for call in self.bigquery_client.load_table_from_uri.call_args_list]
+        self.assertEqual(["CSV", "PARQUET", "CSV"], [job_config.source_format for job_config in job_configs])
+        self.assertTrue(job_configs[0].autodetect)
+
+    def test_batch_load_uses_a_wildcard_for_a_single_format(self):
+        actual = self.load([fake_blob_details("raw/a.avro", 10), fake_blob_details("raw/b.avro", 10)],
+                           load_mode=gcp_interfacer.LOAD_MODE_BATCH)
+        self.assertEqual([["gs://bucket/raw/*"]], [result.source_uris for result in actual])
+
+    def test_per_blob_load_skips_unsupported_formats(self):
+        actual = self.load([fake_blob_details("raw/a.json", 10), fake_blob_details("raw/b.orc.gz", 10)],
+                           load_mode=gcp_interfacer.LOAD_MODE_PER_BLOB)
+        self.assertEqual(["gs://bucket/raw/a.json"], [result.source_uris for result in actual])
+        job_config = self.bigquery_client.load_table_from_uri.call_args[1]["job_config"]
+        self.assertEqual("NEWLINE_DELIMITED_JSON", job_config.source_format)
+
+
+class TestCreateOrUpdateExternalTable(unittest.TestCase):
+
+    def setUp(self):
+        self.bigquery_client = mock.Mock()
+
+    def create_or_update(self, blob_name, **kwargs):
+        with mock.patch("bq_external_table.gcp_interfacer.iter_blob_details",
+                        return_value=iter([fake_blob_details(blob_name, 10)])):
+            return gcp_interfacer.create_or_update_external_table(bigquery_client=self.bigquery_client,
+                                                                  dataset_name="dataset", bucket_name="bucket",
+                                                                  table_id="table", **kwargs)
+
+    def test_create_external_table_with_hive_partitioning(self):
+        actual = self.create_or_update("events/dt=2024-01-01/part-0.parquet", blob_prefix="events/dt=",
+                                       hive_partitioning={"mode": "AUTO"})
+        table = self.bigquery_client.create_table.call_args[0][0]
+        external_config = table.external_data_configuration
+        self.assertEqual([], actual)
+        self.assertEqual("PARQUET", external_config.source_format)
+        self.assertEqual(["gs://bucket/events/dt=*"], external_config.source_uris)
+        self.assertEqual("gs://bucket/events/", external_config.hive_partitioning.source_uri_prefix)
+        self.bigquery_client.load_table_from_uri.assert_not_called()
+
+    def test_update_existing_external_table(self):
+        self.bigquery_client.create_table.side_effect = exceptions.Conflict("Already exists")
+        self.create_or_update("user/data.csv", blob_prefix="user/", csv_options={"skip_leading_rows": 1})
+        table, fields = self.bigquery_client.update_table.call_args[0]
+        self.assertEqual(["external_data_configuration"], fields)
+        self.assertTrue(table.external_data_configuration.autodetect)
+        self.assertEqual(1, table.external_data_configuration.options.skip_leading_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+
+from bq_external_table import manifest, resilience
+from bq_external_table.gcp_interfacer import BlobDetails
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+
+
+def blob_details(name, generation, md5_hash=None):
+    return BlobDetails(name=name, size=10, generation=generation, content_type=None, md5_hash=md5_hash, crc32c=None,
+                       updated=None)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.directory, "manifest.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_filter_new_blobs_skips_loaded_blobs_and_keeps_changed_ones(self):
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_1",
+                              [blob_details("a.csv", 1), blob_details("b.csv", 1, "md5_b"), blob_details("c.csv", 1)])
+        manifest.mark_loaded(self.manifest_path, "job_1")
+        listing = [blob_details("a.csv", 1), blob_details("b.csv", 2, "md5_b"), blob_details("c.csv", 2, "md5_c"),
+                   blob_details("d.csv", 1)]
+        actual = list(manifest.filter_new_blobs(self.manifest_path, "bucket", "dataset.table", listing))
+        self.assertEqual(["c.csv", "d.csv"], [new_blob_details.name for new_blob_details in actual])
+
+    def test_move_job_keeps_the_blobs_of_a_retried_job_pending(self):
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_1", [blob_details("a.csv", 1)])
+        manifest.move_job(self.manifest_path, "job_1", "job_1_retry1")
+        manifest.discard_job(self.manifest_path, "job_1")
+        manifest.mark_loaded(self.manifest_path, "job_1_retry1")
+        actual = list(manifest.filter_new_blobs(self.manifest_path, "bucket", "dataset.table",
+                                                [blob_details("a.csv", 1)]))
+        self.assertEqual([], actual)
+
+    def test_filter_new_blobs_is_per_table(self):
+        manifest.rebuild_table(self.manifest_path, "bucket", "dataset.table", [blob_details("a.csv", 1)])
+        actual = list(manifest.filter_new_blobs(self.manifest_path, "bucket", "dataset.other_table",
+                                                [blob_details("a.csv", 1)]))
+        self.assertEqual(1, len(actual))
+
+    def test_reconcile_pending_jobs(self):
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_done", [blob_details("a.csv", 1)])
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_failed", [blob_details("b.csv", 1)])
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_missing", [blob_details("c.csv", 1)])
+        jobs = {"job_done": mock.Mock(error_result=None),
+                "job_failed": mock.Mock(error_result={"message": "Bad row"})}
+
+        def get_job(job_id, location=None):
+            if job_id not in jobs:
+                raise exceptions.NotFound("Not found")
+            return jobs[job_id]
+
+        bigquery_client = mock.Mock()
+        bigquery_client.get_job.side_effect = get_job
+        manifest.reconcile_pending_jobs(self.manifest_path, bigquery_client)
+        self.assertEqual([("dataset.table", "bucket", manifest.STATUS_LOADED, 1)],
+                         [row[:4] for row in manifest.inspect(self.manifest_path)])
+
+    def test_reconcile_pending_jobs_keeps_jobs_it_cannot_get_pending(self):
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+        self.addCleanup(resilience.configure)
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_flaky", [blob_details("a.csv", 1)])
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_denied", [blob_details("b.csv", 1)])
+        responses = {"job_flaky": [exceptions.ServiceUnavailable("Unavailable"), mock.Mock(error_result=None)]}
+
+        def get_job(job_id, location=None):
+            if job_id == "job_denied":
+                raise exceptions.Forbidden("Access denied")
+            response = responses[job_id].pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        bigquery_client = mock.Mock()
+        bigquery_client.get_job.side_effect = get_job
+        manifest.reconcile_pending_jobs(self.manifest_path, bigquery_client)
+        self.assertEqual([("dataset.table", "bucket", manifest.STATUS_LOADED, 1),
+                          ("dataset.table", "bucket", manifest.STATUS_PENDING, 1)],
+                         [row[:4] for row in manifest.inspect(self.manifest_path)])
+
+    def test_reconcile_pending_jobs_in_a_regional_location(self):
+        bigquery_client = FakeBigQueryClient(location="asia-northeast1")
+        bigquery_client.load_table_from_uri("gs://bucket/a.csv", "fake-project.dataset.table", job_id="job_done")
+        manifest.mark_pending(self.manifest_path, "bucket", "dataset.table", "job_done", [blob_details("a.csv", 1)],
+                              location="asia-northeast1")
+        manifest.reconcile_pending_jobs(self.manifest_path, bigquery_client)
+        self.assertEqual([("dataset.table", "bucket", manifest.STATUS_LOADED, 1)],
+                         [row[:4] for row in manifest.inspect(self.manifest_path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
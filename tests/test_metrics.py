@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bq_external_table import gcp_interfacer, metrics
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.reset()
+        shutil.rmtree(self.directory)
+
+    def test_counters_and_timers_are_aggregated_per_labels(self):
+        metrics.increment("objects", 2, bucket="a")
+        metrics.increment("objects", 3, bucket="a")
+        metrics.increment("objects", bucket="b")
+        metrics.observe("list_page", 0.5, bucket="a")
+        metrics.observe("list_page", 1.5, bucket="a")
+        self.assertEqual(5, metrics.get_registry().get_counter("objects", bucket="a"))
+        self.assertEqual(1, metrics.get_registry().get_counter("objects", bucket="b"))
+        self.assertEqual((2, 2.0, 1.5), metrics.get_registry().get_timer("list_page", bucket="a"))
+
+    def test_span_records_attributes_and_errors(self):
+        with metrics.span("table_load", table="users") as span_attributes:
+            span_attributes["rows"] = 10
+        with self.assertRaises(ValueError):
+            with metrics.span("table_load", table="orders"):
+                raise ValueError("broken")
+        _, _, spans = metrics.get_registry().snapshot()
+        self.assertEqual([({"table": "users"}, {"rows": 10}, None), ({"table": "orders"}, {}, "broken")],
+                         [(span["labels"], span["attributes"], span["error"]) for span in spans])
+        self.assertEqual(1, metrics.get_registry().get_timer("table_load", table="orders")[0])
+
+    def test_exports(self):
+        metrics.increment("gcs_objects_listed", 7, bucket='my"bucket')
+        metrics.observe("bigquery_submit_job", 0.25, table="users")
+        with metrics.span("run"):
+            pass
+        metrics_path = os.path.join(self.directory, "metrics.jsonl")
+        metrics.write_json_lines(metrics_path)
+        with open(metrics_path) as metrics_file:
+            lines = [json.loads(line) for line in metrics_file]
+        self.assertEqual(["span", "counter", "timer", "timer"], [line["type"] for line in lines])
+        self.assertEqual(7, lines[1]["value"])
+        prometheus_text = metrics.format_prometheus()
+        self.assertIn('bq_external_table_gcs_objects_listed_total{bucket="my\\"bucket"} 7', prometheus_text)
+        self.assertIn('bq_external_table_bigquery_submit_job_seconds_count{table="users"} 1', prometheus_text)
+        self.assertIn('bq_external_table_bigquery_submit_job_seconds_max{table="users"} 0.25', prometheus_text)
+
+    def test_run_load_jobs_records_job_statistics(self):
+        bigquery_client = FakeBigQueryClient(bytes_per_row=10)
+        bigquery_client.resolve_source_uris = lambda source_uris: (1, 100)
+        gcp_interfacer.run_load_jobs(bigquery_client=bigquery_client,
+                                     list_of_source_uris=["gs://bucket/a.csv", "gs://bucket/b.csv"],
+                                     dataset_ref=bigquery_client.dataset("dataset"), job_config=None,
+                                     table_id="users", max_concurrent_jobs=2, job_poll_interval=0)
+        registry = metrics.get_registry()
+        self.assertEqual(2, registry.get_counter("bigquery_jobs_submitted", table="users"))
+        self.assertEqual(2, registry.get_counter("bigquery_jobs_finished", table="users", status="succeeded"))
+        self.assertEqual(200, registry.get_counter("bigquery_bytes_loaded", table="users"))
+        self.assertEqual(20, registry.get_counter("bigquery_rows_loaded", table="users"))
+        self.assertEqual(2, registry.get_timer("bigquery_job_running", table="users")[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import datetime
+import unittest
+
+from bq_external_table import blob_catalog, gcp_clients, gcp_interfacer, metrics, partitioning, resilience
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+def get_catalog(*blob_names):
+    return blob_catalog.BlobCatalog.from_pages(bucket_name="bucket", pages=[[
+        gcp_interfacer.BlobDetails(name=blob_name, size=10, generation=1, content_type=None, md5_hash=None,
+                                   crc32c=None, updated=None) for blob_name in blob_names]])
+
+
+class TestPartitioning(unittest.TestCase):
+
+    def test_get_partition_decorator(self):
+        partition_start = partitioning.get_partition_start("2020-03-07T05", date_format="%Y-%m-%dT%H",
+                                                           partition_type=partitioning.PARTITION_TYPE_HOUR)
+        self.assertEqual("2020030705", partitioning.get_partition_decorator(partition_start,
+                                                                            partitioning.PARTITION_TYPE_HOUR))
+        self.assertEqual("20200307", partitioning.get_partition_decorator(partition_start))
+        self.assertEqual("202003", partitioning.get_partition_decorator(
+            partitioning.get_partition_start("2020-03-07", partition_type=partitioning.PARTITION_TYPE_MONTH),
+            partitioning.PARTITION_TYPE_MONTH))
+        self.assertIsNone(partitioning.get_partition_start("latest"))
+        self.assertEqual("events$20200307", partitioning.get_partitioned_table_id("events", "20200307"))
+
+    def test_get_date_range(self):
+        today = datetime.datetime(2020, 3, 7, 15)
+        self.assertEqual((datetime.datetime(2020, 3, 5), datetime.datetime(2020, 3, 7)),
+                         partitioning.get_date_range({"last_days": 3}, today=today))
+        self.assertEqual((datetime.datetime(2020, 1, 1), None),
+                         partitioning.get_date_range({"start_date": "2020-01-01"}))
+        self.assertEqual(["202011", "202012", "202101"],
+                         [partitioning.get_partition_decorator(partition_start, partitioning.PARTITION_TYPE_MONTH)
+                          for partition_start in partitioning.iter_partition_starts(
+                             datetime.datetime(2020, 11, 1), datetime.datetime(2021, 1, 1),
+                             partitioning.PARTITION_TYPE_MONTH)])
+
+    def test_discover_partitions_applies_the_date_range_and_filters(self):
+        catalog = get_catalog("events/region=eu/dt=2020-01-01/part-0.csv",
+                              "events/region=us/dt=2020-01-01/part-0.csv",
+                              "events/region=eu/dt=2020-01-02/part-0.csv",
+                              "events/region=ap/dt=2020-01-02/part-0.csv",
+                              "events/region=eu/dt=2020-01-03/part-0.csv",
+                              "events/region=eu/dt=unknown/part-0.csv",
+                              "events/README.md")
+        actual = partitioning.discover_partitions(catalog=catalog, partitioning={
+            "key": "dt", "end_date": "2020-01-02", "filters": {"region": ["eu", "us"]}})
+        self.assertEqual([("2020-01-01", "20200101", 2), ("2020-01-02", "20200102", 1)],
+                         [(partition.value, partition.decorator, len(partition.blobs)) for partition in actual])
+        self.assertEqual(["events/region=eu/dt=2020-01-01/part-0.csv", "events/region=us/dt=2020-01-01/part-0.csv"],
+                         list(actual[0].blobs.iter_names()))
+
+
+class TestLoadPartitionedTable(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+        self.bigquery_client = FakeBigQueryClient(project="test", gcs_server=self.server)
+        for day in range(1, 6):
+            for index in range(2):
+                self.server.put_object("bucket", "events/dt=2020-01-0{}/part-{}.csv".format(day, index),
+                                       b"a,b\n1,2\n")
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+        resilience.configure()
+        metrics.reset()
+
+    def load(self, load_arguments=None, **table_partitioning):
+        table_partitioning.setdefault("key", "dt")
+        load_arguments = dict({"load_mode": gcp_interfacer.LOAD_MODE_BATCH}, **(load_arguments or {}))
+        return partitioning.load_partitioned_table(bigquery_client=self.bigquery_client, dataset_name="dataset",
+                                                   bucket_name="bucket", table_id="events", blob_prefix="events/",
+                                                   partitioning=table_partitioning, max_concurrent_partitions=3,
+                                                   today=datetime.datetime(2020, 1, 5, 8), job_poll_interval=0.01,
+                                                   **load_arguments)
+
+    def test_each_partition_loads_into_its_decorator(self):
+        actual = self.load(clustering_fields=["a"], write_disposition="WRITE_TRUNCATE")
+        self.assertEqual(5, len(actual))
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertEqual(["gs://bucket/events/dt=2020-01-01/part-0.csv", "gs://bucket/events/dt=2020-01-01/part-1.csv"],
+                         actual[0].source_uris)
+        load_jobs = sorted(self.bigquery_client.jobs.values(), key=lambda load_job: load_job.destination.table_id)
+        self.assertEqual(["events$2020010{}".format(day) for day in range(1, 6)],
+                         [load_job.destination.table_id for load_job in load_jobs])
+        job_config = load_jobs[0].job_config
+        self.assertEqual("DAY", job_config.time_partitioning.type_)
+        self.assertEqual(["a"], job_config.clustering_fields)
+        self.assertEqual("WRITE_TRUNCATE", job_config.write_disposition)
+
+    def test_write_truncate_loads_each_partition_with_one_job_under_per_blob(self):
+        actual = self.load(load_arguments={"load_mode": gcp_interfacer.LOAD_MODE_PER_BLOB}, last_days=1,
+                           write_disposition="WRITE_TRUNCATE")
+        self.assertEqual([["gs://bucket/events/dt=2020-01-05/part-{}.csv".format(index) for index in range(2)]],
+                         [result.source_uris for result in actual])
+        self.assertEqual(["WRITE_TRUNCATE"],
+                         [load_job.job_config.write_disposition for load_job in self.bigquery_client.jobs.values()])
+
+    def test_write_truncate_appends_the_next_jobs_of_a_partition_after_the_first_one(self):
+        self.bigquery_client.job_latency = 0.05
+        actual = self.load(load_arguments={"max_uris_per_job": 1, "max_concurrent_jobs": 4}, last_days=1,
+                           write_disposition="WRITE_TRUNCATE")
+        self.assertEqual(2, len(actual))
+        load_jobs = sorted(self.bigquery_client.jobs.values(), key=lambda load_job: load_job.created_at)
+        self.assertEqual(["WRITE_TRUNCATE", "WRITE_APPEND"],
+                         [load_job.job_config.write_disposition for load_job in load_jobs])
+        self.assertGreaterEqual(load_jobs[1].created_at, load_jobs[0].ends_at)
+
+    def test_write_truncate_is_rejected_with_a_manifest(self):
+        with self.assertRaises(ValueError):
+            self.load(load_arguments={"manifest_path": "manifest.sqlite"}, write_disposition="WRITE_TRUNCATE")
+
+    def test_only_the_partitions_of_the_last_days_are_listed_and_loaded(self):
+        actual = self.load(last_days=2, list_partitions=True)
+        self.assertEqual(["20200104", "20200105"],
+                         sorted(load_job.destination.table_id.split("$")[1]
+                                for load_job in self.bigquery_client.jobs.values()))
+        self.assertEqual(2, len(actual))
+        self.assertEqual(4, metrics.get_registry().get_counter("gcs_objects_listed", bucket="bucket"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+from bq_external_table import gcp_clients, gcp_interfacer, manifest, metrics, planner, resilience, scheduler
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+        for index in range(10):
+            self.server.put_object("bucket", "data/part-{:03d}.csv".format(index), b"a,b\n1,2\n")
+        self.directory = tempfile.TemporaryDirectory()
+        self.load_options = {"max_concurrent_jobs": 2, "max_concurrent_tables": 2, "load_mode": "per_blob",
+                             "max_uris_per_job": 4, "max_bytes_per_job": 10 ** 12, "max_concurrent_partitions": 2}
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+        gcp_clients.configure_clients()
+        resilience.configure()
+        metrics.reset()
+
+    def plan(self, history=None, **table_details):
+        table_details.setdefault("table_name", "table")
+        table_details.setdefault("blob_prefix", "data/")
+        table_tasks = scheduler.get_table_tasks(buckets={"bucket": [table_details]}, dataset_name="dataset")
+        return planner.plan_tables(table_tasks=table_tasks, load_options=self.load_options,
+                                   history=history or planner.read_history(None))[0]
+
+    def test_plan_groups_blobs_into_the_jobs_of_the_load_mode(self):
+        per_blob = self.plan()
+        self.assertEqual((10, 80, 10, 1), (per_blob.blobs, per_blob.input_bytes, per_blob.jobs,
+                                           per_blob.list_requests))
+        self.assertEqual(5 * planner.DEFAULT_JOB_SECONDS + planner.DEFAULT_LIST_PAGE_SECONDS,
+                         per_blob.estimated_seconds)
+        self.assertEqual(1, self.plan(load_mode="batch").jobs)
+        batched = self.plan(load_mode="batch", blob_glob="**.csv")
+        self.assertEqual((3, 32), (batched.jobs, batched.largest_job_bytes))
+
+    def test_plan_counts_the_reads_of_undetected_formats(self):
+        self.server.put_object("bucket", "data/part-999.bin", b"\x00\x01")
+        self.server.put_object("bucket", "data/part-998.gz", b"\x1f\x8b")
+        self.server.put_object("bucket", "data/part-997.parquet.gz", b"\x1f\x8b")
+        actual = self.plan()
+        self.assertEqual((12, 2, 1), (actual.jobs, actual.format_detection_reads, actual.skipped_blobs))
+
+    def test_plan_of_a_partitioned_table(self):
+        for day in range(1, 4):
+            self.server.put_object("bucket", "events/dt=2020-01-0{}/part-0.csv".format(day), b"a,b\n1,2\n")
+        actual = self.plan(blob_prefix="events/", load_mode="batch",
+                           partitioning={"key": "dt", "start_date": "2020-01-02", "end_date": "2020-01-03",
+                                         "list_partitions": True})
+        self.assertEqual((2, 2, 2, 2), (actual.partitions, actual.jobs, actual.blobs, actual.list_requests))
+        self.server.put_object("bucket", "events/dt=2020-01-02/part-1.csv", b"a,b\n1,2\n")
+        truncated = self.plan(blob_prefix="events/", partitioning={"key": "dt", "start_date": "2020-01-02",
+                                                                   "write_disposition": "WRITE_TRUNCATE"})
+        self.assertEqual((2, 2, 3), (truncated.partitions, truncated.jobs, truncated.blobs))
+
+    def test_plan_of_a_partitioned_table_skips_the_blobs_in_the_manifest_of_their_partition(self):
+        for day in range(1, 4):
+            self.server.put_object("bucket", "events/dt=2020-01-0{}/part-0.csv".format(day), b"a,b\n1,2\n")
+        self.load_options["manifest_path"] = os.path.join(self.directory.name, "manifest.sqlite")
+        manifest.rebuild_table(self.load_options["manifest_path"], "bucket", "dataset.events$20200102",
+                               gcp_interfacer.iter_blob_details(bucket_name="bucket",
+                                                                blob_prefix="events/dt=2020-01-02/"))
+        actual = self.plan(table_name="events", blob_prefix="events/", load_mode="batch",
+                           partitioning={"key": "dt", "start_date": "2020-01-02", "end_date": "2020-01-03"})
+        self.assertEqual((2, 1, 1), (actual.partitions, actual.jobs, actual.blobs))
+
+    def test_history_timings_are_used_for_the_estimates(self):
+        history_path = os.path.join(self.directory.name, "history.json")
+        table_tasks = scheduler.get_table_tasks(buckets={"bucket": [{"table_name": "table"}]}, dataset_name="dataset")
+        summary = scheduler.TableSummary(bucket_name="bucket", table_id="table", duration=10.0, jobs=4, failed_jobs=0,
+                                         input_bytes=400, output_rows=4, error=None, dataset_name="dataset")
+        metrics.observe("gcs_list_page", 0.5, bucket="bucket")
+        planner.record_run_history(history_path=history_path, table_tasks=table_tasks,
+                                   list_of_summaries=[summary, summary._replace(error="failed")],
+                                   load_options=self.load_options)
+        history = planner.read_history(history_path)
+        self.assertEqual({"dataset.table": [[4, 400, 20.0]]}, history["tables"])
+        self.assertEqual(planner.JobTimings(seconds_per_job=5.0, bytes_per_job=100.0, runs=1),
+                         planner.get_job_timings(history, "dataset.table"))
+        self.assertEqual(planner.JobTimings(seconds_per_job=5.0, bytes_per_job=100.0, runs=0),
+                         planner.get_job_timings(history, "dataset.other"))
+        self.assertEqual(10.0, planner.estimate_job_seconds(200, planner.get_job_timings(history, "dataset.table")))
+        self.assertEqual(5 * 5.0 + 0.5, self.plan(history=history).estimated_seconds)
+
+    def test_run_plan_reports_totals_and_quota_warnings(self):
+        table_plan = planner.TablePlan(dataset_name="dataset", bucket_name="bucket", table_id="table",
+                                       table_type="native", blobs=2000, input_bytes=2000, jobs=2000, partitions=0,
+                                       list_requests=2, format_detection_reads=0, skipped_blobs=0,
+                                       largest_job_bytes=1, estimated_seconds=100.0, history_runs=1, error=None)
+        plan = planner.get_run_plan(list_of_table_plans=[table_plan, table_plan._replace(table_id="other",
+                                                                                            jobs=10)],
+                                    load_options=self.load_options)
+        self.assertEqual(2010, plan["totals"]["jobs"])
+        self.assertEqual(100.0, plan["totals"]["estimated_seconds"])
+        self.assertEqual(2000, plan["quota"]["max_load_jobs_per_table"])
+        self.assertEqual(["Table dataset.table needs 2000 load jobs, over the 1500 per table and day."],
+                         plan["warnings"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bq_external_table import preprocessing
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+VALID_CSV = "id,name,created,active\n1,a,2024-01-01 10:00:00,true\n2,b,2024-01-02 11:30:00,false\n3,,,\n"
+
+
+class TestPreprocessing(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, "source")
+        self.files = {
+            "valid.csv": VALID_CSV,
+            "nested/bad_row.csv": VALID_CSV + "4,d,2024-01-04 00:00:00,true,extra\n",
+            "wrong_type.csv": VALID_CSV + "x,e,2024-01-05 00:00:00,true\n",
+            "data.json": '{"id": 1}\n',
+        }
+        for relative_path, data in self.files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.source_dir, relative_path)), exist_ok=True)
+            with open(os.path.join(self.source_dir, relative_path), "w") as local_file:
+                local_file.write(data)
+        with gzip.open(os.path.join(self.source_dir, "compressed.csv.gz"), "wt") as local_file:
+            local_file.write(VALID_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def preprocess(self, output_format, **kwargs):
+        list_of_results = preprocessing.preprocess_directory(source_dir=self.source_dir, output_format=output_format,
+                                                             chunk_rows=2, processes=2, **kwargs)
+        return {os.path.relpath(result.source_file_name, self.source_dir).replace(os.sep, "/"): result
+                for result in list_of_results}
+
+    def test_preprocess_directory_compresses_valid_csv_and_quarantines_bad_rows(self):
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_CSV)
+        self.assertEqual(preprocessing.STATUS_CONVERTED, actual["valid.csv"].status)
+        self.assertEqual(3, actual["valid.csv"].rows)
+        with gzip.open(actual["valid.csv"].output_file_name, "rt", newline="") as output_file:
+            self.assertEqual(VALID_CSV.splitlines(), output_file.read().splitlines())
+        self.assertTrue(actual["compressed.csv.gz"].output_file_name.endswith("compressed.csv.gz"))
+        # The values are not typed when the output is CSV, so only the wrong column count is a bad row.
+        self.assertEqual(preprocessing.STATUS_CONVERTED, actual["wrong_type.csv"].status)
+        self.assertEqual(preprocessing.STATUS_QUARANTINED, actual["nested/bad_row.csv"].status)
+        self.assertEqual(1, actual["nested/bad_row.csv"].bad_rows)
+        quarantined_file_name = os.path.join(self.source_dir + "_quarantine", "nested", "bad_row.csv")
+        with open(quarantined_file_name + ".error.json") as report_file:
+            self.assertEqual([{"line": 5, "error": "5 columns instead of 4"}], json.load(report_file)["bad_rows"])
+        self.assertTrue(os.path.exists(quarantined_file_name))
+        self.assertEqual(preprocessing.STATUS_COPIED, actual["data.json"].status)
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir + "_preprocessed", "data.json")))
+
+    def test_preprocess_directory_leaves_out_up_to_max_bad_rows(self):
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_CSV, max_bad_rows=1, compression="none")
+        self.assertEqual(preprocessing.STATUS_CONVERTED, actual["nested/bad_row.csv"].status)
+        self.assertEqual((3, 1), (actual["nested/bad_row.csv"].rows, actual["nested/bad_row.csv"].bad_rows))
+        self.assertTrue(actual["nested/bad_row.csv"].output_file_name.endswith("bad_row.csv"))
+
+    def test_preprocess_directory_quarantines_unexpected_header(self):
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_CSV, expected_header=["id", "name", "created", "flag"])
+        self.assertEqual({preprocessing.STATUS_QUARANTINED},
+                         {result.status for path, result in actual.items() if path.endswith((".csv", ".csv.gz"))})
+        self.assertIn("not the expected", actual["valid.csv"].error)
+
+    def test_preprocess_directory_quarantines_truncated_and_corrupt_gzip_files(self):
+        compressed = gzip.compress(VALID_CSV.encode() * 1000)
+        corrupt = bytearray(compressed)
+        corrupt[30:60] = b"\xff" * 30
+        for relative_path, data in (("truncated.csv.gz", compressed[:len(compressed) // 2]),
+                                    ("corrupt.csv.gz", bytes(corrupt))):
+            with open(os.path.join(self.source_dir, relative_path), "wb") as local_file:
+                local_file.write(data)
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_CSV)
+        self.assertEqual(preprocessing.STATUS_QUARANTINED, actual["truncated.csv.gz"].status)
+        self.assertEqual(preprocessing.STATUS_QUARANTINED, actual["corrupt.csv.gz"].status)
+        self.assertEqual(preprocessing.STATUS_CONVERTED, actual["valid.csv"].status)
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir + "_quarantine", "truncated.csv.gz")))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_preprocess_directory_converts_to_parquet(self):
+        # The types are inferred from the first rows only, so that the last row of wrong_type.csv is a bad row.
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_PARQUET, sample_bytes=len(VALID_CSV))
+        self.assertEqual(preprocessing.STATUS_QUARANTINED, actual["wrong_type.csv"].status)
+        with open(os.path.join(self.source_dir + "_quarantine", "wrong_type.csv.error.json")) as report_file:
+            self.assertIn("invalid literal", json.load(report_file)["bad_rows"][0]["error"])
+        table = pyarrow.parquet.read_table(actual["valid.csv"].output_file_name)
+        self.assertEqual(["id", "name", "created", "active"], table.column_names)
+        self.assertEqual([1, 2, 3], table.column("id").to_pylist())
+        self.assertEqual([True, False, None], table.column("active").to_pylist())
+        self.assertEqual(datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc),
+                         table.column("created").to_pylist()[0])
+
+    @unittest.skipIf(fastavro is None, "fastavro is not installed")
+    def test_preprocess_directory_converts_to_avro(self):
+        actual = self.preprocess(preprocessing.OUTPUT_FORMAT_AVRO)
+        self.assertTrue(actual["compressed.csv.gz"].output_file_name.endswith("compressed.avro"))
+        with open(actual["compressed.csv.gz"].output_file_name, "rb") as avro_file:
+            records = list(fastavro.reader(avro_file))
+        self.assertEqual(3, actual["compressed.csv.gz"].rows)
+        self.assertEqual({"id": 2, "name": "b", "active": False,
+                          "created": datetime.datetime(2024, 1, 2, 11, 30, tzinfo=datetime.timezone.utc)}, records[1])
+        self.assertEqual({"id": 3, "name": None, "created": None, "active": None}, records[2])
+
+    def test_preprocess_directory_rejects_unknown_format(self):
+        with self.assertRaises(ValueError):
+            preprocessing.preprocess_directory(source_dir=self.source_dir, output_format="orc")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import time
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+
+from bq_external_table import gcp_clients, gcp_interfacer, metrics, resilience
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+class TestResilience(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+
+    def tearDown(self):
+        resilience.configure()
+        metrics.reset()
+
+    def test_call_with_retry_retries_transient_errors_only(self):
+        function = mock.Mock(side_effect=[exceptions.TooManyRequests("slow down"),
+                                          exceptions.ServiceUnavailable("unavailable"), "result"])
+        on_throttle = mock.Mock()
+        self.assertEqual("result", resilience.call_with_retry(api=resilience.API_BIGQUERY, function=function,
+                                                              args=(1,), on_throttle=on_throttle))
+        self.assertEqual(3, function.call_count)
+        self.assertEqual(1, on_throttle.call_count)
+        self.assertEqual(1, metrics.get_registry().get_counter("retries", api="bigquery", reason="throttled"))
+        with self.assertRaises(exceptions.BadRequest):
+            resilience.call_with_retry(api=resilience.API_BIGQUERY,
+                                       function=mock.Mock(side_effect=exceptions.BadRequest("invalid")))
+
+    def test_call_with_retry_gives_up_after_max_attempts(self):
+        resilience.configure(max_attempts=3, initial_delay=0.001, max_delay=0.01)
+        function = mock.Mock(side_effect=exceptions.InternalServerError("backend"))
+        with self.assertRaises(exceptions.InternalServerError):
+            resilience.call_with_retry(api=resilience.API_STORAGE, function=function)
+        self.assertEqual(3, function.call_count)
+
+    def test_rate_limit_errors_are_detected_from_their_reason(self):
+        error = exceptions.Forbidden("Exceeded rate limits", errors=[{"reason": "rateLimitExceeded"}])
+        self.assertTrue(resilience.is_retryable_error(error))
+        self.assertTrue(resilience.is_throttling_error(error))
+        self.assertFalse(resilience.is_retryable_error(exceptions.Forbidden("Access denied")))
+
+    def test_token_bucket_limits_the_rate(self):
+        token_bucket = resilience.TokenBucket(rate=100, burst=1)
+        start = time.monotonic()
+        for _ in range(11):
+            token_bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_adaptive_concurrency(self):
+        concurrency = resilience.AdaptiveConcurrency(maximum=8)
+        concurrency.on_throttle()
+        concurrency.on_throttle()
+        self.assertEqual(2, concurrency.limit)
+        for _ in range(2):
+            concurrency.on_success()
+        self.assertEqual(3, concurrency.limit)
+
+    def test_run_load_jobs_does_not_duplicate_jobs_when_responses_are_lost(self):
+        bigquery_client = FakeBigQueryClient(fault_rate=0.3, lost_responses=True)
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=bigquery_client,
+                                              list_of_source_uris=["gs://bucket/{}.csv".format(index)
+                                                                   for index in range(10)],
+                                              dataset_ref=bigquery_client.dataset("dataset"), job_config=None,
+                                              table_id="table", max_concurrent_jobs=4, job_poll_interval=0)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertGreater(bigquery_client.fault_count, 0)
+        self.assertEqual(10, len(bigquery_client.jobs))
+
+    def test_run_load_jobs_reuses_lost_jobs_of_a_regional_data_set(self):
+        bigquery_client = FakeBigQueryClient(fault_rate=0.3, lost_responses=True, location="asia-northeast1")
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=bigquery_client,
+                                              list_of_source_uris=["gs://bucket/{}.csv".format(index)
+                                                                   for index in range(10)],
+                                              dataset_ref=bigquery_client.dataset("dataset"), job_config=None,
+                                              table_id="table", max_concurrent_jobs=4, job_poll_interval=0)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertGreater(bigquery_client.fault_count, 0)
+        self.assertEqual(10, len(bigquery_client.jobs))
+
+    def test_run_load_jobs_runs_transient_job_failures_again(self):
+        bigquery_client = FakeBigQueryClient(failure_rate=0.5, failure_reason="backendError")
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=bigquery_client,
+                                              list_of_source_uris=["gs://bucket/{}.csv".format(index)
+                                                                   for index in range(4)],
+                                              dataset_ref=bigquery_client.dataset("dataset"), job_config=None,
+                                              table_id="table", max_concurrent_jobs=2, job_poll_interval=0)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertTrue(any(result.job_id.endswith("_retry1") for result in actual))
+
+    def test_run_load_jobs_retries_get_distinct_ids_for_tables_named_retry(self):
+        bigquery_client = FakeBigQueryClient(failure_rate=0.5, failure_reason="backendError")
+        actual = gcp_interfacer.run_load_jobs(bigquery_client=bigquery_client,
+                                              list_of_source_uris=["gs://bucket/{}.csv".format(index)
+                                                                   for index in range(4)],
+                                              dataset_ref=bigquery_client.dataset("dataset"), job_config=None,
+                                              table_id="events_retry", max_concurrent_jobs=2, job_poll_interval=0)
+        self.assertTrue(all(result.succeeded for result in actual))
+        self.assertEqual(4, len(set(result.job_id for result in actual)))
+        self.assertEqual(sorted("gs://bucket/{}.csv".format(index) for index in range(4)),
+                         sorted(result.source_uris for result in actual))
+
+    def test_get_retry_job_id(self):
+        self.assertEqual("bq_external_table_events_retry_abc_0_retry2",
+                         gcp_interfacer.get_retry_job_id("bq_external_table_events_retry_abc_0_retry1", 2))
+        self.assertEqual("bq_external_table_events_retry_abc_0_retry1",
+                         gcp_interfacer.get_retry_job_id("bq_external_table_events_retry_abc_0", 1))
+
+    def test_listing_survives_throttled_pages(self):
+        with FakeGCSServer(fault_rate=0.5) as server:
+            server.create_bucket("bucket")
+            server.put_synthetic_objects("bucket", ["data/{}.csv".format(index) for index in range(30)], size=10)
+            gcp_clients.configure_clients(storage_api_endpoint=server.endpoint, project="test")
+            try:
+                actual = list(gcp_interfacer.iter_blob_details(bucket_name="bucket", blob_prefix="data/",
+                                                               page_size=10))
+            finally:
+                gcp_clients.configure_clients()
+        self.assertEqual(30, len(actual))
+        self.assertGreater(server.fault_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import threading
+import time
+import unittest
+
+from bq_external_table import scheduler
+from bq_external_table.gcp_interfacer import LoadJobResult
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.buckets = {
+            "bucket_a": [{"table_name": "a_1", "blob_prefix": "a_1"},
+                         {"table_name": "a_2", "blob_prefix": "a_2", "priority": -1},
+                         {"table_name": "a_3", "blob_prefix": "a_3"}],
+            "bucket_b": [{"table_name": "b_1", "blob_prefix": "b_1"}]
+        }
+
+    def test_get_table_tasks_orders_by_priority_then_config_order(self):
+        actual = [table_task.table_details["table_name"] for table_task in scheduler.get_table_tasks(self.buckets)]
+        self.assertEqual(["a_2", "a_1", "a_3", "b_1"], actual)
+
+    def test_run_table_tasks_respects_limits_and_summarises(self):
+        lock = threading.Lock()
+        running = {"total": 0, "bucket_a": 0, "bucket_b": 0}
+        peaks = {"total": 0, "bucket_a": 0}
+
+        def run_table(table_task):
+            with lock:
+                running["total"] += 1
+                running[table_task.bucket_name] += 1
+                peaks["total"] = max(peaks["total"], running["total"])
+                peaks["bucket_a"] = max(peaks["bucket_a"], running["bucket_a"])
+            time.sleep(0.05)
+            with lock:
+                running["total"] -= 1
+                running[table_task.bucket_name] -= 1
+            if table_task.table_details["table_name"] == "a_3":
+                raise RuntimeError("Listing failed")
+            return [LoadJobResult(source_uris="gs://uri", job_id="job", succeeded=True, error=None, output_rows=5,
+                                  input_bytes=100)]
+
+        table_tasks = scheduler.get_table_tasks(self.buckets)
+        actual = scheduler.run_table_tasks(table_tasks=table_tasks, run_table=run_table, max_concurrent_tables=3,
+                                           max_concurrent_tables_per_bucket=1)
+        self.assertEqual(1, peaks["bucket_a"])
+        self.assertEqual(2, peaks["total"])
+        self.assertEqual(["a_2", "a_1", "a_3", "b_1"], [summary.table_id for summary in actual])
+        self.assertEqual([5, 5, 0, 5], [summary.output_rows for summary in actual])
+        self.assertEqual("Listing failed", actual[2].error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bq_external_table import gcp_clients, schema_inference
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer
+
+
+class TestInferCsvSchema(unittest.TestCase):
+
+    def test_infer_csv_schema_with_header(self):
+        sample = b"id,price,active,day,created at,name\n1,2.5,true,2020-01-01,2020-01-01T10:00:00Z,a\n" \
+                 b"2,3,false,2020-01-02,2020-01-01 10:00:00,\n3,4,TRUE,2020-01-0"
+        actual, has_header = schema_inference.infer_csv_schema(sample=sample, complete=False)
+        self.assertTrue(has_header)
+        self.assertEqual([("id", "INTEGER"), ("price", "FLOAT"), ("active", "BOOLEAN"), ("day", "DATE"),
+                          ("created_at", "TIMESTAMP"), ("name", "STRING")],
+                         [(field["name"], field["type"]) for field in actual])
+
+    def test_infer_csv_schema_without_header(self):
+        actual, has_header = schema_inference.infer_csv_schema(sample=b"1,a\n2,b\n", complete=True)
+        self.assertFalse(has_header)
+        self.assertEqual([{"name": "column_0", "type": "INTEGER"}, {"name": "column_1", "type": "STRING"}], actual)
+
+    def test_infer_csv_schema_keeps_the_first_row_of_text_data(self):
+        actual, has_header = schema_inference.infer_csv_schema(sample=b"alice,paris\nbob,lyon\n", complete=True)
+        self.assertFalse(has_header)
+        self.assertEqual([{"name": "column_0", "type": "STRING"}, {"name": "column_1", "type": "STRING"}], actual)
+
+    def test_infer_csv_schema_widens_conflicting_types(self):
+        actual, _ = schema_inference.infer_csv_schema(sample=b"a,b\n1,1\n1.5,x\n", complete=True)
+        self.assertEqual(["FLOAT", "STRING"], [field["type"] for field in actual])
+
+
+class TestGetCsvSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.server.put_object("bucket", "user/data.csv", b"id,name\n1,a\n2,b\n")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+        self.directory = tempfile.mkdtemp()
+        self.schema_cache_path = os.path.join(self.directory, "schemas.json")
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+        shutil.rmtree(self.directory)
+
+    def get_csv_schema(self, refresh=False):
+        schema, skip_leading_rows = schema_inference.get_csv_schema(bucket_name="bucket", blob_prefix="user",
+                                                                    blob_name="user/data.csv",
+                                                                    schema_cache_path=self.schema_cache_path,
+                                                                    sample_bytes=13, refresh=refresh)
+        return [(field.name, field.field_type) for field in schema], skip_leading_rows
+
+    def test_get_csv_schema_samples_once_and_caches_per_prefix(self):
+        self.assertEqual(([("id", "INTEGER"), ("name", "STRING")], 1), self.get_csv_schema())
+        self.server.put_object("bucket", "user/data.csv", b"id,name\n9,9\n")
+        self.assertEqual(([("id", "INTEGER"), ("name", "STRING")], 1), self.get_csv_schema())
+        self.assertEqual(([("id", "INTEGER"), ("name", "INTEGER")], 1), self.get_csv_schema(refresh=True))
+
+    def test_get_csv_schema_does_not_cache_a_blank_blob(self):
+        self.server.put_object("bucket", "user/data.csv", b"\n  \n")
+        self.assertIsNone(schema_inference.get_csv_schema(bucket_name="bucket", blob_prefix="user",
+                                                          blob_name="user/data.csv",
+                                                          schema_cache_path=self.schema_cache_path))
+        self.assertEqual({}, schema_inference.read_schema_cache(self.schema_cache_path))
+        self.server.put_object("bucket", "user/data.csv", b"id,name\n1,a\n")
+        self.assertEqual(([("id", "INTEGER"), ("name", "STRING")], 1), self.get_csv_schema())
+
+
+if __name__ == '__main__':
+    unittest.main()
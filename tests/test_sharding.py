@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from bq_external_table import metrics, scheduler, sharding
+from bq_external_table.set_run_variables import set_datasets
+
+
+def run_fake_worker(datasets, failing_bucket):
+    """
+    Worker that summarises the tables of its shard without loading them, failing for one bucket.
+    """
+    if failing_bucket in {bucket for buckets in datasets.values() for bucket in buckets}:
+        raise RuntimeError("Worker crashed")
+    metrics.reset()
+    list_of_summaries = []
+    for table_task in scheduler.get_dataset_table_tasks(datasets=datasets):
+        metrics.increment("tables_loaded")
+        list_of_summaries.append(scheduler.get_table_summary(table_task=table_task, list_of_results=[],
+                                                             duration=0.1))
+    return list_of_summaries, metrics.get_registry().snapshot()
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.datasets = set_datasets({
+            "dataset_name": "first",
+            "buckets": {"bucket_{}".format(index): [{"table_name": "table_{}_{}".format(index, table)}
+                                                    for table in range(3)] for index in range(8)},
+            "datasets": {"second": {"bucket_0": [{"table_name": "other"}]}}
+        })
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_set_datasets_merges_the_datasets_of_the_config(self):
+        self.assertEqual(["first", "second"], list(self.datasets))
+        self.assertEqual([{"table_name": "other"}], self.datasets["second"]["bucket_0"])
+        self.assertEqual(25, len(scheduler.get_dataset_table_tasks(self.datasets)))
+
+    def test_parse_shard(self):
+        self.assertEqual(sharding.Shard(index=2, count=4), sharding.parse_shard("2/4"))
+        for value in ("4/4", "1", "a/2", "-1/2"):
+            with self.assertRaises(ValueError):
+                sharding.parse_shard(value)
+
+    def test_shards_cover_every_table_once(self):
+        for shard_by in (sharding.SHARD_BY_BUCKET, sharding.SHARD_BY_TABLE):
+            shards = [sharding.select_shard(self.datasets, sharding.Shard(index=index, count=3), shard_by=shard_by)
+                      for index in range(3)]
+            actual = sorted((table_task.dataset_name, table_task.table_details["table_name"])
+                            for shard in shards for table_task in scheduler.get_dataset_table_tasks(shard))
+            expected = sorted((table_task.dataset_name, table_task.table_details["table_name"])
+                              for table_task in scheduler.get_dataset_table_tasks(self.datasets))
+            self.assertEqual(expected, actual)
+        shards = sharding.split_datasets(self.datasets, shard_count=3, shard_by=sharding.SHARD_BY_BUCKET)
+        self.assertEqual(1, len([shard for shard in shards if "bucket_0" in shard.get("first", {})]))
+        self.assertEqual(shards, sharding.split_datasets(self.datasets, shard_count=3))
+
+    def test_run_worker_processes_merges_summaries_and_metrics(self):
+        actual = sharding.run_worker_processes(datasets=self.datasets, worker_processes=2,
+                                               run_worker=run_fake_worker, worker_arguments=("bucket_7",))
+        self.assertEqual(25, len(actual))
+        failed = [summary for summary in actual if summary.error]
+        self.assertEqual(len(failed), 25 - metrics.get_registry().get_counter("tables_loaded"))
+        self.assertIn("bucket_7", {summary.bucket_name for summary in failed})
+        self.assertEqual({"first", "second"}, {summary.dataset_name for summary in actual})
+
+    def test_run_summaries_can_be_merged(self):
+        table_tasks = scheduler.get_dataset_table_tasks(self.datasets)
+        list_of_summaries = [scheduler.get_table_summary(table_task=table_task, list_of_results=[], duration=1.0)
+                             for table_task in table_tasks]
+        with tempfile.TemporaryDirectory() as directory:
+            summary_path = os.path.join(directory, "summary.json")
+            scheduler.write_run_summary(summary_path=summary_path, list_of_summaries=list_of_summaries)
+            self.assertEqual(list_of_summaries, scheduler.read_run_summary(summary_path=summary_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
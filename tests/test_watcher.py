@@ -0,0 +1,204 @@
+import datetime
+import threading
+import time
+import unittest
+
+from bq_external_table import gcp_clients, gcp_interfacer, metrics, resilience, scheduler, watcher
+from bq_external_table.set_run_variables import set_load_options
+from bq_external_table.testing.fake_bigquery import FakeBigQueryClient
+from bq_external_table.testing.fake_gcs_server import FakeGCSServer, get_object_resource
+
+
+def get_event(blob_name, size=10, received=0.0, bucket_name="bucket"):
+    return watcher.ObjectEvent(bucket_name=bucket_name, blob_details=gcp_interfacer.BlobDetails(
+        name=blob_name, size=size, generation=1, content_type=None, md5_hash=None, crc32c=None, updated=None),
+        ack_id=None, received=received)
+
+
+def get_table_tasks(*list_of_table_details):
+    return scheduler.get_table_tasks(buckets={"bucket": list(list_of_table_details)}, dataset_name="dataset")
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def test_pop_due_waits_for_the_window_or_the_limits(self):
+        table_task, other_table_task = get_table_tasks({"table_name": "a", "blob_prefix": "a/"},
+                                                       {"table_name": "b", "blob_prefix": "b/"})
+        batcher = watcher.MicroBatcher(window_seconds=10, max_blobs=3, max_bytes=100)
+        batcher.add(table_task, get_event("a/0.csv", received=0.0))
+        batcher.add(table_task, get_event("a/1.csv", received=4.0))
+        batcher.add(other_table_task, get_event("b/0.csv", received=5.0))
+        self.assertEqual(6.0, batcher.get_wait(now=4.0, default=60))
+        self.assertEqual([], batcher.pop_due(now=9.0))
+        actual = batcher.pop_due(now=10.0)
+        self.assertEqual([["a/0.csv", "a/1.csv"]], [[event.blob_details.name for event in batch.events]
+                                                    for batch in actual])
+        for index in range(1, 4):
+            batcher.add(other_table_task, get_event("b/{}.csv".format(index), received=11.0))
+        self.assertEqual(4, len(batcher))
+        self.assertEqual([3, 1], [len(batch.events) for batch in batcher.pop_due(now=11.0)])
+        self.assertEqual(60, batcher.get_wait(now=11.0, default=60))
+
+    def test_split_respects_max_bytes(self):
+        table_task, = get_table_tasks({"table_name": "a", "blob_prefix": "a/"})
+        batcher = watcher.MicroBatcher(window_seconds=0, max_blobs=10, max_bytes=100)
+        for index, size in enumerate([60, 30, 20, 150]):
+            batcher.add(table_task, get_event("a/{}.csv".format(index), size=size))
+        self.assertEqual([2, 1, 1], [len(batch.events) for batch in batcher.pop_due(now=0.0, flush=True)])
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_route_event_matches_bucket_prefix_delimiter_and_glob(self):
+        table_tasks = get_table_tasks({"table_name": "all", "blob_prefix": "events/"},
+                                      {"table_name": "top", "blob_prefix": "events/", "blob_delimiter": "/"},
+                                      {"table_name": "csv", "blob_prefix": "events/", "blob_glob": "events/**.csv"},
+                                      {"table_name": "external", "blob_prefix": "events/", "table_type": "external"})
+        watched_table_tasks = watcher.get_watched_table_tasks(table_tasks, load_options={"table_type": "native"})
+
+        def route(blob_name, bucket_name="bucket"):
+            return [table_task.table_details["table_name"] for table_task in watcher.route_event(
+                watched_table_tasks, get_event(blob_name, bucket_name=bucket_name), compiled_globs={})]
+
+        self.assertEqual(["all", "top", "csv"], route("events/a.csv"))
+        self.assertEqual(["all", "csv"], route("events/dt=2020-01-01/a.csv"))
+        self.assertEqual(["all"], route("events/dt=2020-01-01/a.json"))
+        self.assertEqual([], route("other/a.csv"))
+        self.assertEqual([], route("events/a.csv", bucket_name="other"))
+
+    def test_get_object_event_only_keeps_new_objects(self):
+        self.assertIsNone(watcher.get_object_event({"eventType": "OBJECT_DELETE"}, b"{}"))
+        actual = watcher.get_object_event({"eventType": "OBJECT_FINALIZE", "bucketId": "bucket"},
+                                          b'{"name": "a.csv", "size": "12", "generation": "3", '
+                                          b'"updated": "2020-01-01T00:00:00.000Z"}', ack_id="ack")
+        self.assertEqual(("bucket", "a.csv", 12, 3, "ack"), (actual.bucket_name, actual.blob_details.name,
+                                                              actual.blob_details.size, actual.blob_details.generation,
+                                                              actual.ack_id))
+        self.assertEqual(datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), actual.blob_details.updated)
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        resilience.configure(initial_delay=0.001, max_delay=0.01)
+        self.server = FakeGCSServer().start()
+        self.server.create_bucket("bucket")
+        gcp_clients.configure_clients(storage_api_endpoint=self.server.endpoint, project="test")
+        self.bigquery_client = FakeBigQueryClient(project="test", gcs_server=self.server)
+        self.load_options = set_load_options({"max_concurrent_jobs": 2, "job_poll_interval": 0.01,
+                                              "max_concurrent_tables": 2})
+
+    def tearDown(self):
+        self.server.stop()
+        gcp_clients.configure_clients()
+        resilience.configure()
+        metrics.reset()
+
+    def put_objects(self, *blob_names):
+        return [self.server.put_object("bucket", blob_name, b"a,b\n1,2\n") for blob_name in blob_names]
+
+    def test_watch_loads_notified_objects_in_micro_batches_and_acknowledges_them(self):
+        source = watcher.QueueNotificationSource()
+        table_tasks = get_table_tasks({"table_name": "events", "blob_prefix": "events/"},
+                                      {"table_name": "daily", "blob_prefix": "daily/",
+                                       "partitioning": {"key": "dt"}})
+        for blob in self.put_objects("events/0.csv", "events/1.csv", "daily/dt=2020-01-01/0.csv",
+                                     "daily/dt=2020-01-02/0.csv", "other/0.csv"):
+            source.publish_object("bucket", get_object_resource(blob))
+        source.publish({"eventType": "OBJECT_DELETE", "bucketId": "bucket"}, "{}")
+        actual = watcher.watch(table_tasks=table_tasks, source=source, load_options=self.load_options,
+                               watch_options={"batch_window_seconds": 0.05}, exit_when_idle=True,
+                               bigquery_client=self.bigquery_client)
+        self.assertEqual(["daily", "events"], sorted(summary.table_id for summary in actual))
+        self.assertEqual(0, source.get_in_flight_count())
+        destinations = sorted((job.destination.table_id, len(job.source_uris)) for job in
+                              self.bigquery_client.jobs.values())
+        self.assertEqual([("daily$20200101", 1), ("daily$20200102", 1), ("events", 2)], destinations)
+        counters, timers, _ = metrics.get_registry().snapshot()
+        self.assertEqual(2, sum(value for (name, _), value in counters.items() if name == "watch_batches"))
+        self.assertTrue(any(name == "watch_freshness" for name, _ in timers))
+
+    def test_watch_requeues_the_notifications_of_failed_batches(self):
+        source = watcher.QueueNotificationSource()
+        table_tasks = get_table_tasks({"table_name": "events", "blob_prefix": "events/"})
+        self.bigquery_client.failure_rate = 1.0
+        for blob in self.put_objects("events/0.csv"):
+            source.publish_object("bucket", get_object_resource(blob))
+        stop_event = threading.Event()
+        thread = threading.Thread(target=watcher.watch, kwargs=dict(
+            table_tasks=table_tasks, source=source, load_options=self.load_options,
+            watch_options={"batch_window_seconds": 0.01}, stop_event=stop_event,
+            bigquery_client=self.bigquery_client))
+        thread.start()
+
+        def wait_for_batch(succeeded):
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                counters, _, _ = metrics.get_registry().snapshot()
+                if any(name == "watch_batches" and ("succeeded", succeeded) in labels
+                       for (name, labels), _ in counters.items()):
+                    return True
+                time.sleep(0.01)
+            return False
+
+        self.assertTrue(wait_for_batch(succeeded=False))
+        self.bigquery_client.failure_rate = 0.0
+        self.assertTrue(wait_for_batch(succeeded=True))
+        stop_event.set()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(0, source.get_in_flight_count())
+
+    def test_watch_survives_failed_pulls_and_sums_the_batches_of_each_table(self):
+        source = watcher.QueueNotificationSource()
+        pull = source.pull
+        failures = [OSError("Network is unreachable"), OSError("Connection reset")]
+
+        def flaky_pull(timeout):
+            if failures:
+                raise failures.pop(0)
+            return pull(timeout=timeout)
+
+        source.pull = flaky_pull
+        table_tasks = get_table_tasks({"table_name": "events", "blob_prefix": "events/"})
+        for blob in self.put_objects("events/0.csv", "events/1.csv", "events/2.csv"):
+            source.publish_object("bucket", get_object_resource(blob))
+        actual = watcher.watch(table_tasks=table_tasks, source=source, load_options=self.load_options,
+                               watch_options={"batch_window_seconds": 0.01, "batch_max_blobs": 2},
+                               exit_when_idle=True, bigquery_client=self.bigquery_client)
+        self.assertEqual([("events", 2, 0)], [(summary.table_id, summary.jobs, summary.failed_jobs)
+                                              for summary in actual])
+        self.assertEqual(0, source.get_in_flight_count())
+        self.assertEqual(2, metrics.get_registry().get_counter("watch_pull_errors"))
+
+    def test_polling_source_only_returns_objects_updated_since_the_previous_poll(self):
+        self.put_objects("events/old.csv")
+        table_tasks = get_table_tasks({"table_name": "events", "blob_prefix": "events/"})
+        source = watcher.PollingNotificationSource(table_tasks=table_tasks, poll_interval=0, overlap_seconds=60,
+                                                   catch_up=True)
+        self.assertEqual(["events/old.csv"], [event.blob_details.name for event in source.poll()])
+        self.put_objects("events/new.csv")
+        self.assertEqual(["events/new.csv"], [event.blob_details.name for event in source.poll()])
+        self.put_objects("events/old.csv")
+        self.assertEqual(["events/old.csv"], [event.blob_details.name for event in source.poll()])
+        self.assertEqual([], source.poll())
+
+    def test_polling_source_returns_requeued_objects_again(self):
+        self.put_objects("events/0.csv", "events/1.csv")
+        table_tasks = get_table_tasks({"table_name": "events", "blob_prefix": "events/"})
+        source = watcher.PollingNotificationSource(table_tasks=table_tasks, poll_interval=0, overlap_seconds=0,
+                                                   catch_up=True)
+        first_events = sorted(source.poll(), key=lambda event: event.blob_details.name)
+        source.acknowledge([first_events[0].ack_id])
+        source.requeue([first_events[1].ack_id])
+        self.assertEqual(0, source.get_in_flight_count())
+        second_events = source.poll()
+        self.assertEqual(["events/1.csv"], [event.blob_details.name for event in second_events])
+        source.acknowledge([event.ack_id for event in second_events])
+        self.assertEqual([], source.poll())
+        self.assertEqual(0, source.get_in_flight_count())
+
+
+if __name__ == '__main__':
+    unittest.main()